@@ -3,18 +3,27 @@ from datetime import datetime
 from dotenv import load_dotenv
 from typing import List, Optional
 
-from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException, Request
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, ConfigDict
 
 from database import get_db_session, Package, Route, init_db, LinkToken
+from daily_summary import refresh_routes
+from migrate import index_report
+from shared.ai_gateway import ai_gateway
 import secrets
 
 # Logging estruturado e validadores
 from shared.logger import logger, log_api_request
 from shared.validators import validate_coordinates, log_validation_error
+from shared.db_metrics import query_label, get_query_metrics, reset_query_metrics
+from shared.report_cache import report_cache
+from shared.outbound import outbound
+from exports import ALL_DATASETS, ExportError, export_to_file, iter_csv, parse_period, period_label
+import re
 
 
 class PackageOut(BaseModel):
@@ -33,6 +42,22 @@ class PackageOut(BaseModel):
 # in-memory location store for MVP
 _latest_locations: dict[int, dict] = {}
 
+# /route/123/packages -> /route/{id}/packages (evita um label de métrica por ID)
+_NUMERIC_SEGMENT_RE = re.compile(r"/\d+(?=/|$)")
+
+
+def require_api_token(request: Request) -> None:
+    """
+    Dependência das rotas internas (exportação e /metrics/*):
+    Authorization: Bearer <EXPORT_API_TOKEN>. Sem token configurado, 404.
+    """
+    token = os.getenv("EXPORT_API_TOKEN", "")
+    if not token:
+        raise HTTPException(status_code=404, detail="API interna desativada")
+    auth = request.headers.get("Authorization", "")
+    if not secrets.compare_digest(auth.encode(), f"Bearer {token}".encode()):
+        raise HTTPException(status_code=401, detail="Token inválido")
+
 
 def create_app() -> FastAPI:
     load_dotenv()
@@ -64,6 +89,15 @@ def create_app() -> FastAPI:
         allow_headers=["Content-Type", "Authorization"],  # Headers específicos
     )
 
+    # ═══════════════════════════════════════════════════════════
+    # MÉTRICAS DE QUERIES - atribui cada query SQL à rota HTTP
+    # ═══════════════════════════════════════════════════════════
+    @app.middleware("http")
+    async def db_metrics_middleware(request: Request, call_next):
+        label = f"{request.method} {_NUMERIC_SEGMENT_RE.sub('/{id}', request.url.path)}"
+        with query_label(label):
+            return await call_next(request)
+
     # Static and templates
     base_dir = os.path.dirname(os.path.abspath(__file__))
     static_dir = os.path.join(base_dir, "static")
@@ -132,6 +166,108 @@ def create_app() -> FastAPI:
         from fastapi.responses import JSONResponse
         return JSONResponse(content=health_data, status_code=status_code)
 
+    # ═══════════════════════════════════════════════════════════
+    # MÉTRICAS - protegidas por EXPORT_API_TOKEN
+    # ═══════════════════════════════════════════════════════════
+    # GET lê; POST .../reset devolve os valores atuais e zera os contadores
+
+    @app.get("/metrics/db", dependencies=[Depends(require_api_token)])
+    def db_metrics():
+        """
+        Agregados de queries SQL por handler do bot / rota HTTP:
+        quantidade, queries por chamada, tempo total, p50/p95/p99 e lentas.
+        Inclui o relatório de índices do startup (revisão, presentes e faltando).
+        """
+        return {"labels": get_query_metrics(), "indexes": index_report()}
+
+    @app.post("/metrics/db/reset", dependencies=[Depends(require_api_token)])
+    def db_metrics_reset():
+        metrics = db_metrics()
+        reset_query_metrics()
+        return metrics
+
+    @app.get("/metrics/ai", dependencies=[Depends(require_api_token)])
+    def ai_metrics():
+        """
+        Chamadas de IA por label (relatorio, chat_ia): quantidade, p50/p95,
+        tokens, retries, timeouts e erros.
+        """
+        return {
+            "available": ai_gateway.available,
+            "model": ai_gateway.model,
+            "max_concurrency": ai_gateway.max_concurrency,
+            "labels": ai_gateway.metrics(),
+        }
+
+    @app.post("/metrics/ai/reset", dependencies=[Depends(require_api_token)])
+    def ai_metrics_reset():
+        metrics = ai_metrics()
+        ai_gateway.reset_metrics()
+        return metrics
+
+    @app.get("/metrics/cache", dependencies=[Depends(require_api_token)])
+    def cache_metrics():
+        """
+        Cache de relatórios: backend (memória/sqlite), entradas, hits, misses,
+        expirados, evictions e invalidações.
+        """
+        return report_cache.metrics()
+
+    @app.post("/metrics/cache/reset", dependencies=[Depends(require_api_token)])
+    def cache_metrics_reset():
+        metrics = report_cache.metrics()
+        report_cache.reset_metrics()
+        return metrics
+
+    @app.get("/metrics/outbound", dependencies=[Depends(require_api_token)])
+    def outbound_metrics():
+        """
+        Fila de saída do Telegram: mensagens pendentes e, por label, enviados,
+        falhas, retries, flood waits (RetryAfter) e tempo na fila (p50/p95).
+        """
+        return outbound.metrics()
+
+    @app.post("/metrics/outbound/reset", dependencies=[Depends(require_api_token)])
+    def outbound_metrics_reset():
+        metrics = outbound.metrics()
+        outbound.reset_metrics()
+        return metrics
+
+    # ═══════════════════════════════════════════════════════════
+    # EXPORTAÇÃO DE PLANILHAS - protegida por EXPORT_API_TOKEN
+    # ═══════════════════════════════════════════════════════════
+
+    @app.get("/export/{dataset}", dependencies=[Depends(require_api_token)])
+    def export_dataset(dataset: str, format: str = "xlsx", period: Optional[str] = None):
+        """
+        Planilha de entregas, comprovantes, salarios, financeiro ou tudo.
+        Header: Authorization: Bearer <EXPORT_API_TOKEN>
+        Query: format=xlsx|csv|parquet, period=AAAA-MM | MM/AAAA | AAAA
+
+        CSV de um conjunto é transmitido enquanto é lido do banco; os demais
+        são gerados num arquivo temporário (apagado depois da resposta).
+        """
+        try:
+            export_period = parse_period(period)
+            if format.lower() == "csv" and dataset.lower() != ALL_DATASETS:
+                rows = iter_csv(dataset, export_period)
+                filename = f"{dataset.lower()}_{period_label(export_period)}.csv"
+                return StreamingResponse(
+                    rows,
+                    media_type="text/csv; charset=utf-8",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+                )
+            result = export_to_file(dataset, format, export_period)
+        except ExportError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return FileResponse(
+            result.path,
+            media_type=result.media_type,
+            filename=result.filename,
+            background=BackgroundTask(os.remove, result.path),
+        )
+
     @app.get("/route/{route_id}/packages", response_model=List[PackageOut])
     def get_route_packages(route_id: int, db=Depends(get_db_session)):
         logger.info(f"GET /route/{route_id}/packages - Buscando pacotes")
@@ -303,7 +439,9 @@ def create_app() -> FastAPI:
         status: str = "delivered"
 
     @app.post("/package/{package_id}/mark-delivered")
-    def mark_package_delivered(package_id: int, body: MarkDeliveredIn, db=Depends(get_db_session)):
+    def mark_package_delivered(
+        package_id: int, body: MarkDeliveredIn, background_tasks: BackgroundTasks, db=Depends(get_db_session)
+    ):
         """Marca um pacote como entregue diretamente do mapa"""
         try:
             package = db.query(Package).filter(Package.id == package_id).first()
@@ -342,6 +480,10 @@ def create_app() -> FastAPI:
                     # Não falha o endpoint por erro nessa checagem; apenas loga
                     print(f"⚠️ Falha ao atualizar status da rota {route_id}: {e}")
             
+            # Mantém o resumo diário dos relatórios em dia (depois da resposta)
+            if route_id is not None:
+                background_tasks.add_task(refresh_routes, [route_id])
+            
             print(f"✅ Pacote {package_id}: {old_status} → {body.status}")
             
             return {
@@ -7,6 +7,9 @@ de ON DELETE SET NULL para ON DELETE CASCADE.
 
 Resultado: Quando uma rota é excluída, TODAS as receitas e despesas
 vinculadas são automaticamente excluídas também.
+
+⚠️ Substituído pela revisão 0002 em migrations/versions, aplicada
+automaticamente no startup por migrate.py. Mantido apenas como referência.
 """
 
 import sqlite3
@@ -2,10 +2,22 @@
 Script para aplicar índices de performance no banco de dados.
 
 Uso:
-    python apply_indexes.py
+    python apply_indexes.py                                      # migrations/add_performance_indexes.sql
+    python apply_indexes.py migrations/add_period_indexes.sql    # outro arquivo de índices
+
+Funciona em PostgreSQL e SQLite (sem DATABASE_URL usa o database.sqlite local).
+Ao final imprime o plano (EXPLAIN) das consultas por período para conferir
+se os índices estão sendo usados.
+
+Os índices já são criados no startup pela cadeia de migrações (migrate.py);
+este script fica para aplicar SQL avulso e inspecionar os planos. O uso dos
+índices pelas consultas por período é garantido por
+tests/test_period_query_plans.py (python -m pytest).
 """
 
 import os
+import sys
+from datetime import datetime, timedelta
 from pathlib import Path
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
@@ -13,21 +25,47 @@ from dotenv import load_dotenv
 # Carregar variáveis de ambiente
 load_dotenv()
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+_DEFAULT_SQLITE = f"sqlite:///{(Path(__file__).resolve().parent / 'database.sqlite').as_posix()}"
+DATABASE_URL = os.getenv("DATABASE_URL", _DEFAULT_SQLITE)
+
+# Consultas por período (intervalo semiaberto) cujo plano deve usar índice
+PERIOD_QUERIES = {
+    "delivery_proof.timestamp": "SELECT COUNT(*) FROM delivery_proof WHERE timestamp >= :start AND timestamp < :end",
+    "route.created_at": "SELECT COUNT(*) FROM route WHERE created_at >= :start AND created_at < :end",
+    "route.completed_at": "SELECT COUNT(*) FROM route WHERE completed_at >= :start AND completed_at < :end",
+    "route.finalized_at": "SELECT COUNT(*) FROM route WHERE finalized_at >= :start AND finalized_at < :end",
+}
 
-if not DATABASE_URL:
-    print("❌ Erro: DATABASE_URL não configurada no .env")
-    print("Configure a variável DATABASE_URL e tente novamente")
-    exit(1)
+
+def explain_period_queries(conn, dialect: str) -> None:
+    """Imprime o plano de execução das consultas por período"""
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    params = {"start": end - timedelta(days=7), "end": end}
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    print("\n🧭 Planos das consultas por período:\n")
+    for label, sql in PERIOD_QUERIES.items():
+        try:
+            rows = conn.execute(text(prefix + sql), params).fetchall()
+            plan = " | ".join(str(row[-1]) for row in rows)
+            status = "✅" if "idx_" in plan or "Index" in plan else "⚠️"
+            print(f"  {status} {label}: {plan}")
+        except Exception as e:
+            print(f"  ❌ {label}: {e}")
 
 print(f"🔗 Conectando ao banco de dados...")
 print(f"   URL: {DATABASE_URL.split('@')[1] if '@' in DATABASE_URL else 'SQLite local'}")
 
 try:
     engine = create_engine(DATABASE_URL)
+    dialect = engine.dialect.name
     
-    # Ler o arquivo SQL
-    sql_file = Path(__file__).parent / "migrations" / "add_performance_indexes.sql"
+    # Ler o arquivo SQL (argumento opcional, relativo a este diretório)
+    if len(sys.argv) > 1:
+        sql_file = Path(sys.argv[1])
+        if not sql_file.is_absolute():
+            sql_file = Path(__file__).parent / sql_file
+    else:
+        sql_file = Path(__file__).parent / "migrations" / "add_performance_indexes.sql"
     
     if not sql_file.exists():
         print(f"❌ Erro: Arquivo não encontrado: {sql_file}")
@@ -115,15 +153,24 @@ try:
         print(f"\n✅ {created_indexes} índices criados com sucesso!")
         print("\n🔍 Verificando índices criados...\n")
         
-        result = conn.execute(text("""
-            SELECT 
-                tablename,
-                indexname
-            FROM pg_indexes
-            WHERE schemaname = 'public'
-            AND indexname LIKE 'idx_%'
-            ORDER BY tablename, indexname
-        """))
+        if dialect == "sqlite":
+            result = conn.execute(text("""
+                SELECT tbl_name, name
+                FROM sqlite_master
+                WHERE type = 'index'
+                AND name LIKE 'idx_%'
+                ORDER BY tbl_name, name
+            """))
+        else:
+            result = conn.execute(text("""
+                SELECT 
+                    tablename,
+                    indexname
+                FROM pg_indexes
+                WHERE schemaname = 'public'
+                AND indexname LIKE 'idx_%'
+                ORDER BY tablename, indexname
+            """))
         
         indexes = result.fetchall()
         
@@ -138,7 +185,9 @@ try:
             
             print(f"\n✅ Total de índices: {len(indexes)}")
         else:
-            print("⚠️ Nenhum índice encontrado. Pode ser que o banco seja SQLite.")
+            print("⚠️ Nenhum índice encontrado.")
+        
+        explain_period_queries(conn, dialect)
     
     print("\n🎉 Índices aplicados com sucesso!")
     print("\n💡 Próximos passos:")
@@ -6,6 +6,9 @@ extra_expenses, extra_income, calculated_km
 
 Uso:
     python apply_route_automation.py
+
+⚠️ Substituído pela revisão 0001 em migrations/versions, aplicada
+automaticamente no startup por migrate.py. Mantido apenas como referência.
 """
 
 import os
@@ -0,0 +1,180 @@
+"""
+Arquivamento de rotas finalizadas antigas
+
+Move os pacotes e comprovantes de rotas finalizadas há mais de
+ARCHIVE_AFTER_DAYS dias para package_archive / delivery_proof_archive,
+mantendo as tabelas ativas pequenas para as consultas do dia a dia.
+
+- A rota continua em `route`: receitas, despesas e salários apontam para ela.
+- Os relatórios leem o daily_summary, que soma tabelas ativas e de arquivo,
+  então arquivar não altera nenhum número.
+- Cada lote de ARCHIVE_BATCH_SIZE rotas é uma transação (copia + apaga).
+
+Executado diariamente pelo scheduler (scheduler.py) ou manualmente:
+    python archival.py              # arquiva com a idade configurada
+    python archival.py 30           # arquiva rotas finalizadas há mais de 30 dias
+"""
+
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import DateTime, delete, func, insert, literal, select
+
+from database import (
+    SessionLocal, Route, Package, DeliveryProof, PackageArchive, DeliveryProofArchive
+)
+from shared.logger import logger
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+# Idade mínima (dias desde a finalização) para arquivar. 0 desativa o job.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+# Rotas por transação
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "20"))
+
+_PACKAGE_COLUMNS = (
+    "id", "route_id", "tracking_code", "address", "neighborhood", "latitude",
+    "longitude", "status", "raw_data", "order_in_route",
+)
+_PROOF_COLUMNS = (
+    "id", "package_id", "driver_id", "timestamp", "receiver_name", "receiver_document",
+    "notes", "photo1_path", "photo2_path", "latitude", "longitude",
+)
+
+
+def _pending_routes(db, cutoff: datetime, limit: int) -> List[int]:
+    """Rotas finalizadas antes de `cutoff` que ainda têm pacotes nas tabelas ativas"""
+    return [
+        route_id for (route_id,) in (
+            db.query(Route.id)
+            .filter(
+                Route.status == "finalized",
+                Route.finalized_at < cutoff,
+                db.query(Package.id).filter(Package.route_id == Route.id).exists(),
+            )
+            .order_by(Route.finalized_at)
+            .limit(limit)
+            .all()
+        )
+    ]
+
+
+def _archive_batch(db, route_ids: List[int]) -> Dict[str, int]:
+    """Copia e apaga pacotes/comprovantes das rotas (uma transação)"""
+    now = datetime.utcnow()
+    package_ids = select(Package.id).where(Package.route_id.in_(route_ids))
+
+    db.execute(
+        insert(PackageArchive).from_select(
+            [*_PACKAGE_COLUMNS, "archived_at"],
+            select(*[getattr(Package, c) for c in _PACKAGE_COLUMNS], literal(now, DateTime))
+            .where(Package.route_id.in_(route_ids)),
+        )
+    )
+    db.execute(
+        insert(DeliveryProofArchive).from_select(
+            [*_PROOF_COLUMNS, "archived_at"],
+            select(*[getattr(DeliveryProof, c) for c in _PROOF_COLUMNS], literal(now, DateTime))
+            .where(DeliveryProof.package_id.in_(package_ids)),
+        )
+    )
+    proofs = db.execute(
+        delete(DeliveryProof).where(DeliveryProof.package_id.in_(package_ids))
+    ).rowcount
+    packages = db.execute(
+        delete(Package).where(Package.route_id.in_(route_ids))
+    ).rowcount
+    db.commit()
+    return {"packages": packages, "proofs": proofs}
+
+
+def archive_finalized_routes(
+    max_age_days: Optional[int] = None,
+    batch_size: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Arquiva as rotas finalizadas há mais de `max_age_days` dias.
+
+    Returns:
+        {"routes": n, "packages": n, "proofs": n}
+    """
+    max_age_days = ARCHIVE_AFTER_DAYS if max_age_days is None else max_age_days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    totals = {"routes": 0, "packages": 0, "proofs": 0}
+    if max_age_days <= 0:
+        return totals
+
+    cutoff = datetime.now() - timedelta(days=max_age_days)
+    db = SessionLocal()
+    try:
+        while True:
+            route_ids = _pending_routes(db, cutoff, batch_size)
+            if not route_ids:
+                break
+            try:
+                moved = _archive_batch(db, route_ids)
+            except Exception:
+                db.rollback()
+                logger.error(f"[ARCHIVE] Falha ao arquivar rotas {route_ids}", exc_info=True)
+                break
+            totals["routes"] += len(route_ids)
+            totals["packages"] += moved["packages"]
+            totals["proofs"] += moved["proofs"]
+    finally:
+        db.close()
+
+    if totals["routes"]:
+        logger.info(
+            f"[ARCHIVE] {totals['routes']} rota(s) arquivada(s): "
+            f"{totals['packages']} pacote(s), {totals['proofs']} comprovante(s)"
+        )
+    return totals
+
+
+def archived_package_counts(db, route_ids: List[int]) -> Dict[int, Dict[str, int]]:
+    """Totais de pacotes arquivados por rota: {route_id: {"total": n, "delivered": n}}"""
+    if not route_ids:
+        return {}
+    counts: Dict[int, Dict[str, int]] = {}
+    for route_id, status, count in (
+        db.query(PackageArchive.route_id, PackageArchive.status, func.count(PackageArchive.id))
+        .filter(PackageArchive.route_id.in_(route_ids))
+        .group_by(PackageArchive.route_id, PackageArchive.status)
+        .all()
+    ):
+        entry = counts.setdefault(route_id, {"total": 0, "delivered": 0})
+        entry["total"] += count
+        if status == "delivered":
+            entry["delivered"] += count
+    return counts
+
+
+def delete_archived(db, route_id: int) -> None:
+    """Remove o arquivo de uma rota (o SQLite não aplica ON DELETE CASCADE por padrão)"""
+    db.execute(
+        delete(DeliveryProofArchive).where(
+            DeliveryProofArchive.package_id.in_(
+                select(PackageArchive.id).where(PackageArchive.route_id == route_id)
+            )
+        )
+    )
+    db.execute(delete(PackageArchive).where(PackageArchive.route_id == route_id))
+
+
+async def archive_job() -> Dict[str, int]:
+    """Job do scheduler: arquiva sem bloquear o event loop do bot (erros ficam no job_run)"""
+    return await asyncio.to_thread(archive_finalized_routes)
+
+
+if __name__ == "__main__":
+    import sys
+    from database import init_db
+
+    init_db()
+    days_arg = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    print(f"📦 Arquivando rotas finalizadas há mais de {days_arg or ARCHIVE_AFTER_DAYS} dias...")
+    print(f"✅ {archive_finalized_routes(days_arg)}")
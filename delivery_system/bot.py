@@ -1,15 +1,14 @@
+import asyncio
+import functools
 import os
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, List
 from math import radians, sin, cos, sqrt, asin
 import json
+from collections import OrderedDict
 
 import pandas as pd
-try:
-    from groq import Groq  # type: ignore
-except Exception:
-    Groq = None  # Import opcional; IA fica desativada se não disponível
 from dotenv import load_dotenv
 from telegram import (
     Update,
@@ -28,29 +27,58 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
 from database import (
-    SessionLocal, init_db, User, Route, Package, DeliveryProof,
-    Expense, Income, Mileage, AIReport, LinkToken, SalaryPayment
+    SessionLocal, User, Route, Package, DeliveryProof,
+    Expense, Income, Mileage, AIReport, LinkToken, SalaryPayment, DailySummary,
+    PackageArchive, DeliveryProofArchive, JobRun, SchedulerLease,
 )
-from sqlalchemy import func, text, and_, or_, distinct  # ✅ FASE 4.1: Importa utilitários para queries SQL
+from sqlalchemy import func, update as sql_update  # ✅ FASE 4.1: Importa utilitários para queries SQL
 import html
 import shutil
 import re
 
 # Logging estruturado
 from shared.logger import logger, log_bot_command
+from shared.db_metrics import track_handler, get_query_metrics
+from shared.ai_gateway import ai_gateway
+from shared.telegram_stream import TelegramStreamWriter
+from shared.progress import ProgressReporter
+from shared.outbound import outbound, HIGH, NORMAL, LOW
+from shared.update_processor import PerChatUpdateProcessor
+from shared.webhook_queue import webhook_queue
+from shared.fingerprint import fingerprint
+from shared.report_cache import report_cache, month_tag
+from shared.single_flight import single_flight, flight_key
+from shared.periods import day_period, days_period, week_period, month_period, in_period
+from daily_summary import (
+    schedule_refresh, wait_pending_refreshes, route_days, daily_rows, data_version,
+    backfill as backfill_daily_summary, ensure_backfilled, CREATOR,
+)
+from driver_performance import driver_performance, clear_cache as clear_driver_performance_cache
+from precompute import RELATORIO_MONTH, load_snapshot, monthly_report_stats, relatorio_span, snapshot_kpis
+from archival import archived_package_counts, delete_archived
+from exports import (
+    ALL_DATASETS, DATASETS as EXPORT_DATASETS, FORMATS as EXPORT_FORMATS, ExportError,
+    export_to_file, parse_period as parse_export_period,
+)
+from migrate import run_migrations, index_report
+from user_cache import cached_user, user_cache
+from callback_store import store_callback, load_callback
+from import_upload import receive_upload, read_spreadsheet, finish_upload
+from conversation_state import (
+    MASS_PHOTOS_MAX, configure_builder, conversation_metrics, track_conversation_state,
+)
 
 
 # Configurações e diretórios
 load_dotenv()
 BASE_DIR = Path(__file__).resolve().parent
 UPLOADS_DIR = BASE_DIR / "uploads"
-IMPORTS_DIR = UPLOADS_DIR / "imports"
 UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
-IMPORTS_DIR.mkdir(parents=True, exist_ok=True)
 
 BASE_URL = os.getenv("BASE_URL", "http://127.0.0.1:8001")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "SEU_BOT_USERNAME")
@@ -60,23 +88,10 @@ BOT_USERNAME = os.getenv("BOT_USERNAME", "SEU_BOT_USERNAME")
 DEPOT_LAT = float(os.getenv("DEPOT_LAT", "-22.988000"))  # Exemplo: Rocinha, RJ
 DEPOT_LON = float(os.getenv("DEPOT_LON", "-43.248000"))
 
-# Configurar Gemini API
-# Configurar Groq API (substitui Gemini)
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-groq_client = None
-ai_model_name = None
-
-if GROQ_API_KEY and Groq is not None:
-    try:
-        groq_client = Groq(api_key=GROQ_API_KEY)
-        # Modelos disponíveis (nov 2024): llama-3.3-70b-versatile, llama-3.1-8b-instant, gemma2-9b-it
-        ai_model_name = "llama-3.3-70b-versatile"  # Modelo mais recente e poderoso
-        logger.info("Groq API inicializada com sucesso", extra={"model": ai_model_name})
-    except Exception as e:
-        logger.error("Erro ao inicializar Groq API", exc_info=True)
-        logger.warning("Relatórios com IA estarão indisponíveis")
-        groq_client = None
-        ai_model_name = None
+# IA (Groq) via gateway assíncrono: timeout, limite de concorrência, retry e métricas
+ai_model_name = ai_gateway.model if ai_gateway.available else None
+if ai_gateway.available:
+    logger.info("Groq API inicializada com sucesso", extra={"model": ai_model_name})
 else:
     logger.warning("GROQ_API_KEY não configurada - relatórios com IA indisponíveis")
     
@@ -112,30 +127,52 @@ FINALIZE_ASK_INCOME = 67
 # Estado para reset seguro da base
 RESET_CONFIRM = 80
 
-# ==================== CACHE SIMPLES PARA RELATÓRIOS ====================
-# Cache em memória para evitar reprocessar dados que mudam pouco
-# TTL de 5 minutos para estatísticas mensais
-_report_cache = {}
-_cache_ttl_seconds = 300  # 5 minutos
+# ==================== CACHE DE RELATÓRIOS ====================
+# Totais do /relatorio ficam em shared/report_cache (LRU + TTL). Recalcular o
+# resumo diário de um mês (importação, entrega, finalização, despesas...)
+# invalida as entradas com a tag do mês.
+
+def _monthly_stats_key(month: int, year: int) -> str:
+    return f"monthly_stats:{year:04d}-{month:02d}"
 
 def _get_cached_monthly_stats(month: int, year: int):
     """Retorna estatísticas do cache se ainda válidas"""
-    cache_key = f"monthly_stats_{month}_{year}"
-    if cache_key in _report_cache:
-        cached_data, cached_time = _report_cache[cache_key]
-        age_seconds = (datetime.now() - cached_time).total_seconds()
-        if age_seconds < _cache_ttl_seconds:
-            logger.debug(f"Cache HIT para {cache_key} (idade: {age_seconds:.1f}s)")
-            return cached_data
-        else:
-            logger.debug(f"Cache EXPIRED para {cache_key} (idade: {age_seconds:.1f}s)")
-    return None
+    return report_cache.get(_monthly_stats_key(month, year))
+
+def _set_cached_monthly_stats(month: int, year: int, data, depends_on=()):
+    """Salva estatísticas no cache (invalidadas junto com o mês e os meses em depends_on)"""
+    tags = [month_tag(year, month)] + [month_tag(y, m) for y, m in depends_on]
+    report_cache.set(_monthly_stats_key(month, year), data, tags=tags)
+
+
+# ==================== CACHE DE RESPOSTAS DA IA ====================
+# /relatorio: o texto fica no AIReport com o fingerprint dos KPIs do prompt.
+# Mesmo fingerprint → texto reaproveitado; "/relatorio forcar" gera de novo.
+# Mude a versão ao alterar o prompt para invalidar os relatórios salvos.
+_REPORT_PROMPT_VERSION = 1
+_FORCE_REFRESH_ARGS = {"forcar", "forçar", "atualizar", "novo"}
 
-def _set_cached_monthly_stats(month: int, year: int, data):
-    """Salva estatísticas no cache"""
-    cache_key = f"monthly_stats_{month}_{year}"
-    _report_cache[cache_key] = (data, datetime.now())
-    logger.debug(f"Cache SET para {cache_key}")
+# /chat_ia: pareceres em LRU por (pergunta normalizada, fingerprint dos KPIs)
+_advice_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_ADVICE_CACHE_MAX = int(os.getenv("AI_ADVICE_CACHE_SIZE", "64"))
+
+def _get_cached_advice(key: tuple) -> Optional[str]:
+    """Retorna o parecer do cache (e marca como usado recentemente)"""
+    text = _advice_cache.get(key)
+    if text is not None:
+        _advice_cache.move_to_end(key)
+        logger.debug(f"Cache HIT para parecer IA ({key[1][:12]})")
+    return text
+
+def _set_cached_advice(key: tuple, text: str):
+    """Salva o parecer, descartando o menos usado quando passa do limite"""
+    _advice_cache[key] = text
+    _advice_cache.move_to_end(key)
+    while len(_advice_cache) > _ADVICE_CACHE_MAX:
+        _advice_cache.popitem(last=False)
+
+# Respostas da IA aparecem no chat enquanto são geradas (mensagem editada aos poucos)
+_AI_STREAMING = os.getenv("AI_STREAMING", "true").lower() in ("1", "true", "yes")
 
 
 # ==================== OTIMIZAÇÃO DE ROTA (TSP) ====================
@@ -234,6 +271,16 @@ def optimize_route_packages(db, packages: List[Package], start_lat: float, start
     return len(packages_to_optimize)
 
 
+def _optimize_route_in_session(route_id: int, start_lat: float, start_lon: float) -> int:
+    """Otimiza a rota com sessão própria (roda fora do event loop)"""
+    db = SessionLocal()
+    try:
+        packages = db.query(Package).filter(Package.route_id == route_id).all()
+        return optimize_route_packages(db, packages, start_lat, start_lon)
+    finally:
+        db.close()
+
+
 # ==================== UTILIDADES ====================
 
 # Utilidades
@@ -398,6 +445,49 @@ def get_user_by_tid(db, tid: int) -> Optional[User]:
     return db.query(User).filter(User.telegram_user_id == tid).first()
 
 
+MANAGER_ONLY = "⛔ Comando disponível apenas para gerentes."
+
+
+async def _deny_access(update: Update, text: Optional[str], parse_mode: Optional[str]) -> None:
+    """Avisa o acesso negado no lugar certo (alerta no botão ou resposta à mensagem)"""
+    if not text:
+        return
+    if update.callback_query:
+        # Alerta não aceita Markdown e tem limite de 200 caracteres
+        await update.callback_query.answer(text.replace("*", "")[:200], show_alert=True)
+    elif update.effective_message:
+        await update.effective_message.reply_text(text, parse_mode=parse_mode)
+
+
+def session_handler(role: Optional[str] = None, denied: Optional[str] = MANAGER_ONLY,
+                    parse_mode: Optional[str] = None):
+    """
+    Handler com uma sessão por update e o usuário já resolvido.
+
+    O usuário vem do cache (user_cache), o papel é conferido antes de abrir a
+    sessão e a sessão é sempre fechada no fim. O handler recebe
+    (update, context, db, me), com `me` = CachedUser ou None.
+
+    role: papel exigido ("manager"); sem papel, qualquer usuário passa
+    denied: mensagem de acesso negado (None = ignora em silêncio)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user = update.effective_user
+            me = cached_user(user.id) if user else None
+            if role and (not me or me.role != role):
+                await _deny_access(update, denied, parse_mode)
+                return ConversationHandler.END
+            db = SessionLocal()
+            try:
+                return await func(update, context, db, me)
+            finally:
+                db.close()
+        return wrapper
+    return decorator
+
+
 def register_manager_if_first(telegram_user_id: int, full_name: Optional[str]) -> User:
     db = SessionLocal()
     try:
@@ -424,13 +514,17 @@ async def notify_managers(text: str, context: ContextTypes.DEFAULT_TYPE):
         managers = db.query(User).filter(User.role == "manager").all()
     finally:
         db.close()
-    for m in managers:
-        try:
-            await context.bot.send_message(chat_id=m.telegram_user_id, text=text)
-        except Exception as e:
+    # Todos os gerentes de uma vez (a fila de saída cuida dos limites)
+    results = await asyncio.gather(*[
+        outbound.send(context.bot.send_message, chat_id=m.telegram_user_id, text=text,
+                      priority=NORMAL, label="notify_managers")
+        for m in managers
+    ], return_exceptions=True)
+    for m, e in zip(managers, results):
+        if isinstance(e, Exception):
             logger.error(
                 f"Falha ao enviar notificação para gerente {m.telegram_user_id}",
-                exc_info=True,
+                exc_info=e,
                 extra={"manager_id": m.telegram_user_id, "error": str(e)}
             )
 
@@ -633,9 +727,10 @@ async def _process_delivery_argument(update: Update, context: ContextTypes.DEFAU
 # Comandos
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /start - Cadastro inicial e boas-vindas OU inicia entrega via deep link"""
-    init_db()
     u = update.effective_user
-    user = register_manager_if_first(u.id, u.full_name)
+    user = cached_user(u.id)
+    if not user or user.full_name != u.full_name:
+        user = register_manager_if_first(u.id, u.full_name)
 
     arg = _extract_command_argument(update, context)
     if arg:
@@ -936,7 +1031,15 @@ async def help_callback_handler(update: Update, context: ContextTypes.DEFAULT_TY
             "• Análise POR ROTA com margem\n"
             "• Comparação mês anterior\n"
             "• Recomendações prescritivas\n"
-            "• Enviado automaticamente ao canal\n\n"
+            "• Enviado automaticamente ao canal\n"
+            "• Sem mudança nos números, reaproveita o último\n"
+            "  (use `/relatorio forcar` para gerar de novo)\n\n"
+            
+            "*📤 /exportar*\n"
+            "Planilha de entregas, comprovantes, salários e financeiro.\n"
+            "• Formatos: xlsx (padrão), csv, parquet\n"
+            "• Ex.: `/exportar entregas csv 2026-09`\n"
+            "• Sem argumentos: tudo do mês atual em xlsx\n\n"
             
             "*💬 /chat_ia*\n"
             "Converse com seus dados!\n"
@@ -1014,6 +1117,10 @@ async def help_callback_handler(update: Update, context: ContextTypes.DEFAULT_TY
             "Informações técnicas do sistema.\n"
             "• Útil para diagnóstico de problemas\n\n"
             
+            "*🔄 /recalcular_resumos*\n"
+            "Recalcula o resumo diário dos relatórios.\n"
+            "• Opcional: data inicial `AAAA-MM-DD`\n\n"
+            
             "*🗑️ /resetar_empresa*\n"
             "⚠️ PERIGO: Apaga TODOS os dados!\n"
             "• Requer confirmação explícita\n"
@@ -1591,244 +1698,120 @@ async def cmd_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db.close()
 
 
-async def cmd_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gera relatório financeiro com análise de IA (Gemini)"""
+# ==================== /RELATORIO: DADOS, PROMPT E FINGERPRINT ====================
+# Compartilhados pelo comando e pela job noturna opcional (PRECOMPUTE_AI_REPORT)
+
+_RELATORIO_SYSTEM_PROMPT = (
+    "Você é um analista financeiro especializado em logística e entregas. Forneça análises "
+    "profissionais, objetivas e acionáveis em português do Brasil."
+)
+
+
+def _load_monthly_stats(db, now: datetime):
+    """Totais do /relatorio: cache → snapshot noturno (precompute.py) → resumo diário.
+
+    Retorna (stats, veio_do_cache).
+    """
+    stats = _get_cached_monthly_stats(now.month, now.year)
+    if stats is not None:
+        return stats, True
+    version = data_version(db)
+    stats = load_snapshot(db, RELATORIO_MONTH, relatorio_span(now))
+    if stats is None:
+        stats = monthly_report_stats(db, now)
+    # Resumo recalculado durante o cálculo: números possivelmente velhos, não vão ao cache
+    if data_version(db) == version:
+        prev_month = month_period(now, -1)
+        _set_cached_monthly_stats(now.month, now.year, stats,
+                                  depends_on=[(prev_month.start.year, prev_month.start.month)])
+        # Recálculo entre a conferência e a gravação (a invalidação dele pode ter vindo antes)
+        if data_version(db) != version:
+            report_cache.invalidate(month_tag(now.year, now.month))
+    return stats, False
+
+
+def _monthly_stats_in_session(now: datetime):
     db = SessionLocal()
     try:
-        # Verifica permissão
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem gerar relatórios.",
-                parse_mode='Markdown'
-            )
-            return
-        
-        # Envia mensagem de processamento inicial
-        processing_msg = await update.message.reply_text(
-            "📊 *Gerando Relatório*\n\n"
-            "🔄 [▓░░░░░░░░░] 10% - Iniciando...",
-            parse_mode='Markdown'
-        )
-        
-        # Coleta dados do mês atual
-        now = datetime.now()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        # Verifica cache primeiro
-        cached_stats = _get_cached_monthly_stats(now.month, now.year)
-        
-        if cached_stats:
-            # Usa dados do cache (MUITO mais rápido)
-            await processing_msg.edit_text(
-                "📊 *Gerando Relatório*\n\n"
-                "🔄 [▓▓▓░░░░░░░] 30% - Usando dados em cache...",
-                parse_mode='Markdown'
-            )
-            (total_packages, delivered_packages, failed_packages, total_routes, 
-             active_drivers, total_income, total_expenses, total_mileage,
-             total_revenue, total_spent, total_km) = cached_stats
-        else:
-            # ETAPA 1: Coleta todos os dados em UMA ÚNICA QUERY otimizada (20%)
-            await processing_msg.edit_text(
-                "📊 *Gerando Relatório*\n\n"
-                "🔄 [▓▓░░░░░░░░] 20% - Coletando dados (query otimizada)...",
-                parse_mode='Markdown'
-            )
-        
-        # Query única com CTE (Common Table Expression) - MUITO mais rápido que 7 queries
-        monthly_stats = db.execute(text("""
-            WITH package_stats AS (
-                SELECT 
-                    COUNT(*) as total_packages,
-                    SUM(CASE WHEN p.status = 'delivered' THEN 1 ELSE 0 END) as delivered_packages,
-                    SUM(CASE WHEN p.status = 'failed' THEN 1 ELSE 0 END) as failed_packages
-                FROM package p
-                JOIN route r ON p.route_id = r.id
-                WHERE r.created_at >= :month_start
-            ),
-            route_stats AS (
-                SELECT 
-                    COUNT(*) as total_routes,
-                    (SELECT COUNT(*) FROM "user" WHERE role = 'driver') as active_drivers
-                FROM route
-                WHERE created_at >= :month_start
-            ),
-            finance_stats AS (
-                SELECT 
-                    (SELECT COUNT(*) FROM income WHERE date >= :month_date) as total_income_records,
-                    (SELECT COUNT(*) FROM expense WHERE date >= :month_date) as total_expense_records,
-                    (SELECT COUNT(*) FROM mileage WHERE date >= :month_date) as total_mileage_records,
-                    (SELECT COALESCE(SUM(amount), 0) FROM income WHERE date >= :month_date) as total_revenue,
-                    (SELECT COALESCE(SUM(amount), 0) FROM expense WHERE date >= :month_date) as total_spent,
-                    (SELECT COALESCE(SUM(km_total), 0) FROM mileage WHERE date >= :month_date) as total_km
-            )
-            SELECT 
-                ps.total_packages,
-                ps.delivered_packages,
-                ps.failed_packages,
-                rs.total_routes,
-                rs.active_drivers,
-                fs.total_income_records,
-                fs.total_expense_records,
-                fs.total_mileage_records,
-                fs.total_revenue,
-                fs.total_spent,
-                fs.total_km
-            FROM package_stats ps, route_stats rs, finance_stats fs
-        """), {
-            "month_start": month_start,
-            "month_date": month_start.date()
-        }).first()
-        
-        # Extrai valores da query única
-        total_packages = monthly_stats[0] or 0
-        delivered_packages = monthly_stats[1] or 0
-        failed_packages = monthly_stats[2] or 0
-        total_routes = monthly_stats[3] or 0
-        active_drivers = monthly_stats[4] or 0
-        total_income = monthly_stats[5] or 0
-        total_expenses = monthly_stats[6] or 0
-        total_mileage = monthly_stats[7] or 0
-        total_revenue = float(monthly_stats[8] or 0)
-        total_spent = float(monthly_stats[9] or 0)
-        total_km = float(monthly_stats[10] or 0)
-        
-        # Salva no cache para próximas chamadas
-        _set_cached_monthly_stats(now.month, now.year, (
-            total_packages, delivered_packages, failed_packages, total_routes,
-            active_drivers, total_income, total_expenses, total_mileage,
-            total_revenue, total_spent, total_km
-        ))
-        
-        # ETAPA 2: Calcula métricas derivadas (35%)
-        await processing_msg.edit_text(
-            "📊 *Gerando Relatório*\n\n"
-            "🔄 [▓▓▓▓░░░░░░] 35% - Calculando métricas...",
-            parse_mode='Markdown'
-        )
-        
-        net_profit = total_revenue - total_spent
-        profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
-        
-        # ✅ FASE 6: Busca dados do mês anterior para comparação (40%)
-        await processing_msg.edit_text(
-            "📊 *Gerando Relatório*\n\n"
-            "🔄 [▓▓▓▓▓░░░░░] 40% - Comparando com mês anterior...",
-            parse_mode='Markdown'
-        )
-        
-        # Calcula início do mês anterior
-        if now.month == 1:
-            prev_month_start = now.replace(year=now.year-1, month=12, day=1, hour=0, minute=0, second=0, microsecond=0)
-            prev_month_end = month_start
-        else:
-            prev_month_start = now.replace(month=now.month-1, day=1, hour=0, minute=0, second=0, microsecond=0)
-            prev_month_end = month_start
-        
-        # Query para mês anterior (mesma estrutura)
-        prev_stats = db.execute(text("""
-            WITH package_stats AS (
-                SELECT 
-                    COUNT(*) as total_packages,
-                    SUM(CASE WHEN p.status = 'delivered' THEN 1 ELSE 0 END) as delivered_packages
-                FROM package p
-                JOIN route r ON p.route_id = r.id
-                WHERE r.created_at >= :prev_start AND r.created_at < :prev_end
-            ),
-            route_stats AS (
-                SELECT COUNT(*) as total_routes
-                FROM route
-                WHERE created_at >= :prev_start AND created_at < :prev_end
-            ),
-            finance_stats AS (
-                SELECT 
-                    (SELECT COALESCE(SUM(amount), 0) FROM income WHERE date >= :prev_date_start AND date < :prev_date_end) as total_revenue,
-                    (SELECT COALESCE(SUM(amount), 0) FROM expense WHERE date >= :prev_date_start AND date < :prev_date_end) as total_spent
-            )
-            SELECT 
-                ps.total_packages,
-                ps.delivered_packages,
-                rs.total_routes,
-                fs.total_revenue,
-                fs.total_spent
-            FROM package_stats ps, route_stats rs, finance_stats fs
-        """), {
-            "prev_start": prev_month_start,
-            "prev_end": prev_month_end,
-            "prev_date_start": prev_month_start.date(),
-            "prev_date_end": prev_month_end.date()
-        }).first()
-        
-        # Extrai dados do mês anterior
-        prev_packages = prev_stats[0] or 0
-        prev_delivered = prev_stats[1] or 0
-        prev_routes = prev_stats[2] or 0
-        prev_revenue = float(prev_stats[3] or 0)
-        prev_spent = float(prev_stats[4] or 0)
-        prev_profit = prev_revenue - prev_spent
-        
-        # Calcula variações percentuais
-        def calc_variation(current, previous):
-            if previous == 0:
-                return "+100%" if current > 0 else "0%"
-            variation = ((current - previous) / previous) * 100
-            return f"{variation:+.1f}%"
-        
-        variation_packages = calc_variation(total_packages, prev_packages)
-        variation_revenue = calc_variation(total_revenue, prev_revenue)
-        variation_profit = calc_variation(net_profit, prev_profit)
-        variation_routes = calc_variation(total_routes, prev_routes)
-        
-        # Monta texto de comparação
-        comparison_text = f"""
+        return _load_monthly_stats(db, now)
+    finally:
+        db.close()
+
+
+async def _shared_monthly_stats(now: datetime):
+    """_load_monthly_stats fora do event loop; pedidos simultâneos do mesmo mês dividem o cálculo"""
+    return await single_flight.do(
+        flight_key("relatorio_stats", (now.year, now.month), str(data_version())),
+        lambda: asyncio.to_thread(_monthly_stats_in_session, now),
+    )
+
+
+def _kpis_in_session(periods) -> list:
+    db = SessionLocal()
+    try:
+        return snapshot_kpis(db, periods)
+    finally:
+        db.close()
+
+
+async def _shared_kpis(periods) -> list:
+    """KPIs dos períodos fora do event loop; pedidos simultâneos iguais dividem o cálculo"""
+    periods = tuple(periods)
+    return await single_flight.do(
+        flight_key("kpis", periods, str(data_version())),
+        lambda: asyncio.to_thread(_kpis_in_session, periods),
+    )
+
+
+def _relatorio_drivers_data(db, now: datetime) -> list:
+    """Dados por motorista do mês (uma consulta agrupada, em cache por versão do resumo)"""
+    return [
+        {key: d[key] for key in ('name', 'routes', 'packages', 'delivered', 'success_rate')}
+        for d in driver_performance(db, month_period(now))
+    ]
+
+
+def _relatorio_prompt(now: datetime, stats: dict, drivers_data: list) -> str:
+    """Prompt do relatório executivo (números do mês, comparação e motoristas)"""
+    total_packages = stats["total_packages"]
+    delivered_packages = stats["delivered_packages"]
+    failed_packages = stats["failed_packages"]
+    total_routes = stats["total_routes"]
+    active_drivers = stats["active_drivers"]
+    total_revenue = stats["total_revenue"]
+    total_spent = stats["total_spent"]
+    total_km = stats["total_km"]
+    net_profit = total_revenue - total_spent
+    profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
+
+    # Mês anterior (vem junto com os totais do mês, inclusive do cache)
+    prev_packages = stats["prev_packages"]
+    prev_routes = stats["prev_routes"]
+    prev_revenue = stats["prev_revenue"]
+    prev_profit = prev_revenue - stats["prev_spent"]
+
+    # Calcula variações percentuais
+    def calc_variation(current, previous):
+        if previous == 0:
+            return "+100%" if current > 0 else "0%"
+        variation = ((current - previous) / previous) * 100
+        return f"{variation:+.1f}%"
+
+    variation_packages = calc_variation(total_packages, prev_packages)
+    variation_revenue = calc_variation(total_revenue, prev_revenue)
+    variation_profit = calc_variation(net_profit, prev_profit)
+    variation_routes = calc_variation(total_routes, prev_routes)
+
+    # Monta texto de comparação
+    comparison_text = f"""
 📊 COMPARAÇÃO COM MÊS ANTERIOR:
 • Pacotes: {total_packages} vs {prev_packages} ({variation_packages})
 • Rotas: {total_routes} vs {prev_routes} ({variation_routes})
 • Receita: R$ {total_revenue:,.2f} vs R$ {prev_revenue:,.2f} ({variation_revenue})
 • Lucro: R$ {net_profit:,.2f} vs R$ {prev_profit:,.2f} ({variation_profit})
 """
-        
-        # ETAPA 4: Calcula dados por motorista (65%)
-        await processing_msg.edit_text(
-            "📊 *Gerando Relatório*\n\n"
-            "🔄 [▓▓▓▓▓▓▓░░░] 65% - Analisando performance individual...",
-            parse_mode='Markdown'
-        )
-        
-        # Calcula dados por motorista
-        drivers = db.query(User).filter(User.role == "driver").all()
-        drivers_data = []
-        for driver in drivers:
-            driver_routes = db.query(Route).filter(Route.assigned_to_id == driver.id, Route.created_at >= month_start).count()
-            driver_packages = db.query(Package).join(Route).filter(
-                Route.assigned_to_id == driver.id,
-                Route.created_at >= month_start
-            ).count()
-            driver_delivered = db.query(Package).join(Route).filter(
-                Route.assigned_to_id == driver.id,
-                Route.created_at >= month_start,
-                Package.status == "delivered"
-            ).count()
-            
-            drivers_data.append({
-                'name': driver.full_name or f"Motorista {driver.id}",
-                'routes': driver_routes,
-                'packages': driver_packages,
-                'delivered': driver_delivered,
-                'success_rate': (driver_delivered / driver_packages * 100) if driver_packages > 0 else 0
-            })
-        
-        # ETAPA 5: Prepara prompt para IA (75%)
-        await processing_msg.edit_text(
-            "📊 *Gerando Relatório*\n\n"
-            "🔄 [▓▓▓▓▓▓▓▓░░] 75% - Preparando análise inteligente...",
-            parse_mode='Markdown'
-        )
-        
-        # Monta prompt profissional para a IA
-        prompt = f"""Você é um analista financeiro senior especializado em logística e entregas. 
+
+    return f"""Você é um analista financeiro senior especializado em logística e entregas. 
 GERE UM RELATÓRIO EXECUTIVO PROFISSIONAL E BEM ESTRUTURADO.
 
 ═══════════════════════════════════════════════════════════════
@@ -1891,163 +1874,322 @@ INSTRUÇÕES CRÍTICAS PARA O RELATÓRIO:
 
 Gere o RELATÓRIO EXECUTIVO PROFISSIONAL agora:"""
 
-        # ETAPA 6: Processamento com IA (85%)
-        await processing_msg.edit_text(
-            "📊 *Gerando Relatório*\n\n"
-            "� [▓▓▓▓▓▓▓▓▓░] 85% - Processando com IA Groq...",
-            parse_mode='Markdown'
+
+def _relatorio_fingerprint(now: datetime, stats: dict, drivers_data: list) -> str:
+    """Fingerprint dos KPIs do prompt (mesmo valor → texto salvo pode ser reaproveitado)"""
+    return fingerprint({
+        "prompt_version": _REPORT_PROMPT_VERSION,
+        "model": ai_model_name,
+        "month": [now.year, now.month],
+        "totals": [stats[k] for k in ("total_packages", "delivered_packages", "failed_packages", "total_routes",
+                                      "active_drivers", "total_km", "total_revenue", "total_spent")],
+        "previous": [stats[k] for k in ("prev_packages", "prev_delivered", "prev_routes",
+                                        "prev_revenue", "prev_spent")],
+        "drivers": drivers_data,
+    })
+
+
+def _relatorio_messages(prompt: str) -> list:
+    return [
+        {"role": "system", "content": _RELATORIO_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _save_ai_report(db, now: datetime, stats: dict, ai_analysis: str, kpi_fp: str,
+                    created_by: int, existing_report=None):
+    """Salva o texto no AIReport do mês (month/year é chave única)"""
+    if existing_report:
+        # UPDATE: atualiza relatório existente
+        existing_report.report_text = ai_analysis
+        existing_report.total_income = stats["total_income"]
+        existing_report.total_expenses = stats["total_expenses"]
+        existing_report.total_km = stats["total_mileage"]
+        existing_report.kpi_fingerprint = kpi_fp
+        existing_report.created_by = created_by
+        existing_report.created_at = datetime.utcnow()
+    else:
+        # INSERT: cria novo relatório
+        db.add(AIReport(
+            month=now.month,
+            year=now.year,
+            report_text=ai_analysis,
+            total_income=stats["total_income"],
+            total_expenses=stats["total_expenses"],
+            total_km=stats["total_mileage"],
+            kpi_fingerprint=kpi_fp,
+            created_by=created_by
+        ))
+    db.commit()
+
+
+async def precompute_ai_report(now: Optional[datetime] = None) -> dict:
+    """Job noturna (PRECOMPUTE_AI_REPORT=true): deixa o texto de IA do mês pronto.
+
+    Usa o mesmo prompt e fingerprint do /relatorio; de manhã o comando só
+    reaproveita o texto salvo. Não chama a IA se os números não mudaram.
+    """
+    if not ai_gateway.available:
+        return {"generated": False, "reason": "IA indisponível"}
+    now = now or datetime.now()
+    db = SessionLocal()
+    try:
+        manager = db.query(User).filter(User.role == "manager").order_by(User.id).first()
+        if manager is None:
+            return {"generated": False, "reason": "nenhum gerente"}
+        stats, _ = _load_monthly_stats(db, now)
+        drivers_data = _relatorio_drivers_data(db, now)
+        kpi_fp = _relatorio_fingerprint(now, stats, drivers_data)
+        stored_report = db.query(AIReport).filter(
+            AIReport.month == now.month,
+            AIReport.year == now.year
+        ).first()
+        if stored_report and stored_report.kpi_fingerprint == kpi_fp:
+            return {"generated": False, "reason": "KPIs sem alteração"}
+        result = await ai_gateway.complete(
+            _relatorio_messages(_relatorio_prompt(now, stats, drivers_data)),
+            temperature=0.7, max_tokens=2000, label="relatorio_noturno",
         )
-        
-        # Tenta gerar relatório com Groq IA (se disponível)
-        ai_report_generated = False
-        if groq_client:
+        _save_ai_report(db, now, stats, result.text, kpi_fp, manager.telegram_user_id, stored_report)
+        logger.info(f"[PRECOMPUTE] Relatório IA de {now.month}/{now.year} gerado (fingerprint {kpi_fp[:12]})")
+        return {"generated": True, "fingerprint": kpi_fp[:12]}
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def _deliver_ai_report(update: Update, context: ContextTypes.DEFAULT_TYPE, me, processing_msg,
+                             now: datetime, ai_analysis: str, reused_from: Optional[datetime] = None):
+    """Envia o relatório de IA ao canal de análise (ou ao chat) em partes de até 4000 chars.
+
+    reused_from: data de geração quando o texto salvo foi reaproveitado (KPIs sem alteração).
+    """
+    # Define destino preferido: canal/grupo de análise, se configurado
+    preferred_chat_id = me.channel_id if me.channel_id else update.effective_chat.id
+
+    # Tudo pela fila de saída (limite por chat e flood control)
+    def send(chat_id, text, **kwargs):
+        return outbound.send(context.bot.send_message, chat_id=chat_id, text=text,
+                             priority=HIGH, label="relatorio", **kwargs)
+
+    # Divide relatório em mensagens (limite Telegram: 4096 chars)
+    max_length = 4000
+    if len(ai_analysis) <= max_length:
+        msg_text = f"📊 *Relatório Financeiro - {now.strftime('%B/%Y')}*\n\n{ai_analysis}"
+        # Envia para o destino preferido
+        try:
+            await send(preferred_chat_id, msg_text, parse_mode='Markdown')
+        except Exception as ch_err:
+            print(f"Aviso: Não consegui enviar para o destino preferido (Markdown): {ch_err}")
+            # Fallback sem Markdown
             try:
-                # Chama API Groq
-                response = groq_client.chat.completions.create(
-                    model=ai_model_name,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Você é um analista financeiro especializado em logística e entregas. Forneça análises profissionais, objetivas e acionáveis em português do Brasil."
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    temperature=0.7,
-                    max_tokens=2000
+                await send(preferred_chat_id, msg_text)
+            except Exception as ch_err2:
+                print(f"Aviso: Fallback sem Markdown também falhou: {ch_err2}")
+                await outbound.edit(processing_msg, text=msg_text, parse_mode='Markdown',
+                                    priority=HIGH, label="relatorio")
+        else:
+            # Confirmação breve no privado, se necessário
+            if preferred_chat_id != update.effective_chat.id:
+                await outbound.edit(processing_msg, text="✅ Relatório enviado ao grupo de análise.",
+                                    priority=HIGH, label="relatorio")
+    else:
+        # Envia em partes
+        outbound.submit_delete(processing_msg, priority=HIGH, label="relatorio")
+        parts = [ai_analysis[i:i+max_length] for i in range(0, len(ai_analysis), max_length)]
+        first_msg = f"📊 *Relatório Financeiro - {now.strftime('%B/%Y')}*\n\n{parts[0]}"
+        try:
+            await send(preferred_chat_id, first_msg, parse_mode='Markdown')
+            for part in parts[1:]:
+                await send(preferred_chat_id, part, parse_mode='Markdown')
+        except Exception as ch_err:
+            print(f"Aviso: Não consegui enviar partes ao destino preferido (Markdown): {ch_err}")
+            # Fallback sem Markdown
+            try:
+                await send(preferred_chat_id, first_msg)
+                for part in parts[1:]:
+                    await send(preferred_chat_id, part)
+            except Exception as ch_err2:
+                print(f"Aviso: Fallback sem Markdown também falhou: {ch_err2}")
+                for part in [first_msg, *parts[1:]]:
+                    await send(update.effective_chat.id, part, parse_mode='Markdown',
+                               reply_to_message_id=update.message.message_id)
+
+    await _send_ai_report_footer(update, preferred_chat_id, now, reused_from)
+
+
+async def _send_ai_report_footer(update: Update, sent_chat_id: int, now: datetime,
+                                 reused_from: Optional[datetime] = None):
+    """Mensagem final do /relatorio (confirmação no chat de origem)"""
+    model_label = ai_model_name or "Groq"
+
+    def reply(text, **kwargs):
+        return outbound.send(update.get_bot().send_message, chat_id=update.effective_chat.id, text=text,
+                             reply_to_message_id=update.message.message_id,
+                             priority=HIGH, label="relatorio", **kwargs)
+
+    if sent_chat_id == update.effective_chat.id:
+        if reused_from:
+            await reply(
+                f"♻️ *Relatório reaproveitado*\n\n"
+                f"Os números não mudaram desde {reused_from.strftime('%d/%m/%Y %H:%M')}.\n"
+                f"_Use /relatorio forcar para gerar uma nova análise._",
+                parse_mode='Markdown'
+            )
+        else:
+            await reply(
+                f"✅ *Relatório salvo!*\n\n"
+                f"🤖 Gerado por IA Groq ({model_label})\n"
+                f"📅 {now.strftime('%d/%m/%Y %H:%M')}\n"
+                f"_Use /relatorio novamente para atualizar._",
+                parse_mode='Markdown'
+            )
+    else:
+        await reply("✅ Relatório enviado ao grupo de análise.")
+
+
+
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem gerar relatórios.", parse_mode="Markdown")
+async def cmd_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
+    """Gera relatório financeiro com análise de IA (Gemini)"""
+    # Mensagem de progresso: etapas rápidas (ex.: cache) se juntam numa
+    # edição só; no máximo uma edição por intervalo (shared/progress.py)
+    progress = await ProgressReporter.start(
+        update.message.reply_text, "📊 *Gerando Relatório*", 10, "Iniciando..."
+    )
+    processing_msg = progress.message
+        
+    # Coleta dados do mês atual
+    now = datetime.now()
+        
+    # Totais do mês: cache → snapshot noturno → resumo diário (mês + mês anterior)
+    await progress.update(20, "Coletando dados do resumo diário...")
+    stats, from_cache = await _shared_monthly_stats(now)
+    if from_cache:
+        await progress.update(30, "Usando dados em cache...")
+        
+    # ETAPA 4: Calcula dados por motorista (65%)
+    await progress.update(65, "Analisando performance individual...")
+    drivers_data = _relatorio_drivers_data(db, now)
+        
+    # ETAPA 5: Prepara prompt para IA (75%)
+    await progress.update(75, "Preparando análise inteligente...")
+    prompt = _relatorio_prompt(now, stats, drivers_data)
+
+    # Fingerprint dos KPIs do prompt: se nada mudou desde o último AIReport
+    # do mês, reaproveita o texto salvo em vez de chamar a IA de novo
+    force_refresh = any(arg.lower() in _FORCE_REFRESH_ARGS for arg in (context.args or []))
+    kpi_fp = _relatorio_fingerprint(now, stats, drivers_data)
+    stored_report = db.query(AIReport).filter(
+        AIReport.month == now.month,
+        AIReport.year == now.year
+    ).first()
+    if stored_report and not force_refresh and stored_report.kpi_fingerprint == kpi_fp:
+        logger.info(f"Relatório IA reaproveitado ({now.month}/{now.year}, fingerprint {kpi_fp[:12]})")
+        await progress.finish()
+        await _deliver_ai_report(
+            update, context, me, processing_msg, now, stored_report.report_text,
+            reused_from=stored_report.created_at,
+        )
+        return
+
+    # ETAPA 6: Processamento com IA (85%)
+    await progress.update(85, "Processando com IA Groq...", icon="🤖")
+        
+    # Tenta gerar relatório com Groq IA (se disponível)
+    ai_report_generated = False
+    if ai_gateway.available:
+        try:
+            ai_messages = _relatorio_messages(prompt)
+            report_title = f"📊 Relatório Financeiro - {now.strftime('%B/%Y')}"
+            writer = None
+            if _AI_STREAMING:
+                # Texto aparece no destino enquanto a IA escreve (sem esperar a resposta inteira)
+                await progress.update(90, "IA escrevendo a análise...", icon="✍️")
+                writer = TelegramStreamWriter(
+                    context.bot,
+                    me.channel_id if me.channel_id else update.effective_chat.id,
+                    prefix=f"{report_title}\n\n",
+                    fallback_chat_id=update.effective_chat.id,
                 )
                 
-                ai_analysis = response.choices[0].message.content
-                
-                # Salva no banco (AIReport usa month/year como chave única)
+            async def generate_report() -> str:
+                if writer is not None:
+                    text = (await writer.consume(ai_gateway.stream(
+                        ai_messages, temperature=0.7, max_tokens=2000, label="relatorio",
+                    ))).strip()
+                    await writer.finish(f"📊 *Relatório Financeiro - {now.strftime('%B/%Y')}*\n\n{text}",
+                                        parse_mode='Markdown')
+                else:
+                    # Chama API Groq (assíncrono: não trava o bot durante a geração)
+                    result = await ai_gateway.complete(
+                        ai_messages, temperature=0.7, max_tokens=2000, label="relatorio",
+                    )
+                    text = result.text
+                    
+                # Salva no banco (AIReport usa month/year como chave única).
+                # Sessão própria, relendo o relatório: o voo é compartilhado e
+                # pode continuar depois que o handler que o iniciou (e a
+                # sessão dele) terminou ou foi cancelado
+                save_db = SessionLocal()
                 try:
-                    # Tenta encontrar relatório existente do mês
-                    existing_report = db.query(AIReport).filter(
+                    current_report = save_db.query(AIReport).filter(
                         AIReport.month == now.month,
                         AIReport.year == now.year
                     ).first()
-                    
-                    if existing_report:
-                        # UPDATE: atualiza relatório existente
-                        existing_report.report_text = ai_analysis
-                        existing_report.total_income = total_income
-                        existing_report.total_expenses = total_expenses
-                        existing_report.total_km = total_mileage
-                        existing_report.created_by = me.telegram_user_id
-                    else:
-                        # INSERT: cria novo relatório
-                        report = AIReport(
-                            month=now.month,
-                            year=now.year,
-                            report_text=ai_analysis,
-                            total_income=total_income,
-                            total_expenses=total_expenses,
-                            total_km=total_mileage,
-                            created_by=me.telegram_user_id
-                        )
-                        db.add(report)
-                    
-                    db.commit()
+                    _save_ai_report(save_db, now, stats, text, kpi_fp, me.telegram_user_id, current_report)
                 except Exception as save_err:
                     # Se falhar ao salvar, apenas mostra o relatório
                     print(f"Aviso ao salvar relatório: {save_err}")
-                    db.rollback()
-                
-                # ETAPA 7: Finalização (100%)
-                await processing_msg.edit_text(
-                    "📊 *Gerando Relatório*\n\n"
-                    "🔄 [▓▓▓▓▓▓▓▓▓▓] 100% - Finalizando...",
-                    parse_mode='Markdown'
-                )
+                    save_db.rollback()
+                finally:
+                    save_db.close()
+                return text
                 
-                # Define destino preferido: canal/grupo de análise, se configurado
-                preferred_chat_id = me.channel_id if me.channel_id else update.effective_chat.id
-                model_label = ai_model_name or "Groq"
-                # Divide relatório em mensagens (limite Telegram: 4096 chars)
-                max_length = 4000
-                if len(ai_analysis) <= max_length:
-                    msg_text = f"📊 *Relatório Financeiro - {now.strftime('%B/%Y')}*\n\n{ai_analysis}"
-                    # Envia para o destino preferido
-                    try:
-                        await context.bot.send_message(chat_id=preferred_chat_id, text=msg_text, parse_mode='Markdown')
-                    except Exception as ch_err:
-                        print(f"Aviso: Não consegui enviar para o destino preferido (Markdown): {ch_err}")
-                        # Fallback sem Markdown
-                        try:
-                            await context.bot.send_message(chat_id=preferred_chat_id, text=msg_text)
-                        except Exception as ch_err2:
-                            print(f"Aviso: Fallback sem Markdown também falhou: {ch_err2}")
-                            await processing_msg.edit_text(msg_text, parse_mode='Markdown')
-                    else:
-                        # Confirmação breve no privado, se necessário
-                        if preferred_chat_id != update.effective_chat.id:
-                            await processing_msg.edit_text("✅ Relatório enviado ao grupo de análise.")
-                else:
-                    # Envia em partes
-                    await processing_msg.delete()
-                    parts = [ai_analysis[i:i+max_length] for i in range(0, len(ai_analysis), max_length)]
-                    first_msg = f"📊 *Relatório Financeiro - {now.strftime('%B/%Y')}*\n\n{parts[0]}"
-                    try:
-                        await context.bot.send_message(chat_id=preferred_chat_id, text=first_msg, parse_mode='Markdown')
-                        for part in parts[1:]:
-                            await context.bot.send_message(chat_id=preferred_chat_id, text=part, parse_mode='Markdown')
-                    except Exception as ch_err:
-                        print(f"Aviso: Não consegui enviar partes ao destino preferido (Markdown): {ch_err}")
-                        # Fallback sem Markdown
-                        try:
-                            await context.bot.send_message(chat_id=preferred_chat_id, text=first_msg)
-                            for part in parts[1:]:
-                                await context.bot.send_message(chat_id=preferred_chat_id, text=part)
-                        except Exception as ch_err2:
-                            print(f"Aviso: Fallback sem Markdown também falhou: {ch_err2}")
-                            msg1 = await update.message.reply_text(first_msg, parse_mode='Markdown')
-                            for part in parts[1:]:
-                                await update.message.reply_text(part, parse_mode='Markdown')
+            # Pedidos simultâneos com os mesmos KPIs esperam a mesma chamada à IA
+            ai_analysis = await single_flight.do(
+                flight_key("relatorio", (now.year, now.month), kpi_fp), generate_report
+            )
                 
-                # Mensagem final
-                if preferred_chat_id == update.effective_chat.id:
-                    await update.message.reply_text(
-                        f"✅ *Relatório salvo!*\n\n"
-                        f"🤖 Gerado por IA Groq ({model_label})\n"
-                        f"📅 {now.strftime('%d/%m/%Y %H:%M')}\n"
-                        f"_Use /relatorio novamente para atualizar._",
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await update.message.reply_text("✅ Relatório enviado ao grupo de análise.")
-                ai_report_generated = True
+            ai_report_generated = True
+            if writer is not None and writer.started:
+                # Relatório já está no destino; só confirma
+                await progress.delete()
+                await _send_ai_report_footer(update, writer.chat_id, now)
+            else:
+                # ETAPA 7: Finalização (a mensagem de progresso vira o relatório)
+                await progress.finish()
+                await _deliver_ai_report(update, context, me, processing_msg, now, ai_analysis)
                 
-            except Exception as e:
-                # Falha na IA - vai gerar relatório simples abaixo
-                error_msg = str(e)
-                print(f"Erro no Groq: {error_msg}")  # Log para debug
-        
-        # Se IA falhou ou não está disponível, gera relatório simples
-        if not ai_report_generated:
-            await processing_msg.edit_text(
-                f"📊 *Relatório Financeiro - {now.strftime('%B/%Y')}*\n\n"
-                f"⚠️ _Relatório básico (IA indisponível)_\n\n"
-                f"📦 *ENTREGAS*\n"
-                f"• Total: {total_packages} pacotes\n"
-                f"• Entregues: {delivered_packages} ({(delivered_packages/total_packages*100 if total_packages > 0 else 0):.1f}%)\n"
-                f"• Falhas: {failed_packages}\n\n"
-                f"🚚 *OPERAÇÕES*\n"
-                f"• Rotas criadas: {total_routes}\n"
-                f"• Motoristas ativos: {active_drivers}\n"
-                f"• Média: {(total_packages/total_routes if total_routes > 0 else 0):.1f} pacotes/rota\n\n"
-                f"💰 *REGISTROS FINANCEIROS*\n"
-                f"• Receitas: {total_income} registros\n"
-                f"• Despesas: {total_expenses} registros\n"
-                f"• Quilometragem: {total_mileage} registros\n\n"
-                f"📅 {now.strftime('%d/%m/%Y %H:%M')}\n\n"
-                f"_Configure GROQ_API_KEY para análise com IA_",
-                parse_mode='Markdown'
-            )
-    
-    finally:
-        db.close()
+        except Exception as e:
+            # Falha na IA - vai gerar relatório simples abaixo
+            # (texto parcial de um stream interrompido não é salvo)
+            error_msg = str(e)
+            print(f"Erro no Groq: {error_msg}")  # Log para debug
+        
+    # Se IA falhou ou não está disponível, gera relatório simples
+    if not ai_report_generated:
+        await progress.finish(
+            f"📊 *Relatório Financeiro - {now.strftime('%B/%Y')}*\n\n"
+            f"⚠️ _Relatório básico (IA indisponível)_\n\n"
+            f"📦 *ENTREGAS*\n"
+            f"• Total: {stats['total_packages']} pacotes\n"
+            f"• Entregues: {stats['delivered_packages']} ({(stats['delivered_packages']/stats['total_packages']*100 if stats['total_packages'] > 0 else 0):.1f}%)\n"
+            f"• Falhas: {stats['failed_packages']}\n\n"
+            f"🚚 *OPERAÇÕES*\n"
+            f"• Rotas criadas: {stats['total_routes']}\n"
+            f"• Motoristas ativos: {stats['active_drivers']}\n"
+            f"• Média: {(stats['total_packages']/stats['total_routes'] if stats['total_routes'] > 0 else 0):.1f} pacotes/rota\n\n"
+            f"💰 *REGISTROS FINANCEIROS*\n"
+            f"• Receitas: {stats['total_income']} registros\n"
+            f"• Despesas: {stats['total_expenses']} registros\n"
+            f"• Quilometragem: {stats['total_mileage']} registros\n\n"
+            f"📅 {now.strftime('%d/%m/%Y %H:%M')}\n\n"
+            f"_Configure GROQ_API_KEY para análise com IA_",
+            parse_mode='Markdown'
+        )
 
 
 async def cmd_cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2096,15 +2238,114 @@ async def cmd_meu_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
-async def cmd_debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando de debug para diagnosticar problemas - APENAS GERENTE"""
-    db = SessionLocal()
+@session_handler(role="manager")
+async def cmd_recalcular_resumos(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
+    """Recalcula o resumo diário (daily_summary) - APENAS GERENTE
+    
+    Uso: /recalcular_resumos [AAAA-MM-DD]  (sem data = todo o histórico)
+    """
+    start = None
+    arg = _extract_command_argument(update, context)
+    if arg:
+        try:
+            start = datetime.strptime(arg.strip(), "%Y-%m-%d").date()
+        except ValueError:
+            await update.message.reply_text(
+                "❌ Data inválida. Use o formato `AAAA-MM-DD` (ex: `/recalcular_resumos 2025-01-01`).",
+                parse_mode='Markdown'
+            )
+            return
+    
+    processing_msg = await update.message.reply_text("🔄 Recalculando resumo diário...")
     try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text("⛔ Comando disponível apenas para gerentes.")
+        written = await asyncio.to_thread(backfill_daily_summary, start)
+    except Exception as e:
+        logger.error("Falha ao recalcular daily_summary", exc_info=True)
+        await processing_msg.edit_text(f"❌ Erro ao recalcular: {str(e)[:200]}")
+        return
+    
+    report_cache.clear()
+    await processing_msg.edit_text(
+        f"✅ *Resumo diário recalculado!*\n\n"
+        f"📅 Desde: {start.strftime('%d/%m/%Y') if start else 'início do histórico'}\n"
+        f"🗂️ Linhas gravadas: {written}",
+        parse_mode='Markdown'
+    )
+
+
+# Limite de upload de arquivos da API de bots do Telegram
+_TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+
+@session_handler(role="manager")
+async def cmd_exportar(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
+    """Exporta planilha de entregas/comprovantes/salários/financeiro - APENAS GERENTE
+
+    Uso: /exportar [conjunto] [formato] [período]
+      conjunto: entregas, comprovantes, salarios, financeiro, tudo (padrão)
+      formato: xlsx (padrão), csv, parquet
+      período: AAAA-MM, MM/AAAA ou AAAA (padrão: mês atual)
+    """
+    dataset, fmt, period_arg = ALL_DATASETS, "xlsx", None
+    for token in (_extract_command_argument(update, context) or "").lower().split():
+        if token in EXPORT_DATASETS or token == ALL_DATASETS:
+            dataset = token
+        elif token in EXPORT_FORMATS:
+            fmt = token
+        else:
+            period_arg = token
+    try:
+        period = parse_export_period(period_arg)
+    except ExportError as e:
+        await update.message.reply_text(
+            f"❌ {e}\n\n"
+            f"Uso: `/exportar [conjunto] [formato] [período]`\n"
+            f"Ex.: `/exportar entregas xlsx 2026-09`",
+            parse_mode='Markdown'
+        )
+        return
+
+    progress = await ProgressReporter.start(
+        update.message.reply_text, "📤 *Exportando planilha*", None,
+        f"{dataset} · {fmt} · {period.start.strftime('%d/%m/%Y')} a {period.last_day.strftime('%d/%m/%Y')}"
+    )
+    try:
+        result = await asyncio.to_thread(export_to_file, dataset, fmt, period)
+    except ExportError as e:
+        await progress.finish(f"❌ {e}", parse_mode=None)
+        return
+    except Exception as e:
+        logger.error("Falha ao exportar planilha", exc_info=True)
+        await progress.finish(f"❌ Erro ao exportar: {str(e)[:200]}", parse_mode=None)
+        return
+
+    try:
+        size = os.path.getsize(result.path)
+        if size > _TELEGRAM_DOCUMENT_LIMIT:
+            await progress.finish(
+                f"⚠️ Arquivo com {size / 1024 / 1024:.0f} MB passa do limite do Telegram (50 MB).\n"
+                f"Escolha um período menor ou use a API (/export/{dataset}).",
+                parse_mode=None
+            )
             return
-        
+
+        await progress.update(None, f"Enviando arquivo ({result.total_rows} linhas)...")
+        with open(result.path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=f,
+                filename=result.filename,
+                caption="📤 " + " · ".join(f"{name}: {count}" for name, count in result.rows.items()),
+            )
+        await progress.delete()
+    finally:
+        os.remove(result.path)
+
+
+@session_handler(role="manager")
+async def cmd_debug(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
+    """Comando de debug para diagnosticar problemas - APENAS GERENTE"""
+    try:
         # Coleta informações de debug
         debug_info = []
         
@@ -2180,51 +2421,157 @@ async def cmd_debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 for col in missing_cols:
                     debug_info.append(f"      • `{col}`")
                 debug_info.append(f"\n   💡 **SOLUÇÃO:** Execute a migration!")
-                debug_info.append(f"   `python delivery_system/apply_route_automation.py`")
+                debug_info.append("   `python delivery_system/migrate.py`")
             else:
                 debug_info.append(f"   ✅ Todas as colunas OK ({len(column_names)} total)")
         except Exception as e:
             debug_info.append(f"\n❌ **Erro ao verificar tabela:** `{str(e)[:100]}`")
         
-        # Monta mensagem final
-        message = "🔧 **DEBUG SYSTEM**\n\n" + "\n".join(debug_info)
-        
-        # Adiciona instruções
-        message += "\n\n━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        message += "📋 **Como usar este relatório:**\n"
-        message += "1. Tire print desta mensagem\n"
-        message += "2. Mande para o desenvolvedor\n"
-        message += "3. Copie a parte com ❌ se houver\n\n"
-        message += "💡 **Comandos úteis:**\n"
-        message += "• `/meu_id` - Ver seu ID\n"
-        message += "• `/drivers` - Listar motoristas\n"
-        message += "• `/relatorio` - Testar relatório"
-        
-        await update.message.reply_text(message, parse_mode='Markdown')
-        
-    except Exception as e:
-        await update.message.reply_text(
+        # 6. Migrações e índices (verificados no startup por migrate.py)
+        report = index_report()
+        if report:
+            debug_info.append(
+                f"\n🗂️ **Migrações:** revisão `{report['revision']}` | "
+                f"{len(report['present'])} índices OK"
+            )
+            if report["missing"]:
+                debug_info.append(f"   ⚠️ **Índices faltando:** {', '.join(report['missing'][:10])}")
+
+        # 7. Chamadas de IA (latência, tokens, retries)
+        ai_metrics = ai_gateway.metrics()
+        if ai_metrics:
+            debug_info.append("\n🤖 **Chamadas de IA** (qtd | p50/p95 ms | tokens | retries/erros):")
+            for m in ai_metrics:
+                debug_info.append(
+                    f"   • `{m['label']}`: {m['calls']} | {m['p50_ms']:.0f}/{m['p95_ms']:.0f} | "
+                    f"{m['prompt_tokens']}+{m['completion_tokens']} | {m['retries']}/{m['errors']}"
+                )
+                if m['ttft_p50_ms'] is not None:
+                    debug_info.append(
+                        f"     ↳ 1º token (stream): {m['ttft_p50_ms']:.0f}/{m['ttft_p95_ms']:.0f} ms"
+                    )
+
+        # 8. Cache de relatórios
+        cache_metrics = report_cache.metrics()
+        hit_rate = f"{cache_metrics['hit_rate']:.0f}%" if cache_metrics['hit_rate'] is not None else "-"
+        debug_info.append(
+            f"\n🗃️ **Cache de Relatórios** ({cache_metrics['backend']}): {cache_metrics['entries']} entrada(s) | "
+            f"hit {hit_rate} | {cache_metrics['invalidated']} invalidada(s)"
+        )
+        shared_calls = [m for m in single_flight.metrics() if m['shared']]
+        if shared_calls:
+            debug_info.append(
+                "   🔀 Pedidos simultâneos aproveitados: "
+                + ", ".join(f"`{m['command']}` {m['shared']}/{m['executions']}" for m in shared_calls)
+            )
+
+        # 9. Queries SQL por handler/rota (top 8 por tempo total)
+        try:
+            query_metrics = get_query_metrics()[:8]
+            if query_metrics:
+                debug_info.append("\n⏱️ **Queries por Handler** (qtd | q/chamada | p50/p95/p99 ms):")
+                for m in query_metrics:
+                    per_call = m['queries_per_call'] if m['queries_per_call'] is not None else "-"
+                    debug_info.append(
+                        f"   • `{m['label']}`: {m['queries']} | {per_call} | "
+                        f"{m['p50_ms']:.0f}/{m['p95_ms']:.0f}/{m['p99_ms']:.0f}"
+                        + (f" | 🐢 {m['slow']}" if m['slow'] else "")
+                    )
+        except Exception as e:
+            debug_info.append(f"\n❌ **Erro nas métricas de queries:** `{str(e)[:50]}`")
+
+        # 10. Última execução de cada job do scheduler (tabela job_run)
+        try:
+            last_runs = (
+                db.query(JobRun)
+                .filter(JobRun.id.in_(db.query(func.max(JobRun.id)).group_by(JobRun.job_id)))
+                .order_by(JobRun.job_id)
+                .all()
+            )
+            if last_runs:
+                debug_info.append("\n⏰ **Jobs** (última execução):")
+                for run in last_runs:
+                    icon = {"ok": "✅", "running": "⏳"}.get(run.status, "❌")
+                    debug_info.append(
+                        f"   {icon} `{run.job_id}`: {run.started_at.strftime('%d/%m %H:%M')} | "
+                        f"{run.duration_ms or 0:.0f} ms"
+                    )
+            # Réplica que roda as jobs (lease renovado pelo heartbeat do scheduler)
+            lease = db.get(SchedulerLease, "scheduler")
+            if lease:
+                state = "vencido" if lease.expires_at < datetime.utcnow() else "ativo"
+                debug_info.append(
+                    f"   👑 Líder: `{lease.holder}` ({state}, desde {lease.acquired_at.strftime('%d/%m %H:%M')} UTC)"
+                )
+        except Exception as e:
+            debug_info.append(f"\n❌ **Erro no histórico de jobs:** `{str(e)[:50]}`")
+
+        # 11. Fila de saída do Telegram (envios, flood waits, tempo na fila)
+        outbound_metrics = outbound.metrics()
+        if outbound_metrics["labels"] or outbound_metrics["pending"]:
+            debug_info.append(
+                f"\n📨 **Fila de Saída:** {outbound_metrics['pending']} pendente(s) "
+                f"(enviados | falhas | flood | p95 fila ms):"
+            )
+            for m in outbound_metrics["labels"]:
+                debug_info.append(
+                    f"   • `{m['label']}`: {m['sent']} | {m['failed']} | {m['flood_waits']} | {m['queue_p95_ms']:.0f}"
+                )
+
+        # 12. Updates simultâneos (PerChatUpdateProcessor)
+        processor = context.application.update_processor
+        if isinstance(processor, PerChatUpdateProcessor):
+            m = processor.metrics()
+            debug_info.append(
+                f"\n⚙️ **Updates:** {m['in_flight']}/{m['max_workers']} em andamento | "
+                f"pico {m['max_in_flight']} | {m['chats_waiting']} chat(s) na fila | {m['processed']} processados"
+            )
+        if webhook_queue.running:
+            m = webhook_queue.metrics()
+            debug_info.append(
+                f"   📥 Fila do webhook: {m['depth']}/{m['capacity']} (pico {m['max_depth']}) | "
+                f"{m['duplicates']} duplicado(s) | {m['rejected_full']} recusado(s) | p95 {m['wait_p95_ms']:.0f} ms"
+            )
+        m = user_cache.metrics()
+        debug_info.append(
+            f"   👤 Cache de usuários: {m['entries']} | acerto {m['hit_rate']:.0%} | "
+            f"{m['invalidations']} invalidação(ões) | TTL {m['ttl_s']:.0f}s"
+        )
+        m = conversation_metrics(context.application)
+        debug_info.append(
+            f"   💬 Estado de conversa: {m['users']} usuário(s) | {m['keys']} chave(s) | "
+            f"{m['bytes'] / 1024:.1f} KB | {m['expired_keys']} vencida(s) removida(s)"
+        )
+
+        # Monta mensagem final
+        message = "🔧 **DEBUG SYSTEM**\n\n" + "\n".join(debug_info)
+        
+        # Adiciona instruções
+        message += "\n\n━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        message += "📋 **Como usar este relatório:**\n"
+        message += "1. Tire print desta mensagem\n"
+        message += "2. Mande para o desenvolvedor\n"
+        message += "3. Copie a parte com ❌ se houver\n\n"
+        message += "💡 **Comandos úteis:**\n"
+        message += "• `/meu_id` - Ver seu ID\n"
+        message += "• `/drivers` - Listar motoristas\n"
+        message += "• `/relatorio` - Testar relatório"
+        
+        await update.message.reply_text(message, parse_mode='Markdown')
+        
+    except Exception as e:
+        await update.message.reply_text(
             f"❌ **Erro no Debug:**\n\n"
             f"`{str(e)}`\n\n"
             f"Mande este erro para o desenvolvedor!",
             parse_mode='Markdown'
         )
-    finally:
-        db.close()
 
 
-async def cmd_configurar_canal_analise(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ Acesso Negado\n\nApenas gerentes podem configurar canais.")
+async def cmd_configurar_canal_analise(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Configura canal dedicado para receber análises e relatórios"""
-    db = SessionLocal()
     try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text(
-                "⛔ Acesso Negado\n\n"
-                "Apenas gerentes podem configurar canais."
-            )
-            return
-        
         # Pega o canal_id do usuário se já tem
         if me.channel_id:
             text = (
@@ -2255,21 +2602,15 @@ async def cmd_configurar_canal_analise(update: Update, context: ContextTypes.DEF
         
     except Exception as e:
         await update.message.reply_text(f"❌ Erro: {str(e)}")
-    finally:
-        db.close()
 
 
-async def handle_channel_id_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied=None)
+async def handle_channel_id_input(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Processa o ID do canal quando o usuário responde ao /configurar_canal_análise"""
     if not context.user_data.get('waiting_for_channel_id'):
         return  # Não está esperando por um ID de canal
     
-    db = SessionLocal()
     try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            return
-        
         channel_id = update.message.text.strip()
         
         # Valida se é um número negativo (formato de canal Telegram)
@@ -2286,9 +2627,8 @@ async def handle_channel_id_input(update: Update, context: ContextTypes.DEFAULT_
                 await update.message.reply_text(text)
             return
         
-        # Salva o ID do canal no banco
-        me.channel_id = channel_id
-        db.add(me)
+        # Salva o ID do canal no banco (me é a cópia do cache, só leitura)
+        db.get(User, me.id).channel_id = channel_id
         db.commit()
         
         # Limpa o estado
@@ -2306,81 +2646,73 @@ async def handle_channel_id_input(update: Update, context: ContextTypes.DEFAULT_
         
     except Exception as e:
         await update.message.reply_text(f"❌ Erro: {str(e)}")
-    finally:
-        db.close()
 
 
-async def cmd_rotas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem gerenciar rotas.", parse_mode="Markdown")
+async def cmd_rotas(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Gerencia todas as rotas: visualiza status, rastreia ativas e deleta se necessário"""
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem gerenciar rotas.",
-                parse_mode='Markdown'
-            )
-            return
+    # Busca todas as rotas com informações
+    routes = db.query(Route).order_by(Route.created_at.desc()).all()
         
-        # Busca todas as rotas com informações
-        routes = db.query(Route).order_by(Route.created_at.desc()).all()
-        
-        if not routes:
-            await update.message.reply_text(
-                "📭 *Nenhuma Rota Cadastrada*\n\n"
-                "Use /importar para criar uma nova rota primeiro!",
-                parse_mode='Markdown'
-            )
-            return
+    if not routes:
+        await update.message.reply_text(
+            "📭 *Nenhuma Rota Cadastrada*\n\n"
+            "Use /importar para criar uma nova rota primeiro!",
+            parse_mode='Markdown'
+        )
+        return
         
-        # Cria keyboard com rotas e status
-        keyboard = []
-        for route in routes[:30]:  # Limita a 30 rotas
-            route_name = route.name or f"Rota {route.id}"
-            
-            # Determina status
-            total_packages = db.query(Package).filter(Package.route_id == route.id).count()
-            delivered_packages = db.query(Package).filter(
-                Package.route_id == route.id,
-                Package.status == "delivered"
-            ).count()
-            
-            if route.assigned_to_id:
-                if total_packages > 0 and delivered_packages == total_packages:
-                    status_emoji = "✅"  # Concluída
-                    status_text = "Concluída"
-                else:
-                    status_emoji = "🔴"  # Em rota
-                    status_text = "Em Rota"
+    # Cria keyboard com rotas e status
+    keyboard = []
+    # Rotas antigas têm os pacotes em package_archive (archival.py)
+    archived = archived_package_counts(
+        db, [r.id for r in routes[:30] if r.status == "finalized"]
+    )
+    for route in routes[:30]:  # Limita a 30 rotas
+        route_name = route.name or f"Rota {route.id}"
+            
+        # Determina status
+        total_packages = db.query(Package).filter(Package.route_id == route.id).count()
+        delivered_packages = db.query(Package).filter(
+            Package.route_id == route.id,
+            Package.status == "delivered"
+        ).count()
+        if route.id in archived:
+            total_packages += archived[route.id]["total"]
+            delivered_packages += archived[route.id]["delivered"]
+            
+        if route.assigned_to_id:
+            if total_packages > 0 and delivered_packages == total_packages:
+                status_emoji = "✅"  # Concluída
+                status_text = "Concluída"
             else:
-                status_emoji = "⚪"  # Pendente
-                status_text = "Pendente"
+                status_emoji = "🔴"  # Em rota
+                status_text = "Em Rota"
+        else:
+            status_emoji = "⚪"  # Pendente
+            status_text = "Pendente"
             
-            driver_name = ""
-            if route.assigned_to:
-                driver_name = f" - {route.assigned_to.full_name or f'ID {route.assigned_to.telegram_user_id}'}"
+        driver_name = ""
+        if route.assigned_to:
+            driver_name = f" - {route.assigned_to.full_name or f'ID {route.assigned_to.telegram_user_id}'}"
             
-            keyboard.append([
-                InlineKeyboardButton(
-                    text=f"{status_emoji} {route_name}{driver_name} ({delivered_packages}/{total_packages})",
-                    callback_data=f"view_route:{route.id}"
-                )
-            ])
-        
-        await update.message.reply_text(
-            "📋 *Gerenciamento de Rotas*\n\n"
-            "Status:\n"
-            "• ⚪ Pendente (sem motorista)\n"
-            "• 🔴 Em Rota (ativo)\n"
-            "• ✅ Concluída (100% entregue)\n\n"
-            "Clique em uma rota para ver detalhes e opções:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        keyboard.append([
+            InlineKeyboardButton(
+                text=f"{status_emoji} {route_name}{driver_name} ({delivered_packages}/{total_packages})",
+                callback_data=f"view_route:{route.id}"
+            )
+        ])
         
-    finally:
-        db.close()
+    await update.message.reply_text(
+        "📋 *Gerenciamento de Rotas*\n\n"
+        "Status:\n"
+        "• ⚪ Pendente (sem motorista)\n"
+        "• 🔴 Em Rota (ativo)\n"
+        "• ✅ Concluída (100% entregue)\n\n"
+        "Clique em uma rota para ver detalhes e opções:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
 
 
 async def on_view_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3050,6 +3382,7 @@ async def finalize_km_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             db.add(salary_payment)
             
             db.commit()
+            schedule_refresh([route_id])
             
             # Busca informações para mensagem final (route_name já definido)
             driver = db.get(User, route.assigned_to_id) if route.assigned_to_id else None
@@ -3127,6 +3460,7 @@ async def on_finalize_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
         route.status = "finalized"
         route.finalized_at = datetime.now()
         db.commit()
+        schedule_refresh([route_id])
         
         # Busca informações para mensagem final
         route_name = route.name or f"Rota {route_id}"
@@ -3185,6 +3519,13 @@ async def on_delete_view_route(update: Update, context: ContextTypes.DEFAULT_TYP
             Package.route_id == route_id,
             Package.status == "delivered"
         ).count()
+        archived = archived_package_counts(db, [route_id]).get(route_id)
+        if archived:
+            package_count += archived["total"]
+            delivered_count += archived["delivered"]
+        
+        # Dias do resumo diário que dependem desta rota (recalculados após excluir)
+        affected_days = route_days(db, [route_id])
         
         # Deleta comprovantes associados
         db.query(DeliveryProof).filter(
@@ -3195,10 +3536,12 @@ async def on_delete_view_route(update: Update, context: ContextTypes.DEFAULT_TYP
         
         # Deleta pacotes
         db.query(Package).filter(Package.route_id == route_id).delete()
+        delete_archived(db, route_id)
         
         # Deleta rota
         db.delete(route)
         db.commit()
+        schedule_refresh(days=affected_days)
         
         delete_text = (
             f"✅ *Rota Excluída!*\n\n"
@@ -3223,125 +3566,103 @@ async def on_delete_view_route(update: Update, context: ContextTypes.DEFAULT_TYP
         db.close()
 
 
-async def on_back_to_routes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ Acesso negado!")
+async def on_back_to_routes(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Callback para voltar à lista de rotas"""
     query = update.callback_query
     await query.answer()
     
     # Executa cmd_rotas diretamente passando a query
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await query.answer("⛔ Acesso negado!", show_alert=True)
-            return
+    routes = db.query(Route).order_by(Route.created_at.desc()).all()
         
-        routes = db.query(Route).order_by(Route.created_at.desc()).all()
-        
-        if not routes:
-            await query.edit_message_text(
-                "📭 *Nenhuma Rota Cadastrada*\n\n"
-                "Use /importar para criar uma nova rota!",
-                parse_mode='Markdown'
-            )
-            return
+    if not routes:
+        await query.edit_message_text(
+            "📭 *Nenhuma Rota Cadastrada*\n\n"
+            "Use /importar para criar uma nova rota!",
+            parse_mode='Markdown'
+        )
+        return
         
-        keyboard = []
-        for route in routes[:30]:
-            route_name = route.name or f"Rota {route.id}"
-            
-            total_packages = db.query(Package).filter(Package.route_id == route.id).count()
-            delivered_packages = db.query(Package).filter(
-                Package.route_id == route.id,
-                Package.status == "delivered"
-            ).count()
-            
-            if route.assigned_to_id:
-                if total_packages > 0 and delivered_packages == total_packages:
-                    status_emoji = "✅"
-                    status_text = "Concluída"
-                else:
-                    status_emoji = "🔴"
-                    status_text = "Em Rota"
+    keyboard = []
+    for route in routes[:30]:
+        route_name = route.name or f"Rota {route.id}"
+            
+        total_packages = db.query(Package).filter(Package.route_id == route.id).count()
+        delivered_packages = db.query(Package).filter(
+            Package.route_id == route.id,
+            Package.status == "delivered"
+        ).count()
+            
+        if route.assigned_to_id:
+            if total_packages > 0 and delivered_packages == total_packages:
+                status_emoji = "✅"
+                status_text = "Concluída"
             else:
-                status_emoji = "⚪"
-                status_text = "Pendente"
+                status_emoji = "🔴"
+                status_text = "Em Rota"
+        else:
+            status_emoji = "⚪"
+            status_text = "Pendente"
             
-            driver_name = ""
-            if route.assigned_to:
-                driver_name = f" - {route.assigned_to.full_name or f'ID {route.assigned_to.telegram_user_id}'}"
+        driver_name = ""
+        if route.assigned_to:
+            driver_name = f" - {route.assigned_to.full_name or f'ID {route.assigned_to.telegram_user_id}'}"
             
-            keyboard.append([
-                InlineKeyboardButton(
-                    text=f"{status_emoji} {route_name}{driver_name} ({delivered_packages}/{total_packages})",
-                    callback_data=f"view_route:{route.id}"
-                )
-            ])
-        
-        await query.edit_message_text(
-            "📋 *Gerenciamento de Rotas*\n\n"
-            "Status:\n"
-            "• ⚪ Pendente (sem motorista)\n"
-            "• 🔴 Em Rota (ativo)\n"
-            "• ✅ Concluída (100% entregue)\n\n"
-            "Clique em uma rota para ver detalhes e opções:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        keyboard.append([
+            InlineKeyboardButton(
+                text=f"{status_emoji} {route_name}{driver_name} ({delivered_packages}/{total_packages})",
+                callback_data=f"view_route:{route.id}"
+            )
+        ])
         
-    finally:
-        db.close()
+    await query.edit_message_text(
+        "📋 *Gerenciamento de Rotas*\n\n"
+        "Status:\n"
+        "• ⚪ Pendente (sem motorista)\n"
+        "• 🔴 Em Rota (ativo)\n"
+        "• ✅ Concluída (100% entregue)\n\n"
+        "Clique em uma rota para ver detalhes e opções:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
 
 
-async def cmd_configurarcanal(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem configurar canais.", parse_mode="Markdown")
+async def cmd_configurarcanal(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Configura canal do Telegram para receber provas de entrega de um motorista"""
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem configurar canais.",
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
-        
-        # Lista motoristas
-        drivers = db.query(User).filter(User.role == "driver").all()
-        
-        if not drivers:
-            await update.message.reply_text(
-                "📭 *Nenhum Motorista Cadastrado*\n\n"
-                "Use /cadastrardriver para cadastrar motoristas primeiro!",
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
-        
-        # Cria keyboard com motoristas
-        keyboard = []
-        for driver in drivers[:20]:
-            name = driver.full_name or f"ID {driver.telegram_user_id}"
-            has_channel = "✅" if driver.channel_id else "⚪"
-            
-            keyboard.append([
-                InlineKeyboardButton(
-                    text=f"{has_channel} {name}",
-                    callback_data=f"config_channel:{driver.id}"
-                )
-            ])
+    # Lista motoristas
+    drivers = db.query(User).filter(User.role == "driver").all()
         
+    if not drivers:
         await update.message.reply_text(
-            "📢 *Configurar Canal de Entregas*\n\n"
-            "Selecione o motorista:\n\n"
-            "✅ = Canal já configurado\n"
-            "⚪ = Sem canal",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            "📭 *Nenhum Motorista Cadastrado*\n\n"
+            "Use /cadastrardriver para cadastrar motoristas primeiro!",
             parse_mode='Markdown'
         )
-        return CONFIG_CHANNEL_SELECT_DRIVER
+        return ConversationHandler.END
         
-    finally:
-        db.close()
+    # Cria keyboard com motoristas
+    keyboard = []
+    for driver in drivers[:20]:
+        name = driver.full_name or f"ID {driver.telegram_user_id}"
+        has_channel = "✅" if driver.channel_id else "⚪"
+            
+        keyboard.append([
+            InlineKeyboardButton(
+                text=f"{has_channel} {name}",
+                callback_data=f"config_channel:{driver.id}"
+            )
+        ])
+        
+    await update.message.reply_text(
+        "📢 *Configurar Canal de Entregas*\n\n"
+        "Selecione o motorista:\n\n"
+        "✅ = Canal já configurado\n"
+        "⚪ = Sem canal",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+    return CONFIG_CHANNEL_SELECT_DRIVER
 
 
 async def on_config_channel_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3641,106 +3962,94 @@ async def on_config_home_location(update: Update, context: ContextTypes.DEFAULT_
 
 # ==================== ENVIAR ROTA PARA MOTORISTA ====================
 
-async def cmd_enviarrota(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem enviar rotas para motoristas.", parse_mode="Markdown")
+async def cmd_enviarrota(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Comando para gerente enviar rota para motorista"""
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
+    args = context.args or []
+    if len(args) == 2:
+        try:
+            route_id = int(args[0])
+            driver_tid = int(args[1])
+        except ValueError:
             await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem enviar rotas para motoristas.",
+                "❌ *IDs Inválidos*\n\n"
+                "Use: `/enviarrota <id_rota> <id_motorista>`",
                 parse_mode='Markdown'
             )
             return
-        args = context.args or []
-        if len(args) == 2:
-            try:
-                route_id = int(args[0])
-                driver_tid = int(args[1])
-            except ValueError:
-                await update.message.reply_text(
-                    "❌ *IDs Inválidos*\n\n"
-                    "Use: `/enviarrota <id_rota> <id_motorista>`",
-                    parse_mode='Markdown'
-                )
-                return
-            route = db.get(Route, route_id)
-            if not route:
-                await update.message.reply_text(
-                    "❌ *Rota Não Encontrada*\n\n"
-                    f"Não existe rota com ID `{route_id}`.",
-                    parse_mode='Markdown'
-                )
-                return
-            driver = get_user_by_tid(db, driver_tid)
-            if not driver:
-                driver = User(telegram_user_id=driver_tid, full_name=None, role="driver")
-                db.add(driver)
-                db.flush()
-            route.assigned_to_id = driver.id
-            db.commit()
-            count = db.query(Package).filter(Package.route_id == route.id).count()
-            link = f"{BASE_URL}/map/{route.id}/{driver_tid}"
-            route_name = route.name or f"Rota {route.id}"
-            driver_name = driver.full_name or f"ID {driver_tid}"
+        route = db.get(Route, route_id)
+        if not route:
+            await update.message.reply_text(
+                "❌ *Rota Não Encontrada*\n\n"
+                f"Não existe rota com ID `{route_id}`.",
+                parse_mode='Markdown'
+            )
+            return
+        driver = get_user_by_tid(db, driver_tid)
+        if not driver:
+            driver = User(telegram_user_id=driver_tid, full_name=None, role="driver")
+            db.add(driver)
+            db.flush()
+        route.assigned_to_id = driver.id
+        db.commit()
+        count = db.query(Package).filter(Package.route_id == route.id).count()
+        link = f"{BASE_URL}/map/{route.id}/{driver_tid}"
+        route_name = route.name or f"Rota {route.id}"
+        driver_name = driver.full_name or f"ID {driver_tid}"
             
-            try:
-                # Envia para o motorista
-                await context.bot.send_message(
-                    chat_id=driver_tid,
-                    text=(
-                        f"🎯 *Nova Rota Atribuída!*\n\n"
-                        f"📦 Rota: *{route_name}*\n"
-                        f"📊 Total de Pacotes: *{count}*\n"
-                        f"🗺️ Mapa Interativo: [Clique Aqui]({link})\n\n"
-                        f"💡 _Abra o mapa para ver todas as entregas e começar!_"
-                    ),
-                    parse_mode='Markdown'
-                )
+        try:
+            # Envia para o motorista
+            await outbound.send(
+                context.bot.send_message,
+                chat_id=driver_tid,
+                priority=HIGH,
+                label="enviarrota",
+                text=(
+                    f"🎯 *Nova Rota Atribuída!*\n\n"
+                    f"📦 Rota: *{route_name}*\n"
+                    f"📊 Total de Pacotes: *{count}*\n"
+                    f"🗺️ Mapa Interativo: [Clique Aqui]({link})\n\n"
+                    f"💡 _Abra o mapa para ver todas as entregas e começar!_"
+                ),
+                parse_mode='Markdown'
+            )
                 
-                # Envia também para o gerente (para rastreamento)
-                await update.message.reply_text(
-                    f"✅ *Rota Enviada com Sucesso!*\n\n"
-                    f"📦 *Rota:* {route_name}\n"
-                    f"👤 *Motorista:* {driver_name}\n"
-                    f"📊 *Pacotes:* {count}\n\n"
-                    f"🗺️ *Link de Rastreamento:*\n"
-                    f"{link}\n\n"
-                    f"💡 _Use este link para acompanhar em tempo real!_\n"
-                    f"_Atualização automática a cada 30 segundos._",
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                logger.error(
-                    f"Falha ao enviar mensagem para motorista {driver_tid}",
-                    exc_info=True,
-                    extra={
-                        "driver_telegram_id": driver_tid,
-                        "route_id": route.id,
-                        "route_name": route_name,
-                        "error": str(e)
-                    }
-                )
-                await update.message.reply_text(
-                    "⚠️ *Erro ao Enviar*\n\n"
-                    "Não consegui enviar a mensagem ao motorista.\n\n"
-                    "Possíveis causas:\n"
-                    "• O motorista ainda não iniciou conversa com o bot\n"
-                    "• O ID do motorista está incorreto\n\n"
-                    "💡 Peça ao motorista para enviar /start no bot.",
-                    parse_mode='Markdown'
-                )
-            return
-    finally:
-        db.close()
+            # Envia também para o gerente (para rastreamento)
+            await update.message.reply_text(
+                f"✅ *Rota Enviada com Sucesso!*\n\n"
+                f"📦 *Rota:* {route_name}\n"
+                f"👤 *Motorista:* {driver_name}\n"
+                f"📊 *Pacotes:* {count}\n\n"
+                f"🗺️ *Link de Rastreamento:*\n"
+                f"{link}\n\n"
+                f"💡 _Use este link para acompanhar em tempo real!_\n"
+                f"_Atualização automática a cada 30 segundos._",
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(
+                f"Falha ao enviar mensagem para motorista {driver_tid}",
+                exc_info=True,
+                extra={
+                    "driver_telegram_id": driver_tid,
+                    "route_id": route.id,
+                    "route_name": route_name,
+                    "error": str(e)
+                }
+            )
+            await update.message.reply_text(
+                "⚠️ *Erro ao Enviar*\n\n"
+                "Não consegui enviar a mensagem ao motorista.\n\n"
+                "Possíveis causas:\n"
+                "• O motorista ainda não iniciou conversa com o bot\n"
+                "• O ID do motorista está incorreto\n\n"
+                "💡 Peça ao motorista para enviar /start no bot.",
+                parse_mode='Markdown'
+            )
+        return
 
     # Interativo: listar rotas
-    db = SessionLocal()
-    try:
-        routes = db.query(Route).order_by(Route.created_at.desc()).all()
-    finally:
-        db.close()
+    routes = db.query(Route).order_by(Route.created_at.desc()).all()
     if not routes:
         await update.message.reply_text(
             "📭 *Nenhuma Rota Disponível*\n\n"
@@ -3801,7 +4110,8 @@ async def on_select_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return SEND_SELECT_DRIVER
 
 
-async def on_select_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ Apenas gerentes podem enviar rotas!")
+async def on_select_driver(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Callback quando gerente seleciona motorista para receber rota"""
     query = update.callback_query
     data = query.data or ""
@@ -3823,175 +4133,165 @@ async def on_select_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
-    db = SessionLocal()
-    try:
-        route = db.get(Route, int(route_id))
-        if not route:
-            await query.edit_message_text(
-                "❌ *Rota Não Encontrada*\n\n"
-                f"A rota ID `{route_id}` não existe mais.",
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
+    route = db.get(Route, int(route_id))
+    if not route:
+        await query.edit_message_text(
+            "❌ *Rota Não Encontrada*\n\n"
+            f"A rota ID `{route_id}` não existe mais.",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
         
-        driver = get_user_by_tid(db, driver_tid)
-        if not driver:
-            driver = User(telegram_user_id=driver_tid, full_name=None, role="driver")
-            db.add(driver)
-            db.flush()
+    driver = get_user_by_tid(db, driver_tid)
+    if not driver:
+        driver = User(telegram_user_id=driver_tid, full_name=None, role="driver")
+        db.add(driver)
+        db.flush()
         
-        # ✅ FASE 4.1: Calcula salário automaticamente (100 ou 150)
-        today = datetime.now().date()
-        routes_today = db.query(Route).filter(
-            Route.assigned_to_id == driver.id,
-            func.date(Route.created_at) == today,
-            Route.status.in_(["in_progress", "completed", "finalized"])
-        ).count()
+    # ✅ FASE 4.1: Calcula salário automaticamente (100 ou 150)
+    today = datetime.now().date()
+    routes_today = db.query(Route).filter(
+        Route.assigned_to_id == driver.id,
+        in_period(Route.created_at, day_period(today)),
+        Route.status.in_(["in_progress", "completed", "finalized"])
+    ).count()
+        
+    # Primeira rota = 100, segunda+ = 50
+    driver_salary = 100.0 if routes_today == 0 else 50.0
+        
+    # Atualiza rota
+    route.assigned_to_id = driver.id
+    route.driver_salary = driver_salary
+    route.status = "in_progress"
+        
+    # ✅ FASE 4.1: Cria Expense do salário (pendente de confirmação)
+    expense = Expense(
+        date=today,
+        type="salario",
+        description=f"Salário - {driver.full_name or f'ID {driver_tid}'} - {route.name or f'Rota {route.id}'}",
+        amount=driver_salary,
+        employee_name=driver.full_name or f"ID {driver_tid}",
+        route_id=route.id,
+        confirmed=0,  # ✅ Só confirma quando finalizar a rota (0 = False, 1 = True)
+        created_by=me.telegram_user_id
+    )
+    db.add(expense)
         
-        # Primeira rota = 100, segunda+ = 50
-        driver_salary = 100.0 if routes_today == 0 else 50.0
+    db.commit()
+    schedule_refresh([route.id])
+        
+    # Informações básicas
+    count = db.query(Package).filter(Package.route_id == route.id).count()
+    route_name = route.name or f"Rota {route.id}"
+    driver_name = driver.full_name or f"ID {driver_tid}"
+    link = f"{BASE_URL}/map/{route.id}/{driver_tid}"
+        
+    # ==================== RESPONDE RÁPIDO (evita timeout) ====================
+    progress = ProgressReporter(
+        query.message,
+        f"⏳ *Enviando Rota...*\n\n"
+        f"📦 *Rota:* {route_name}\n"
+        f"👤 *Motorista:* {driver_name}\n"
+        f"📊 *Pacotes:* {count}\n"
+        f"💼 *Salário:* R$ {driver_salary:.2f}",
+    )
+    await progress.update(None, "_Preparando..._")
         
-        # Atualiza rota
-        route.assigned_to_id = driver.id
-        route.driver_salary = driver_salary
-        route.status = "in_progress"
+    # ==================== OTIMIZAÇÃO EM BACKGROUND ====================
+    # Faz otimização SEM bloquear a resposta do Telegram
+    opt_msg = ""
+    try:
+        route_id = route.id
+        start_lat = driver.home_latitude or DEPOT_LAT
+        start_lon = driver.home_longitude or DEPOT_LON
+        coords = db.query(Package.id, Package.latitude, Package.longitude).filter(
+            Package.route_id == route_id
+        ).order_by(Package.id).all()
+            
+        # Mesma rota, mesmos pacotes e mesmo ponto de partida (ex.: clique
+        # duplo em enviar) → uma única otimização para todos os pedidos
+        key = flight_key("otimizacao", route_id, fingerprint([start_lat, start_lon, [list(c) for c in coords]]))
+            
+        # Espera no máximo 3 segundos (evita travar); depois disso a
+        # otimização continua sozinha, com sessão própria
+        await progress.update(None, "_Otimizando a ordem das entregas..._", icon="🎯")
+        try:
+            await asyncio.wait_for(
+                single_flight.do(key, lambda: asyncio.to_thread(
+                    _optimize_route_in_session, route_id, start_lat, start_lon
+                )),
+                timeout=3.0,
+            )
+            if driver.home_latitude and driver.home_longitude:
+                opt_msg = "\n🎯 *Rota otimizada* a partir da casa!"
+            else:
+                opt_msg = "\n⚠️ _Sem endereço. Use /configurarcasa._"
+        except asyncio.TimeoutError:
+            opt_msg = "\n⏳ _Otimização continua em background..._"
+    except Exception as e:
+        logger.error(f"Erro na otimização: {e}")
+        opt_msg = ""
+    # ==================================================================
         
-        # ✅ FASE 4.1: Cria Expense do salário (pendente de confirmação)
-        me = get_user_by_tid(db, update.effective_user.id)
-        expense = Expense(
-            date=today,
-            type="salario",
-            description=f"Salário - {driver.full_name or f'ID {driver_tid}'} - {route.name or f'Rota {route.id}'}",
-            amount=driver_salary,
-            employee_name=driver.full_name or f"ID {driver_tid}",
-            route_id=route.id,
-            confirmed=0,  # ✅ Só confirma quando finalizar a rota (0 = False, 1 = True)
-            created_by=me.telegram_user_id if me else update.effective_user.id
+    await progress.update(None, "_Avisando o motorista..._", icon="📨")
+    try:
+        await outbound.send(
+            context.bot.send_message,
+            chat_id=driver_tid,
+            priority=HIGH,
+            label="enviarrota",
+            text=(
+                f"🎯 *Nova Rota Atribuída!*\n\n"
+                f"📦 Rota: *{route_name}*\n"
+                f"📊 Total de Pacotes: *{count}*\n"
+                f"🗺️ Mapa Interativo: [Clique Aqui]({link})\n"
+                f"{opt_msg}\n\n"
+                f"💡 _Abra o mapa para ver todas as entregas e começar!_"
+            ),
+            parse_mode='Markdown',
+            disable_web_page_preview=True
         )
-        db.add(expense)
-        
-        db.commit()
-        
-        # Informações básicas
-        count = db.query(Package).filter(Package.route_id == route.id).count()
-        route_name = route.name or f"Rota {route.id}"
-        driver_name = driver.full_name or f"ID {driver_tid}"
-        link = f"{BASE_URL}/map/{route.id}/{driver_tid}"
-        
-        # ==================== RESPONDE RÁPIDO (evita timeout) ====================
-        await query.edit_message_text(
-            f"⏳ *Enviando Rota...*\n\n"
+        await progress.finish(
+            f"✅ *Rota Enviada com Sucesso!*\n\n"
             f"📦 *Rota:* {route_name}\n"
             f"👤 *Motorista:* {driver_name}\n"
             f"📊 *Pacotes:* {count}\n"
-            f"💼 *Salário:* R$ {driver_salary:.2f}\n\n"
-            f"🔄 _Preparando..._",
+            f"{opt_msg}\n\n"
+            f"� *Financeiro:*\n"
+            f"💵 Receita: R$ {route.revenue:.2f}\n"
+            f"💼 Salário: R$ {driver_salary:.2f}\n"
+            f"📊 Lucro Bruto: R$ {route.revenue - driver_salary:.2f}\n\n"
+            f"�🗺️ *Link de Rastreamento:*\n"
+            f"{link}\n\n"
+            f"💡 _Use este link para acompanhar em tempo real!_",
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(
+            f"Falha ao enviar rota {route.id} para motorista {driver_tid}",
+            exc_info=True,
+            extra={
+                "route_id": route.id,
+                "driver_telegram_id": driver_tid,
+                "route_name": route_name,
+                "error": str(e)
+            }
+        )
+        await progress.finish(
+            "⚠️ *Erro ao Enviar*\n\n"
+            "Não consegui enviar a mensagem ao motorista.\n\n"
+            "Possíveis causas:\n"
+            "• O motorista ainda não iniciou conversa com o bot\n"
+            "• O ID do motorista está incorreto\n\n"
+            "💡 Peça ao motorista para enviar /start no bot.",
             parse_mode='Markdown'
         )
-        
-        # ==================== OTIMIZAÇÃO EM BACKGROUND ====================
-        # Faz otimização SEM bloquear a resposta do Telegram
-        opt_msg = ""
-        try:
-            all_packages = db.query(Package).filter(Package.route_id == route.id).all()
-            start_lat = driver.home_latitude or DEPOT_LAT
-            start_lon = driver.home_longitude or DEPOT_LON
-            
-            # Roda em timeout máximo de 3 segundos (evita travar)
-            import asyncio
-            from concurrent.futures import ThreadPoolExecutor
-            
-            with ThreadPoolExecutor() as pool:
-                loop = asyncio.get_event_loop()
-                future = loop.run_in_executor(
-                    pool, 
-                    optimize_route_packages, 
-                    db, all_packages, start_lat, start_lon
-                )
-                
-                try:
-                    await asyncio.wait_for(future, timeout=3.0)
-                    if driver.home_latitude and driver.home_longitude:
-                        opt_msg = "\n🎯 *Rota otimizada* a partir da casa!"
-                    else:
-                        opt_msg = "\n⚠️ _Sem endereço. Use /configurarcasa._"
-                except asyncio.TimeoutError:
-                    opt_msg = "\n⏳ _Otimização continua em background..._"
-        except Exception as e:
-            logger.error(f"Erro na otimização: {e}")
-            opt_msg = ""
-        # ==================================================================
-        
-        try:
-            await context.bot.send_message(
-                chat_id=driver_tid,
-                text=(
-                    f"🎯 *Nova Rota Atribuída!*\n\n"
-                    f"📦 Rota: *{route_name}*\n"
-                    f"📊 Total de Pacotes: *{count}*\n"
-                    f"🗺️ Mapa Interativo: [Clique Aqui]({link})\n"
-                    f"{opt_msg}\n\n"
-                    f"💡 _Abra o mapa para ver todas as entregas e começar!_"
-                ),
-                parse_mode='Markdown',
-                disable_web_page_preview=True
-            )
-            await query.edit_message_text(
-                f"✅ *Rota Enviada com Sucesso!*\n\n"
-                f"📦 *Rota:* {route_name}\n"
-                f"👤 *Motorista:* {driver_name}\n"
-                f"📊 *Pacotes:* {count}\n"
-                f"{opt_msg}\n\n"
-                f"� *Financeiro:*\n"
-                f"💵 Receita: R$ {route.revenue:.2f}\n"
-                f"💼 Salário: R$ {driver_salary:.2f}\n"
-                f"📊 Lucro Bruto: R$ {route.revenue - driver_salary:.2f}\n\n"
-                f"�🗺️ *Link de Rastreamento:*\n"
-                f"{link}\n\n"
-                f"💡 _Use este link para acompanhar em tempo real!_",
-                parse_mode='Markdown'
-            )
-        except Exception as e:
-            logger.error(
-                f"Falha ao enviar rota {route.id} para motorista {driver_tid}",
-                exc_info=True,
-                extra={
-                    "route_id": route.id,
-                    "driver_telegram_id": driver_tid,
-                    "route_name": route_name,
-                    "error": str(e)
-                }
-            )
-            await query.edit_message_text(
-                "⚠️ *Erro ao Enviar*\n\n"
-                "Não consegui enviar a mensagem ao motorista.\n\n"
-                "Possíveis causas:\n"
-                "• O motorista ainda não iniciou conversa com o bot\n"
-                "• O ID do motorista está incorreto\n\n"
-                "💡 Peça ao motorista para enviar /start no bot.",
-                parse_mode='Markdown'
-            )
-    finally:
-        db.close()
     context.user_data.pop("send_route_id", None)
     return ConversationHandler.END
 
 
-async def cmd_importar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem importar rotas.\n\n"
-                "Se você é motorista, aguarde o gerente enviar as rotas para você!",
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
-    finally:
-        db.close()
-    
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem importar rotas.\n\nSe você é motorista, aguarde o gerente enviar as rotas para você!", parse_mode="Markdown")
+async def cmd_importar(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     await update.message.reply_text(
         "📥 *Importar Nova Rota*\n\n"
         "📂 *Envie o arquivo da planilha*\n\n"
@@ -4039,43 +4339,34 @@ async def handle_import_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # ✅ FASE 3.2: FEEDBACK IMEDIATO
     await update.message.chat.send_action(action=ChatAction.UPLOAD_DOCUMENT)
-    processing_msg = await update.message.reply_text(
-        "⏳ *Processando arquivo...*\n\n"
-        "📥 Baixando e analisando dados...",
-        parse_mode='Markdown'
+    progress = await ProgressReporter.start(
+        update.message.reply_text, "⏳ *Processando arquivo...*", None, "Baixando arquivo...", icon="📥"
     )
     
-    file = await doc.get_file()
-    local_path = IMPORTS_DIR / filename
-    await file.download_to_drive(local_path)
+    # Em memória (cada importação com seus bytes; nada sobrescreve a de outro gerente)
+    upload = await receive_upload(await doc.get_file(), filename, doc.file_size)
+    await progress.update(None, "Lendo planilha...", icon="📊")
 
     # ✅ FASE 3.2: PARSE COM RELATÓRIO (robusto)
-    try:
-        if suffix == ".xlsx":
-            df = pd.read_excel(local_path)
-        else:
-            # CSV: tenta UTF-8 e fallback latin-1
-            try:
-                df = pd.read_csv(local_path)
-            except Exception:
-                df = pd.read_csv(local_path, encoding="latin-1", sep=",")
-    except Exception as read_err:
-        try:
-            await processing_msg.edit_text(
-                "❌ *Erro ao Ler Arquivo*\n\n"
-                "Não consegui abrir a planilha. Verifique o formato/codificação e tente novamente.\n\n"
-                f"Detalhes: `{str(read_err)[:200]}`",
-                parse_mode='Markdown'
-            )
-        except Exception:
-            await processing_msg.edit_text(
-                "Erro ao ler arquivo. Detalhes: " + str(read_err)[:200]
-            )
+    try:
+        df = await asyncio.to_thread(read_spreadsheet, upload)
+    except Exception as read_err:
+        await progress.finish(
+            "❌ *Erro ao Ler Arquivo*\n\n"
+            "Não consegui abrir a planilha. Verifique o formato/codificação e tente novamente.\n\n"
+            f"Detalhes: `{str(read_err)[:200]}`",
+            parse_mode='Markdown',
+            fallback_text="Erro ao ler arquivo. Detalhes: " + str(read_err)[:200],
+        )
         return ConversationHandler.END
+    finally:
+        # Cópia em uploads/imports/<hash> (se IMPORT_ARCHIVE) em segundo plano
+        finish_upload(upload)
+    await progress.update(None, "Analisando colunas e endereços...", icon="🔍")
     items, report = parse_import_dataframe(df)
     
     if not items:
-        await processing_msg.edit_text(
+        await progress.finish(
             "❌ *Erro ao Processar*\n\n"
             "Não encontrei dados válidos no arquivo.\n\n"
             "Verifique se o arquivo possui:\n"
@@ -4183,19 +4474,14 @@ async def handle_import_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
         ]
     ]
     
-    try:
-        await processing_msg.edit_text(
-            preview_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        # Fallback caso alguma entidade quebre o Markdown
-        safe_text = preview_text.replace("*", "").replace("_", "").replace("`", "")
-        await processing_msg.edit_text(
-            safe_text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    # Fallback caso alguma entidade quebre o Markdown
+    safe_text = preview_text.replace("*", "").replace("_", "").replace("`", "")
+    await progress.finish(
+        preview_text,
+        parse_mode='Markdown',
+        fallback_text=safe_text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
     
     # Salva dados no context para usar no callback
     context.user_data['pending_import'] = {
@@ -4228,11 +4514,8 @@ async def on_import_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     report = pending['report']
     
     # Atualiza mensagem para mostrar progresso
-    await query.edit_message_text(
-        "⏳ *Importando Pacotes...*\n\n"
-        f"📦 Salvando {len(items)} pacotes no banco de dados...",
-        parse_mode='Markdown'
-    )
+    progress = ProgressReporter(query.message, "⏳ *Importando Pacotes...*")
+    await progress.update(None, f"Salvando {len(items)} pacotes no banco de dados...", icon="📦")
     
     db = SessionLocal()
     try:
@@ -4249,7 +4532,7 @@ async def on_import_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db.flush()
         
         # ✅ FASE 4.1: Cria Income automaticamente
-        me = get_user_by_tid(db, update.effective_user.id)
+        me = cached_user(update.effective_user.id, db)
         income = Income(
             date=datetime.now().date(),
             amount=260.0,
@@ -4277,6 +4560,7 @@ async def on_import_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         db.add_all(packages)
         db.commit()
+        schedule_refresh([route.id])
         
         # ✅ FASE 4.1: MENSAGEM FINAL COM RECEITA AUTOMÁTICA
         success_text = (
@@ -4307,13 +4591,7 @@ async def on_import_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"3. O motorista receberá o mapa interativo"
         )
         
-        try:
-            await query.edit_message_text(
-                success_text,
-                parse_mode='Markdown'
-            )
-        except Exception:
-            await query.edit_message_text(success_text)
+        await progress.finish(success_text, parse_mode='Markdown')
         
         # Limpa dados do context
         context.user_data.pop('pending_import', None)
@@ -4325,13 +4603,14 @@ async def on_import_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db.rollback()
         logger.error(f"Erro ao importar pacotes: {str(e)}", exc_info=True)
         try:
-            await query.edit_message_text(
+            await progress.finish(
                 f"❌ Erro ao Importar\n\n"
                 f"Detalhes: {str(e)}\n\n"
-                f"Tente novamente com /importar"
+                f"Tente novamente com /importar",
+                parse_mode=None
             )
         except Exception:
-            await query.edit_message_text("Erro ao importar. Tente novamente com /importar")
+            await progress.finish("Erro ao importar. Tente novamente com /importar", parse_mode=None)
         return ConversationHandler.END
     finally:
         db.close()
@@ -4355,7 +4634,8 @@ async def on_import_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def on_delete_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ Apenas gerentes podem excluir motoristas!")
+async def on_delete_driver(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     """Callback para excluir motorista"""
     query = update.callback_query
     await query.answer()
@@ -4366,14 +4646,7 @@ async def on_delete_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     driver_id = int(data.split(":", 1)[1])
     
-    db = SessionLocal()
     try:
-        # Verifica permissão
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await query.answer("⛔ Apenas gerentes podem excluir motoristas!", show_alert=True)
-            return
-        
         # Busca motorista
         driver = db.get(User, driver_id)
         if not driver:
@@ -4392,11 +4665,15 @@ async def on_delete_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 show_alert=True
             )
             # Desvincula rotas
+            unlinked_route_ids = [r_id for (r_id,) in db.query(Route.id).filter(Route.assigned_to_id == driver_id).all()]
             db.query(Route).filter(Route.assigned_to_id == driver_id).update({"assigned_to_id": None})
+        else:
+            unlinked_route_ids = []
         
         # Deleta motorista
         db.delete(driver)
         db.commit()
+        schedule_refresh(unlinked_route_ids)
         
         await query.edit_message_text(
             f"✅ *Motorista Excluído!*\n\n"
@@ -4408,24 +4685,11 @@ async def on_delete_driver(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         await query.answer(f"❌ Erro ao excluir: {str(e)}", show_alert=True)
-    finally:
-        db.close()
 
 
 # Cadastro/listagem de entregadores
-async def add_driver_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem cadastrar motoristas.",
-                parse_mode='Markdown'
-            )
-            return ConversationHandler.END
-    finally:
-        db.close()
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem cadastrar motoristas.", parse_mode="Markdown")
+async def add_driver_start(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     await update.message.reply_text(
         "👤 *Cadastrar Novo Motorista*\n\n"
         "Informe o *Telegram User ID* do motorista.\n\n"
@@ -4488,20 +4752,9 @@ async def add_driver_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def list_drivers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-        if not me or me.role != "manager":
-            await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem listar motoristas.",
-                parse_mode='Markdown'
-            )
-            return
-        drivers = db.query(User).filter(User.role == "driver").order_by(User.id.desc()).all()
-    finally:
-        db.close()
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem listar motoristas.", parse_mode="Markdown")
+async def list_drivers(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
+    drivers = db.query(User).filter(User.role == "driver").order_by(User.id.desc()).all()
     if not drivers:
         await update.message.reply_text(
             "👥 *Nenhum Motorista Cadastrado*\n\n"
@@ -4657,7 +4910,7 @@ async def fail_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Pacote não encontrado.")
             return ConversationHandler.END
 
-        driver = get_user_by_tid(db, update.effective_user.id)
+        driver = cached_user(update.effective_user.id, db)
         proof = DeliveryProof(
             package_id=package.id,
             driver_id=driver.id if driver else None,
@@ -4683,6 +4936,7 @@ async def fail_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 r.status = "completed"
                 r.completed_at = datetime.now()
                 db.commit()
+        schedule_refresh([route_id])
 
         driver_name = driver.full_name or f"ID {driver.telegram_user_id}" if driver else "N/A"
         await update.message.reply_text(
@@ -4693,8 +4947,11 @@ async def fail_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Notifica canal do motorista, se existir
         if driver and driver.channel_id:
             try:
-                await context.bot.send_message(
+                await outbound.send(
+                    context.bot.send_message,
                     chat_id=driver.channel_id,
+                    priority=LOW,
+                    label="insucesso",
                     text=(
                         f"❌ Insucesso de Entrega\n\n"
                         f"Motorista: {driver_name}\n"
@@ -4706,12 +4963,12 @@ async def fail_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     )
                 )
                 if context.user_data.get("fail_photo_id"):
-                    try:
-                        await context.bot.send_photo(chat_id=driver.channel_id, photo=context.user_data["fail_photo_id"], caption="Insucesso - Foto")
-                    except Exception:
-                        pass
+                    outbound.submit(
+                        context.bot.send_photo, chat_id=driver.channel_id, priority=LOW, label="insucesso",
+                        photo=context.user_data["fail_photo_id"], caption="Insucesso - Foto",
+                    )
             except Exception:
-                pass
+                pass  # falha já registrada pela fila de saída
 
         # Não notificar gerentes/grupo de análise para insucessos (somente canal do motorista)
         pass
@@ -4730,6 +4987,14 @@ async def mass_photos_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.photo:
         photo = update.message.photo[-1]
         photos = context.user_data.get("mass_photos", [])
+        if len(photos) >= MASS_PHOTOS_MAX:
+            kb = ReplyKeyboardMarkup([["Próximo"]], resize_keyboard=True)
+            await update.message.reply_text(
+                f"⚠️ Limite de {MASS_PHOTOS_MAX} fotos atingido. Toque em *Próximo* para continuar.",
+                reply_markup=kb,
+                parse_mode='Markdown'
+            )
+            return MASS_PHOTOS
         photos.append(photo.file_id)
         context.user_data["mass_photos"] = photos
         kb = ReplyKeyboardMarkup([["Próximo"]], resize_keyboard=True)
@@ -4853,6 +5118,113 @@ async def photo2(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return await finalize_delivery(update, context)
 
 
+def _proof_photo_chunks(p1: Optional[str], p2: Optional[str], mass_list: List[str]) -> List[List[tuple]]:
+    """Fotos do comprovante em álbuns de até 10: [(file_id, legenda), ...] por envio"""
+    if mass_list:
+        # Entrega em massa: fotos dos pacotes + foto do local (envio separado)
+        photos = [(fid, "Pacote" if idx == 0 else None) for idx, fid in enumerate(mass_list)]
+        chunks = [photos[i:i + 10] for i in range(0, len(photos), 10)]
+        if p2:
+            chunks.append([(p2, "Local/Porta")])
+        return chunks
+    photos = [(fid, cap) for fid, cap in ((p1, "Foto 1 - Recebedor/Pacote"), (p2, "Foto 2 - Local/Porta")) if fid]
+    return [photos] if photos else []
+
+
+async def _publish_delivery_proof(
+    bot,
+    chat_id,
+    summary: str,
+    progress_message: Optional[str],
+    p1: Optional[str],
+    p2: Optional[str],
+    mass_list: List[str],
+    priority: int,
+) -> None:
+    """
+    Publica o comprovante: resumo, fotos e progresso da rota.
+
+    Resumo e álbuns entram na fila de saída de uma vez (álbuns não esperam o
+    anterior); a fila do chat mantém a ordem. O progresso só entra depois do
+    resultado dos álbuns, para ficar atrás das fotos reenviadas uma a uma.
+    Levanta exceção só se o resumo não puder ser enviado.
+    """
+    def send(method, **kwargs):
+        return outbound.submit(method, chat_id=chat_id, priority=priority, label="comprovante", **kwargs)
+
+    def send_photos(chunk):
+        if len(chunk) == 1:
+            return send(bot.send_photo, photo=chunk[0][0], caption=chunk[0][1])
+        return send(bot.send_media_group, media=[InputMediaPhoto(fid, caption=cap) for fid, cap in chunk])
+
+    first = send(bot.send_message, text=summary)
+    albums = [(chunk, send_photos(chunk)) for chunk in _proof_photo_chunks(p1, p2, mass_list)]
+
+    try:
+        await first
+    except Exception:
+        # Chat inacessível: o resto falharia igual
+        for _, future in albums:
+            future.cancel()
+        raise
+
+    retry = []
+    for chunk, future in albums:
+        try:
+            await future
+        except Exception as e:
+            if len(chunk) > 1:
+                logger.warning(f"Álbum do comprovante falhou em {chat_id}, enviando fotos uma a uma: {e}")
+                retry.extend(send_photos([item]) for item in chunk)
+    if progress_message:
+        retry.append(send(bot.send_message, text=progress_message))
+    # Falhas já registradas pela fila de saída (log + métricas)
+    await asyncio.gather(*retry, return_exceptions=True)
+
+
+def _refresh_delivered_routes(delivered_ids: List[int]) -> None:
+    """Agenda o resumo diário das rotas afetadas (entregas em grupo podem cruzar rotas)"""
+    db = SessionLocal()
+    try:
+        schedule_refresh([
+            r_id for (r_id,) in db.query(Package.route_id).filter(Package.id.in_(delivered_ids)).distinct()
+        ])
+    except Exception:
+        logger.warning("Resumo diário não agendado após a entrega", exc_info=True)
+    finally:
+        db.close()
+
+
+async def _publish_delivery_proof_background(
+    bot,
+    channel_id: Optional[str],
+    driver_chat_id: int,
+    summary: str,
+    progress_message: str,
+    p1: Optional[str],
+    p2: Optional[str],
+    mass_list: List[str],
+    delivered_ids: List[int],
+) -> None:
+    """Task de segundo plano do finalize_delivery: resumo diário e comprovante (canal do motorista ou o próprio chat)"""
+    _refresh_delivered_routes(delivered_ids)
+    if channel_id:
+        # Envia para o CANAL (arquivo: prioridade baixa na fila de saída)
+        try:
+            await _publish_delivery_proof(bot, channel_id, summary, progress_message, p1, p2, mass_list, priority=LOW)
+            return
+        except Exception as e:
+            # Fallback: envia no chat atual (não notifica gerentes)
+            logger.warning(f"Comprovante não enviado ao canal {channel_id}: {e}")
+            summary = f"⚠️ Não foi possível enviar ao canal do motorista: {str(e)}\n\n{summary}"
+            progress_message, mass_list = None, []
+    # Sem canal configurado - envia no chat atual (sem notificar gerentes)
+    try:
+        await _publish_delivery_proof(bot, driver_chat_id, summary, progress_message, p1, p2, mass_list, priority=HIGH)
+    except Exception:
+        pass  # falha já registrada pela fila de saída
+
+
 async def finalize_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pkg_ids = context.user_data.get("deliver_package_ids")
     pkg_id = context.user_data.get("deliver_package_id")
@@ -4869,7 +5241,7 @@ async def finalize_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = SessionLocal()
     try:
         # ✅ FASE 2.2: MOSTRA PREVIEW DOS DADOS ANTES DE SALVAR
-        driver = get_user_by_tid(db, update.effective_user.id)
+        driver = cached_user(update.effective_user.id, db)
         
         # Extrai dados do context
         receiver_name_val = context.user_data.get("receiver_name", "Não informado")
@@ -5090,186 +5462,6 @@ async def finalize_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Progresso: {(delivered_packages/total_packages*100 if total_packages > 0 else 0):.0f}%"
     )
     
-    # Verifica se motorista tem canal configurado
-    if driver.channel_id:
-        # Envia para o CANAL
-        try:
-            # Envia informações
-            await context.bot.send_message(
-                chat_id=driver.channel_id,
-                text=summary
-            )
-            
-            # Envia fotos como grupo/media
-            p1 = context.user_data.get("photo1_file_id")
-            p2 = context.user_data.get("photo2_file_id")
-            mass_list = context.user_data.get("mass_photos") or []
-            
-            # Prioriza enviar fotos em massa (se houver)
-            if mass_list:
-                # Envia em grupos de até 10
-                batch = []
-                for idx, fid in enumerate(mass_list, start=1):
-                    cap = "Pacote"
-                    batch.append(InputMediaPhoto(fid, caption=cap if idx == 1 else None))
-                    if len(batch) == 10:
-                        try:
-                            await context.bot.send_media_group(chat_id=driver.channel_id, media=batch)
-                        except Exception:
-                            for item in batch:
-                                try:
-                                    await context.bot.send_photo(chat_id=driver.channel_id, photo=item.media, caption=item.caption)
-                                except Exception:
-                                    pass
-                        batch = []
-                if batch:
-                    try:
-                        await context.bot.send_media_group(chat_id=driver.channel_id, media=batch)
-                    except Exception:
-                        for item in batch:
-                            try:
-                                await context.bot.send_photo(chat_id=driver.channel_id, photo=item.media, caption=item.caption)
-                            except Exception:
-                                pass
-                # Envia foto do local (se houver)
-                if p2:
-                    try:
-                        await context.bot.send_photo(chat_id=driver.channel_id, photo=p2, caption="Local/Porta")
-                    except Exception:
-                        pass
-            else:
-                # Fluxo unitário normal
-                if p1 and p2:
-                    media = [
-                        InputMediaPhoto(p1, caption="Foto 1 - Recebedor/Pacote"),
-                        InputMediaPhoto(p2, caption="Foto 2 - Local/Porta")
-                    ]
-                    try:
-                        await context.bot.send_media_group(chat_id=driver.channel_id, media=media)
-                    except Exception:
-                        if p1:
-                            try:
-                                await context.bot.send_photo(chat_id=driver.channel_id, photo=p1, caption="Foto 1 - Recebedor/Pacote")
-                            except Exception:
-                                pass
-                        if p2:
-                            try:
-                                await context.bot.send_photo(chat_id=driver.channel_id, photo=p2, caption="Foto 2 - Local/Porta")
-                            except Exception:
-                                pass
-                else:
-                    if p1:
-                        try:
-                            await context.bot.send_photo(chat_id=driver.channel_id, photo=p1, caption="Foto 1 - Recebedor/Pacote")
-                        except Exception:
-                            pass
-                    if p2:
-                        try:
-                            await context.bot.send_photo(chat_id=driver.channel_id, photo=p2, caption="Foto 2 - Local/Porta")
-                        except Exception:
-                            pass
-            
-            # Envia progresso após as fotos
-            await context.bot.send_message(
-                chat_id=driver.channel_id,
-                text=progress_message
-            )
-            
-        except Exception as e:
-            # Fallback: envia no chat atual (não notifica gerentes)
-            try:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=f"⚠️ Não foi possível enviar ao canal do motorista: {str(e)}\n\n{summary}")
-            except Exception:
-                pass
-            p1 = context.user_data.get("photo1_file_id")
-            p2 = context.user_data.get("photo2_file_id")
-            if p1:
-                try:
-                    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=p1, caption="Foto 1 - Recebedor/Pacote")
-                except Exception:
-                    pass
-            if p2:
-                try:
-                    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=p2, caption="Foto 2 - Local/Porta")
-                except Exception:
-                    pass
-    else:
-            # Sem canal configurado - envia no chat atual (sem notificar gerentes)
-            try:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=summary)
-            except Exception:
-                pass
-            p1 = context.user_data.get("photo1_file_id")
-            p2 = context.user_data.get("photo2_file_id")
-            mass_list = context.user_data.get("mass_photos") or []
-            if mass_list:
-                batch = []
-                for idx, fid in enumerate(mass_list, start=1):
-                    cap = "Pacote" if idx == 1 else None
-                    batch.append(InputMediaPhoto(fid, caption=cap))
-                    if len(batch) == 10:
-                        try:
-                            await context.bot.send_media_group(chat_id=update.effective_chat.id, media=batch)
-                        except Exception:
-                            for item in batch:
-                                try:
-                                    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=item.media, caption=item.caption)
-                                except Exception:
-                                    pass
-                        batch = []
-                if batch:
-                    try:
-                        await context.bot.send_media_group(chat_id=update.effective_chat.id, media=batch)
-                    except Exception:
-                        for item in batch:
-                            try:
-                                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=item.media, caption=item.caption)
-                            except Exception:
-                                pass
-                if p2:
-                    try:
-                        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=p2, caption="Local/Porta")
-                    except Exception:
-                        pass
-            else:
-                if p1 and p2:
-                    media = [
-                        InputMediaPhoto(p1, caption="Foto 1 - Recebedor/Pacote"),
-                        InputMediaPhoto(p2, caption="Foto 2 - Local/Porta")
-                    ]
-                    try:
-                        await context.bot.send_media_group(chat_id=update.effective_chat.id, media=media)
-                    except Exception:
-                        if p1:
-                            try:
-                                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=p1, caption="Foto 1 - Recebedor/Pacote")
-                            except Exception:
-                                pass
-                        if p2:
-                            try:
-                                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=p2, caption="Foto 2 - Local/Porta")
-                            except Exception:
-                                pass
-                else:
-                    if p1:
-                        try:
-                            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=p1, caption="Foto 1 - Recebedor/Pacote")
-                        except Exception:
-                            pass
-                    if p2:
-                        try:
-                            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=p2, caption="Foto 2 - Local/Porta")
-                        except Exception:
-                            pass
-            # Envia progresso após as fotos
-            try:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=progress_message
-                )
-            except Exception:
-                pass
-
     # ✅ FASE 2.3: MENSAGEM FINAL DETALHADA COM SUCESSO
     # Atualiza mensagem de preview para sucesso final
     try:
@@ -5297,8 +5489,11 @@ async def finalize_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Botão rápido (opcional) para abrir o mapa
     if map_url:
         try:
-            await context.bot.send_message(
+            await outbound.send(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
+                priority=HIGH,
+                label="entrega",
                 text="🗺️ *Próxima Entrega*\n\n"
                      f"📊 Progresso: {delivered_packages}/{total_packages} ({(delivered_packages/total_packages*100 if total_packages > 0 else 0):.0f}%)\n\n"
                      "Abra o mapa para continuar:",
@@ -5310,6 +5505,22 @@ async def finalize_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
     
+    # Comprovante publicado em segundo plano: o motorista não espera as fotos
+    context.application.create_task(
+        _publish_delivery_proof_background(
+            context.bot,
+            driver.channel_id,
+            update.effective_chat.id,
+            summary,
+            progress_message,
+            context.user_data.get("photo1_file_id"),
+            context.user_data.get("photo2_file_id"),
+            list(context.user_data.get("mass_photos") or []),
+            list(delivered_ids),
+        ),
+        update=update,
+    )
+    
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -5327,108 +5538,67 @@ async def finalize_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== GERENCIAR REGISTROS FINANCEIROS ====================
 
-async def cmd_meus_registros(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@session_handler(role="manager", denied="⛔ *Acesso Negado*\n\nApenas gerentes podem gerenciar registros.", parse_mode="Markdown")
+async def cmd_meus_registros(update: Update, context: ContextTypes.DEFAULT_TYPE, db, user):
     """Lista todos os registros financeiros do manager com opções de editar/excluir"""
-    db = SessionLocal()
-    try:
-        user = get_user_by_tid(db, update.effective_user.id)
-        if not user or user.role != "manager":
-            await update.message.reply_text(
-                "⛔ *Acesso Negado*\n\n"
-                "Apenas gerentes podem gerenciar registros.",
-                parse_mode='Markdown'
-            )
-            return
-        
-        # Busca TODAS as datas que têm registros financeiros (Mileage, Expense, Income)
-        now = datetime.now()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        # Busca datas em Mileage, Expense e Income
-        mileage_dates = db.query(Mileage.date).filter(
-            Mileage.date >= month_start.date(),
-            Mileage.created_by == (user.telegram_user_id if user else update.effective_user.id)
-        ).all()
-        
-        expense_dates = db.query(Expense.date).filter(
-            Expense.date >= month_start.date(),
-            Expense.created_by == (user.telegram_user_id if user else update.effective_user.id)
-        ).all()
-        
-        income_dates = db.query(Income.date).filter(
-            Income.date >= month_start.date(),
-            Income.created_by == (user.telegram_user_id if user else update.effective_user.id)
-        ).all()
-        
-        # Combina todas as datas únicas
-        all_dates = set()
-        for date_tuple in mileage_dates + expense_dates + income_dates:
-            all_dates.add(date_tuple[0])
+    # Dias do mês com registros financeiros lançados por este gerente (resumo diário)
+    now = datetime.now()
+    month_so_far = days_period(month_period(now).start, now.date())
+    creator_tid = user.telegram_user_id
+        
+    day_rows = [
+        r for r in daily_rows(db, month_so_far, CREATOR, creator_tid)
+        if r.revenue_count or r.expense_count or r.mileage_count
+    ]
         
-        if not all_dates:
-            await update.message.reply_text(
-                "📭 *Nenhum Registro Encontrado*\n\n"
-                "Você não tem registros financeiros neste mês.\n\n"
-                "Finalize rotas para criar registros automáticos!",
-                parse_mode='Markdown'
-            )
-            return
+    if not day_rows:
+        await update.message.reply_text(
+            "📭 *Nenhum Registro Encontrado*\n\n"
+            "Você não tem registros financeiros neste mês.\n\n"
+            "Finalize rotas para criar registros automáticos!",
+            parse_mode='Markdown'
+        )
+        return
         
-        # Ordena datas em ordem decrescente
-        sorted_dates = sorted(all_dates, reverse=True)
+    # Mileage do mês em uma única query (o ID vira o callback do dia)
+    mileage_ids = dict(
+        db.query(Mileage.date, Mileage.id).filter(
+            in_period(Mileage.date, month_so_far),
+            Mileage.created_by == creator_tid
+        ).order_by(Mileage.id.desc()).all()
+    )
         
-        # Cria keyboard com datas dos registros
-        keyboard = []
-        for record_date in sorted_dates[:30]:  # Limita a 30
-            date_str = record_date.strftime("%d/%m/%Y")
-            
-            # Busca dados associados a essa data
-            mileage_day = db.query(Mileage).filter(
-                Mileage.date == record_date,
-                Mileage.created_by == user.id
-            ).first()
-            
-            expenses_day = db.query(Expense).filter(
-                Expense.date == record_date,
-                Expense.created_by == user.id
-            ).all()
-            
-            income_day = db.query(Income).filter(
-                Income.date == record_date,
-                Income.created_by == user.id
-            ).all()
-            
-            total_income = sum(inc.amount for inc in income_day)
-            total_expenses = sum(exp.amount for exp in expenses_day)
-            balance = total_income - total_expenses
+    # Cria keyboard com datas dos registros (já em ordem decrescente)
+    keyboard = []
+    for row in day_rows[:30]:  # Limita a 30
+        record_date = row.day
+        date_str = record_date.strftime("%d/%m/%Y")
+        balance = row.revenue - row.expenses
             
-            # Determina emoji baseado no balance
-            emoji = "💚" if balance >= 0 else "❌"
+        # Determina emoji baseado no balance
+        emoji = "💚" if balance >= 0 else "❌"
             
-            # Se tem Mileage, usa o ID dele; senão, cria um ID virtual com a data
-            if mileage_day:
-                callback_id = f"view_fin_record:{mileage_day.id}"
-            else:
-                # Cria ID virtual: "date_YYYYMMDD"
-                callback_id = f"view_fin_record_by_date:{record_date.strftime('%Y%m%d')}"
+        # Se tem Mileage, usa o ID dele; senão, cria um ID virtual com a data
+        if record_date in mileage_ids:
+            callback_id = f"view_fin_record:{mileage_ids[record_date]}"
+        else:
+            # Cria ID virtual: "date_YYYYMMDD"
+            callback_id = f"view_fin_record_by_date:{record_date.strftime('%Y%m%d')}"
             
-            keyboard.append([
-                InlineKeyboardButton(
-                    text=f"{emoji} {date_str} - R$ {balance:,.2f}",
-                    callback_data=callback_id
-                )
-            ])
-        
-        await update.message.reply_text(
-            "📋 *Meus Registros Financeiros*\n\n"
-            "Selecione um dia para visualizar, editar ou excluir:\n\n"
-            "💚 = Lucro | ❌ = Prejuízo",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        keyboard.append([
+            InlineKeyboardButton(
+                text=f"{emoji} {date_str} - R$ {balance:,.2f}",
+                callback_data=callback_id
+            )
+        ])
         
-    finally:
-        db.close()
+    await update.message.reply_text(
+        "📋 *Meus Registros Financeiros*\n\n"
+        "Selecione um dia para visualizar, editar ou excluir:\n\n"
+        "💚 = Lucro | ❌ = Prejuízo",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
 
 
 async def on_view_fin_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -5671,6 +5841,7 @@ async def on_confirm_delete_fin(update: Update, context: ContextTypes.DEFAULT_TY
             
             db.delete(mileage)
             db.commit()
+            schedule_refresh(days=[record_date])
             
             await query.edit_message_text(
                 f"✅ *Registro Excluído!*\n\n"
@@ -5707,6 +5878,7 @@ async def on_confirm_delete_fin(update: Update, context: ContextTypes.DEFAULT_TY
             ).delete()
             
             db.commit()
+            schedule_refresh(days=[record_date])
             
             await query.edit_message_text(
                 f"✅ *Registro Excluído!*\n\n"
@@ -5739,123 +5911,9 @@ async def cmd_chat_ia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     - Conselho/opinião baseado em KPIs reais (Income, Expense, Mileage, Deliveries)
     """
 
-    def _week_range(ref: datetime, offset_weeks: int = 0):
-        # Considera semana de segunda a domingo
-        base = ref.replace(hour=0, minute=0, second=0, microsecond=0)
-        weekday = base.weekday()  # 0=segunda
-        monday = base.replace() - pd.Timedelta(days=weekday) + pd.Timedelta(weeks=offset_weeks)
-        sunday = monday + pd.Timedelta(days=6)
-        return monday.date(), sunday.date()
-
-    def _month_range(ref: datetime, offset_months: int = 0):
-        year = ref.year
-        month = ref.month + offset_months
-        while month > 12:
-            month -= 12
-            year += 1
-        while month < 1:
-            month += 12
-            year -= 1
-        start = datetime(year, month, 1)
-        if month == 12:
-            end = datetime(year + 1, 1, 1) - pd.Timedelta(days=1)
-        else:
-            end = datetime(year, month + 1, 1) - pd.Timedelta(days=1)
-        return start.date(), end.date()
-
     def esc(s: str) -> str:
         return html.escape(str(s or "")).replace("\n", " ")
 
-    def _kpis(db, start_date, end_date):
-        # ✅ Totais de receitas e despesas - APENAS DE ROTAS FINALIZADAS
-        # Receitas que NÃO têm route_id (extras gerais) OU que pertencem a rotas finalizadas
-        income_total = db.query(func.coalesce(func.sum(Income.amount), 0.0)).filter(
-            and_(
-                Income.date >= start_date, 
-                Income.date <= end_date,
-                or_(
-                    Income.route_id.is_(None),  # Receitas sem rota (gerais)
-                    Income.route_id.in_(  # Ou receitas de rotas finalizadas
-                        db.query(Route.id).filter(Route.status == 'finalized')
-                    )
-                )
-            )
-        ).scalar() or 0.0
-
-        # Despesas que NÃO têm route_id (extras gerais) OU que pertencem a rotas finalizadas
-        expense_total = db.query(func.coalesce(func.sum(Expense.amount), 0.0)).filter(
-            and_(
-                Expense.date >= start_date, 
-                Expense.date <= end_date,
-                or_(
-                    Expense.route_id.is_(None),  # Despesas sem rota (gerais)
-                    Expense.route_id.in_(  # Ou despesas de rotas finalizadas
-                        db.query(Route.id).filter(Route.status == 'finalized')
-                    )
-                )
-            )
-        ).scalar() or 0.0
-
-        # Quebra por tipo de despesa - APENAS DE ROTAS FINALIZADAS
-        expense_rows = db.query(Expense.type, func.coalesce(func.sum(Expense.amount), 0.0)).filter(
-            and_(
-                Expense.date >= start_date, 
-                Expense.date <= end_date,
-                or_(
-                    Expense.route_id.is_(None),
-                    Expense.route_id.in_(
-                        db.query(Route.id).filter(Route.status == 'finalized')
-                    )
-                )
-            )
-        ).group_by(Expense.type).all()
-        expense_breakdown = {t: float(v or 0.0) for (t, v) in expense_rows}
-
-        # KM total
-        km_total = db.query(func.coalesce(func.sum(Mileage.km_total), 0.0)).filter(
-            and_(Mileage.date >= start_date, Mileage.date <= end_date)
-        ).scalar() or 0.0
-
-        # Rotas
-        routes_completed = db.query(func.count(Route.id)).filter(
-            and_(Route.completed_at.isnot(None), func.date(Route.completed_at) >= start_date, func.date(Route.completed_at) <= end_date)
-        ).scalar() or 0
-        routes_finalized = db.query(func.count(Route.id)).filter(
-            and_(Route.finalized_at.isnot(None), func.date(Route.finalized_at) >= start_date, func.date(Route.finalized_at) <= end_date)
-        ).scalar() or 0
-
-        # Entregas e insucessos por DeliveryProof no período (distintos por pacote)
-        delivered_count = db.query(func.count(distinct(DeliveryProof.package_id))).join(Package, Package.id == DeliveryProof.package_id).filter(
-            and_(func.date(DeliveryProof.timestamp) >= start_date, func.date(DeliveryProof.timestamp) <= end_date, Package.status == 'delivered')
-        ).scalar() or 0
-        failed_count = db.query(func.count(distinct(DeliveryProof.package_id))).join(Package, Package.id == DeliveryProof.package_id).filter(
-            and_(func.date(DeliveryProof.timestamp) >= start_date, func.date(DeliveryProof.timestamp) <= end_date, Package.status == 'failed')
-        ).scalar() or 0
-
-        total_income = float(income_total)
-        total_expense = float(expense_total)
-        profit = total_income - total_expense
-        total_deliveries = delivered_count + failed_count
-        success_rate = (delivered_count / total_deliveries * 100.0) if total_deliveries > 0 else 0.0
-        avg_income_per_route = (total_income / routes_completed) if routes_completed else 0.0
-        avg_expense_per_route = (total_expense / routes_completed) if routes_completed else 0.0
-
-        return {
-            "period": {"start": str(start_date), "end": str(end_date)},
-            "income_total": round(total_income, 2),
-            "expense_total": round(total_expense, 2),
-            "profit": round(profit, 2),
-            "expense_breakdown": expense_breakdown,
-            "km_total": round(float(km_total), 2),
-            "routes_completed": int(routes_completed),
-            "routes_finalized": int(routes_finalized),
-            "delivered": int(delivered_count),
-            "failed": int(failed_count),
-            "success_rate": round(success_rate, 2),
-            "avg_income_per_route": round(avg_income_per_route, 2),
-            "avg_expense_per_route": round(avg_expense_per_route, 2),
-        }
-
     def _format_report(title: str, k: dict) -> str:
         eb_items = []
         for t, v in sorted(k.get("expense_breakdown", {}).items()):
@@ -5927,7 +5985,7 @@ async def cmd_chat_ia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Descobre destino preferido: grupo/canal de análise, se configurado
     db = SessionLocal()
     try:
-        me = get_user_by_tid(db, update.effective_user.id)
+        me = cached_user(update.effective_user.id, db)
         target_chat_id = update.effective_chat.id
         redirect_notice = False
         if me and me.role == "manager" and getattr(me, 'channel_id', None):
@@ -5941,55 +5999,48 @@ async def cmd_chat_ia(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 1) Relatório semanal (atual ou passado)
         if "relatório semanal" in qlow or "relatorio semanal" in qlow or "semanal" in qlow:
             last = ("passada" in qlow) or ("anterior" in qlow)
-            start, end = _week_range(now, offset_weeks=-1 if last else 0)
-            k = _kpis(db, start, end)
+            k = (await _shared_kpis([week_period(now, -1 if last else 0)]))[0]
             report = _format_report("📊 Relatório Semanal", k)
             await context.bot.send_message(chat_id=target_chat_id, text=report, parse_mode='HTML')
             return
 
         # 2) Comparação entre semanas (atual vs passada)
         if "comparação entre semanas" in qlow or "comparacao entre semanas" in qlow or "comparar semanas" in qlow:
-            a_start, a_end = _week_range(now, 0)
-            b_start, b_end = _week_range(now, -1)
-            a = _kpis(db, a_start, a_end)
-            b = _kpis(db, b_start, b_end)
+            a, b = await _shared_kpis([week_period(now, 0), week_period(now, -1)])
             comp = _format_compare("📈 Comparação: Semana Atual vs Semana Passada", "Semana Atual", a, "Semana Passada", b)
             await context.bot.send_message(chat_id=target_chat_id, text=comp, parse_mode='HTML')
             return
 
         # 3) Comparação entre meses (atual vs anterior)
         if "comparação entre meses" in qlow or "comparacao entre meses" in qlow or "comparar meses" in qlow:
-            a_start, a_end = _month_range(now, 0)
-            b_start, b_end = _month_range(now, -1)
-            a = _kpis(db, a_start, a_end)
-            b = _kpis(db, b_start, b_end)
+            a, b = await _shared_kpis([month_period(now, 0), month_period(now, -1)])
             comp = _format_compare("📈 Comparação: Mês Atual vs Mês Anterior", "Mês Atual", a, "Mês Anterior", b)
             await context.bot.send_message(chat_id=target_chat_id, text=comp, parse_mode='HTML')
             return
 
         # 4) Conselho/Opinião com base nos números (usa IA com KPIs como contexto)
         # KPIs recentes (mês atual, mês anterior, últimas 4 semanas)
-        if not groq_client or not ai_model_name:
+        if not ai_gateway.available:
             await update.message.reply_text(
                 "⚠️ IA indisponível para aconselhamento. Configure GROQ_API_KEY.",
                 parse_mode='Markdown'
             )
             return
 
-        cm_start, cm_end = _month_range(now, 0)
-        pm_start, pm_end = _month_range(now, -1)
-        cw_start, cw_end = _week_range(now, 0)
-        pw_start, pw_end = _week_range(now, -1)
-        k_curr_month = _kpis(db, cm_start, cm_end)
-        k_prev_month = _kpis(db, pm_start, pm_end)
-        k_curr_week = _kpis(db, cw_start, cw_end)
-        k_prev_week = _kpis(db, pw_start, pw_end)
+        # Os quatro períodos: snapshot noturno (precompute.py) ou uma única consulta ao resumo diário
+        k_curr_month, k_prev_month, k_curr_week, k_prev_week = await _shared_kpis([
+            month_period(now, 0), month_period(now, -1), week_period(now, 0), week_period(now, -1),
+        ])
 
         context_blob = {
             "current_month": k_curr_month,
             "previous_month": k_prev_month,
             "current_week": k_curr_week,
             "previous_week": k_prev_week,
+            "drivers_current_month": [
+                {key: d[key] for key in ("name", "routes", "packages", "delivered", "failed", "success_rate")}
+                for d in driver_performance(db, month_period(now, 0))
+            ],
         }
 
         sys = (
@@ -6018,18 +6069,42 @@ async def cmd_chat_ia(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"- Se for sobre contratar, calcule viabilidade (custo vs receita extra esperada).\n"
             f"- Se for sobre despesas, sugira otimizações realistas para o contexto local."
         )
+        # Mesma pergunta com os mesmos números → mesmo parecer (sem nova chamada à IA)
+        advice_key = (" ".join(qlow.split()), fingerprint(context_blob))
+        cached_advice = _get_cached_advice(advice_key)
+        ai_messages = [
+            {"role": "system", "content": sys},
+            {"role": "user", "content": usr},
+        ]
+        writer = None
         try:
-            resp = groq_client.chat.completions.create(
-                model=ai_model_name,
-                messages=[
-                    {"role": "system", "content": sys},
-                    {"role": "user", "content": usr},
-                ],
-                temperature=0.3,
-                max_tokens=1500,
-            )
-            raw = (resp.choices[0].message.content or "").strip()
+            if cached_advice is not None:
+                raw = cached_advice
+            else:
+                if _AI_STREAMING:
+                    # Parecer aparece enquanto a IA escreve; formatação HTML entra no final
+                    writer = TelegramStreamWriter(
+                        context.bot, target_chat_id,
+                        prefix=f"🧮 Parecer Financeiro\n{question}\n\n",
+                        fallback_chat_id=update.effective_chat.id,
+                    )
+
+                async def generate_advice() -> str:
+                    if writer is not None:
+                        text = await writer.consume(ai_gateway.stream(
+                            ai_messages, temperature=0.3, max_tokens=1500, label="chat_ia",
+                        ))
+                    else:
+                        text = (await ai_gateway.complete(
+                            ai_messages, temperature=0.3, max_tokens=1500, label="chat_ia",
+                        )).text
+                    _set_cached_advice(advice_key, text.strip())
+                    return text.strip()
+
+                # Mesma pergunta repetida enquanto a IA responde → uma chamada só
+                raw = await single_flight.do(flight_key("chat_ia", advice_key[0], advice_key[1]), generate_advice)
         except Exception as e:
+            writer = None
             raw = (
                 f"⚠️ Não consegui acessar a IA agora ({e}). Segue contexto numérico:\n\n" +
                 _format_report("Mês Atual", k_curr_month) + "\n\n" +
@@ -6061,26 +6136,21 @@ async def cmd_chat_ia(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Monta mensagem final com cabeçalho e corpo
         header = f"<b>🧮 Parecer Financeiro</b>\n<i>{html.escape(question)}</i>\n"
         final_msg = header + "\n" + answer
+        plain = final_msg.replace('<b>', '').replace('</b>', '').replace('<i>', '').replace('</i>', '').replace('<code>', '').replace('</code>', '')
+        if writer is not None and writer.started:
+            await writer.finish(final_msg, parse_mode='HTML', fallback_text=html.unescape(plain))
+            return
         try:
             await context.bot.send_message(chat_id=target_chat_id, text=final_msg, parse_mode='HTML')
         except Exception as e:
             # Fallback sem formatação se HTML falhar
-            plain = final_msg.replace('<b>', '').replace('</b>', '').replace('<i>', '').replace('</i>', '').replace('<code>', '').replace('</code>', '')
             await update.message.reply_text(plain)
     finally:
         db.close()
 
 
-async def cmd_resetar_empresa(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db = SessionLocal()
-    try:
-        me = get_user_by_tid(db, update.effective_user.id)
-    finally:
-        db.close()
-    if not me or me.role != "manager":
-        await update.message.reply_text("⛔ Apenas gerentes podem resetar os dados.")
-        return ConversationHandler.END
-
+@session_handler(role="manager", denied="⛔ Apenas gerentes podem resetar os dados.")
+async def cmd_resetar_empresa(update: Update, context: ContextTypes.DEFAULT_TYPE, db, me):
     today = datetime.now().strftime('%Y-%m-%d')
     phrase = f"APAGAR TUDO {today}"
     context.user_data['reset_phrase'] = phrase
@@ -6112,13 +6182,18 @@ async def on_reset_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Apagar dados (ordem para evitar referencias)
         db.query(DeliveryProof).delete(synchronize_session=False)
         db.query(Package).delete(synchronize_session=False)
+        db.query(DeliveryProofArchive).delete(synchronize_session=False)
+        db.query(PackageArchive).delete(synchronize_session=False)
         db.query(Expense).delete(synchronize_session=False)
         db.query(Income).delete(synchronize_session=False)
         db.query(Mileage).delete(synchronize_session=False)
         db.query(AIReport).delete(synchronize_session=False)
+        db.query(DailySummary).delete(synchronize_session=False)
         db.query(LinkToken).delete(synchronize_session=False)
         db.query(Route).delete(synchronize_session=False)
         db.commit()
+        clear_driver_performance_cache()
+        report_cache.clear()
     except Exception as e:
         db.rollback()
         await update.message.reply_text(f"❌ Erro ao limpar dados: {e}")
@@ -6157,11 +6232,26 @@ async def _post_init(application):
         print(f"⚠️ Falha ao remover webhook no startup: {e}")
 
 
+async def _post_shutdown(application):
+    """Termina os recálculos do resumo diário agendados pelos handlers"""
+    await wait_pending_refreshes()
+
+
 def build_application():
     if not BOT_TOKEN:
         raise RuntimeError("Defina a variável de ambiente BOT_TOKEN")
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(_post_init).build()
+    run_migrations()
+    ensure_backfilled()
+    app = (
+        # user_data com validade por chave (e persistência, se configurada)
+        configure_builder(ApplicationBuilder())
+        .token(BOT_TOKEN)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        # Chats diferentes em paralelo; o mesmo chat sempre em ordem
+        .concurrent_updates(PerChatUpdateProcessor.from_env())
+        .build()
+    )
     
     # Configura todos os handlers
     setup_bot_handlers(app)
@@ -6174,11 +6264,17 @@ def setup_bot_handlers(app: Application):
     Configura os handlers do bot sem iniciar polling.
     Usado para integração com webhook no unified_app.py
     """
+    # Antes de tudo: marca atividade do usuário e varre o user_data vencido
+    app.add_handler(TypeHandler(Update, track_conversation_state), group=-1)
+    # Com CONVERSATION_STATE_DB, as conversas sobrevivem a um restart
+    persist = app.persistence is not None
     # Comandos básicos
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CallbackQueryHandler(help_callback_handler, pattern=r"^help_"))
     app.add_handler(CommandHandler("meu_id", cmd_meu_id))
     app.add_handler(CommandHandler("debug", cmd_debug))
+    app.add_handler(CommandHandler("recalcular_resumos", cmd_recalcular_resumos))
+    app.add_handler(CommandHandler("exportar", cmd_exportar))
     app.add_handler(CommandHandler("rotas", cmd_rotas))
     app.add_handler(CallbackQueryHandler(on_view_route, pattern=r"^view_route:\d+$"))
     app.add_handler(CallbackQueryHandler(on_track_view_route, pattern=r"^track_view_route:\d+$"))
@@ -6205,7 +6301,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="reset_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(reset_conv)
     app.add_handler(CallbackQueryHandler(on_view_fin_record, pattern=r"^view_fin_record:"))
@@ -6233,7 +6329,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="import_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(import_conv)
 
@@ -6245,7 +6341,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="config_channel_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(config_channel_conv)
     
@@ -6261,7 +6357,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="config_home_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(config_home_conv)
     
@@ -6283,7 +6379,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="finalize_route_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(finalize_route_conv)
     
@@ -6296,7 +6392,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="send_route_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(send_route_conv)
     
@@ -6327,7 +6423,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="delivery_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(delivery_conv)
 
@@ -6339,7 +6435,7 @@ def setup_bot_handlers(app: Application):
         },
         fallbacks=[CommandHandler("cancelar", cmd_cancelar)],
         name="add_driver_conv",
-        persistent=False,
+        persistent=persist,
     )
     app.add_handler(add_driver_conv)
     app.add_handler(CommandHandler("drivers", list_drivers))
@@ -6369,6 +6465,28 @@ def setup_bot_handlers(app: Application):
 
     app.add_error_handler(on_error)
 
+    # Atribui as queries SQL de cada callback ao handler correspondente (/debug)
+    _instrument_handlers(app)
+
+
+def _instrument_handlers(app: Application):
+    """Envolve os callbacks registrados (inclusive dentro de ConversationHandlers) com track_handler"""
+    def _wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            inner = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                inner.extend(state_handlers)
+            for h in inner:
+                _wrap(h)
+            return
+        callback = getattr(handler, "callback", None)
+        if callback and not getattr(callback, "__db_metrics_wrapped__", False):
+            handler.callback = track_handler(callback)
+
+    for group_handlers in app.handlers.values():
+        for handler in group_handlers:
+            _wrap(handler)
+
 
 # ================================================================================
 # GERENCIAMENTO DE SALÁRIOS
@@ -6441,11 +6559,12 @@ async def cmd_salarios_pendentes(update: Update, context: ContextTypes.DEFAULT_T
         
         # Botão para confirmar todos
         if len(pending_payments) > 1:
-            all_ids = ",".join(str(p.id) for p in pending_payments)
+            # Ids guardados no servidor: a lista não cabe nos 64 bytes do callback_data
+            confirm_all = store_callback(db, "confirm_salary_all", {"ids": [p.id for p in pending_payments]})
             buttons.append([
                 InlineKeyboardButton(
                     f"✅ CONFIRMAR TODOS (R$ {total_pending:.2f})",
-                    callback_data=f"confirm_salary_all:{all_ids}"
+                    callback_data=confirm_all
                 )
             ])
         
@@ -6524,31 +6643,42 @@ async def on_confirm_salary_all(update: Update, context: ContextTypes.DEFAULT_TY
             await query.edit_message_text("❌ Você não tem permissão para confirmar pagamentos.")
             return
         
-        # Extrai IDs dos pagamentos
-        ids_str = query.data.split(':')[1]
-        payment_ids = [int(x) for x in ids_str.split(',')]
-        
-        payments = db.query(SalaryPayment).filter(SalaryPayment.id.in_(payment_ids)).all()
-        
-        if not payments:
-            await query.edit_message_text("❌ Nenhum pagamento encontrado.")
-            return
+        # Ids guardados no servidor (callback_store); botões antigos trazem a lista no próprio callback_data
+        payload = load_callback(db, query.data)
+        if payload is not None:
+            payment_ids = [int(x) for x in payload.get("ids", [])]
+        else:
+            ids_str = query.data.split(':', 1)[1]
+            if not re.fullmatch(r"\d+(,\d+)*", ids_str):
+                await query.edit_message_text(
+                    "⌛ Este botão expirou.\n\nUse /salarios_pendentes para ver os pagamentos atuais."
+                )
+                return
+            payment_ids = [int(x) for x in ids_str.split(',')]
         
-        # Confirma todos os pagamentos pendentes/atrasados
-        confirmed_count = 0
-        total_amount = 0
+        # Confirma todos os pendentes/atrasados num único UPDATE ... WHERE id IN (...)
         now = datetime.now()
-        
-        for payment in payments:
-            if payment.status in ['pending', 'overdue']:
-                payment.status = 'paid'
-                payment.paid_date = now
-                payment.confirmed_by = update.effective_user.id
-                confirmed_count += 1
-                total_amount += payment.amount
-        
+        paid_amounts = db.execute(
+            sql_update(SalaryPayment)
+            .where(
+                SalaryPayment.id.in_(payment_ids),
+                SalaryPayment.status.in_(['pending', 'overdue'])
+            )
+            .values(status='paid', paid_date=now, confirmed_by=update.effective_user.id)
+            .returning(SalaryPayment.amount)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
         db.commit()
         
+        if not paid_amounts:
+            await query.edit_message_text(
+                "⚠️ Nenhum pagamento pendente nesta lista (já foram confirmados?).\n\n"
+                "Use /salarios_pendentes para ver os pagamentos atuais."
+            )
+            return
+        confirmed_count = len(paid_amounts)
+        total_amount = sum(paid_amounts)
+        
         await query.edit_message_text(
             f"✅ *Pagamentos Confirmados em Lote!*\n\n"
             f"📊 Quantidade: {confirmed_count} pagamento(s)\n"
@@ -6566,20 +6696,21 @@ async def on_confirm_salary_all(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 def main():
-    from scheduler import start_scheduler
-    
-    # Inicia o scheduler de notificações
-    scheduler = start_scheduler()
+    from scheduler import start_scheduler, stop_scheduler
     
     # Inicia o bot
     app = build_application()
+    
+    # Inicia o scheduler de notificações (e o relatório IA noturno, se ativado),
+    # enviando pelo mesmo bot da Application
+    scheduler = start_scheduler(ai_report_job=precompute_ai_report, bot=app.bot)
     print("Bot iniciado. Pressione Ctrl+C para sair.")
     
     try:
         app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
     except (KeyboardInterrupt, SystemExit):
         print("\n🛑 Encerrando bot e scheduler...")
-        scheduler.shutdown()
+        stop_scheduler(scheduler)
         print("✅ Bot encerrado com sucesso!")
 
 
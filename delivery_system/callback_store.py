@@ -0,0 +1,102 @@
+"""
+Payload de botões guardado no servidor (callback_data curto)
+
+O Telegram limita o callback_data a 64 bytes. Botões cujo payload cresce
+(ex.: "CONFIRMAR TODOS" com a lista de ids de salários) quebravam com poucos
+itens. Agora o payload vai para a tabela link_token (a mesma dos deep links
+de grupo) e o botão leva só a ação e um token curto:
+
+- store_callback(db, action, data) grava `data` com type "cb:<action>" e
+  validade de CALLBACK_TOKEN_TTL_S e devolve "<action>:<token>" (token de
+  12 caracteres, cabe com folga nos 64 bytes)
+- load_callback(db, callback_data) devolve o payload, ou None se o token não
+  existe ou já venceu
+- purge_expired_callbacks(db) apaga os tokens vencidos; roda sozinho a cada
+  store_callback, no máximo uma vez por CALLBACK_PURGE_INTERVAL_S por processo
+
+Exemplo:
+    from callback_store import store_callback, load_callback
+
+    InlineKeyboardButton("✅ Todos", callback_data=store_callback(db, "confirm_salary_all", {"ids": ids}))
+    ...
+    payload = load_callback(db, query.data)   # {"ids": [...]} ou None
+"""
+
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from database import LinkToken
+from shared.logger import logger
+
+
+CALLBACK_TOKEN_TTL_S = int(os.getenv("CALLBACK_TOKEN_TTL_S", str(7 * 24 * 3600)))
+CALLBACK_PURGE_INTERVAL_S = int(os.getenv("CALLBACK_PURGE_INTERVAL_S", "3600"))
+# Limite do Telegram para callback_data
+CALLBACK_DATA_LIMIT = 64
+# Prefixo do type em link_token (separa dos tokens de deep link)
+TYPE_PREFIX = "cb:"
+
+_purge_lock = threading.Lock()
+_last_purge = 0.0
+
+
+def store_callback(db, action: str, data: dict, ttl_s: int = CALLBACK_TOKEN_TTL_S) -> str:
+    """Grava o payload (com commit) e devolve o callback_data "<action>:<token>" """
+    _maybe_purge(db)
+    token = secrets.token_urlsafe(9)
+    callback_data = f"{action}:{token}"
+    # link_token.type tem 32 caracteres
+    if len(callback_data.encode()) > CALLBACK_DATA_LIMIT or len(TYPE_PREFIX + action) > 32:
+        raise ValueError(f"Ação longa demais para callback_data: {action!r}")
+    db.add(LinkToken(
+        token=token,
+        type=f"{TYPE_PREFIX}{action}",
+        data=data,
+        expires_at=datetime.utcnow() + timedelta(seconds=ttl_s),
+    ))
+    db.commit()
+    return callback_data
+
+
+def load_callback(db, callback_data: str) -> Optional[dict]:
+    """Payload do botão, ou None se o token não existe ou já venceu"""
+    action, sep, token = (callback_data or "").rpartition(":")
+    if not sep or not token:
+        return None
+    rec = db.query(LinkToken).filter(
+        LinkToken.token == token,
+        LinkToken.type == f"{TYPE_PREFIX}{action}",
+    ).first()
+    if rec is None or (rec.expires_at is not None and rec.expires_at < datetime.utcnow()):
+        return None
+    return rec.data
+
+
+def purge_expired_callbacks(db) -> int:
+    """Apaga os tokens vencidos. Retorna quantos apagou."""
+    deleted = db.query(LinkToken).filter(
+        LinkToken.expires_at.isnot(None),
+        LinkToken.expires_at < datetime.utcnow(),
+    ).delete(synchronize_session=False)
+    db.commit()
+    if deleted:
+        logger.info(f"[CALLBACK] {deleted} token(s) de botão vencido(s) apagado(s)")
+    return deleted
+
+
+def _maybe_purge(db) -> None:
+    global _last_purge
+    with _purge_lock:
+        now = time.monotonic()
+        if _last_purge and now - _last_purge < CALLBACK_PURGE_INTERVAL_S:
+            return
+        _last_purge = now
+    try:
+        purge_expired_callbacks(db)
+    except Exception:
+        db.rollback()
+        logger.warning("[CALLBACK] Falha ao apagar tokens vencidos", exc_info=True)
@@ -0,0 +1,377 @@
+"""
+Estado de conversa (context.user_data) com validade, limites e persistência
+
+O user_data de cada usuário só crescia: `route_brief_sent_<rota>` para toda
+rota já iniciada, importações pendentes (com todos os pacotes da planilha),
+listas da finalização e fotos em massa. Quase nada era removido fora dos
+caminhos de sucesso, então a memória crescia com cada motorista e rota.
+
+- ConversationState: o dict usado como user_data (via ContextTypes). Guarda
+  quando cada chave foi gravada, sem mudar o código dos handlers
+- Validade por chave (_KEY_POLICIES): conta desde a gravação (ex.: resumo de
+  rota já enviado, 24h) ou desde a última mensagem do usuário (fluxos em
+  andamento; ninguém perde o estado no meio de uma entrega)
+- Varredura: a cada mensagem, no máximo uma vez por
+  CONVERSATION_SWEEP_INTERVAL_S, remove chaves vencidas de todos os usuários
+  e descarta usuários sem estado e inativos
+- Limite de listas: MASS_PHOTOS_MAX fotos por entrega em massa
+- Métricas: usuários, chaves, bytes (tamanho serializado) e varreduras
+  (/metrics/conversations e /debug)
+- Persistência opcional (CONVERSATION_STATE_DB): user_data e estado das
+  conversas num arquivo SQLite; um restart não perde entregas em andamento
+
+Exemplo:
+    builder = configure_builder(Application.builder().token(BOT_TOKEN))
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, track_conversation_state), group=-1)
+"""
+
+import asyncio
+import json
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, ContextTypes, PersistenceInput
+
+from shared.logger import logger
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+# Chaves sem regra própria vencem após N s sem mensagens do usuário
+CONVERSATION_TTL_S = float(os.getenv("CONVERSATION_TTL_S", str(6 * 3600)))
+CONVERSATION_SWEEP_INTERVAL_S = float(os.getenv("CONVERSATION_SWEEP_INTERVAL_S", "300"))
+# Arquivo SQLite para persistir o estado (vazio = só em memória)
+CONVERSATION_STATE_DB = os.getenv("CONVERSATION_STATE_DB", "")
+# Fotos por entrega em massa
+MASS_PHOTOS_MAX = int(os.getenv("MASS_PHOTOS_MAX", "50"))
+
+# (prefixo da chave, validade em s, conta desde a última mensagem do usuário?)
+_KEY_POLICIES: Tuple[Tuple[str, float, bool], ...] = (
+    ("route_brief_sent_", 24 * 3600, False),
+    ("pending_import", 30 * 60, True),
+)
+
+_last_sweep = 0.0
+_counters = {"sweeps": 0, "expired_keys": 0, "dropped_users": 0, "last_sweep_ms": 0.0}
+
+
+def _key_policy(key) -> Tuple[float, bool]:
+    if isinstance(key, str):
+        for prefix, ttl_s, sliding in _KEY_POLICIES:
+            if key.startswith(prefix):
+                return ttl_s, sliding
+    return CONVERSATION_TTL_S, True
+
+
+class ConversationState(dict):
+    """user_data que registra a hora de gravação de cada chave"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._written: Dict[object, float] = {}
+        self.last_seen = time.time()
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        # O pickle padrão de subclasse de dict grava os itens antes do __dict__
+        return _restore_state, (dict(self), dict(self._written), self.last_seen)
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self._written[key] = time.time()
+
+    def __delitem__(self, key) -> None:
+        super().__delitem__(key)
+        self._written.pop(key, None)
+
+    def pop(self, key, *default):
+        self._written.pop(key, None)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._written.pop(key, None)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        super().clear()
+        self._written.clear()
+
+    def touch(self) -> None:
+        """Marca atividade do usuário (renova as chaves que contam desde a última mensagem)"""
+        self.last_seen = time.time()
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Remove as chaves vencidas. Retorna quantas removeu."""
+        now = now or time.time()
+        expired = []
+        for key in list(self):
+            ttl_s, sliding = _key_policy(key)
+            since = self._written.setdefault(key, now)
+            if sliding:
+                since = max(since, self.last_seen)
+            if now - since > ttl_s:
+                expired.append(key)
+        for key in expired:
+            del self[key]
+        return len(expired)
+
+    def size_bytes(self) -> int:
+        try:
+            return len(pickle.dumps(dict(self), pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return sys.getsizeof(self) + sum(sys.getsizeof(v) for v in self.values())
+
+
+def _restore_state(items: dict, written: dict, last_seen: float) -> ConversationState:
+    state = ConversationState()
+    dict.update(state, items)
+    state._written = written
+    state.last_seen = last_seen
+    return state
+
+
+# ═══════════════════════════════════════════════════════════
+# VARREDURA E MÉTRICAS
+# ═══════════════════════════════════════════════════════════
+
+def sweep_user_data(application) -> dict:
+    """Remove chaves vencidas de todos os usuários e descarta os vazios e inativos"""
+    start = time.perf_counter()
+    now = time.time()
+    expired_keys = 0
+    changed, dropped = [], []
+    for user_id, data in list(application.user_data.items()):
+        if not isinstance(data, ConversationState):
+            continue
+        removed = data.sweep(now)
+        if removed:
+            expired_keys += removed
+            changed.append(user_id)
+        if not data and now - data.last_seen > CONVERSATION_TTL_S:
+            dropped.append(user_id)
+
+    for user_id in dropped:
+        application.drop_user_data(user_id)
+    if application.persistence is not None and changed:
+        application.mark_data_for_update_persistence(
+            user_ids=[uid for uid in changed if uid not in dropped]
+        )
+
+    duration_ms = (time.perf_counter() - start) * 1000
+    _counters["sweeps"] += 1
+    _counters["expired_keys"] += expired_keys
+    _counters["dropped_users"] += len(dropped)
+    _counters["last_sweep_ms"] = round(duration_ms, 1)
+    if expired_keys or dropped:
+        logger.info(
+            f"[STATE] Varredura: {expired_keys} chave(s) vencida(s), "
+            f"{len(dropped)} usuário(s) descartado(s) em {duration_ms:.0f}ms"
+        )
+    return {"expired_keys": expired_keys, "dropped_users": len(dropped)}
+
+
+def maybe_sweep(application) -> None:
+    global _last_sweep
+    now = time.monotonic()
+    if _last_sweep and now - _last_sweep < CONVERSATION_SWEEP_INTERVAL_S:
+        return
+    _last_sweep = now
+    try:
+        sweep_user_data(application)
+    except Exception:
+        logger.warning("[STATE] Falha na varredura do user_data", exc_info=True)
+
+
+async def track_conversation_state(update, context) -> None:
+    """Handler (grupo -1): marca atividade do usuário e dispara a varredura periódica"""
+    if update.effective_user is not None and isinstance(context.user_data, ConversationState):
+        context.user_data.touch()
+    maybe_sweep(context.application)
+
+
+def _key_family(key) -> str:
+    # route_brief_sent_123 → route_brief_sent_*
+    return re.sub(r"\d+$", "*", str(key))
+
+
+def conversation_metrics(application, reset: bool = False) -> dict:
+    """Tamanho do user_data deste processo (bytes = tamanho serializado)"""
+    sizes = []
+    families = Counter()
+    for data in list(application.user_data.values()):
+        sizes.append(data.size_bytes() if isinstance(data, ConversationState) else sys.getsizeof(data))
+        families.update(_key_family(key) for key in data)
+    result = {
+        "users": len(sizes),
+        "keys": sum(families.values()),
+        "bytes": sum(sizes),
+        "largest_user_bytes": max(sizes, default=0),
+        "top_keys": dict(families.most_common(10)),
+        "ttl_s": CONVERSATION_TTL_S,
+        "persistence": CONVERSATION_STATE_DB or None,
+        **_counters,
+    }
+    if reset:
+        _counters.update(sweeps=0, expired_keys=0, dropped_users=0, last_sweep_ms=0.0)
+    return result
+
+
+# ═══════════════════════════════════════════════════════════
+# PERSISTÊNCIA (SQLite)
+# ═══════════════════════════════════════════════════════════
+
+class SQLitePersistence(BasePersistence):
+    """
+    Guarda user_data e o estado das ConversationHandler persistentes num
+    arquivo SQLite local (um por instância). A Application grava as mudanças
+    a cada update_interval segundos e ao desligar.
+    """
+
+    def __init__(self, path: str, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_state ("
+                "user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversation_state ("
+                "name TEXT NOT NULL, conv_key TEXT NOT NULL, state BLOB NOT NULL, "
+                "PRIMARY KEY (name, conv_key))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    # user_data ─────────────────────────────────────────────
+
+    async def get_user_data(self) -> Dict[int, ConversationState]:
+        rows = await asyncio.to_thread(self._execute, "SELECT user_id, data FROM user_state")
+        result = {}
+        for user_id, blob in rows:
+            try:
+                data = pickle.loads(blob)
+            except Exception:
+                logger.warning(f"[STATE] user_data ilegível do usuário {user_id}; ignorado")
+                continue
+            if not isinstance(data, ConversationState):
+                data = ConversationState(data)
+            data.sweep()
+            result[user_id] = data
+        logger.info(f"[STATE] user_data de {len(result)} usuário(s) restaurado de {self.path}")
+        return result
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        try:
+            blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.warning(f"[STATE] user_data do usuário {user_id} não serializável; não persistido",
+                           exc_info=True)
+            return
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (user_id, blob, time.time()),
+        )
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        pass
+
+    # conversas ─────────────────────────────────────────────
+
+    async def get_conversations(self, name: str) -> Dict:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT conv_key, state FROM conversation_state WHERE name = ?", (name,)
+        )
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        conv_key = json.dumps(list(key))
+        if new_state is None:
+            await asyncio.to_thread(
+                self._execute,
+                "DELETE FROM conversation_state WHERE name = ? AND conv_key = ?", (name, conv_key),
+            )
+            return
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO conversation_state (name, conv_key, state) VALUES (?, ?, ?) "
+            "ON CONFLICT(name, conv_key) DO UPDATE SET state = excluded.state",
+            (name, conv_key, pickle.dumps(new_state)),
+        )
+
+    # não persistidos (store_data desativa) ─────────────────
+
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+
+def configure_builder(builder):
+    """user_data como ConversationState e, se configurado, persistência em SQLite"""
+    builder = builder.context_types(ContextTypes(user_data=ConversationState))
+    if CONVERSATION_STATE_DB:
+        builder = builder.persistence(SQLitePersistence(CONVERSATION_STATE_DB))
+    return builder
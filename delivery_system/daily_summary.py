@@ -0,0 +1,556 @@
+"""
+Resumo diário materializado (tabela daily_summary)
+
+Os relatórios (/relatorio, /chat_ia e /meus_registros) somam poucas linhas
+desta tabela em vez de varrer income, expense, mileage, route, package e
+delivery_proof a cada chamada.
+
+Manutenção:
+- Eventos (importação, atribuição, entrega, falha, finalização, exclusões)
+  chamam refresh_routes()/refresh_days(), que recalculam apenas os dias
+  afetados. Handlers async usam schedule_refresh(): o recálculo roda numa
+  thread, fora do event loop, e pedidos próximos viram um só.
+- A gravação é um upsert pela chave (scope, scope_id, day): recálculos
+  simultâneos do mesmo dia não conflitam, e um recálculo mais antigo
+  (updated_at menor) não sobrescreve um mais novo.
+- backfill() recalcula todo o histórico (comando /recalcular_resumos ou
+  `python daily_summary.py`).
+- Pacotes e comprovantes arquivados (archival.py) entram no cálculo como
+  os ativos, então arquivar não altera o resumo.
+- data_version() muda a cada recálculo (contador na tabela data_version,
+  visto por todos os processos); leitores com cache (ex.:
+  driver_performance.py) usam o número na chave. O cache de relatórios
+  (shared/report_cache.py) perde as entradas dos meses recalculados e os
+  snapshots noturnos (precompute.py) que cobrem os dias recalculados são
+  apagados na mesma transação.
+
+Uso:
+    python daily_summary.py                 # recalcula todo o histórico
+    python daily_summary.py 2025-01-01      # recalcula a partir da data
+"""
+
+import asyncio
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import Date, Integer, and_, delete, distinct, func, literal, select, union_all
+
+from database import (
+    SessionLocal, DailySummary, ReportSnapshot, Income, Expense, Mileage, Route, Package, DeliveryProof,
+    PackageArchive, DeliveryProofArchive, bump_data_version, read_data_versions,
+)
+from shared.logger import logger
+from shared.periods import Period, in_period
+from shared.report_cache import month_tag, report_cache
+
+
+COMPANY = "company"
+DRIVER = "driver"
+CREATOR = "creator"
+
+# Campos numéricos somados nos relatórios
+NUMERIC_FIELDS = (
+    "revenue", "revenue_count", "expenses", "expense_count",
+    "revenue_finalized", "expenses_finalized", "km", "mileage_count",
+    "routes_created", "packages_total", "packages_delivered", "packages_failed",
+    "routes_completed", "routes_finalized", "deliveries", "failures",
+)
+
+# Quantos dias são recalculados por transação no backfill
+BACKFILL_CHUNK_DAYS = 31
+
+# Pacotes/comprovantes ativos e arquivados (archival.py) entram igualmente no resumo
+PACKAGE_SOURCES = ((Package, DeliveryProof), (PackageArchive, DeliveryProofArchive))
+
+# Linhas por INSERT no upsert
+UPSERT_BATCH_SIZE = 500
+
+# Contador em data_version (banco) incrementado a cada recálculo gravado
+VERSION_NAME = "daily_summary"
+# Um recálculo gravando por vez neste processo (threads da API + bot)
+_write_lock = threading.Lock()
+
+# Pedidos de recálculo dos handlers async (schedule_refresh), juntados
+_pending_routes: Set[int] = set()
+_pending_days: Set[date] = set()
+_refresh_task: Optional[asyncio.Task] = None
+
+
+def _empty() -> dict:
+    values = {field: 0 for field in NUMERIC_FIELDS}
+    values["expenses_by_type"] = {}
+    return values
+
+
+def _as_date(value) -> Optional[date]:
+    """func.date() devolve str no SQLite e date no Postgres"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+# ═══════════════════════════════════════════════════════════
+# CÁLCULO A PARTIR DAS TABELAS DE ORIGEM
+# ═══════════════════════════════════════════════════════════
+
+def _compute(db, period: Period) -> Dict[Tuple[str, int, date], dict]:
+    """Recalcula as linhas do período agrupando por dia nas tabelas de origem"""
+    rows: Dict[Tuple[str, int, date], dict] = defaultdict(_empty)
+
+    def targets(day, driver_id=None, creator_id=None):
+        keys = [(COMPANY, 0, day)]
+        if driver_id is not None:
+            keys.append((DRIVER, driver_id, day))
+        if creator_id is not None:
+            keys.append((CREATOR, creator_id, day))
+        return [rows[k] for k in keys]
+
+    # 1. Receitas (status da rota define se entra no financeiro "finalizado")
+    incomes = (
+        db.query(Income.date, Income.created_by, Income.route_id, Route.assigned_to_id, Route.status,
+                 func.sum(Income.amount), func.count(Income.id))
+        .outerjoin(Route, Route.id == Income.route_id)
+        .filter(in_period(Income.date, period))
+        .group_by(Income.date, Income.created_by, Income.route_id, Route.assigned_to_id, Route.status)
+        .all()
+    )
+    for day, creator_id, route_id, driver_id, route_status, amount, count in incomes:
+        finalized = route_id is None or route_status == "finalized"
+        for r in targets(_as_date(day), driver_id, creator_id):
+            r["revenue"] += float(amount or 0)
+            r["revenue_count"] += count
+            if finalized:
+                r["revenue_finalized"] += float(amount or 0)
+
+    # 2. Despesas (com quebra por tipo no financeiro "finalizado")
+    expenses = (
+        db.query(Expense.date, Expense.type, Expense.created_by, Expense.route_id, Route.assigned_to_id,
+                 Route.status, func.sum(Expense.amount), func.count(Expense.id))
+        .outerjoin(Route, Route.id == Expense.route_id)
+        .filter(in_period(Expense.date, period))
+        .group_by(Expense.date, Expense.type, Expense.created_by, Expense.route_id,
+                  Route.assigned_to_id, Route.status)
+        .all()
+    )
+    for day, exp_type, creator_id, route_id, driver_id, route_status, amount, count in expenses:
+        finalized = route_id is None or route_status == "finalized"
+        for r in targets(_as_date(day), driver_id, creator_id):
+            r["expenses"] += float(amount or 0)
+            r["expense_count"] += count
+            if finalized:
+                r["expenses_finalized"] += float(amount or 0)
+                by_type = r["expenses_by_type"]
+                by_type[exp_type] = by_type.get(exp_type, 0.0) + float(amount or 0)
+
+    # 3. Quilometragem
+    mileage = (
+        db.query(Mileage.date, Mileage.created_by, func.sum(Mileage.km_total), func.count(Mileage.id))
+        .filter(in_period(Mileage.date, period))
+        .group_by(Mileage.date, Mileage.created_by)
+        .all()
+    )
+    for day, creator_id, km, count in mileage:
+        for r in targets(_as_date(day), creator_id=creator_id):
+            r["km"] += float(km or 0)
+            r["mileage_count"] += count
+
+    # 4. Rotas criadas e seus pacotes
+    created_day = func.date(Route.created_at)
+    routes_created = (
+        db.query(created_day, Route.assigned_to_id, func.count(Route.id))
+        .filter(in_period(Route.created_at, period))
+        .group_by(created_day, Route.assigned_to_id)
+        .all()
+    )
+    for day, driver_id, count in routes_created:
+        for r in targets(_as_date(day), driver_id):
+            r["routes_created"] += count
+
+    for package_model, _ in PACKAGE_SOURCES:
+        packages = (
+            db.query(created_day, Route.assigned_to_id, package_model.status, func.count(package_model.id))
+            .join(Route, Route.id == package_model.route_id)
+            .filter(in_period(Route.created_at, period))
+            .group_by(created_day, Route.assigned_to_id, package_model.status)
+            .all()
+        )
+        for day, driver_id, status, count in packages:
+            for r in targets(_as_date(day), driver_id):
+                r["packages_total"] += count
+                if status == "delivered":
+                    r["packages_delivered"] += count
+                elif status == "failed":
+                    r["packages_failed"] += count
+
+    # 5. Rotas concluídas / finalizadas no dia
+    for column, field in ((Route.completed_at, "routes_completed"), (Route.finalized_at, "routes_finalized")):
+        event_day = func.date(column)
+        for day, driver_id, count in (
+            db.query(event_day, Route.assigned_to_id, func.count(Route.id))
+            .filter(in_period(column, period))
+            .group_by(event_day, Route.assigned_to_id)
+            .all()
+        ):
+            for r in targets(_as_date(day), driver_id):
+                r[field] += count
+
+    # 6. Entregas e insucessos (pacotes distintos com prova no dia, pelo status atual)
+    for package_model, proof_model in PACKAGE_SOURCES:
+        proof_day = func.date(proof_model.timestamp)
+        base = (
+            in_period(proof_model.timestamp, period),
+            package_model.status.in_(("delivered", "failed")),
+        )
+        company_proofs = (
+            db.query(proof_day, package_model.status, func.count(distinct(proof_model.package_id)))
+            .join(package_model, package_model.id == proof_model.package_id)
+            .filter(*base)
+            .group_by(proof_day, package_model.status)
+            .all()
+        )
+        driver_proofs = (
+            db.query(proof_day, proof_model.driver_id, package_model.status,
+                     func.count(distinct(proof_model.package_id)))
+            .join(package_model, package_model.id == proof_model.package_id)
+            .filter(*base)
+            .group_by(proof_day, proof_model.driver_id, package_model.status)
+            .all()
+        )
+        for day, status, count in company_proofs:
+            rows[(COMPANY, 0, _as_date(day))]["deliveries" if status == "delivered" else "failures"] += count
+        for day, driver_id, status, count in driver_proofs:
+            if driver_id is None:
+                continue
+            rows[(DRIVER, driver_id, _as_date(day))]["deliveries" if status == "delivered" else "failures"] += count
+
+    return rows
+
+
+def _upsert_rows(db, values: List[dict]) -> None:
+    """
+    INSERT ... ON CONFLICT (scope, scope_id, day) DO UPDATE, em lotes.
+    Nunca substitui uma linha com updated_at mais novo: um recálculo que leu
+    as tabelas antes (outra réplica) não desfaz o de um recálculo posterior.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        db.add_all([DailySummary(**v) for v in values])
+        return
+    for i in range(0, len(values), UPSERT_BATCH_SIZE):
+        stmt = insert(DailySummary).values(values[i:i + UPSERT_BATCH_SIZE])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["scope", "scope_id", "day"],
+            set_={name: stmt.excluded[name] for name in values[0] if name not in ("scope", "scope_id", "day")},
+            where=DailySummary.updated_at <= stmt.excluded.updated_at,
+        )
+        db.execute(stmt)
+
+
+def _replace_period(db, period: Period) -> int:
+    """
+    Substitui as linhas do período pelo recálculo (uma transação).
+
+    Upsert pela chave única (scope, scope_id, day) e depois remoção das linhas
+    do período que não foram regravadas: dois recálculos simultâneos do mesmo
+    dia (outra réplica, ou a API e o bot) não esbarram na chave única nem
+    apagam as linhas um do outro no meio do caminho.
+
+    Cálculo e carimbo de tempo ficam dentro do _write_lock: neste processo,
+    quem leu as tabelas depois também grava depois. Entre processos, o
+    upsert não regrava linhas com updated_at mais novo.
+    """
+    with _write_lock:
+        now = datetime.utcnow()
+        rows = _compute(db, period)
+        # Versão primeiro: trava o contador antes de apagar os snapshots; quem
+        # grava snapshots (precompute.py) confere a versão na própria transação
+        bump_data_version(db, VERSION_NAME)
+        if rows:
+            _upsert_rows(db, [
+                {"day": day, "scope": scope, "scope_id": scope_id, "updated_at": now, **values}
+                for (scope, scope_id, day), values in rows.items()
+            ])
+        db.execute(delete(DailySummary).where(
+            in_period(DailySummary.day, period),
+            DailySummary.updated_at < now,
+        ))
+        # Snapshots pré-calculados que cobrem algum dia do período ficam velhos
+        db.execute(delete(ReportSnapshot).where(
+            ReportSnapshot.period_start < period.end,
+            ReportSnapshot.period_end > period.start,
+        ))
+        db.commit()
+    report_cache.invalidate(*_month_tags(period))
+    return len(rows)
+
+
+def _month_tags(period: Period) -> List[str]:
+    """Tags de cache dos meses que o período toca"""
+    tags = []
+    year, month = period.start.year, period.start.month
+    last = period.last_day
+    while (year, month) <= (last.year, last.month):
+        tags.append(month_tag(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return tags
+
+
+def data_version(db=None, for_update: bool = False) -> int:
+    """
+    Versão atual do resumo: muda sempre que alguma linha é recalculada, por
+    qualquer processo (fica na tabela data_version).
+    for_update: trava o contador até o commit de quem chama (precompute.py)
+    """
+    if db is not None:
+        return read_data_versions(db, VERSION_NAME, for_update=for_update)[0]
+    session = SessionLocal()
+    try:
+        return read_data_versions(session, VERSION_NAME)[0]
+    finally:
+        session.close()
+
+
+# ═══════════════════════════════════════════════════════════
+# ATUALIZAÇÃO INCREMENTAL (chamada pelos eventos)
+# ═══════════════════════════════════════════════════════════
+
+def route_days(db, route_ids: Iterable[int]) -> Set[date]:
+    """Dias cujas linhas dependem das rotas informadas (criação, eventos, finanças e provas)"""
+    ids = [rid for rid in set(route_ids) if rid is not None]
+    if not ids:
+        return set()
+
+    days: Set[date] = set()
+    for created_at, completed_at, finalized_at in (
+        db.query(Route.created_at, Route.completed_at, Route.finalized_at).filter(Route.id.in_(ids)).all()
+    ):
+        days.update(d.date() for d in (created_at, completed_at, finalized_at) if d)
+
+    for model in (Income, Expense):
+        days.update(d for (d,) in db.query(model.date).filter(model.route_id.in_(ids)).distinct().all())
+
+    for package_model, proof_model in PACKAGE_SOURCES:
+        days.update(
+            _as_date(d) for (d,) in (
+                db.query(func.date(proof_model.timestamp).label("day"))
+                .join(package_model, package_model.id == proof_model.package_id)
+                .filter(package_model.route_id.in_(ids))
+                .distinct()
+                .all()
+            )
+        )
+    days.discard(None)
+    return days
+
+
+def refresh_days(days: Iterable[Optional[date]]) -> None:
+    """Recalcula os dias informados. Nunca propaga erro para o fluxo que chamou."""
+    days = sorted({_as_date(d) for d in days if d is not None})
+    if not days:
+        return
+    db = SessionLocal()
+    try:
+        _replace_period(db, Period(days[0], days[-1] + timedelta(days=1)))
+    except Exception:
+        db.rollback()
+        logger.error(f"Falha ao atualizar daily_summary ({days[0]} a {days[-1]})", exc_info=True)
+    finally:
+        db.close()
+
+
+def refresh_routes(route_ids: Iterable[int], extra_days: Iterable[Optional[date]] = ()) -> None:
+    """Recalcula todos os dias ligados às rotas (+ dias extras, ex.: hoje ou dias de uma rota já excluída)"""
+    db = SessionLocal()
+    try:
+        days = route_days(db, route_ids)
+    except Exception:
+        logger.error("Falha ao levantar dias das rotas para o daily_summary", exc_info=True)
+        days = set()
+    finally:
+        db.close()
+    refresh_days(days | {_as_date(d) for d in extra_days if d is not None})
+
+
+def schedule_refresh(route_ids: Iterable[int] = (), days: Iterable[Optional[date]] = ()) -> None:
+    """
+    Versão para handlers async: agenda o recálculo numa thread e volta na hora.
+    Pedidos que chegam enquanto um recálculo roda são juntados no próximo.
+    Os ids/dias são lidos agora (pode receber um generator de uma query aberta).
+    """
+    global _refresh_task
+    _pending_routes.update(rid for rid in route_ids if rid is not None)
+    _pending_days.update(_as_date(d) for d in days if d is not None)
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.get_running_loop().create_task(_drain_refreshes())
+
+
+async def _drain_refreshes() -> None:
+    while _pending_routes or _pending_days:
+        route_ids, days = set(_pending_routes), set(_pending_days)
+        _pending_routes.clear()
+        _pending_days.clear()
+        await asyncio.to_thread(refresh_routes, route_ids, days)
+
+
+async def wait_pending_refreshes() -> None:
+    """Espera os recálculos agendados (desligamento do bot)"""
+    if _refresh_task is not None and not _refresh_task.done():
+        await _refresh_task
+
+
+# ═══════════════════════════════════════════════════════════
+# BACKFILL
+# ═══════════════════════════════════════════════════════════
+
+def _first_day(db) -> Optional[date]:
+    candidates = [
+        db.query(func.min(Income.date)).scalar(),
+        db.query(func.min(Expense.date)).scalar(),
+        db.query(func.min(Mileage.date)).scalar(),
+        db.query(func.min(Route.created_at)).scalar(),
+        db.query(func.min(DeliveryProof.timestamp)).scalar(),
+        db.query(func.min(DeliveryProofArchive.timestamp)).scalar(),
+    ]
+    days = [_as_date(c) for c in candidates if c is not None]
+    return min(days) if days else None
+
+
+def backfill(start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """
+    Recalcula o resumo de [start, end] (padrão: todo o histórico até hoje),
+    em blocos de BACKFILL_CHUNK_DAYS dias. Retorna quantas linhas foram gravadas.
+    """
+    db = SessionLocal()
+    try:
+        start = start or _first_day(db)
+        if start is None:
+            return 0
+        end = (end or date.today()) + timedelta(days=1)
+        written = 0
+        chunk_start = start
+        while chunk_start < end:
+            chunk_end = min(chunk_start + timedelta(days=BACKFILL_CHUNK_DAYS), end)
+            written += _replace_period(db, Period(chunk_start, chunk_end))
+            chunk_start = chunk_end
+        logger.info(f"daily_summary recalculado de {start} a {end - timedelta(days=1)}: {written} linhas")
+        return written
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def ensure_backfilled() -> None:
+    """Popula o resumo na primeira execução (tabela vazia com dados existentes)"""
+    db = SessionLocal()
+    try:
+        if db.query(DailySummary.id).first() is not None:
+            return
+    finally:
+        db.close()
+    try:
+        backfill()
+    except Exception:
+        logger.error("Falha no backfill inicial do daily_summary", exc_info=True)
+
+
+# ═══════════════════════════════════════════════════════════
+# LEITURA (relatórios)
+# ═══════════════════════════════════════════════════════════
+
+def _accumulate(total: dict, row: DailySummary) -> None:
+    for field in NUMERIC_FIELDS:
+        total[field] += getattr(row, field) or 0
+    for exp_type, amount in (row.expenses_by_type or {}).items():
+        total["expenses_by_type"][exp_type] = total["expenses_by_type"].get(exp_type, 0.0) + amount
+
+
+def summarize(db, period: Period, scope: str = COMPANY, scope_id: int = 0) -> dict:
+    """Soma as linhas do período de um escopo"""
+    total = _empty()
+    for row in db.query(DailySummary).filter(
+        DailySummary.scope == scope,
+        DailySummary.scope_id == scope_id,
+        in_period(DailySummary.day, period),
+    ):
+        _accumulate(total, row)
+    return total
+
+
+def summarize_periods(db, periods: Sequence[Period], scope: str = COMPANY, scope_id: int = 0) -> List[dict]:
+    """
+    Soma as linhas de vários períodos em uma única consulta (mesma ordem de `periods`).
+
+    Os períodos viram uma CTE (idx, início, fim) unida ao resumo pelo intervalo
+    [início, fim); cada linha volta com o índice do período. Dias que caem em
+    mais de um período (ex.: semana dentro do mês) voltam uma vez por período.
+    """
+    totals = [_empty() for _ in periods]
+    if not periods:
+        return totals
+    bounds = union_all(*[
+        select(
+            literal(idx, Integer).label("idx"),
+            literal(period.start, Date).label("period_start"),
+            literal(period.end, Date).label("period_end"),
+        )
+        for idx, period in enumerate(periods)
+    ]).cte("periods")
+    rows = (
+        db.query(bounds.c.idx, DailySummary)
+        .select_from(bounds)
+        .join(DailySummary, and_(
+            DailySummary.day >= bounds.c.period_start,
+            DailySummary.day < bounds.c.period_end,
+        ))
+        .filter(DailySummary.scope == scope, DailySummary.scope_id == scope_id)
+    )
+    for idx, row in rows:
+        _accumulate(totals[idx], row)
+    return totals
+
+
+def summarize_by_scope_id(db, period: Period, scope: str) -> Dict[int, dict]:
+    """Soma as linhas do período de um escopo, separadas por scope_id (ex.: por motorista)"""
+    totals: Dict[int, dict] = defaultdict(_empty)
+    for row in db.query(DailySummary).filter(
+        DailySummary.scope == scope,
+        in_period(DailySummary.day, period),
+    ):
+        _accumulate(totals[row.scope_id], row)
+    return dict(totals)
+
+
+def daily_rows(db, period: Period, scope: str = COMPANY, scope_id: int = 0) -> List[DailySummary]:
+    """Linhas do período de um escopo, da mais recente para a mais antiga"""
+    return (
+        db.query(DailySummary)
+        .filter(
+            DailySummary.scope == scope,
+            DailySummary.scope_id == scope_id,
+            in_period(DailySummary.day, period),
+        )
+        .order_by(DailySummary.day.desc())
+        .all()
+    )
+
+
+if __name__ == "__main__":
+    import sys
+    from database import init_db
+
+    init_db()
+    start_arg = date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None
+    print(f"🔄 Recalculando daily_summary{f' a partir de {start_arg}' if start_arg else ''}...")
+    print(f"✅ {backfill(start_arg)} linhas gravadas")
@@ -2,10 +2,12 @@ from __future__ import annotations
 
 from datetime import datetime
 import os
+import threading
 from typing import Optional, List
 
 from sqlalchemy import (
     create_engine,
+    event,
     Integer,
     BigInteger,
     String,
@@ -17,10 +19,17 @@ from sqlalchemy import (
     CheckConstraint,
     Date,
     Text,
+    Index,
+    insert,
+    select,
+    text,
+    update,
 )
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
 from pathlib import Path
 
+from shared.db_metrics import install_query_instrumentation
+
 
 # --- SQLAlchemy Base/Engine/Session setup ---
 _BASE_DIR = Path(__file__).resolve().parent
@@ -33,6 +42,11 @@ class Base(DeclarativeBase):
     pass
 
 
+def _partial(condition: str) -> dict:
+    """Índice parcial (WHERE) válido no SQLite e no Postgres"""
+    return {"sqlite_where": text(condition), "postgresql_where": text(condition)}
+
+
 engine = create_engine(
     DATABASE_URL,
     echo=False,
@@ -41,6 +55,9 @@ engine = create_engine(
     pool_recycle=300         # recicla conexões a cada 5 minutos
 )
 
+# Mede quantidade/latência das queries por handler do bot ou rota HTTP
+install_query_instrumentation(engine)
+
 # Importante: expire_on_commit=False evita que os objetos sejam expirados após commit,
 # o que causava erros do tipo "Instance <X> is not bound to a Session" quando
 # acessávamos atributos depois de commits em diferentes pontos do código.
@@ -76,6 +93,9 @@ class User(Base):
 
     __table_args__ = (
         CheckConstraint("role in ('manager','driver')", name="ck_user_role"),
+        Index("idx_user_role", "role"),
+        Index("idx_user_home_location", "home_latitude", "home_longitude",
+              **_partial("home_latitude IS NOT NULL AND home_longitude IS NOT NULL")),
     )
 
 
@@ -107,6 +127,14 @@ class Route(Base):
     
     __table_args__ = (
         CheckConstraint("status in ('pending','in_progress','completed','finalized')", name="ck_route_status"),
+        # Filtros de período (migrations/add_period_indexes.sql)
+        Index("idx_route_created_at", "created_at"),
+        Index("idx_route_completed_at", "completed_at"),
+        Index("idx_route_finalized_at", "finalized_at"),
+        # Índices de performance (migrations/versions/0003_performance_indexes.py)
+        Index("idx_route_status", "status"),
+        Index("idx_route_assigned_created", "assigned_to_id", "created_at"),
+        Index("idx_route_active", "created_at", "assigned_to_id", **_partial("assigned_to_id IS NOT NULL")),
     )
 
 
@@ -134,6 +162,8 @@ class Package(Base):
     __table_args__ = (
         CheckConstraint("status in ('pending','delivered','failed')", name="ck_package_status"),
         UniqueConstraint("route_id", "tracking_code", name="uq_route_tracking"),
+        Index("idx_package_route_status", "route_id", "status"),
+        Index("idx_package_order_in_route", "route_id", "order_in_route", **_partial("order_in_route IS NOT NULL")),
     )
 
 
@@ -156,6 +186,55 @@ class DeliveryProof(Base):
     package: Mapped[Package] = relationship(back_populates="proofs")
     driver: Mapped[Optional[User]] = relationship(back_populates="delivery_proofs")
 
+    __table_args__ = (
+        # Filtros de período (migrations/add_period_indexes.sql)
+        Index("idx_deliveryproof_timestamp", "timestamp"),
+    )
+
+
+# --- Arquivo morto (rotas finalizadas antigas) ---
+# Pacotes e comprovantes de rotas finalizadas há mais de ARCHIVE_AFTER_DAYS
+# são movidos para estas tabelas por archival.py. A rota continua em `route`
+# (receitas, despesas e salários apontam para ela) e o daily_summary soma
+# as tabelas ativas e as de arquivo, então os relatórios não mudam.
+class PackageArchive(Base):
+    """Pacote arquivado (mesmas colunas e id de `package`)"""
+    __tablename__ = "package_archive"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    route_id: Mapped[int] = mapped_column(Integer, ForeignKey("route.id", ondelete="CASCADE"), index=True)
+    tracking_code: Mapped[str] = mapped_column(String(255), nullable=False)
+    address: Mapped[Optional[str]] = mapped_column(String(500))
+    neighborhood: Mapped[Optional[str]] = mapped_column(String(255))
+    latitude: Mapped[Optional[float]] = mapped_column(Float)
+    longitude: Mapped[Optional[float]] = mapped_column(Float)
+    status: Mapped[str] = mapped_column(String(20), nullable=False)
+    raw_data: Mapped[Optional[dict]] = mapped_column(JSON)
+    order_in_route: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    archived_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class DeliveryProofArchive(Base):
+    """Comprovante arquivado (mesmas colunas e id de `delivery_proof`)"""
+    __tablename__ = "delivery_proof_archive"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    package_id: Mapped[int] = mapped_column(Integer, ForeignKey("package_archive.id", ondelete="CASCADE"), index=True)
+    driver_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("user.id", ondelete="SET NULL"), nullable=True)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    receiver_name: Mapped[Optional[str]] = mapped_column(String(255))
+    receiver_document: Mapped[Optional[str]] = mapped_column(String(100))
+    notes: Mapped[Optional[str]] = mapped_column(String(1000))
+    photo1_path: Mapped[Optional[str]] = mapped_column(String(500))
+    photo2_path: Mapped[Optional[str]] = mapped_column(String(500))
+    latitude: Mapped[Optional[float]] = mapped_column(Float)
+    longitude: Mapped[Optional[float]] = mapped_column(Float)
+    archived_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("idx_deliveryproof_archive_timestamp", "timestamp"),
+    )
+
 
 # --- Financial Models (Manager only) ---
 class Expense(Base):
@@ -180,6 +259,9 @@ class Expense(Base):
 
     __table_args__ = (
         CheckConstraint("type in ('combustivel','salario','manutencao','pedagio','combustivel_outro','outro')", name="ck_expense_type"),
+        Index("idx_expense_date_type", "date", "type"),
+        Index("idx_expense_created_by", "created_by", "date"),
+        Index("idx_expense_route_id", "route_id"),
     )
 
 
@@ -198,6 +280,10 @@ class Income(Base):
     # relationships
     route: Mapped[Optional[Route]] = relationship()
 
+    __table_args__ = (
+        Index("idx_income_route", "route_id", **_partial("route_id IS NOT NULL")),
+    )
+
 
 class Mileage(Base):
     """Registro de quilometragem rodada"""
@@ -224,6 +310,8 @@ class AIReport(Base):
     total_income: Mapped[float] = mapped_column(Float)
     total_expenses: Mapped[float] = mapped_column(Float)
     total_km: Mapped[float] = mapped_column(Float)
+    # Hash dos KPIs usados no prompt: igual ao atual → relatório reaproveitado sem chamar a IA
+    kpi_fingerprint: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     created_by: Mapped[int] = mapped_column(BigInteger, ForeignKey("user.telegram_user_id"), nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
@@ -233,14 +321,19 @@ class AIReport(Base):
 
 
 class LinkToken(Base):
-    """Tokens curtos para deep links (ex.: grupos de pacotes)."""
+    """Tokens curtos para deep links (ex.: grupos de pacotes) e botões (callback_store.py)."""
     __tablename__ = "link_token"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     token: Mapped[str] = mapped_column(String(64), unique=True, index=True, nullable=False)
-    type: Mapped[str] = mapped_column(String(32), nullable=False)  # ex: 'deliver_group'
+    type: Mapped[str] = mapped_column(String(32), nullable=False)  # ex: 'deliver_group', 'cb:confirm_salary_all'
     data: Mapped[dict] = mapped_column(JSON, nullable=False)       # payload (ex.: {"ids":[...]})
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)  # None = não expira
+
+    __table_args__ = (
+        Index("idx_link_token_expires", "expires_at", **_partial("expires_at IS NOT NULL")),
+    )
 
 
 class SalaryPayment(Base):
@@ -282,9 +375,190 @@ class SalaryPayment(Base):
     )
 
 
-def init_db() -> None:
-    """Create all tables if not exist."""
-    Base.metadata.create_all(bind=engine)
+class DailySummary(Base):
+    """Resumo diário materializado (alimenta /relatorio, /chat_ia e /meus_registros)
+
+    Uma linha por dia e escopo:
+    - scope='company'  scope_id=0                 → totais da empresa
+    - scope='driver'   scope_id=user.id           → métricas das rotas do motorista
+    - scope='creator'  scope_id=telegram_user_id  → registros financeiros lançados pelo gerente
+    Mantido por daily_summary.py (eventos + backfill).
+    """
+    __tablename__ = "daily_summary"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    day: Mapped[datetime] = mapped_column(Date, nullable=False)
+    scope: Mapped[str] = mapped_column(String(16), nullable=False)
+    scope_id: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    # Financeiro (todas as entradas do dia)
+    revenue: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
+    revenue_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    expenses: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
+    expense_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    # Financeiro considerando apenas lançamentos sem rota ou de rotas finalizadas
+    revenue_finalized: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
+    expenses_finalized: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
+    expenses_by_type: Mapped[dict] = mapped_column(JSON, default=dict, nullable=False)
+
+    # Quilometragem
+    km: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
+    mileage_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+    # Rotas criadas no dia e seus pacotes (status atual)
+    routes_created: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    packages_total: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    packages_delivered: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    packages_failed: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+    # Eventos do dia
+    routes_completed: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    routes_finalized: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    deliveries: Mapped[int] = mapped_column(Integer, default=0, nullable=False)  # pacotes com prova no dia e status delivered
+    failures: Mapped[int] = mapped_column(Integer, default=0, nullable=False)    # pacotes com prova no dia e status failed
+
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("scope", "scope_id", "day", name="uq_daily_summary_scope_day"),
+        CheckConstraint("scope in ('company','driver','creator')", name="ck_daily_summary_scope"),
+    )
+
+
+class ReportSnapshot(Base):
+    """Resultado pré-calculado de um relatório (precompute.py, job noturno)
+
+    kind='relatorio_month' → totais do /relatorio (mês + mês anterior)
+    kind='kpis'            → KPIs do /chat_ia de uma semana ou mês
+    [period_start, period_end) cobre todos os dias usados no cálculo: quando
+    daily_summary recalcula algum desses dias, o snapshot é apagado.
+    """
+    __tablename__ = "report_snapshot"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(32), nullable=False)
+    period_start: Mapped[datetime] = mapped_column(Date, nullable=False)
+    period_end: Mapped[datetime] = mapped_column(Date, nullable=False)
+    data: Mapped[dict] = mapped_column(JSON, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("kind", "period_start", "period_end", name="uq_report_snapshot_period"),
+        Index("idx_report_snapshot_range", "period_start", "period_end"),
+    )
+
+
+class JobRun(Base):
+    """Histórico das execuções das jobs do scheduler (duração e falhas)"""
+    __tablename__ = "job_run"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    job_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    started_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    duration_ms: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False)  # ok, error
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    detail: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)
+
+    __table_args__ = (
+        Index("idx_job_run_job_started", "job_id", "started_at"),
+    )
+
+
+class SchedulerLease(Base):
+    """Lease do líder do scheduler: só o processo dono roda as jobs (leader_lease.py)"""
+    __tablename__ = "scheduler_lease"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    holder: Mapped[str] = mapped_column(String(128), nullable=False)  # host:pid:sufixo
+    acquired_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    renewed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class DataVersion(Base):
+    """Contadores de versão compartilhados entre processos (chaves de cache)
+
+    name='daily_summary' → muda a cada recálculo do resumo diário
+    name='users'         → muda a cada gravação em user
+    Incrementados na mesma transação da alteração (bump_data_version).
+    """
+    __tablename__ = "data_version"
+
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+def bump_data_version(conn, name: str) -> None:
+    """Incrementa o contador `name` na transação de `conn` (Session ou Connection)"""
+    now = datetime.utcnow()
+    dialect = conn.get_bind().dialect.name if hasattr(conn, "get_bind") else conn.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    else:
+        updated = conn.execute(
+            update(DataVersion).where(DataVersion.name == name)
+            .values(version=DataVersion.version + 1, updated_at=now)
+        ).rowcount
+        if not updated:
+            conn.execute(insert(DataVersion).values(name=name, version=1, updated_at=now))
+        return
+    stmt = upsert(DataVersion).values(name=name, version=1, updated_at=now)
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=["name"],
+        set_={"version": DataVersion.version + 1, "updated_at": now},
+    ))
+
+
+# Contador de data_version incrementado a cada gravação em user (qualquer processo)
+USERS_VERSION = "users"
+
+
+def _bump_users_version(_mapper, connection, _target) -> None:
+    """Usuário criado/alterado/removido: nomes, papéis e lista de motoristas mudam"""
+    bump_data_version(connection, USERS_VERSION)
+
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    event.listen(User, _event_name, _bump_users_version)
+
+
+def read_data_versions(conn, *names: str, for_update: bool = False) -> tuple:
+    """
+    Versões atuais (0 para contador ainda não criado), na ordem pedida.
+    for_update: trava as linhas até o fim da transação (Postgres; no SQLite
+    a transação que já gravou algo segura os outros escritores)
+    """
+    stmt = select(DataVersion.name, DataVersion.version).where(DataVersion.name.in_(names))
+    if for_update:
+        stmt = stmt.with_for_update()
+    found = dict(conn.execute(stmt).all())
+    return tuple(found.get(name, 0) for name in names)
+
+
+_db_initialized = False
+_init_lock = threading.Lock()
+
+
+def init_db(force: bool = False) -> None:
+    """Create all tables if not exist.
+
+    Não altera tabelas existentes: colunas e índices novos são aplicados
+    pela cadeia de migrações (migrate.py).
+
+    Roda uma vez por processo (o create_all inspeciona todas as tabelas);
+    chamadas seguintes não fazem nada, a não ser com force=True.
+    """
+    global _db_initialized
+    with _init_lock:
+        if _db_initialized and not force:
+            return
+        Base.metadata.create_all(bind=engine)
+        _db_initialized = True
 
 
 def get_db_session():
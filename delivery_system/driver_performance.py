@@ -0,0 +1,107 @@
+"""
+Performance por motorista (rotas, pacotes, entregas, falhas e taxa de sucesso)
+
+Uma única consulta agrupada: motoristas (user) LEFT JOIN nas linhas de
+escopo 'driver' do resumo diário (daily_summary), somando no banco. Motorista
+sem rotas no período aparece com zeros.
+
+O resultado fica em cache por (período, versão do resumo, versão dos
+usuários). As duas versões ficam na tabela data_version e são lidas a cada
+chamada (uma consulta pela chave primária): um recálculo do daily_summary ou
+uma alteração em usuário feitos por outro worker/réplica também mudam a
+chave, então o cache nunca devolve número velho.
+
+Usado por /relatorio e /chat_ia (e por um futuro ranking de motoristas).
+
+Exemplo:
+    from driver_performance import driver_performance
+
+    for d in driver_performance(db, month_period(now)):
+        print(d["name"], d["delivered"], d["success_rate"])
+"""
+
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from sqlalchemy import and_, func
+
+from database import DailySummary, User, USERS_VERSION, read_data_versions
+from daily_summary import DRIVER, VERSION_NAME as SUMMARY_VERSION
+from shared.logger import logger
+from shared.periods import Period, in_period
+
+
+# Períodos guardados (LRU)
+PERFORMANCE_CACHE_SIZE = 32
+
+_cache: "OrderedDict[Tuple, List[dict]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _query(db, period: Period) -> List[dict]:
+    s = DailySummary
+    rows = (
+        db.query(
+            User.id,
+            User.full_name,
+            func.coalesce(func.sum(s.routes_created), 0),
+            func.coalesce(func.sum(s.packages_total), 0),
+            func.coalesce(func.sum(s.packages_delivered), 0),
+            func.coalesce(func.sum(s.packages_failed), 0),
+            func.coalesce(func.sum(s.deliveries), 0),
+            func.coalesce(func.sum(s.failures), 0),
+        )
+        .outerjoin(s, and_(s.scope == DRIVER, s.scope_id == User.id, in_period(s.day, period)))
+        .filter(User.role == "driver")
+        .group_by(User.id, User.full_name)
+        .order_by(User.id)
+        .all()
+    )
+    result = []
+    for driver_id, name, routes, packages, delivered, failed, deliveries, failures in rows:
+        packages = int(packages)
+        delivered = int(delivered)
+        result.append({
+            "driver_id": driver_id,
+            "name": name or f"Motorista {driver_id}",
+            "routes": int(routes),
+            "packages": packages,
+            "delivered": delivered,
+            "failed": int(failed),
+            # Provas registradas no período (pelo dia da entrega, não da rota)
+            "deliveries": int(deliveries),
+            "failures": int(failures),
+            "success_rate": round(delivered / packages * 100, 2) if packages else 0.0,
+        })
+    return result
+
+
+def driver_performance(db, period: Period) -> List[dict]:
+    """
+    Métricas de cada motorista no período (rotas criadas no período e seus pacotes).
+
+    Returns:
+        [{"driver_id", "name", "routes", "packages", "delivered", "failed",
+          "deliveries", "failures", "success_rate"}, ...] em ordem de cadastro
+    """
+    key = (period.start, period.end, *read_data_versions(db, SUMMARY_VERSION, USERS_VERSION))
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+    if cached is None:
+        cached = _query(db, period)
+        with _lock:
+            _cache[key] = cached
+            while len(_cache) > PERFORMANCE_CACHE_SIZE:
+                _cache.popitem(last=False)
+        logger.debug(f"driver_performance calculado ({period.start} a {period.last_day}, {len(cached)} motoristas)")
+    # Cópias: quem chama pode alterar os dicts sem estragar o cache
+    return [dict(row) for row in cached]
+
+
+def clear_cache() -> None:
+    """Descarta tudo (ex.: após apagar tabelas em massa, sem passar pelo resumo)"""
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,477 @@
+"""
+Exportação de planilhas (entregas, comprovantes, salários, financeiro)
+
+Os gerentes montavam à mão as planilhas mensais. /exportar (bot) e
+GET /export/{conjunto} (API) geram o arquivo direto do banco:
+
+- XLSX: workbook write-only do openpyxl (uma aba por conjunto); as linhas vão
+  para o disco à medida que são escritas
+- CSV: UTF-8 com BOM (acentos corretos no Excel)
+- Parquet: precisa do pacote opcional pyarrow (não está no requirements.txt)
+
+A consulta é lida em lotes de EXPORT_BATCH_SIZE linhas (yield_per: cursor do
+servidor no PostgreSQL), e cada lote é escrito antes de ler o próximo. A
+memória não depende do tamanho do período: um ano inteiro usa o mesmo que um
+mês. Pacotes e comprovantes arquivados (archival.py) entram junto com os
+ativos.
+
+Conjuntos: entregas, comprovantes, salarios, financeiro (ou "tudo").
+Vários conjuntos em CSV/Parquet saem num .zip com um arquivo por conjunto.
+
+Uso manual:
+    python exports.py entregas xlsx 2026-09
+    python exports.py tudo csv 2026
+"""
+
+import csv
+import os
+import re
+import tempfile
+import zipfile
+from datetime import date, datetime
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import Integer, String, cast, literal, null, select, union_all
+
+from database import (
+    SessionLocal, User, Route, Package, DeliveryProof, PackageArchive, DeliveryProofArchive,
+    Expense, Income, Mileage, SalaryPayment,
+)
+from shared.logger import logger
+from shared.periods import Period, days_period, in_period, month_period
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+# Linhas lidas do banco (e escritas no arquivo) por vez
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+FORMATS = ("xlsx", "csv", "parquet")
+ALL_DATASETS = "tudo"
+
+_MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "zip": "application/zip",
+}
+
+
+class ExportError(ValueError):
+    """Pedido de exportação inválido (conjunto, formato, período ou dependência)"""
+
+
+# Coluna da planilha: (cabeçalho, tipo) — tipo: int, float, str, date, datetime, bool
+Column = Tuple[str, str]
+
+
+class Dataset(NamedTuple):
+    name: str
+    title: str
+    columns: List[Column]
+    query: Callable[[Period], object]  # período -> select()
+
+
+class ExportResult(NamedTuple):
+    path: str
+    filename: str
+    media_type: str
+    rows: Dict[str, int]
+
+    @property
+    def total_rows(self) -> int:
+        return sum(self.rows.values())
+
+
+# ═══════════════════════════════════════════════════════════
+# CONSULTAS
+# ═══════════════════════════════════════════════════════════
+
+_PACKAGE_COLUMNS = (
+    "id", "route_id", "tracking_code", "address", "neighborhood",
+    "latitude", "longitude", "status", "order_in_route",
+)
+_PROOF_COLUMNS = (
+    "id", "package_id", "driver_id", "timestamp", "receiver_name",
+    "receiver_document", "notes", "latitude", "longitude",
+)
+
+
+def _all_packages():
+    """Pacotes ativos + arquivados (o arquivo mantém o mesmo id)"""
+    return union_all(
+        select(*[getattr(Package, c) for c in _PACKAGE_COLUMNS]),
+        select(*[getattr(PackageArchive, c) for c in _PACKAGE_COLUMNS]),
+    ).subquery("pkg")
+
+
+def _all_proofs(period: Period):
+    """Comprovantes ativos + arquivados do período"""
+    return union_all(
+        select(*[getattr(DeliveryProof, c) for c in _PROOF_COLUMNS])
+        .where(in_period(DeliveryProof.timestamp, period)),
+        select(*[getattr(DeliveryProofArchive, c) for c in _PROOF_COLUMNS])
+        .where(in_period(DeliveryProofArchive.timestamp, period)),
+    ).subquery("proof")
+
+
+def _entregas_query(period: Period):
+    pkg = _all_packages()
+    return (
+        select(
+            Route.created_at, Route.id, Route.name, User.full_name, pkg.c.order_in_route,
+            pkg.c.tracking_code, pkg.c.address, pkg.c.neighborhood, pkg.c.status,
+            pkg.c.latitude, pkg.c.longitude,
+        )
+        .select_from(pkg)
+        .join(Route, Route.id == pkg.c.route_id)
+        .outerjoin(User, User.id == Route.assigned_to_id)
+        .where(in_period(Route.created_at, period))
+        .order_by(Route.created_at, Route.id, pkg.c.order_in_route, pkg.c.id)
+    )
+
+
+def _comprovantes_query(period: Period):
+    proof = _all_proofs(period)
+    pkg = _all_packages()
+    return (
+        select(
+            proof.c.timestamp, pkg.c.route_id, pkg.c.tracking_code, pkg.c.status, User.full_name,
+            proof.c.receiver_name, proof.c.receiver_document, proof.c.notes,
+            proof.c.latitude, proof.c.longitude,
+        )
+        .select_from(proof)
+        .outerjoin(pkg, pkg.c.id == proof.c.package_id)
+        .outerjoin(User, User.id == proof.c.driver_id)
+        .order_by(proof.c.timestamp, proof.c.id)
+    )
+
+
+def _salarios_query(period: Period):
+    return (
+        select(
+            SalaryPayment.due_date, User.full_name, SalaryPayment.route_id, Route.name,
+            SalaryPayment.week_start, SalaryPayment.week_end, SalaryPayment.amount,
+            SalaryPayment.status, SalaryPayment.paid_date, SalaryPayment.notes,
+        )
+        .select_from(SalaryPayment)
+        .outerjoin(User, User.id == SalaryPayment.driver_id)
+        .outerjoin(Route, Route.id == SalaryPayment.route_id)
+        .where(in_period(SalaryPayment.due_date, period))
+        .order_by(SalaryPayment.due_date, SalaryPayment.id)
+    )
+
+
+def _financeiro_query(period: Period):
+    """Receitas, despesas e quilometragem numa tabela só (ordenada por data)"""
+    rows = union_all(
+        select(
+            Income.date.label("date"),
+            literal("receita", String).label("kind"),
+            literal("receita", String).label("category"),
+            Income.description.label("description"),
+            Income.amount.label("amount"),
+            Income.route_id.label("route_id"),
+            literal(1, Integer).label("confirmed"),
+        ).where(in_period(Income.date, period)),
+        select(
+            Expense.date, literal("despesa", String), Expense.type, Expense.description,
+            Expense.amount, Expense.route_id, Expense.confirmed,
+        ).where(in_period(Expense.date, period)),
+        select(
+            Mileage.date, literal("km", String), literal("km", String), Mileage.notes,
+            Mileage.km_total, cast(null(), Integer), literal(1, Integer),
+        ).where(in_period(Mileage.date, period)),
+    ).subquery("fin")
+    return select(
+        rows.c.date, rows.c.kind, rows.c.category, rows.c.description,
+        rows.c.amount, rows.c.route_id, rows.c.confirmed,
+    ).order_by(rows.c.date, rows.c.kind)
+
+
+DATASETS: Dict[str, Dataset] = {
+    "entregas": Dataset("entregas", "Entregas", [
+        ("Criada em", "datetime"), ("Rota", "int"), ("Nome da rota", "str"), ("Motorista", "str"),
+        ("Ordem", "int"), ("Código", "str"), ("Endereço", "str"), ("Bairro", "str"),
+        ("Status", "str"), ("Latitude", "float"), ("Longitude", "float"),
+    ], _entregas_query),
+    "comprovantes": Dataset("comprovantes", "Comprovantes", [
+        ("Data/hora", "datetime"), ("Rota", "int"), ("Código", "str"), ("Status", "str"),
+        ("Motorista", "str"), ("Recebedor", "str"), ("Documento", "str"), ("Observações", "str"),
+        ("Latitude", "float"), ("Longitude", "float"),
+    ], _comprovantes_query),
+    "salarios": Dataset("salarios", "Salários", [
+        ("Vencimento", "date"), ("Motorista", "str"), ("Rota", "int"), ("Nome da rota", "str"),
+        ("Semana início", "date"), ("Semana fim", "date"), ("Valor", "float"),
+        ("Status", "str"), ("Pago em", "datetime"), ("Observações", "str"),
+    ], _salarios_query),
+    "financeiro": Dataset("financeiro", "Financeiro", [
+        ("Data", "date"), ("Tipo", "str"), ("Categoria", "str"), ("Descrição", "str"),
+        ("Valor (R$ ou km)", "float"), ("Rota", "int"), ("Confirmado", "bool"),
+    ], _financeiro_query),
+}
+
+
+# ═══════════════════════════════════════════════════════════
+# PARÂMETROS
+# ═══════════════════════════════════════════════════════════
+
+def resolve_datasets(name: str) -> List[str]:
+    name = (name or "").strip().lower()
+    if name == ALL_DATASETS:
+        return list(DATASETS)
+    if name not in DATASETS:
+        raise ExportError(f"Conjunto desconhecido: {name}. Use {', '.join(DATASETS)} ou {ALL_DATASETS}.")
+    return [name]
+
+
+def parse_period(arg: Optional[str], now: Optional[datetime] = None) -> Period:
+    """
+    "2026-09", "09/2026" (mês) ou "2026" (ano inteiro). Sem valor = mês atual.
+    """
+    if not arg:
+        return month_period(now or datetime.now())
+    arg = arg.strip()
+    match = re.fullmatch(r"(\d{4})-(\d{1,2})", arg) or re.fullmatch(r"(\d{1,2})/(\d{4})", arg)
+    if match:
+        a, b = (int(g) for g in match.groups())
+        year, month = (a, b) if len(match.group(1)) == 4 else (b, a)
+        if 1 <= month <= 12:
+            return month_period(date(year, month, 1))
+    elif re.fullmatch(r"\d{4}", arg):
+        year = int(arg)
+        return days_period(date(year, 1, 1), date(year, 12, 31))
+    raise ExportError(f"Período inválido: {arg}. Use AAAA-MM, MM/AAAA ou AAAA.")
+
+
+def period_label(period: Period) -> str:
+    """Rótulo para o nome do arquivo: 2026-09, 2026 ou 2026-09-01_2026-09-15"""
+    if period == month_period(period.start):
+        return period.start.strftime("%Y-%m")
+    if period.start == date(period.start.year, 1, 1) and period.end == date(period.start.year + 1, 1, 1):
+        return str(period.start.year)
+    return f"{period.start.isoformat()}_{period.last_day.isoformat()}"
+
+
+# ═══════════════════════════════════════════════════════════
+# LEITURA EM LOTES
+# ═══════════════════════════════════════════════════════════
+
+def _coerce(value, kind: str):
+    """Normaliza o valor do banco (o SQLite devolve texto em colunas de UNION)"""
+    if value is None:
+        return None
+    if kind == "datetime":
+        return datetime.fromisoformat(value) if isinstance(value, str) else value
+    if kind == "date":
+        if isinstance(value, str):
+            return date.fromisoformat(value[:10])
+        return value.date() if isinstance(value, datetime) else value
+    if kind == "int":
+        return int(value)
+    if kind == "float":
+        return float(value)
+    if kind == "bool":
+        return bool(value)
+    return value
+
+
+def iter_batches(db, dataset: Dataset, period: Period, batch_size: Optional[int] = None) -> Iterator[List[tuple]]:
+    """Linhas do conjunto em lotes, já normalizadas. Só um lote fica em memória."""
+    kinds = [kind for _, kind in dataset.columns]
+    stmt = dataset.query(period).execution_options(yield_per=batch_size or EXPORT_BATCH_SIZE)
+    result = db.execute(stmt)
+    try:
+        for partition in result.partitions():
+            yield [tuple(_coerce(v, k) for v, k in zip(row, kinds)) for row in partition]
+    finally:
+        result.close()
+
+
+# ═══════════════════════════════════════════════════════════
+# ESCRITA
+# ═══════════════════════════════════════════════════════════
+
+def _csv_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime) else value.isoformat()
+    if isinstance(value, bool):
+        return "sim" if value else "não"
+    return value
+
+
+def _write_csv(db, dataset: Dataset, period: Period, path: str) -> int:
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow([header for header, _ in dataset.columns])
+        for batch in iter_batches(db, dataset, period):
+            writer.writerows([_csv_value(v) for v in row] for row in batch)
+            count += len(batch)
+    return count
+
+
+def _parquet_schema(dataset: Dataset):
+    import pyarrow as pa
+
+    types = {
+        "int": pa.int64(), "float": pa.float64(), "str": pa.string(),
+        "date": pa.date32(), "datetime": pa.timestamp("us"), "bool": pa.bool_(),
+    }
+    return pa.schema([(header, types[kind]) for header, kind in dataset.columns])
+
+
+def _write_parquet(db, dataset: Dataset, period: Period, path: str) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError("Formato parquet requer o pacote pyarrow (pip install pyarrow). Use xlsx ou csv.")
+
+    schema = _parquet_schema(dataset)
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in iter_batches(db, dataset, period):
+            columns = list(zip(*batch))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                schema=schema,
+            ))
+            count += len(batch)
+        if count == 0:
+            writer.write_table(schema.empty_table())
+    return count
+
+
+def _write_xlsx(db, datasets: Sequence[Dataset], period: Period, path: str) -> Dict[str, int]:
+    """Uma aba por conjunto; o workbook write-only não guarda as linhas em memória"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    workbook = Workbook(write_only=True)
+    counts = {}
+    for dataset in datasets:
+        sheet = workbook.create_sheet(dataset.title)
+        header = []
+        for title, _ in dataset.columns:
+            cell = WriteOnlyCell(sheet, value=title)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        sheet.append(header)
+        count = 0
+        for batch in iter_batches(db, dataset, period):
+            for row in batch:
+                sheet.append(row)
+            count += len(batch)
+        counts[dataset.name] = count
+    workbook.save(path)
+    return counts
+
+
+_WRITERS = {"csv": _write_csv, "parquet": _write_parquet}
+
+
+def export_to_file(
+    dataset_name: str,
+    fmt: str = "xlsx",
+    period: Optional[Period] = None,
+    directory: Optional[str] = None,
+) -> ExportResult:
+    """
+    Gera o arquivo num diretório temporário (quem chama apaga o arquivo depois
+    de enviar). Abre a própria sessão: pode rodar em thread (asyncio.to_thread).
+
+    Raises:
+        ExportError: conjunto, formato ou período inválido; pyarrow ausente
+    """
+    fmt = (fmt or "xlsx").lower()
+    if fmt not in FORMATS:
+        raise ExportError(f"Formato desconhecido: {fmt}. Use {', '.join(FORMATS)}.")
+    names = resolve_datasets(dataset_name)
+    period = period or parse_period(None)
+    datasets = [DATASETS[name] for name in names]
+
+    base = f"{dataset_name.lower()}_{period_label(period)}"
+    single = fmt == "xlsx" or len(datasets) == 1
+    extension = fmt if single else "zip"
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=f".{extension}", dir=directory)
+    os.close(fd)
+
+    started = datetime.now()
+    db = SessionLocal()
+    try:
+        if fmt == "xlsx":
+            rows = _write_xlsx(db, datasets, period, path)
+        elif single:
+            rows = {datasets[0].name: _WRITERS[fmt](db, datasets[0], period, path)}
+        else:
+            rows = {}
+            with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                for dataset in datasets:
+                    part = f"{path}.{dataset.name}.{fmt}"
+                    try:
+                        rows[dataset.name] = _WRITERS[fmt](db, dataset, period, part)
+                        archive.write(part, f"{dataset.name}_{period_label(period)}.{fmt}")
+                    finally:
+                        if os.path.exists(part):
+                            os.remove(part)
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        db.close()
+
+    elapsed = (datetime.now() - started).total_seconds()
+    logger.info(
+        f"[EXPORT] {base}.{extension}: {sum(rows.values())} linha(s), "
+        f"{os.path.getsize(path) / 1024:.0f} KB em {elapsed:.1f}s"
+    )
+    return ExportResult(path, f"{base}.{extension}", _MEDIA_TYPES[extension], rows)
+
+
+class _EchoWriter:
+    """Arquivo falso para csv.writer: writerow() devolve a linha formatada"""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def _csv_chunks(dataset: Dataset, period: Period) -> Iterator[bytes]:
+    writer = csv.writer(_EchoWriter())
+    db = SessionLocal()
+    try:
+        yield writer.writerow([header for header, _ in dataset.columns]).encode("utf-8-sig")
+        for batch in iter_batches(db, dataset, period):
+            yield "".join(writer.writerow([_csv_value(v) for v in row]) for row in batch).encode("utf-8")
+    finally:
+        db.close()
+
+
+def iter_csv(dataset_name: str, period: Period) -> Iterator[bytes]:
+    """
+    CSV de um conjunto gerado sob demanda (StreamingResponse da API): cada
+    lote vira bytes assim que é lido, sem arquivo intermediário.
+
+    Raises:
+        ExportError: conjunto inválido ("tudo" não cabe num CSV só)
+    """
+    names = resolve_datasets(dataset_name)
+    if len(names) != 1:
+        raise ExportError("CSV transmitido aceita um conjunto por vez.")
+    return _csv_chunks(DATASETS[names[0]], period)
+
+if __name__ == "__main__":
+    import sys
+    from database import init_db
+
+    init_db()
+    args = sys.argv[1:]
+    result = export_to_file(
+        args[0] if args else ALL_DATASETS,
+        args[1] if len(args) > 1 else "xlsx",
+        parse_period(args[2] if len(args) > 2 else None),
+        directory=".",
+    )
+    print(f"✅ {result.path} ({result.total_rows} linha(s): {result.rows})")
@@ -0,0 +1,167 @@
+"""
+Recebimento das planilhas de importação (/importar)
+
+Antes, cada planilha ia para uploads/imports/<nome do arquivo> e era lida de
+volta do disco. Dois gerentes enviando "rota.xlsx" ao mesmo tempo
+sobrescreviam o arquivo um do outro (e um importava a planilha do outro).
+Agora:
+
+- Até IMPORT_MEMORY_MAX_MB o arquivo é baixado para a memória
+  (download_to_memory) e o pandas lê direto dos bytes, sem passar pelo disco
+- Acima disso (ou tamanho desconhecido e grande demais), vai para um arquivo
+  temporário exclusivo desta importação
+- Arquivamento (IMPORT_ARCHIVE): cópia em uploads/imports/<sha256>.<ext>,
+  gravada em segundo plano depois da leitura. Nome pelo conteúdo: reenvio da
+  mesma planilha não duplica, planilhas diferentes nunca se sobrescrevem
+
+Exemplo:
+    upload = await receive_upload(await doc.get_file(), doc.file_name, doc.file_size)
+    try:
+        df = await asyncio.to_thread(read_spreadsheet, upload)
+    finally:
+        finish_upload(upload)   # arquiva (se ativado) e apaga o temporário
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional, Set, Union
+
+import pandas as pd
+
+from shared.logger import logger
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+BASE_DIR = Path(__file__).resolve().parent
+IMPORTS_DIR = BASE_DIR / "uploads" / "imports"
+# Acima deste tamanho o download vai para arquivo temporário
+IMPORT_MEMORY_MAX_BYTES = int(float(os.getenv("IMPORT_MEMORY_MAX_MB", "10")) * 1024 * 1024)
+# Guarda uma cópia de cada planilha importada em IMPORTS_DIR
+IMPORT_ARCHIVE = os.getenv("IMPORT_ARCHIVE", "true").lower() == "true"
+
+_HASH_CHUNK = 1024 * 1024
+
+# Tasks de arquivamento em andamento (referência evita que sejam coletadas)
+_archive_tasks: Set[asyncio.Task] = set()
+
+
+class UploadedSheet:
+    """Planilha recebida: bytes em memória ou arquivo temporário"""
+
+    def __init__(self, filename: str, data: Optional[bytes] = None, path: Optional[Path] = None):
+        self.filename = filename
+        self.suffix = Path(filename).suffix.lower()
+        self.data = data
+        self.path = path
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else self.path.stat().st_size
+
+    def source(self) -> Union[io.BytesIO, Path]:
+        """Origem para o pandas; cada chamada começa do início do arquivo"""
+        # BytesIO sobre bytes compartilha o buffer (sem cópia)
+        return io.BytesIO(self.data) if self.data is not None else self.path
+
+
+async def receive_upload(tg_file, filename: str, size_hint: Optional[int] = None) -> UploadedSheet:
+    """Baixa o arquivo do Telegram para a memória (ou temporário, se grande)"""
+    size = size_hint or getattr(tg_file, "file_size", None) or 0
+    if size <= IMPORT_MEMORY_MAX_BYTES:
+        buffer = io.BytesIO()
+        await tg_file.download_to_memory(out=buffer)
+        return UploadedSheet(filename, data=buffer.getvalue())
+
+    fd, tmp_name = tempfile.mkstemp(prefix="import_", suffix=Path(filename).suffix.lower())
+    os.close(fd)
+    try:
+        await tg_file.download_to_drive(tmp_name)
+    except Exception:
+        os.unlink(tmp_name)
+        raise
+    logger.info(f"[IMPORT] {filename}: {size / 1024 / 1024:.1f} MB, baixado para arquivo temporário")
+    return UploadedSheet(filename, path=Path(tmp_name))
+
+
+def read_spreadsheet(upload: UploadedSheet) -> pd.DataFrame:
+    """Lê .xlsx ou .csv (CSV: UTF-8 e fallback latin-1). Bloqueante: use em thread."""
+    if upload.suffix == ".xlsx":
+        return pd.read_excel(upload.source())
+    try:
+        return pd.read_csv(upload.source())
+    except Exception:
+        return pd.read_csv(upload.source(), encoding="latin-1", sep=",")
+
+
+# ═══════════════════════════════════════════════════════════
+# ARQUIVAMENTO (segundo plano)
+# ═══════════════════════════════════════════════════════════
+
+def _content_hash(upload: UploadedSheet) -> str:
+    digest = hashlib.sha256()
+    if upload.data is not None:
+        digest.update(upload.data)
+    else:
+        with open(upload.path, "rb") as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_path(upload: UploadedSheet) -> Path:
+    return IMPORTS_DIR / f"{_content_hash(upload)}{upload.suffix}"
+
+
+def _archive_and_cleanup(upload: UploadedSheet, archive: bool) -> Optional[Path]:
+    try:
+        target = None
+        if archive:
+            target = archive_path(upload)
+            if not target.exists():
+                IMPORTS_DIR.mkdir(parents=True, exist_ok=True)
+                # Grava ao lado e renomeia: nunca fica um arquivo pela metade.
+                # Parcial exclusivo (mkstemp): duas cópias da mesma planilha
+                # arquivadas ao mesmo tempo não gravam no mesmo arquivo
+                fd, partial_name = tempfile.mkstemp(prefix=f"{target.name}.", suffix=".part", dir=IMPORTS_DIR)
+                partial = Path(partial_name)
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        if upload.data is not None:
+                            f.write(upload.data)
+                        else:
+                            with open(upload.path, "rb") as src:
+                                shutil.copyfileobj(src, f, _HASH_CHUNK)
+                    os.replace(partial, target)
+                except BaseException:
+                    partial.unlink(missing_ok=True)
+                    raise
+                logger.info(f"[IMPORT] {upload.filename} arquivado como {target.name}")
+        return target
+    except Exception:
+        logger.warning(f"[IMPORT] Falha ao arquivar {upload.filename}", exc_info=True)
+        return None
+    finally:
+        if upload.path is not None:
+            upload.path.unlink(missing_ok=True)
+
+
+def finish_upload(upload: UploadedSheet, archive: bool = IMPORT_ARCHIVE) -> None:
+    """Arquiva (se ativado) e apaga o temporário em segundo plano"""
+    if not archive and upload.path is None:
+        return
+    task = asyncio.get_running_loop().create_task(
+        asyncio.to_thread(_archive_and_cleanup, upload, archive)
+    )
+    _archive_tasks.add(task)
+    task.add_done_callback(_archive_tasks.discard)
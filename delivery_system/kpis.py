@@ -0,0 +1,138 @@
+"""
+Motor de KPIs por período (/chat_ia)
+
+compute_kpis() calcula os indicadores de vários períodos (ex.: mês atual,
+mês anterior, semana atual e semana passada) com uma única consulta ao
+resumo diário (daily_summary.summarize_periods), em vez de uma consulta por
+período.
+
+Receitas/despesas consideram apenas lançamentos sem rota ou de rotas
+finalizadas (campos *_finalized do resumo).
+
+Benchmark (banco SQLite temporário com um ano de resumo sintético):
+    python kpis.py
+"""
+
+from typing import List, Sequence
+
+from daily_summary import summarize_periods
+from shared.periods import Period
+
+
+def kpis_from_totals(period: Period, totals: dict) -> dict:
+    """Converte os totais somados do resumo no dicionário de KPIs"""
+    income_total = totals["revenue_finalized"]
+    expense_total = totals["expenses_finalized"]
+    expense_breakdown = {t: float(v or 0.0) for t, v in totals["expenses_by_type"].items()}
+    km_total = totals["km"]
+    routes_completed = totals["routes_completed"]
+    routes_finalized = totals["routes_finalized"]
+    delivered_count = totals["deliveries"]
+    failed_count = totals["failures"]
+
+    total_income = float(income_total)
+    total_expense = float(expense_total)
+    profit = total_income - total_expense
+    total_deliveries = delivered_count + failed_count
+    success_rate = (delivered_count / total_deliveries * 100.0) if total_deliveries > 0 else 0.0
+    avg_income_per_route = (total_income / routes_completed) if routes_completed else 0.0
+    avg_expense_per_route = (total_expense / routes_completed) if routes_completed else 0.0
+
+    return {
+        "period": {"start": str(period.start), "end": str(period.last_day)},
+        "income_total": round(total_income, 2),
+        "expense_total": round(total_expense, 2),
+        "profit": round(profit, 2),
+        "expense_breakdown": expense_breakdown,
+        "km_total": round(float(km_total), 2),
+        "routes_completed": int(routes_completed),
+        "routes_finalized": int(routes_finalized),
+        "delivered": int(delivered_count),
+        "failed": int(failed_count),
+        "success_rate": round(success_rate, 2),
+        "avg_income_per_route": round(avg_income_per_route, 2),
+        "avg_expense_per_route": round(avg_expense_per_route, 2),
+    }
+
+
+def compute_kpis(db, periods: Sequence[Period]) -> List[dict]:
+    """KPIs da empresa para cada período (mesma ordem), numa única consulta"""
+    return [
+        kpis_from_totals(period, totals)
+        for period, totals in zip(periods, summarize_periods(db, periods))
+    ]
+
+
+# ═══════════════════════════════════════════════════════════
+# BENCHMARK
+# ═══════════════════════════════════════════════════════════
+
+def _benchmark(iterations: int = 200) -> None:
+    """Compara compute_kpis (1 consulta) com summarize() por período (N consultas)"""
+    import random
+    import tempfile
+    import time
+    from datetime import date, timedelta
+    from pathlib import Path
+
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+
+    from database import Base, DailySummary
+    from daily_summary import COMPANY, CREATOR, DRIVER, summarize
+    from shared.periods import month_period, week_period
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.sqlite'}")
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+
+        # Um ano de resumo: empresa + 4 motoristas + 1 gerente por dia
+        rng = random.Random(42)
+        today = date.today()
+        rows = []
+        for offset in range(365):
+            day = today - timedelta(days=offset)
+            for scope, scope_id in [(COMPANY, 0)] + [(DRIVER, i) for i in range(1, 5)] + [(CREATOR, 99)]:
+                delivered = rng.randint(0, 120)
+                failed = rng.randint(0, 10)
+                rows.append(DailySummary(
+                    day=day, scope=scope, scope_id=scope_id,
+                    revenue=rng.uniform(0, 2000), revenue_count=rng.randint(0, 5),
+                    expenses=rng.uniform(0, 900), expense_count=rng.randint(0, 6),
+                    revenue_finalized=rng.uniform(0, 2000), expenses_finalized=rng.uniform(0, 900),
+                    expenses_by_type={"combustivel": rng.uniform(0, 300), "salario": rng.uniform(0, 500)},
+                    km=rng.uniform(0, 80), mileage_count=rng.randint(0, 2),
+                    routes_created=rng.randint(0, 4), packages_total=delivered + failed,
+                    packages_delivered=delivered, packages_failed=failed,
+                    routes_completed=rng.randint(0, 4), routes_finalized=rng.randint(0, 4),
+                    deliveries=delivered, failures=failed,
+                ))
+        db = Session()
+        db.add_all(rows)
+        db.commit()
+
+        queries = {"n": 0}
+        event.listen(engine, "before_cursor_execute", lambda *args: queries.__setitem__("n", queries["n"] + 1))
+        periods = [month_period(today, 0), month_period(today, -1), week_period(today, 0), week_period(today, -1)]
+
+        def run(label, fn):
+            db.expire_all()
+            queries["n"] = 0
+            start = time.perf_counter()
+            for _ in range(iterations):
+                result = fn()
+            elapsed = (time.perf_counter() - start) * 1000 / iterations
+            print(f"{label:<32} {elapsed:8.2f} ms/chamada   {queries['n'] / iterations:.0f} consulta(s)")
+            return result
+
+        print(f"📊 {len(rows)} linhas de resumo, {len(periods)} períodos, {iterations} repetições")
+        old = run("summarize() por período", lambda: [kpis_from_totals(p, summarize(db, p)) for p in periods])
+        new = run("compute_kpis() (1 consulta)", lambda: compute_kpis(db, periods))
+        print("✅ Resultados idênticos" if old == new else "❌ Resultados diferentes")
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,145 @@
+"""
+Lease de líder no banco (uma réplica por vez roda as jobs do scheduler)
+
+Cada processo tenta, a cada heartbeat, pegar ou renovar a linha `name` da
+tabela scheduler_lease:
+
+- UPDATE condicional (dono atual = eu OU lease vencido): atômico no SQLite e
+  no Postgres, então só um processo vence a disputa
+- Sem linha ainda: INSERT; quem perder (chave duplicada) fica de fora
+- O lease vale LEASE_TTL_S; o líder renova antes (heartbeat a cada TTL/3).
+  Se o líder morrer sem liberar, outra réplica assume quando o lease vence
+- release() no desligamento libera na hora para a próxima réplica
+- holds(): além do is_leader, confere o prazo do último lease obtido
+  (relógio monotônico, contado do início da renovação). Heartbeat atrasado
+  (event loop travado) não deixa o processo agir como líder com o lease
+  vencido, quando outra réplica já pode ter assumido
+
+Exemplo:
+    lease = LeaderLease("scheduler")
+    if lease.try_acquire():      # True = sou o líder (pegou ou renovou)
+        ...
+    if lease.holds():            # antes de cada job: líder e lease ainda no prazo
+        ...
+    lease.release()
+"""
+
+import os
+import secrets
+import socket
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import case, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from database import SchedulerLease, SessionLocal
+from shared.logger import logger
+
+
+LEASE_TTL_S = int(os.getenv("SCHEDULER_LEASE_TTL_S", "60"))
+
+
+def _holder_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+
+
+class LeaderLease:
+    """Lease renovável guardado na tabela scheduler_lease"""
+
+    def __init__(self, name: str, ttl_s: int = LEASE_TTL_S, holder: Optional[str] = None):
+        self.name = name
+        self.ttl_s = ttl_s
+        self.holder = holder or _holder_id()
+        self.is_leader = False
+        self.acquired_at: Optional[datetime] = None
+        # Prazo (time.monotonic) do último lease obtido
+        self.valid_until = 0.0
+
+    def holds(self) -> bool:
+        """Líder e com o lease dentro do prazo (sem depender do próximo heartbeat)"""
+        return self.is_leader and time.monotonic() < self.valid_until
+
+    def try_acquire(self) -> bool:
+        """Pega ou renova o lease. Atualiza e devolve is_leader."""
+        # Prazo contado de antes do UPDATE: nunca depois do que o banco registra
+        deadline = time.monotonic() + self.ttl_s
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=self.ttl_s)
+        lease = SchedulerLease
+        db = SessionLocal()
+        try:
+            taken = db.execute(
+                update(lease)
+                .where(lease.name == self.name, or_(lease.holder == self.holder, lease.expires_at < now))
+                .values(
+                    holder=self.holder,
+                    # Renovação mantém o início da liderança; tomada começa agora
+                    acquired_at=case((lease.holder == self.holder, lease.acquired_at), else_=now),
+                    renewed_at=now,
+                    expires_at=expires,
+                )
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not taken and db.get(lease, self.name) is None:
+                db.add(lease(name=self.name, holder=self.holder, acquired_at=now,
+                             renewed_at=now, expires_at=expires))
+                try:
+                    db.flush()
+                    taken = 1
+                except IntegrityError:
+                    db.rollback()  # outra réplica criou a linha primeiro
+                    taken = 0
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Sem banco não dá para garantir exclusividade: deixa de ser líder
+            logger.warning(f"[LEADER] Falha ao renovar o lease '{self.name}'", exc_info=True)
+            taken = 0
+        finally:
+            db.close()
+
+        was_leader, self.is_leader = self.is_leader, bool(taken)
+        self.valid_until = deadline if self.is_leader else 0.0
+        if self.is_leader and not was_leader:
+            self.acquired_at = now
+            logger.info(f"[LEADER] {self.holder} assumiu o lease '{self.name}'")
+        elif was_leader and not self.is_leader:
+            self.acquired_at = None
+            logger.warning(f"[LEADER] {self.holder} perdeu o lease '{self.name}'")
+        return self.is_leader
+
+    def release(self) -> None:
+        """Libera o lease (se for meu) para outra réplica assumir sem esperar o TTL"""
+        db = SessionLocal()
+        try:
+            db.query(SchedulerLease).filter(
+                SchedulerLease.name == self.name,
+                SchedulerLease.holder == self.holder,
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.warning(f"[LEADER] Falha ao liberar o lease '{self.name}'", exc_info=True)
+        finally:
+            db.close()
+            self.is_leader = False
+            self.acquired_at = None
+            self.valid_until = 0.0
+
+    def current(self) -> Optional[dict]:
+        """Quem tem o lease agora (para métricas/debug)"""
+        db = SessionLocal()
+        try:
+            row = db.get(SchedulerLease, self.name)
+            if row is None:
+                return None
+            return {
+                "holder": row.holder,
+                "acquired_at": row.acquired_at.isoformat(timespec="seconds"),
+                "expires_at": row.expires_at.isoformat(timespec="seconds"),
+                "expired": row.expires_at < datetime.utcnow(),
+            }
+        finally:
+            db.close()
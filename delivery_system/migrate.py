@@ -0,0 +1,155 @@
+"""
+Migrações versionadas do banco (Alembic)
+
+Roda uma vez no startup (unified_app.py, bot.py e startup.py):
+1. init_db() cria as tabelas que ainda não existem
+2. `alembic upgrade head` aplica as revisões pendentes de migrations/versions
+   (colunas antigas, FKs com CASCADE e índices dos dois bancos)
+3. Cria os índices declarados nos modelos que ainda faltam (ex.: bancos
+   antigos cujas tabelas não foram criadas por init_db())
+4. Confere se todos os índices existem no banco e registra o resultado
+   (log + /metrics/db + /debug). Índice faltando gera WARNING no log em vez
+   de passar despercebido.
+
+Uso manual:
+    python migrate.py           # aplica e mostra o relatório de índices
+"""
+
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import inspect
+
+from database import Base, engine, init_db
+from shared.logger import logger
+
+
+_BASE_DIR = Path(__file__).resolve().parent
+
+_lock = threading.Lock()
+_done = False
+_last_report: Optional[Dict] = None
+
+
+def _alembic_config() -> Config:
+    config = Config(str(_BASE_DIR / "alembic.ini"))
+    config.set_main_option("script_location", str(_BASE_DIR / "migrations"))
+    return config
+
+
+def current_revision() -> Optional[str]:
+    """Revisão aplicada no banco (None se nunca migrado)"""
+    with engine.connect() as connection:
+        return MigrationContext.configure(connection).get_current_revision()
+
+
+def create_missing_indexes() -> int:
+    """Cria os índices dos modelos que não existem no banco. Retorna quantos criou."""
+    inspector = inspect(engine)
+    created = 0
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if not index.name or index.name in existing:
+                continue
+            try:
+                index.create(bind=engine)
+                created += 1
+                logger.info(f"🔧 Índice criado: {table.name}.{index.name}")
+            except Exception as e:
+                logger.error(f"❌ Falha ao criar índice {table.name}.{index.name}: {e}")
+    return created
+
+
+def check_indexes() -> Dict:
+    """
+    Compara os índices declarados nos modelos com os existentes no banco.
+
+    Returns:
+        {"revision", "dialect", "checked_at", "present": [...], "missing": [...]}
+    """
+    global _last_report
+    inspector = inspect(engine)
+    present, missing = [], []
+    for table in Base.metadata.sorted_tables:
+        expected = sorted(ix.name for ix in table.indexes if ix.name)
+        if not expected:
+            continue
+        existing = (
+            {ix["name"] for ix in inspector.get_indexes(table.name)}
+            if inspector.has_table(table.name) else set()
+        )
+        for name in expected:
+            (present if name in existing else missing).append(f"{table.name}.{name}")
+
+    report = {
+        "revision": current_revision(),
+        "dialect": engine.dialect.name,
+        "checked_at": datetime.now().isoformat(timespec="seconds"),
+        "present": present,
+        "missing": missing,
+    }
+    _last_report = report
+
+    if missing:
+        logger.warning(f"⚠️ {len(missing)} índice(s) faltando no banco: {', '.join(missing)}")
+    else:
+        logger.info(f"✅ Índices OK ({len(present)} verificados, revisão {report['revision']})")
+    return report
+
+
+def index_report() -> Optional[Dict]:
+    """Último resultado de check_indexes() (None antes do startup)"""
+    return _last_report
+
+
+def run_migrations() -> Dict:
+    """
+    Aplica as migrações pendentes e verifica os índices.
+
+    Só executa uma vez por processo; chamadas seguintes devolvem o último
+    relatório. Falha na migração é logada e não impede o app de subir
+    (os índices faltando aparecem no relatório).
+    """
+    global _done
+    with _lock:
+        if _done and _last_report is not None:
+            return _last_report
+
+        init_db()
+        try:
+            before = current_revision()
+            with engine.begin() as connection:
+                config = _alembic_config()
+                config.attributes["connection"] = connection
+                command.upgrade(config, "head")
+            after = current_revision()
+            if before != after:
+                logger.info(f"🔄 Migrações aplicadas: {before or 'nenhuma'} → {after}")
+        except Exception:
+            logger.error("❌ Falha ao aplicar migrações", exc_info=True)
+
+        try:
+            create_missing_indexes()
+        except Exception:
+            logger.error("❌ Falha ao criar índices faltantes", exc_info=True)
+
+        _done = True
+        return check_indexes()
+
+
+if __name__ == "__main__":
+    report = run_migrations()
+    print(f"📦 Revisão: {report['revision']} ({report['dialect']})")
+    print(f"✅ Índices presentes: {len(report['present'])}")
+    if report["missing"]:
+        print(f"⚠️ Índices faltando: {len(report['missing'])}")
+        for name in report["missing"]:
+            print(f"   • {name}")
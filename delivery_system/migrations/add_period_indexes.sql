@@ -0,0 +1,46 @@
+-- ═══════════════════════════════════════════════════════════
+-- MIGRATION: Índices para filtros de período
+-- Data: 2026-10-19
+-- Descrição: Índices das colunas DateTime filtradas por intervalo
+--            semiaberto [início, fim) (shared/periods.py).
+--            Compatível com SQLite e PostgreSQL.
+-- Uso: python apply_indexes.py migrations/add_period_indexes.sql
+-- ═══════════════════════════════════════════════════════════
+
+BEGIN;
+
+-- ─────────────────────────────────────────────────────────
+-- 1. DELIVERY_PROOF
+-- ─────────────────────────────────────────────────────────
+-- Entregas/insucessos por dia (resumo diário, KPIs)
+CREATE INDEX IF NOT EXISTS idx_deliveryproof_timestamp 
+ON delivery_proof(timestamp);
+
+-- ─────────────────────────────────────────────────────────
+-- 2. ROUTE
+-- ─────────────────────────────────────────────────────────
+-- Rotas criadas no período (sem filtro de motorista)
+CREATE INDEX IF NOT EXISTS idx_route_created_at 
+ON route(created_at);
+
+-- Rotas concluídas no período
+CREATE INDEX IF NOT EXISTS idx_route_completed_at 
+ON route(completed_at);
+
+-- Rotas finalizadas no período
+CREATE INDEX IF NOT EXISTS idx_route_finalized_at 
+ON route(finalized_at);
+
+COMMIT;
+
+-- ═══════════════════════════════════════════════════════════
+-- ROLLBACK (se necessário)
+-- ═══════════════════════════════════════════════════════════
+/*
+BEGIN;
+DROP INDEX IF EXISTS idx_deliveryproof_timestamp;
+DROP INDEX IF EXISTS idx_route_created_at;
+DROP INDEX IF EXISTS idx_route_completed_at;
+DROP INDEX IF EXISTS idx_route_finalized_at;
+COMMIT;
+*/
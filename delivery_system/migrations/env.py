@@ -0,0 +1,59 @@
+"""
+Ambiente do Alembic para o Rocinha Entrega
+
+Usado por migrate.run_migrations() no startup e pela linha de comando:
+    cd delivery_system && alembic upgrade head
+"""
+
+import sys
+from pathlib import Path
+
+from alembic import context
+
+# Permite `from database import ...` ao rodar pelo CLI do alembic
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import Base, engine  # noqa: E402
+
+config = context.config
+target_metadata = Base.metadata
+
+
+def run_migrations_offline() -> None:
+    """Gera o SQL sem conectar (alembic upgrade head --sql)"""
+    context.configure(
+        url=str(engine.url),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        render_as_batch=engine.dialect.name == "sqlite",
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    """Aplica na conexão recebida de migrate.py (ou no engine do app)"""
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        _run(connection)
+        return
+    with engine.connect() as connection:
+        _run(connection)
+
+
+def _run(connection) -> None:
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        # SQLite não tem ALTER de constraints: o Alembic recria a tabela
+        render_as_batch=connection.dialect.name == "sqlite",
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,74 @@
+"""Colunas adicionadas pelos scripts avulsos
+
+Substitui apply_route_automation.py, ADD_HOME_ADDRESS_COLUMNS.sql e
+ADD_ORDER_IN_ROUTE_COLUMN.sql. Cada coluna só é criada se ainda não existir,
+então a revisão roda tanto em bancos antigos quanto nos criados por init_db().
+
+Revision ID: 0001
+Revises:
+Create Date: 2025-01-20
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+COLUMNS = {
+    "user": [
+        sa.Column("home_latitude", sa.Float(), nullable=True),
+        sa.Column("home_longitude", sa.Float(), nullable=True),
+        sa.Column("home_address", sa.String(500), nullable=True),
+    ],
+    "package": [
+        sa.Column("order_in_route", sa.Integer(), nullable=True),
+    ],
+    "route": [
+        sa.Column("revenue", sa.Float(), nullable=False, server_default="260.0"),
+        sa.Column("driver_salary", sa.Float(), nullable=True),
+        sa.Column("status", sa.String(20), nullable=False, server_default="pending"),
+        sa.Column("completed_at", sa.DateTime(), nullable=True),
+        sa.Column("finalized_at", sa.DateTime(), nullable=True),
+        sa.Column("extra_expenses", sa.Float(), nullable=False, server_default="0.0"),
+        sa.Column("extra_income", sa.Float(), nullable=False, server_default="0.0"),
+        sa.Column("calculated_km", sa.Float(), nullable=True),
+    ],
+    "expense": [
+        # A FK com ON DELETE CASCADE é aplicada na revisão 0002
+        sa.Column("route_id", sa.Integer(), nullable=True),
+        sa.Column("confirmed", sa.Integer(), nullable=False, server_default="1"),
+    ],
+}
+
+
+def _existing_columns(table: str) -> set:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table(table):
+        return set()
+    return {c["name"] for c in inspector.get_columns(table)}
+
+
+def upgrade() -> None:
+    for table, columns in COLUMNS.items():
+        existing = _existing_columns(table)
+        if not existing:
+            continue  # tabela será criada por init_db() com o modelo atual
+        for column in columns:
+            if column.name not in existing:
+                op.add_column(table, column)
+                if table == "route" and column.name == "status":
+                    # Rotas antigas com motorista já estavam em andamento
+                    op.execute("UPDATE route SET status = 'in_progress' WHERE assigned_to_id IS NOT NULL")
+
+
+def downgrade() -> None:
+    # Colunas fazem parte do modelo atual; remover quebraria o app
+    pass
@@ -0,0 +1,110 @@
+"""ON DELETE CASCADE em expense.route_id e income.route_id
+
+Substitui apply_cascade_migration.py / change_cascade_delete.sql (antes
+disparado por RUN_MIGRATION=true). Só altera a tabela se a FK ainda não
+tiver CASCADE.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2025-01-20
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# SQLite não altera FKs: a tabela é recriada (mesmo SQL de change_cascade_delete.sql)
+SQLITE_REBUILD = {
+    "expense": (
+        """
+        CREATE TABLE expense_new (
+            id INTEGER PRIMARY KEY,
+            date DATE NOT NULL,
+            type VARCHAR(50) NOT NULL,
+            description VARCHAR(500) NOT NULL,
+            amount REAL NOT NULL,
+            fuel_type VARCHAR(50),
+            fuel_liters REAL,
+            employee_name VARCHAR(255),
+            route_id INTEGER,
+            confirmed INTEGER DEFAULT 1 NOT NULL,
+            created_by BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (route_id) REFERENCES route(id) ON DELETE CASCADE,
+            FOREIGN KEY (created_by) REFERENCES "user"(telegram_user_id),
+            CONSTRAINT ck_expense_type CHECK (type IN ('combustivel','salario','manutencao','pedagio','combustivel_outro','outro'))
+        )
+        """,
+        "id, date, type, description, amount, fuel_type, fuel_liters, "
+        "employee_name, route_id, confirmed, created_by, created_at",
+    ),
+    "income": (
+        """
+        CREATE TABLE income_new (
+            id INTEGER PRIMARY KEY,
+            date DATE NOT NULL,
+            route_id INTEGER,
+            description VARCHAR(500) NOT NULL,
+            amount REAL NOT NULL,
+            created_by BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (route_id) REFERENCES route(id) ON DELETE CASCADE,
+            FOREIGN KEY (created_by) REFERENCES "user"(telegram_user_id)
+        )
+        """,
+        "id, date, route_id, description, amount, created_by, created_at",
+    ),
+}
+
+
+def _route_fk(inspector, table: str):
+    """FK de route_id → route.id (ou None)"""
+    for fk in inspector.get_foreign_keys(table):
+        if fk.get("referred_table") == "route" and fk.get("constrained_columns") == ["route_id"]:
+            return fk
+    return None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    for table, (create_sql, columns) in SQLITE_REBUILD.items():
+        if not inspector.has_table(table):
+            continue
+        fk = _route_fk(inspector, table)
+        if fk and (fk.get("options") or {}).get("ondelete", "").upper() == "CASCADE":
+            continue
+
+        if bind.dialect.name == "sqlite":
+            index_sql = [
+                sql for (sql,) in bind.exec_driver_sql(
+                    "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                    (table,),
+                )
+            ]
+            op.execute(create_sql)
+            op.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}")
+            op.execute(f"DROP TABLE {table}")
+            op.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+            for sql in index_sql:
+                op.execute(sql)
+        else:
+            name = (fk or {}).get("name") or f"{table}_route_id_fkey"
+            if fk:
+                op.drop_constraint(name, table, type_="foreignkey")
+            op.create_foreign_key(name, table, "route", ["route_id"], ["id"], ondelete="CASCADE")
+
+
+def downgrade() -> None:
+    # Voltar para SET NULL deixaria receitas/despesas órfãs; não suportado
+    pass
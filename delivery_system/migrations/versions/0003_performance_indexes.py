@@ -0,0 +1,78 @@
+"""Índices de performance e de período nos dois bancos
+
+Substitui add_performance_indexes.sql (só rodava no Postgres: BEGIN/pg_indexes)
+e add_period_indexes.sql. Os índices parciais usam WHERE, suportado tanto
+pelo SQLite quanto pelo Postgres. Índices já existentes (mesmo nome) são mantidos.
+
+Não recriados por já existirem via index=True nos modelos:
+idx_income_date (ix_income_date), idx_mileage_date (ix_mileage_date) e
+idx_deliveryproof_package (ix_delivery_proof_package_id).
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2025-01-20
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (nome, tabela, colunas, WHERE do índice parcial)
+INDEXES = (
+    # Performance (add_performance_indexes.sql)
+    ("idx_package_route_status", "package", ["route_id", "status"], None),
+    ("idx_package_order_in_route", "package", ["route_id", "order_in_route"], "order_in_route IS NOT NULL"),
+    ("idx_route_assigned_created", "route", ["assigned_to_id", "created_at"], None),
+    ("idx_route_active", "route", ["created_at", "assigned_to_id"], "assigned_to_id IS NOT NULL"),
+    ("idx_user_role", "user", ["role"], None),
+    ("idx_user_home_location", "user", ["home_latitude", "home_longitude"],
+     "home_latitude IS NOT NULL AND home_longitude IS NOT NULL"),
+    ("idx_expense_date_type", "expense", ["date", "type"], None),
+    ("idx_expense_created_by", "expense", ["created_by", "date"], None),
+    ("idx_income_route", "income", ["route_id"], "route_id IS NOT NULL"),
+    # Automação financeira (add_route_automation_fields.sql)
+    ("idx_route_status", "route", ["status"], None),
+    ("idx_expense_route_id", "expense", ["route_id"], None),
+    # Filtros de período (add_period_indexes.sql)
+    ("idx_route_created_at", "route", ["created_at"], None),
+    ("idx_route_completed_at", "route", ["completed_at"], None),
+    ("idx_route_finalized_at", "route", ["finalized_at"], None),
+    ("idx_deliveryproof_timestamp", "delivery_proof", ["timestamp"], None),
+)
+
+
+def _existing_indexes(inspector, table: str) -> set:
+    if not inspector.has_table(table):
+        return set()
+    return {ix["name"] for ix in inspector.get_indexes(table)}
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    existing = {}
+    for name, table, columns, where in INDEXES:
+        if table not in existing:
+            existing[table] = _existing_indexes(inspector, table)
+        if name in existing[table] or not inspector.has_table(table):
+            continue
+        kwargs = {}
+        if where:
+            kwargs = {"sqlite_where": sa.text(where), "postgresql_where": sa.text(where)}
+        op.create_index(name, table, columns, **kwargs)
+        existing[table].add(name)
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    for name, table, _, _ in reversed(INDEXES):
+        if name in _existing_indexes(inspector, table):
+            op.drop_index(name, table_name=table)
@@ -0,0 +1,31 @@
+"""Coluna ai_report.kpi_fingerprint (cache de relatórios de IA)
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2025-01-22
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("ai_report"):
+        return
+    if "kpi_fingerprint" not in {c["name"] for c in inspector.get_columns("ai_report")}:
+        op.add_column("ai_report", sa.Column("kpi_fingerprint", sa.String(64), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("ai_report") as batch:
+        batch.drop_column("kpi_fingerprint")
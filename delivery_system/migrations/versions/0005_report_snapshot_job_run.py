@@ -0,0 +1,59 @@
+"""Tabelas report_snapshot (relatórios pré-calculados) e job_run (histórico do scheduler)
+
+Em bancos novos init_db() já cria as duas tabelas; aqui só são criadas se
+ainda não existirem.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2025-01-24
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table("report_snapshot"):
+        op.create_table(
+            "report_snapshot",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("kind", sa.String(32), nullable=False),
+            sa.Column("period_start", sa.Date, nullable=False),
+            sa.Column("period_end", sa.Date, nullable=False),
+            sa.Column("data", sa.JSON, nullable=False),
+            sa.Column("created_at", sa.DateTime, nullable=False),
+            sa.UniqueConstraint("kind", "period_start", "period_end", name="uq_report_snapshot_period"),
+        )
+        op.create_index("idx_report_snapshot_range", "report_snapshot", ["period_start", "period_end"])
+
+    if not inspector.has_table("job_run"):
+        op.create_table(
+            "job_run",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("job_id", sa.String(64), nullable=False),
+            sa.Column("started_at", sa.DateTime, nullable=False),
+            sa.Column("finished_at", sa.DateTime, nullable=True),
+            sa.Column("duration_ms", sa.Float, nullable=True),
+            sa.Column("status", sa.String(16), nullable=False),
+            sa.Column("error", sa.Text, nullable=True),
+            sa.Column("detail", sa.JSON, nullable=True),
+        )
+        op.create_index("idx_job_run_job_started", "job_run", ["job_id", "started_at"])
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    for table in ("job_run", "report_snapshot"):
+        if inspector.has_table(table):
+            op.drop_table(table)
@@ -0,0 +1,41 @@
+"""Coluna link_token.expires_at (payload de botões com validade)
+
+Tokens de deep link antigos ficam com expires_at NULL (não expiram); os
+tokens de botão (callback_store.py) são apagados depois de vencidos.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2025-01-27
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("link_token"):
+        return
+    if "expires_at" not in {c["name"] for c in inspector.get_columns("link_token")}:
+        op.add_column("link_token", sa.Column("expires_at", sa.DateTime, nullable=True))
+    if "idx_link_token_expires" not in {ix["name"] for ix in inspector.get_indexes("link_token")}:
+        where = sa.text("expires_at IS NOT NULL")
+        op.create_index("idx_link_token_expires", "link_token", ["expires_at"],
+                        sqlite_where=where, postgresql_where=where)
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if "idx_link_token_expires" in {ix["name"] for ix in inspector.get_indexes("link_token")}:
+        op.drop_index("idx_link_token_expires", table_name="link_token")
+    with op.batch_alter_table("link_token") as batch:
+        batch.drop_column("expires_at")
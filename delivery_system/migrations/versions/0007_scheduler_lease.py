@@ -0,0 +1,40 @@
+"""Tabela scheduler_lease (líder único do scheduler entre réplicas)
+
+Em bancos novos init_db() já cria a tabela; aqui só é criada se ainda não
+existir.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2025-01-29
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: Union[str, None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("scheduler_lease"):
+        op.create_table(
+            "scheduler_lease",
+            sa.Column("name", sa.String(64), primary_key=True),
+            sa.Column("holder", sa.String(128), nullable=False),
+            sa.Column("acquired_at", sa.DateTime, nullable=False),
+            sa.Column("renewed_at", sa.DateTime, nullable=False),
+            sa.Column("expires_at", sa.DateTime, nullable=False),
+        )
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table("scheduler_lease"):
+        op.drop_table("scheduler_lease")
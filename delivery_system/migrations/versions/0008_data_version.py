@@ -0,0 +1,40 @@
+"""Tabela data_version (versões do resumo diário e dos usuários entre processos)
+
+Os caches de driver_performance.py e a checagem do precompute.py usavam
+contadores em memória de cada processo; a versão agora fica no banco. Em
+bancos novos init_db() já cria a tabela; aqui só é criada se ainda não
+existir.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2025-01-30
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0008"
+down_revision: Union[str, None] = "0007"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("data_version"):
+        op.create_table(
+            "data_version",
+            sa.Column("name", sa.String(32), primary_key=True),
+            sa.Column("version", sa.BigInteger, nullable=False, server_default="0"),
+            sa.Column("updated_at", sa.DateTime, nullable=False),
+        )
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table("data_version"):
+        op.drop_table("data_version")
@@ -0,0 +1,180 @@
+"""
+Pré-cálculo noturno dos relatórios (report_snapshot)
+
+A job do scheduler (04:00, fora do horário de entregas) grava:
+- Totais do /relatorio do mês atual, com a comparação do mês anterior
+- KPIs do /chat_ia: mês atual, mês anterior, semana atual e semana passada
+- (Opcional, PRECOMPUTE_AI_REPORT=true) o texto de IA do /relatorio, salvo
+  em ai_report com o fingerprint dos KPIs (bot.precompute_ai_report)
+
+De manhã, /relatorio e "relatório semanal" leem o snapshot (uma linha) em
+vez de somar o resumo diário. Quando daily_summary recalcula um dia coberto
+por um snapshot, o snapshot é apagado na mesma transação: nunca fica velho,
+apenas volta a ser calculado na hora.
+
+Uso manual:
+    python precompute.py
+"""
+
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+from database import SessionLocal, ReportSnapshot, User
+from daily_summary import data_version, summarize_periods
+from driver_performance import driver_performance
+from kpis import compute_kpis
+from shared.logger import logger
+from shared.periods import Period, month_period, week_period
+
+
+PRECOMPUTE_REPORTS = os.getenv("PRECOMPUTE_REPORTS", "true").lower() in ("1", "true", "yes")
+PRECOMPUTE_AI_REPORT = os.getenv("PRECOMPUTE_AI_REPORT", "false").lower() in ("1", "true", "yes")
+# Snapshots não renovados há mais tempo que isso são removidos pela job
+SNAPSHOT_MAX_AGE_DAYS = 7
+
+RELATORIO_MONTH = "relatorio_month"
+KPIS = "kpis"
+
+
+# ═══════════════════════════════════════════════════════════
+# CÁLCULOS
+# ═══════════════════════════════════════════════════════════
+
+def relatorio_span(now: datetime) -> Period:
+    """Dias usados pelos totais do /relatorio (mês anterior + mês atual)"""
+    return Period(month_period(now, -1).start, month_period(now, 0).end)
+
+
+def monthly_report_stats(db, now: datetime) -> dict:
+    """Totais do mês atual e do mês anterior usados pelo /relatorio (uma consulta ao resumo)"""
+    month_totals, prev_totals = summarize_periods(db, [month_period(now, 0), month_period(now, -1)])
+    return {
+        "total_packages": month_totals["packages_total"],
+        "delivered_packages": month_totals["packages_delivered"],
+        "failed_packages": month_totals["packages_failed"],
+        "total_routes": month_totals["routes_created"],
+        "active_drivers": db.query(User.id).filter(User.role == "driver").count(),
+        "total_income": month_totals["revenue_count"],
+        "total_expenses": month_totals["expense_count"],
+        "total_mileage": month_totals["mileage_count"],
+        "total_revenue": float(month_totals["revenue"]),
+        "total_spent": float(month_totals["expenses"]),
+        "total_km": float(month_totals["km"]),
+        "prev_packages": prev_totals["packages_total"],
+        "prev_delivered": prev_totals["packages_delivered"],
+        "prev_routes": prev_totals["routes_created"],
+        "prev_revenue": float(prev_totals["revenue"]),
+        "prev_spent": float(prev_totals["expenses"]),
+    }
+
+
+# ═══════════════════════════════════════════════════════════
+# SNAPSHOTS
+# ═══════════════════════════════════════════════════════════
+
+def save_snapshot(db, kind: str, period: Period, data: dict) -> None:
+    """Grava (ou substitui) o snapshot do período. Commit fica com quem chama."""
+    snapshot = db.query(ReportSnapshot).filter(
+        ReportSnapshot.kind == kind,
+        ReportSnapshot.period_start == period.start,
+        ReportSnapshot.period_end == period.end,
+    ).first()
+    if snapshot is None:
+        db.add(ReportSnapshot(kind=kind, period_start=period.start, period_end=period.end,
+                              data=data, created_at=datetime.utcnow()))
+    else:
+        snapshot.data = data
+        snapshot.created_at = datetime.utcnow()
+
+
+def load_snapshots(db, kind: str, periods: Sequence[Period]) -> Dict[Period, dict]:
+    """Snapshots existentes dos períodos (uma consulta)"""
+    if not periods:
+        return {}
+    wanted = set(periods)
+    rows = db.query(ReportSnapshot).filter(
+        ReportSnapshot.kind == kind,
+        ReportSnapshot.period_start.in_({p.start for p in periods}),
+    ).all()
+    found = {}
+    for row in rows:
+        period = Period(row.period_start, row.period_end)
+        if period in wanted:
+            found[period] = row.data
+    return found
+
+
+def load_snapshot(db, kind: str, period: Period) -> Optional[dict]:
+    return load_snapshots(db, kind, [period]).get(period)
+
+
+def snapshot_kpis(db, periods: Sequence[Period]) -> List[dict]:
+    """KPIs dos períodos: snapshot noturno quando existe, cálculo na hora para o resto"""
+    found = load_snapshots(db, KPIS, periods)
+    missing = [p for p in periods if p not in found]
+    if missing:
+        found.update(zip(missing, compute_kpis(db, missing)))
+    return [found[p] for p in periods]
+
+
+# ═══════════════════════════════════════════════════════════
+# JOB
+# ═══════════════════════════════════════════════════════════
+
+def precompute_reports(now: Optional[datetime] = None) -> dict:
+    """Calcula e grava os snapshots. Retorna um resumo para o histórico da job."""
+    now = now or datetime.now()
+    db = SessionLocal()
+    try:
+        # Versão no banco: vê recálculos feitos por qualquer processo
+        version = data_version(db)
+        snapshots = {(RELATORIO_MONTH, relatorio_span(now)): monthly_report_stats(db, now)}
+        periods = [month_period(now, 0), month_period(now, -1), week_period(now, 0), week_period(now, -1)]
+        for period, kpis in zip(periods, compute_kpis(db, periods)):
+            snapshots[(KPIS, period)] = kpis
+
+        # Versão conferida na mesma transação da gravação: um recálculo não passa
+        # entre a conferência e o commit (e o que vier depois apaga estes
+        # snapshots). Postgres: o contador fica travado desde antes das
+        # gravações. SQLite: conferida de novo depois da primeira gravação,
+        # quando a transação já segura os outros escritores.
+        stale = data_version(db, for_update=True) != version
+        if not stale:
+            for (kind, period), data in snapshots.items():
+                save_snapshot(db, kind, period, data)
+            db.flush()
+            stale = data_version(db) != version
+        if stale:
+            db.rollback()
+            logger.warning("[PRECOMPUTE] Resumo diário mudou durante o cálculo; snapshots descartados")
+            return {"snapshots": 0, "skipped": True}
+        removed = db.query(ReportSnapshot).filter(
+            ReportSnapshot.created_at < datetime.utcnow() - timedelta(days=SNAPSHOT_MAX_AGE_DAYS)
+        ).delete(synchronize_session=False)
+        db.commit()
+
+        # Aquece o cache em memória do ranking por motorista (mesmo processo do bot)
+        driver_performance(db, month_period(now, 0))
+
+        logger.info(f"[PRECOMPUTE] {len(snapshots)} snapshot(s) gravado(s), {removed} antigo(s) removido(s)")
+        return {"snapshots": len(snapshots), "removed": removed}
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def precompute_job() -> dict:
+    """Job do scheduler: cálculo fora do event loop do bot"""
+    return await asyncio.to_thread(precompute_reports)
+
+
+if __name__ == "__main__":
+    from database import init_db
+
+    init_db()
+    result = precompute_reports()
+    print(f"✅ {result['snapshots']} snapshot(s) gravado(s)")
@@ -1,16 +1,50 @@
 """
 Scheduler para notificações automáticas de salários
-Executa duas jobs:
+Executa as jobs:
 1. Toda quinta-feira às 12:00 - notifica salários pendentes do dia
 2. Todo dia às 09:00 - notifica salários atrasados e atualiza status
+3. Todo dia às 03:30 - arquiva rotas finalizadas antigas (archival.py)
+4. Todo dia às 04:00 - pré-calcula os relatórios do dia (precompute.py)
+
+Cada execução fica registrada na tabela job_run (início, duração, status,
+erro e o resumo devolvido pela job). A linha é gravada no início (status
+"running") e reserva o horário: se o horário já tem execução registrada
+(disparo normal x recuperação), a segunda não roda.
+
+As jobs de salário usam o bot da Application (start_scheduler(bot=...)),
+uma consulta agregada (pagamentos + motoristas), um único UPDATE para os
+atrasados e enviam para todos os gerentes ao mesmo tempo.
+
+Réplicas (unified_app em mais de uma instância): todas sobem o scheduler,
+mas só a dona do lease (leader_lease.py, tabela scheduler_lease) roda as
+jobs; as demais ignoram o horário e assumem se a líder sumir. Ao virar
+líder, as jobs cujo último horário passou sem execução em job_run (ex.:
+deploy às 08:59) rodam uma vez, em ordem (até SCHEDULER_CATCHUP_HOURS).
+
+Simulação (não envia nem grava; mostra o tempo de cada etapa):
+    python scheduler.py --dry-run
 """
 
-from datetime import datetime
+import asyncio
+import functools
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, update
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from database import SessionLocal, SalaryPayment, User
+from database import SessionLocal, SalaryPayment, User, JobRun
+from leader_lease import LeaderLease, LEASE_TTL_S
 from shared.logger import logger
+from shared.outbound import outbound
+from archival import archive_job, ARCHIVE_AFTER_DAYS
+from callback_store import store_callback
+from precompute import precompute_job, PRECOMPUTE_REPORTS, PRECOMPUTE_AI_REPORT
 import os
 
 
@@ -19,216 +53,507 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN não configurado no .env")
 
+# Só uma réplica roda as jobs (false = toda instância roda, como antes)
+SCHEDULER_LEADER_LOCK = os.getenv("SCHEDULER_LEADER_LOCK", "true").lower() == "true"
+# Execuções perdidas há até N horas rodam quando o processo vira líder (0 desativa)
+SCHEDULER_CATCHUP_HOURS = float(os.getenv("SCHEDULER_CATCHUP_HOURS", "24"))
+# Atraso tolerado para disparar uma job (ex.: event loop ocupado no horário)
+SCHEDULER_MISFIRE_GRACE_S = int(os.getenv("SCHEDULER_MISFIRE_GRACE_S", "300"))
+# Heartbeat do lease bem antes de ele vencer
+HEARTBEAT_S = max(5, LEASE_TTL_S // 3)
+HEARTBEAT_JOB_ID = "scheduler_leader_heartbeat"
+CATCH_UP_JOB_ID = "scheduler_catch_up"
+LEASE_NAME = "scheduler"
+# Durações mantidas por job para p50/p95
+JOB_SAMPLES = 50
+
+
+# ═══════════════════════════════════════════════════════════
+# HISTÓRICO DE EXECUÇÕES (job_run)
+# ═══════════════════════════════════════════════════════════
+
+def _claim_job_run(job_id: str, started_at: datetime, fire_time: Optional[datetime]):
+    """
+    Grava a execução no início (status "running") e devolve o id da linha.
+
+    fire_time (UTC): horário atendido. Se já existe execução iniciada nesse
+    horário ou depois, devolve False (outra execução já o atendeu, ou ainda
+    está rodando). Sem banco, devolve None e a job roda mesmo assim.
+    """
+    db = SessionLocal()
+    try:
+        if fire_time is not None:
+            last = db.query(func.max(JobRun.started_at)).filter(JobRun.job_id == job_id).scalar()
+            if last is not None and last >= fire_time:
+                return False
+        run = JobRun(job_id=job_id, started_at=started_at, status="running")
+        db.add(run)
+        db.commit()
+        return run.id
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"[SCHEDULER] Não consegui registrar o início de {job_id}: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def _record_job_run(run_id: Optional[int], job_id: str, started_at: datetime, duration_ms: float,
+                    status: str, error=None, detail=None):
+    """Completa a linha do início (ou grava uma nova, se o início não foi registrado)"""
+    db = SessionLocal()
+    try:
+        run = db.get(JobRun, run_id) if run_id is not None else None
+        if run is None:
+            run = JobRun(job_id=job_id, started_at=started_at)
+            db.add(run)
+        run.finished_at = datetime.utcnow()
+        run.duration_ms = round(duration_ms, 1)
+        run.status = status
+        run.error = error
+        run.detail = detail
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"[SCHEDULER] Não consegui registrar a execução de {job_id}: {e}")
+    finally:
+        db.close()
+
+
+# ═══════════════════════════════════════════════════════════
+# MÉTRICAS DAS JOBS (por processo)
+# ═══════════════════════════════════════════════════════════
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class _JobStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0      # horário disparou, mas este processo não é o líder
+        self.duplicates = 0   # horário já atendido por outra execução (job_run)
+        self.catch_ups = 0    # execuções recuperadas ao virar líder
+        self.last_status: Optional[str] = None
+        self.last_started: Optional[datetime] = None
+        self.last_duration_ms: Optional[float] = None
+        self._durations = deque(maxlen=JOB_SAMPLES)
+
+    def record(self, started_at: datetime, duration_ms: float, status: str) -> None:
+        self.runs += 1
+        if status != "ok":
+            self.errors += 1
+        self.last_status = status
+        self.last_started = started_at
+        self.last_duration_ms = round(duration_ms, 1)
+        self._durations.append(duration_ms)
+
+    def as_dict(self) -> dict:
+        durations = sorted(self._durations)
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "skipped_not_leader": self.skipped,
+            "skipped_already_run": self.duplicates,
+            "catch_ups": self.catch_ups,
+            "last_status": self.last_status,
+            "last_started_utc": self.last_started.isoformat(timespec="seconds") if self.last_started else None,
+            "last_duration_ms": self.last_duration_ms,
+            "duration_p50_ms": round(_percentile(durations, 50), 1),
+            "duration_p95_ms": round(_percentile(durations, 95), 1),
+        }
+
+
+_job_stats: Dict[str, _JobStats] = {}
+_scheduler: Optional[AsyncIOScheduler] = None
+_lease: Optional[LeaderLease] = None
+_catch_up_task: Optional[asyncio.Task] = None
+
+
+def _is_leader() -> bool:
+    # holds(): o lease ainda está no prazo, mesmo se o heartbeat atrasou
+    return _lease is None or _lease.holds()
+
+
+def _current_fire_time(job_id: str) -> Optional[datetime]:
+    """Horário agendado que o disparo normal da job está atendendo (com fuso)"""
+    job = _scheduler.get_job(job_id) if _scheduler is not None else None
+    if job is None:
+        return None
+    now = datetime.now(_scheduler.timezone)
+    fire = job.trigger.get_next_fire_time(None, now - timedelta(seconds=SCHEDULER_MISFIRE_GRACE_S))
+    return fire if fire is not None and fire <= now else None
+
+
+def _tracked(job_id: str, job, uses_fire_time: bool = False):
+    """
+    Envolve a job para registrar cada execução em job_run (só roda no líder)
+
+    fire_time: horário perdido, com fuso (recuperação); no disparo normal, o
+    horário agendado atual. Cada horário roda uma vez só (_claim_job_run).
+    uses_fire_time: a job recebe now=<horário agendado> quando roda na
+    recuperação (o dia da execução atrasada não é o dia do horário perdido)
+    """
+    stats = _job_stats.setdefault(job_id, _JobStats())
+
+    @functools.wraps(job)
+    async def run(fire_time: Optional[datetime] = None):
+        if not _is_leader():
+            stats.skipped += 1
+            logger.info(f"[SCHEDULER] Job {job_id} ignorada: outra réplica é a líder (ou lease vencido)")
+            return
+        catch_up = fire_time is not None
+        fire_time = fire_time or _current_fire_time(job_id)
+        started_at = datetime.utcnow()
+        run_id = _claim_job_run(
+            job_id, started_at,
+            fire_time.astimezone(timezone.utc).replace(tzinfo=None) if fire_time else None,
+        )
+        if run_id is False:
+            stats.duplicates += 1
+            logger.info(f"[SCHEDULER] Job {job_id} ignorada: horário {fire_time:%d/%m %H:%M} já executado")
+            return
+        start = time.perf_counter()
+        status, error, detail = "ok", None, None
+        try:
+            # Horário local do scheduler, sem fuso (como o datetime.now() das jobs)
+            kwargs = {"now": fire_time.replace(tzinfo=None)} if uses_fire_time and catch_up else {}
+            result = await job(**kwargs)
+            if isinstance(result, dict):
+                detail = result
+        except Exception as e:
+            status, error = "error", f"{type(e).__name__}: {e}"
+            logger.error(f"[SCHEDULER] Erro na job {job_id}", exc_info=True)
+        duration_ms = (time.perf_counter() - start) * 1000
+        stats.record(started_at, duration_ms, status)
+        _record_job_run(run_id, job_id, started_at, duration_ms, status, error, detail)
+        logger.info(f"[SCHEDULER] Job {job_id}: {status} em {duration_ms:.0f}ms")
+    return run
+
+
+# ═══════════════════════════════════════════════════════════
+# BOT COMPARTILHADO
+# ═══════════════════════════════════════════════════════════
+
+_bot: Optional[Bot] = None
+
+
+def set_bot(bot: Bot) -> None:
+    """Usa o bot da Application (mesma conexão HTTP e mesma fila de saída)"""
+    global _bot
+    _bot = bot
+
+
+def _get_bot() -> Bot:
+    global _bot
+    if _bot is None:
+        # Scheduler rodando sem a Application (ex.: execução manual): um bot por processo
+        _bot = Bot(token=BOT_TOKEN)
+    return _bot
+
+
+# ═══════════════════════════════════════════════════════════
+# SALÁRIOS: CONSULTA, MENSAGEM E ENVIO
+# ═══════════════════════════════════════════════════════════
+
+def _salary_rows(db, *conditions) -> list:
+    """Pagamentos com o nome do motorista numa consulta só (agrupados por motorista)"""
+    return (
+        db.query(
+            SalaryPayment.id,
+            SalaryPayment.driver_id,
+            SalaryPayment.route_id,
+            SalaryPayment.amount,
+            SalaryPayment.due_date,
+            User.full_name,
+        )
+        .outerjoin(User, User.id == SalaryPayment.driver_id)
+        .filter(*conditions)
+        .order_by(SalaryPayment.driver_id, SalaryPayment.due_date, SalaryPayment.id)
+        .all()
+    )
+
+
+def _salary_details(rows, today, show_overdue: bool):
+    """Texto por motorista e botões de confirmação (um por pagamento)"""
+    text, buttons = "", []
+    for _, payments in groupby(rows, key=lambda r: r.driver_id):
+        payments = list(payments)
+        driver_name = payments[0].full_name or "Desconhecido"
+        text += f"👤 *{driver_name}*\n"
+        for payment in payments:
+            route_info = f"Rota #{payment.route_id}" if payment.route_id else "Avulso"
+            text += f"  • {route_info} - R$ {payment.amount:.2f}\n"
+            if show_overdue:
+                days_overdue = (today - payment.due_date).days
+                text += f"     ⏰ Vencimento: {payment.due_date.strftime('%d/%m/%Y')} ({days_overdue} dias de atraso)\n"
+            buttons.append([
+                InlineKeyboardButton(
+                    f"✅ Confirmar R$ {payment.amount:.2f} ({driver_name[:15]})",
+                    callback_data=f"confirm_salary:{payment.id}"
+                )
+            ])
+        text += f"  💵 Subtotal: R$ {sum(p.amount for p in payments):.2f}\n\n"
+    return text, buttons
+
+
+def _confirm_all_button(db, rows, total_amount: float, dry_run: bool) -> list:
+    # Ids guardados no servidor: a lista não cabe nos 64 bytes do callback_data
+    confirm_all = (
+        "confirm_salary_all:dry-run" if dry_run
+        else store_callback(db, "confirm_salary_all", {"ids": [r.id for r in rows]})
+    )
+    return [InlineKeyboardButton(f"✅ CONFIRMAR TODOS (R$ {total_amount:.2f})", callback_data=confirm_all)]
+
+
+async def _send_to_managers(db, message: str, keyboard: InlineKeyboardMarkup, dry_run: bool) -> dict:
+    """Envia para todos os gerentes de uma vez (a fila de saída cuida dos limites)"""
+    managers = db.query(User.telegram_user_id, User.full_name).filter(
+        User.role.in_(['manager', 'admin'])
+    ).all()
+    if dry_run:
+        return {"managers": len(managers), "sent": 0, "failed": 0}
+
+    bot = _get_bot()
+    results = await asyncio.gather(*[
+        outbound.send(
+            bot.send_message,
+            chat_id=manager.telegram_user_id,
+            label="salary_notification",
+            text=message,
+            parse_mode='Markdown',
+            reply_markup=keyboard
+        )
+        for manager in managers
+    ], return_exceptions=True)
+    failed = 0
+    for manager, result in zip(managers, results):
+        if isinstance(result, Exception):
+            failed += 1
+            logger.error(f"[SCHEDULER] Erro ao enviar para {manager.full_name}: {result}")
+    return {"managers": len(managers), "sent": len(managers) - failed, "failed": failed}
+
+
+class _Timer:
+    """Tempo de cada etapa da job (ms), devolvido no resumo (job_run e --dry-run)"""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def lap(self, step: str) -> None:
+        now = time.perf_counter()
+        self.timings[step] = round((now - self._last) * 1000, 1)
+        self._last = now
+
 
-async def notify_thursday_salaries():
+async def notify_thursday_salaries(dry_run: bool = False, now: Optional[datetime] = None) -> dict:
     """
     Job executada toda quinta-feira às 12:00
     Notifica manager sobre salários com vencimento no dia
+
+    dry_run: consulta e monta a mensagem, mas não envia nem grava nada
+    now: horário agendado (recuperação de execução perdida); padrão: agora
     """
     db = SessionLocal()
-    bot = Bot(token=BOT_TOKEN)
-    
+    timer = _Timer()
     try:
-        today = datetime.now().date()
+        today = (now or datetime.now()).date()
         
-        # Busca salários com vencimento hoje e status pending
-        payments_today = db.query(SalaryPayment).filter(
-            SalaryPayment.due_date == today,
-            SalaryPayment.status == 'pending'
-        ).all()
-        
-        if not payments_today:
-            logger.info("[SCHEDULER] Nenhum salário vencendo hoje (quinta-feira)")
-            return
+        # Salários com vencimento hoje e status pending (já com o nome do motorista)
+        rows = _salary_rows(db, SalaryPayment.due_date == today, SalaryPayment.status == 'pending')
+        timer.lap("query")
+        summary = {"dry_run": dry_run, "payments": len(rows), "timings_ms": timer.timings}
         
-        # Agrupa por motorista
-        from collections import defaultdict
-        by_driver = defaultdict(list)
-        for payment in payments_today:
-            by_driver[payment.driver_id].append(payment)
+        if not rows:
+            logger.info(f"[SCHEDULER] Nenhum salário vencendo em {today:%d/%m/%Y} (quinta-feira)")
+            return summary
         
-        total_amount = sum(p.amount for p in payments_today)
+        total_amount = sum(r.amount for r in rows)
         
         # Monta mensagem
         message = "🔔 *LEMBRETE: QUINTA-FEIRA - DIA DE PAGAMENTO!*\n\n"
         message += f"📅 Vencimento: {today.strftime('%d/%m/%Y')}\n"
         message += f"💰 Total a pagar: R$ {total_amount:.2f}\n\n"
         message += "👥 *Salários do dia:*\n\n"
-        
-        buttons = []
-        
-        for driver_id, payments in by_driver.items():
-            driver = db.get(User, driver_id)
-            driver_name = driver.full_name if driver else "Desconhecido"
-            total_driver = sum(p.amount for p in payments)
-            
-            message += f"👤 *{driver_name}*\n"
-            for payment in payments:
-                route_info = f"Rota #{payment.route_id}" if payment.route_id else "Avulso"
-                message += f"  • {route_info} - R$ {payment.amount:.2f}\n"
-                
-                # Botão individual
-                buttons.append([
-                    InlineKeyboardButton(
-                        f"✅ Confirmar R$ {payment.amount:.2f} ({driver_name[:15]})",
-                        callback_data=f"confirm_salary:{payment.id}"
-                    )
-                ])
-            
-            message += f"  💵 Subtotal: R$ {total_driver:.2f}\n\n"
-        
+        details, buttons = _salary_details(rows, today, show_overdue=False)
+        message += details
         message += "👇 *Confirme os pagamentos:*"
         
         # Botão para confirmar todos
-        if len(payments_today) > 1:
-            all_ids = ",".join(str(p.id) for p in payments_today)
-            buttons.append([
-                InlineKeyboardButton(
-                    f"✅ CONFIRMAR TODOS (R$ {total_amount:.2f})",
-                    callback_data=f"confirm_salary_all:{all_ids}"
-                )
-            ])
-        
-        keyboard = InlineKeyboardMarkup(buttons)
+        if len(rows) > 1:
+            buttons.append(_confirm_all_button(db, rows, total_amount, dry_run))
+        timer.lap("build")
         
-        # Busca managers para enviar notificação
-        managers = db.query(User).filter(User.role.in_(['manager', 'admin'])).all()
-        
-        for manager in managers:
-            try:
-                await bot.send_message(
-                    chat_id=manager.telegram_user_id,
-                    text=message,
-                    parse_mode='Markdown',
-                    reply_markup=keyboard
-                )
-                logger.info(f"[SCHEDULER] Notificação quinta-feira enviada para {manager.full_name}")
-            except Exception as e:
-                logger.error(f"[SCHEDULER] Erro ao enviar para {manager.full_name}: {e}")
-        
-    except Exception as e:
-        logger.error(f"[SCHEDULER] Erro em notify_thursday_salaries: {e}")
+        summary.update(await _send_to_managers(db, message, InlineKeyboardMarkup(buttons), dry_run))
+        timer.lap("send")
+        summary["message_chars"] = len(message)
+        logger.info(f"[SCHEDULER] Lembrete de quinta-feira: {summary}")
+        return summary
     finally:
         db.close()
 
 
-async def notify_overdue_salaries():
+async def notify_overdue_salaries(dry_run: bool = False) -> dict:
     """
     Job executada todo dia às 09:00
     Atualiza status de pendentes para overdue e notifica sobre atrasos
+
+    dry_run: o UPDATE roda e é desfeito (rollback); nada é enviado
     """
     db = SessionLocal()
-    bot = Bot(token=BOT_TOKEN)
-    
+    timer = _Timer()
     try:
         today = datetime.now().date()
         
-        # Busca salários vencidos (due_date < hoje) e ainda pending ou overdue
-        overdue_payments = db.query(SalaryPayment).filter(
-            SalaryPayment.due_date < today,
-            SalaryPayment.status.in_(['pending', 'overdue'])
-        ).all()
-        
-        if not overdue_payments:
-            logger.info("[SCHEDULER] Nenhum salário atrasado")
-            return
-        
-        # Atualiza status de pending para overdue
-        updated_count = 0
-        for payment in overdue_payments:
-            if payment.status == 'pending':
-                payment.status = 'overdue'
-                updated_count += 1
-        
-        if updated_count > 0:
+        # pending → overdue num único UPDATE
+        marked = db.execute(
+            update(SalaryPayment)
+            .where(SalaryPayment.due_date < today, SalaryPayment.status == 'pending')
+            .values(status='overdue', updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if dry_run:
+            db.rollback()
+        else:
             db.commit()
-            logger.info(f"[SCHEDULER] {updated_count} salário(s) marcado(s) como atrasado")
+        if marked and not dry_run:
+            logger.info(f"[SCHEDULER] {marked} salário(s) marcado(s) como atrasado")
+        timer.lap("update")
         
-        # Agrupa por motorista
-        from collections import defaultdict
-        by_driver = defaultdict(list)
-        for payment in overdue_payments:
-            by_driver[payment.driver_id].append(payment)
+        # Salários vencidos (due_date < hoje) e ainda não pagos
+        rows = _salary_rows(db, SalaryPayment.due_date < today, SalaryPayment.status.in_(['pending', 'overdue']))
+        timer.lap("query")
+        summary = {"dry_run": dry_run, "marked_overdue": marked, "payments": len(rows), "timings_ms": timer.timings}
         
-        total_amount = sum(p.amount for p in overdue_payments)
+        if not rows:
+            logger.info("[SCHEDULER] Nenhum salário atrasado")
+            return summary
+        
+        total_amount = sum(r.amount for r in rows)
         
         # Monta mensagem de alerta
         message = "⚠️ *ATENÇÃO: SALÁRIOS ATRASADOS!*\n\n"
         message += f"🔴 Total em atraso: R$ {total_amount:.2f}\n"
-        message += f"📊 Quantidade: {len(overdue_payments)} pagamento(s)\n\n"
+        message += f"📊 Quantidade: {len(rows)} pagamento(s)\n\n"
         message += "👥 *Detalhamento:*\n\n"
-        
-        buttons = []
-        
-        for driver_id, payments in by_driver.items():
-            driver = db.get(User, driver_id)
-            driver_name = driver.full_name if driver else "Desconhecido"
-            total_driver = sum(p.amount for p in payments)
-            
-            message += f"👤 *{driver_name}*\n"
-            for payment in payments:
-                days_overdue = (today - payment.due_date).days
-                route_info = f"Rota #{payment.route_id}" if payment.route_id else "Avulso"
-                message += f"  • {route_info} - R$ {payment.amount:.2f}\n"
-                message += f"     ⏰ Vencimento: {payment.due_date.strftime('%d/%m/%Y')} ({days_overdue} dias de atraso)\n"
-                
-                # Botão individual
-                buttons.append([
-                    InlineKeyboardButton(
-                        f"✅ Confirmar R$ {payment.amount:.2f} ({driver_name[:15]})",
-                        callback_data=f"confirm_salary:{payment.id}"
-                    )
-                ])
-            
-            message += f"  💵 Subtotal: R$ {total_driver:.2f}\n\n"
-        
+        details, buttons = _salary_details(rows, today, show_overdue=True)
+        message += details
         message += "⚡ *Regularize os pagamentos o quanto antes!*\n"
         message += "👇 Confirme os pagamentos:"
         
         # Botão para confirmar todos
-        if len(overdue_payments) > 1:
-            all_ids = ",".join(str(p.id) for p in overdue_payments)
-            buttons.append([
-                InlineKeyboardButton(
-                    f"✅ CONFIRMAR TODOS (R$ {total_amount:.2f})",
-                    callback_data=f"confirm_salary_all:{all_ids}"
-                )
-            ])
-        
-        keyboard = InlineKeyboardMarkup(buttons)
+        if len(rows) > 1:
+            buttons.append(_confirm_all_button(db, rows, total_amount, dry_run))
+        timer.lap("build")
         
-        # Busca managers para enviar notificação
-        managers = db.query(User).filter(User.role.in_(['manager', 'admin'])).all()
-        
-        for manager in managers:
-            try:
-                await bot.send_message(
-                    chat_id=manager.telegram_user_id,
-                    text=message,
-                    parse_mode='Markdown',
-                    reply_markup=keyboard
-                )
-                logger.info(f"[SCHEDULER] Notificação de atrasos enviada para {manager.full_name}")
-            except Exception as e:
-                logger.error(f"[SCHEDULER] Erro ao enviar para {manager.full_name}: {e}")
-        
-    except Exception as e:
-        logger.error(f"[SCHEDULER] Erro em notify_overdue_salaries: {e}")
+        summary.update(await _send_to_managers(db, message, InlineKeyboardMarkup(buttons), dry_run))
+        timer.lap("send")
+        summary["message_chars"] = len(message)
+        logger.info(f"[SCHEDULER] Alerta de atrasos: {summary}")
+        return summary
+    finally:
+        db.close()
+
+
+# ═══════════════════════════════════════════════════════════
+# LÍDER E RECUPERAÇÃO DE EXECUÇÕES PERDIDAS
+# ═══════════════════════════════════════════════════════════
+
+def _last_job_runs() -> Dict[str, datetime]:
+    """Início (UTC) da última execução registrada de cada job"""
+    db = SessionLocal()
+    try:
+        rows = db.query(JobRun.job_id, func.max(JobRun.started_at)).group_by(JobRun.job_id).all()
+        return {job_id: started_at for job_id, started_at in rows}
     finally:
         db.close()
 
 
-def start_scheduler():
+async def _catch_up_missed_runs(scheduler: AsyncIOScheduler) -> None:
+    """
+    Roda uma vez cada job cujo último horário passou sem execução em job_run
+    (processo fora do ar ou sem líder no horário), em ordem de horário.
+    Jobs sem histórico (instalação nova) esperam o próximo horário normal.
+    """
+    if SCHEDULER_CATCHUP_HOURS <= 0:
+        return
+    now = datetime.now(scheduler.timezone)
+    window = timedelta(hours=SCHEDULER_CATCHUP_HOURS)
+    last_runs = await asyncio.to_thread(_last_job_runs)
+
+    missed = []
+    for job in scheduler.get_jobs():
+        last = last_runs.get(job.id)
+        if job.id not in _job_stats or last is None:
+            continue
+        # Horário mais recente que passou depois da última execução (vários = um só)
+        due = None
+        fire = job.trigger.get_next_fire_time(None, last.replace(tzinfo=timezone.utc) + timedelta(seconds=1))
+        while fire is not None and fire <= now:
+            due = fire
+            fire = job.trigger.get_next_fire_time(fire, fire + timedelta(seconds=1))
+        if due is not None and now - due <= window:
+            missed.append((due, job))
+
+    for due, job in sorted(missed, key=lambda item: item[0]):
+        if not _is_leader():
+            logger.warning("[SCHEDULER] Liderança perdida durante a recuperação; parando")
+            return
+        logger.warning(f"[SCHEDULER] Recuperando {job.id} (horário perdido: {due:%d/%m %H:%M})")
+        _job_stats[job.id].catch_ups += 1
+        await job.func(fire_time=due)
+
+
+def _start_catch_up(scheduler: AsyncIOScheduler) -> None:
+    # Task separada: o heartbeat não pode esperar jobs longas
+    global _catch_up_task
+    if _catch_up_task is None or _catch_up_task.done():
+        _catch_up_task = asyncio.get_running_loop().create_task(_catch_up_missed_runs(scheduler))
+
+
+async def _lease_heartbeat(scheduler: AsyncIOScheduler) -> None:
+    """Pega/renova o lease; ao virar líder, recupera as execuções perdidas"""
+    was_leader = _lease.is_leader
+    if await asyncio.to_thread(_lease.try_acquire) and not was_leader:
+        _start_catch_up(scheduler)
+
+
+def start_scheduler(ai_report_job=None, bot: Optional[Bot] = None):
     """
-    Inicia o scheduler com as duas jobs configuradas:
+    Inicia o scheduler com as jobs configuradas:
     - Quinta-feira 12:00: Notifica salários do dia
     - Todo dia 09:00: Notifica salários atrasados
+    - Todo dia 03:30: Arquiva rotas finalizadas antigas (se ARCHIVE_AFTER_DAYS > 0)
+    - Todo dia 04:00: Pré-calcula relatórios (se PRECOMPUTE_REPORTS)
+
+    Com SCHEDULER_LEADER_LOCK, só a réplica dona do lease roda as jobs
+    (heartbeat a cada HEARTBEAT_S). Encerrar com stop_scheduler().
+
+    ai_report_job: corrotina que gera o texto de IA do /relatorio
+    (bot.precompute_ai_report); roda depois do pré-cálculo se PRECOMPUTE_AI_REPORT.
+    bot: bot da Application, usado nas notificações (sem ele, um Bot próprio)
     """
-    scheduler = AsyncIOScheduler(timezone='America/Sao_Paulo')
+    global _scheduler, _lease
+    if bot is not None:
+        set_bot(bot)
+    # coalesce: vários horários atrasados viram uma execução só;
+    # misfire_grace_time: tolera o event loop ocupado no horário exato
+    scheduler = AsyncIOScheduler(
+        timezone='America/Sao_Paulo',
+        job_defaults={"coalesce": True, "misfire_grace_time": SCHEDULER_MISFIRE_GRACE_S},
+    )
     
     # Job 1: Quinta-feira às 12:00
     scheduler.add_job(
-        notify_thursday_salaries,
+        _tracked('thursday_salary_notification', notify_thursday_salaries, uses_fire_time=True),
         trigger=CronTrigger(day_of_week='thu', hour=12, minute=0),
         id='thursday_salary_notification',
         name='Notificação de Salários - Quinta-feira 12:00',
@@ -238,7 +563,7 @@ def start_scheduler():
     
     # Job 2: Todo dia às 09:00
     scheduler.add_job(
-        notify_overdue_salaries,
+        _tracked('daily_overdue_notification', notify_overdue_salaries),
         trigger=CronTrigger(hour=9, minute=0),
         id='daily_overdue_notification',
         name='Notificação de Salários Atrasados - Diária 09:00',
@@ -246,7 +571,120 @@ def start_scheduler():
     )
     logger.info("[SCHEDULER] Job configurada: Todo dia 09:00 - Notificação de atrasos")
     
+    # Job 3: Todo dia às 03:30 (fora do horário de entregas)
+    if ARCHIVE_AFTER_DAYS > 0:
+        scheduler.add_job(
+            _tracked('daily_route_archive', archive_job),
+            trigger=CronTrigger(hour=3, minute=30),
+            id='daily_route_archive',
+            name='Arquivamento de Rotas Finalizadas - Diária 03:30',
+            replace_existing=True
+        )
+        logger.info(f"[SCHEDULER] Job configurada: Todo dia 03:30 - Arquivamento (> {ARCHIVE_AFTER_DAYS} dias)")
+    
+    # Job 4: Todo dia às 04:00 (depois do arquivamento, antes do expediente)
+    if PRECOMPUTE_REPORTS:
+        scheduler.add_job(
+            _tracked('daily_report_precompute', precompute_job),
+            trigger=CronTrigger(hour=4, minute=0),
+            id='daily_report_precompute',
+            name='Pré-cálculo de Relatórios - Diária 04:00',
+            replace_existing=True
+        )
+        logger.info("[SCHEDULER] Job configurada: Todo dia 04:00 - Pré-cálculo de relatórios")
+        
+        if PRECOMPUTE_AI_REPORT and ai_report_job is not None:
+            scheduler.add_job(
+                _tracked('daily_ai_report_precompute', ai_report_job),
+                trigger=CronTrigger(hour=4, minute=15),
+                id='daily_ai_report_precompute',
+                name='Relatório IA do Mês - Diária 04:15',
+                replace_existing=True
+            )
+            logger.info("[SCHEDULER] Job configurada: Todo dia 04:15 - Relatório IA do mês")
+    
+    if SCHEDULER_LEADER_LOCK:
+        _lease = LeaderLease(LEASE_NAME)
+        scheduler.add_job(
+            _lease_heartbeat,
+            trigger=IntervalTrigger(seconds=HEARTBEAT_S),
+            args=[scheduler],
+            id=HEARTBEAT_JOB_ID,
+            name=f'Lease do Scheduler - a cada {HEARTBEAT_S}s',
+            next_run_time=datetime.now(scheduler.timezone),
+            replace_existing=True
+        )
+        logger.info(f"[SCHEDULER] Lease de líder ativo ({_lease.holder}, TTL {_lease.ttl_s}s)")
+    else:
+        _lease = None
+        scheduler.add_job(
+            _catch_up_missed_runs,
+            args=[scheduler],
+            id=CATCH_UP_JOB_ID,
+            name='Recuperação de Execuções Perdidas',
+            replace_existing=True
+        )
+    
     scheduler.start()
+    _scheduler = scheduler
     logger.info("[SCHEDULER] ✅ Scheduler iniciado com sucesso!")
     
     return scheduler
+
+
+def stop_scheduler(scheduler: Optional[AsyncIOScheduler] = None) -> None:
+    """Para o scheduler e libera o lease para outra réplica assumir na hora"""
+    global _scheduler
+    scheduler = scheduler or _scheduler
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
+    if _catch_up_task is not None and not _catch_up_task.done():
+        _catch_up_task.cancel()
+    if _lease is not None:
+        _lease.release()
+    _scheduler = None
+    logger.info("[SCHEDULER] Scheduler parado")
+
+
+def scheduler_metrics(reset: bool = False) -> dict:
+    """Liderança e métricas por job deste processo (/metrics/scheduler e /debug)"""
+    jobs = {}
+    for job_id, stats in _job_stats.items():
+        job = _scheduler.get_job(job_id) if _scheduler is not None else None
+        jobs[job_id] = {
+            **stats.as_dict(),
+            "next_run": job.next_run_time.isoformat(timespec="seconds") if job and job.next_run_time else None,
+        }
+    result = {
+        "running": _scheduler is not None and _scheduler.running,
+        "leader_lock": _lease is not None,
+        "is_leader": _is_leader(),
+        "holder": _lease.holder if _lease else None,
+        "lease": _lease.current() if _lease else None,
+        "jobs": jobs,
+    }
+    if reset:
+        for stats in _job_stats.values():
+            stats.reset()
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    if "--dry-run" not in sys.argv[1:]:
+        print("Uso: python scheduler.py --dry-run")
+        sys.exit(1)
+
+    async def _dry_run():
+        for name, job in (("Quinta-feira", notify_thursday_salaries), ("Atrasados", notify_overdue_salaries)):
+            start = time.perf_counter()
+            summary = await job(dry_run=True)
+            total_ms = (time.perf_counter() - start) * 1000
+            steps = " | ".join(f"{step} {ms:.1f} ms" for step, ms in summary["timings_ms"].items())
+            print(f"🧪 {name}: {summary.get('payments', 0)} pagamento(s), "
+                  f"{summary.get('marked_overdue', 0)} a marcar como atrasado(s), "
+                  f"{summary.get('managers', 0)} gerente(s)")
+            print(f"   ⏱️ {steps} | total {total_ms:.1f} ms")
+
+    asyncio.run(_dry_run())
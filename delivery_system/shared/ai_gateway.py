@@ -0,0 +1,411 @@
+"""
+Gateway de IA (Groq) para Rocinha Entrega
+
+Centraliza as chamadas ao LLM para que nenhum handler bloqueie o event loop:
+- Cliente assíncrono (AsyncGroq)
+- Timeout por chamada (AI_TIMEOUT_S)
+- Semáforo global limitando chamadas simultâneas (AI_MAX_CONCURRENCY)
+- Retry com backoff exponencial + jitter em 429, 5xx, timeout e falha de conexão
+  (respeita Retry-After quando a API informa)
+- Métricas de latência (p50/p95), tempo até o primeiro token, tokens,
+  retries e erros por label
+- stream(): entrega o texto em pedaços conforme o modelo gera
+
+GROQ_BASE_URL permite apontar para um servidor local (stub) em testes.
+
+Exemplo:
+    from shared.ai_gateway import ai_gateway
+
+    if ai_gateway.available:
+        result = await ai_gateway.complete(messages, max_tokens=800, label="chat_ia")
+        print(result.text, result.completion_tokens)
+
+        async for piece in ai_gateway.stream(messages, label="relatorio"):
+            ...
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+try:
+    import groq  # type: ignore
+    from groq import AsyncGroq  # type: ignore
+except Exception:
+    groq = None
+    AsyncGroq = None  # Import opcional; IA fica desativada se não disponível
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+AI_TIMEOUT_S = float(os.getenv("AI_TIMEOUT_S", "60"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "2"))
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "3"))
+AI_BACKOFF_BASE_S = float(os.getenv("AI_BACKOFF_BASE_S", "1.0"))
+AI_BACKOFF_MAX_S = float(os.getenv("AI_BACKOFF_MAX_S", "20"))
+# Amostras de latência mantidas por label
+SAMPLE_SIZE = 200
+
+
+class AIUnavailableError(RuntimeError):
+    """IA não configurada (sem GROQ_API_KEY ou pacote groq ausente)"""
+
+
+@dataclass
+class AIResult:
+    text: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency_ms: float
+    attempts: int
+
+
+class _AIStats:
+    """Agregados de um label (ex.: relatorio, chat_ia)"""
+
+    __slots__ = ("calls", "errors", "retries", "timeouts", "prompt_tokens",
+                 "completion_tokens", "total_ms", "samples", "ttft_samples")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_ms = 0.0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+        self.ttft_samples = deque(maxlen=SAMPLE_SIZE)
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    if groq is None:
+        return False
+    if isinstance(exc, (groq.RateLimitError, groq.InternalServerError,
+                        groq.APITimeoutError, groq.APIConnectionError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    """Segundos pedidos pela API no header Retry-After (429)"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AIGateway:
+    """Cliente assíncrono do LLM com timeout, limite de concorrência, retry e métricas"""
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        model: str = DEFAULT_MODEL,
+        base_url: Optional[str] = None,
+        timeout_s: float = AI_TIMEOUT_S,
+        max_concurrency: int = AI_MAX_CONCURRENCY,
+        max_retries: int = AI_MAX_RETRIES,
+        backoff_base_s: float = AI_BACKOFF_BASE_S,
+        backoff_max_s: float = AI_BACKOFF_MAX_S,
+    ):
+        self.model = model
+        self.timeout_s = timeout_s
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.max_concurrency = max(1, max_concurrency)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._stats: Dict[str, _AIStats] = {}
+        self._lock = threading.Lock()
+        self._client = None
+
+        if api_key and AsyncGroq is not None:
+            try:
+                # Retries ficam por conta do gateway (com jitter e métricas)
+                self._client = AsyncGroq(
+                    api_key=api_key, base_url=base_url, timeout=timeout_s, max_retries=0
+                )
+            except Exception:
+                logger.error("Erro ao inicializar cliente Groq", exc_info=True)
+                self._client = None
+
+    @classmethod
+    def from_env(cls) -> "AIGateway":
+        return cls(
+            api_key=os.getenv("GROQ_API_KEY"),
+            model=os.getenv("GROQ_MODEL", DEFAULT_MODEL),
+            base_url=os.getenv("GROQ_BASE_URL") or None,
+        )
+
+    @property
+    def available(self) -> bool:
+        return self._client is not None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Criado sob demanda para nascer no event loop em uso
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _get_stats(self, label: str) -> _AIStats:
+        stats = self._stats.get(label)
+        if stats is None:
+            stats = self._stats.setdefault(label, _AIStats())
+        return stats
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        """Backoff exponencial com jitter completo (ou Retry-After, se maior)"""
+        delay = random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+        retry_after = _retry_after(exc)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max_s))
+        return delay
+
+    def _record_success(self, label: str, latency_ms: float, prompt_tokens: int,
+                        completion_tokens: int, ttft_ms: Optional[float] = None) -> None:
+        with self._lock:
+            stats = self._get_stats(label)
+            stats.calls += 1
+            stats.total_ms += latency_ms
+            stats.samples.append(latency_ms)
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            if ttft_ms is not None:
+                stats.ttft_samples.append(ttft_ms)
+
+    def _record_failure(self, label: str, exc: BaseException, elapsed_ms: float, will_retry: bool) -> None:
+        timed_out = isinstance(exc, asyncio.TimeoutError) or (
+            groq is not None and isinstance(exc, groq.APITimeoutError)
+        )
+        with self._lock:
+            stats = self._get_stats(label)
+            if timed_out:
+                stats.timeouts += 1
+            if will_retry:
+                stats.retries += 1
+            else:
+                stats.calls += 1
+                stats.errors += 1
+                stats.total_ms += elapsed_ms
+
+    def _should_retry(self, label: str, exc: BaseException, attempt: int, elapsed_ms: float) -> bool:
+        """Registra a falha e decide se vale tentar de novo"""
+        will_retry = _is_retryable(exc) and attempt < self.max_retries
+        self._record_failure(label, exc, elapsed_ms, will_retry)
+        if not will_retry:
+            logger.error(
+                f"IA falhou em {label} após {attempt + 1} tentativa(s): "
+                f"{type(exc).__name__}: {exc}"
+            )
+        return will_retry
+
+    async def complete(
+        self,
+        messages: List[dict],
+        *,
+        temperature: float = 0.7,
+        max_tokens: int = 1000,
+        label: str = "ai",
+    ) -> AIResult:
+        """
+        Executa um chat completion.
+
+        Raises:
+            AIUnavailableError: IA não configurada
+            Exception: erro da API após esgotar as tentativas (ou erro não recuperável)
+        """
+        if not self.available:
+            raise AIUnavailableError("GROQ_API_KEY não configurada")
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                async with self._get_semaphore():
+                    start = time.perf_counter()
+                    response = await asyncio.wait_for(
+                        self._client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            temperature=temperature,
+                            max_tokens=max_tokens,
+                        ),
+                        timeout=self.timeout_s,
+                    )
+            except Exception as exc:
+                if not self._should_retry(label, exc, attempt, (time.perf_counter() - start) * 1000):
+                    raise
+                delay = self._backoff(attempt, exc)
+                logger.warning(
+                    f"IA {label}: {type(exc).__name__} na tentativa {attempt + 1}, "
+                    f"nova tentativa em {delay:.1f}s"
+                )
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            latency_ms = (time.perf_counter() - start) * 1000
+            usage = getattr(response, "usage", None)
+            prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+            completion_tokens = int(getattr(usage, "completion_tokens", 0) or 0)
+            self._record_success(label, latency_ms, prompt_tokens, completion_tokens)
+
+            return AIResult(
+                text=(response.choices[0].message.content or ""),
+                model=getattr(response, "model", None) or self.model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                latency_ms=latency_ms,
+                attempts=attempt + 1,
+            )
+
+    async def stream(
+        self,
+        messages: List[dict],
+        *,
+        temperature: float = 0.7,
+        max_tokens: int = 1000,
+        label: str = "ai",
+    ) -> AsyncIterator[str]:
+        """
+        Chat completion em streaming: gera os pedaços de texto conforme chegam.
+
+        O timeout vale para o primeiro pedaço e para cada intervalo entre pedaços.
+        Só há retry enquanto nada foi entregue; depois disso o erro é propagado
+        (quem consome decide o que fazer com o texto parcial).
+        """
+        if not self.available:
+            raise AIUnavailableError("GROQ_API_KEY não configurada")
+
+        attempt = 0
+        while True:
+            semaphore = self._get_semaphore()
+            await semaphore.acquire()
+            start = time.perf_counter()
+            ttft_ms = None
+            prompt_tokens = completion_tokens = 0
+            response = None
+            try:
+                try:
+                    response = await asyncio.wait_for(
+                        self._client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            temperature=temperature,
+                            max_tokens=max_tokens,
+                            stream=True,
+                        ),
+                        timeout=self.timeout_s,
+                    )
+                    chunks = response.__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout_s)
+                        except StopAsyncIteration:
+                            break
+                        # O Groq manda o uso de tokens no último pedaço (x_groq.usage)
+                        usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+                        if usage is not None:
+                            prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+                            completion_tokens = int(getattr(usage, "completion_tokens", 0) or 0)
+                        piece = chunk.choices[0].delta.content if chunk.choices else None
+                        if piece:
+                            if ttft_ms is None:
+                                ttft_ms = (time.perf_counter() - start) * 1000
+                            yield piece
+                except Exception as exc:
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    if ttft_ms is not None:
+                        # Texto parcial já entregue: não dá para repetir
+                        self._record_failure(label, exc, elapsed_ms, will_retry=False)
+                        logger.error(f"IA {label}: stream interrompido ({type(exc).__name__}: {exc})")
+                        raise
+                    if not self._should_retry(label, exc, attempt, elapsed_ms):
+                        raise
+                    delay = self._backoff(attempt, exc)
+                    logger.warning(
+                        f"IA {label}: {type(exc).__name__} na tentativa {attempt + 1}, "
+                        f"nova tentativa em {delay:.1f}s"
+                    )
+                else:
+                    self._record_success(
+                        label, (time.perf_counter() - start) * 1000,
+                        prompt_tokens, completion_tokens, ttft_ms,
+                    )
+                    return
+            finally:
+                semaphore.release()
+                close = getattr(response, "close", None)
+                if close is not None:
+                    try:
+                        await close()
+                    except Exception:
+                        pass
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def metrics(self) -> List[dict]:
+        """Agregados por label, ordenados pela quantidade de chamadas (desc)"""
+        with self._lock:
+            snapshot = [
+                (label, s.calls, s.errors, s.retries, s.timeouts, s.prompt_tokens,
+                 s.completion_tokens, s.total_ms, sorted(s.samples), sorted(s.ttft_samples))
+                for label, s in self._stats.items()
+            ]
+        result = []
+        for (label, calls, errors, retries, timeouts, prompt_tokens,
+             completion_tokens, total_ms, samples, ttft) in snapshot:
+            result.append({
+                "label": label,
+                "calls": calls,
+                "errors": errors,
+                "retries": retries,
+                "timeouts": timeouts,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "avg_ms": round(total_ms / calls, 2) if calls else 0.0,
+                "p50_ms": round(_percentile(samples, 50), 2),
+                "p95_ms": round(_percentile(samples, 95), 2),
+                "ttft_p50_ms": round(_percentile(ttft, 50), 2) if ttft else None,
+                "ttft_p95_ms": round(_percentile(ttft, 95), 2) if ttft else None,
+            })
+        result.sort(key=lambda r: r["calls"], reverse=True)
+        return result
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+# Instância única usada pelo bot e pela API
+ai_gateway = AIGateway.from_env()
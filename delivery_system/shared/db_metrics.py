@@ -0,0 +1,216 @@
+"""
+Instrumentação de queries SQL para Rocinha Entrega
+
+Registra, via eventos do SQLAlchemy, quantas queries cada handler do bot
+ou rota HTTP executa, o tempo total e os percentis p50/p95/p99.
+Queries acima do limite (DB_SLOW_QUERY_MS) são logadas sem os parâmetros.
+"""
+
+import functools
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger, log_database_query
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+    def log_database_query(query_type: str, table: str, duration_ms: float = None):
+        logger.debug(f"Query {query_type} em {table}")
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+# Quantidade de amostras mantidas por label para cálculo de percentis
+SAMPLE_SIZE = int(os.getenv("DB_METRICS_SAMPLES", "500"))
+# Label usado quando a query não acontece dentro de um handler/rota
+DEFAULT_LABEL = "sem_contexto"
+
+# Handler do bot ou rota HTTP que está executando no momento
+current_label: ContextVar[str] = ContextVar("db_query_label", default=DEFAULT_LABEL)
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+class _LabelStats:
+    """Agregados de um label (handler ou rota)"""
+
+    __slots__ = ("queries", "total_ms", "max_ms", "slow", "invocations", "samples")
+
+    def __init__(self):
+        self.queries = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.slow = 0
+        self.invocations = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+
+_stats: Dict[str, _LabelStats] = {}
+_lock = threading.Lock()
+
+
+def _get_stats(label: str) -> _LabelStats:
+    stats = _stats.get(label)
+    if stats is None:
+        stats = _stats.setdefault(label, _LabelStats())
+    return stats
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _describe(statement: str):
+    """Extrai (tipo, tabela) de um SQL para o log padronizado"""
+    stripped = statement.lstrip()
+    query_type = stripped.split(None, 1)[0].upper() if stripped else "?"
+    match = _TABLE_RE.search(statement)
+    return query_type, (match.group(1) if match else "?")
+
+
+# ═══════════════════════════════════════════════════════════
+# CONTEXTO (handler/rota atual)
+# ═══════════════════════════════════════════════════════════
+
+@contextmanager
+def query_label(label: str):
+    """
+    Atribui as queries executadas dentro do bloco ao label informado.
+
+    Exemplo:
+        with query_label("cmd_relatorio"):
+            db.query(Route).all()
+    """
+    token = current_label.set(label)
+    with _lock:
+        _get_stats(label).invocations += 1
+    try:
+        yield
+    finally:
+        current_label.reset(token)
+
+
+def track_handler(func, label: Optional[str] = None):
+    """Envolve um callback async para que suas queries sejam atribuídas a ele"""
+    name = label or getattr(func, "__name__", "handler")
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with query_label(name):
+            return await func(*args, **kwargs)
+
+    wrapper.__db_metrics_wrapped__ = True
+    return wrapper
+
+
+# ═══════════════════════════════════════════════════════════
+# EVENTOS DO SQLALCHEMY
+# ═══════════════════════════════════════════════════════════
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("query_start_time")
+    if not starts:
+        return
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+    label = current_label.get()
+    is_slow = duration_ms >= SLOW_QUERY_MS
+
+    with _lock:
+        stats = _get_stats(label)
+        stats.queries += 1
+        stats.total_ms += duration_ms
+        stats.samples.append(duration_ms)
+        if duration_ms > stats.max_ms:
+            stats.max_ms = duration_ms
+        if is_slow:
+            stats.slow += 1
+
+    if is_slow:
+        # Parâmetros nunca são logados (podem conter nomes, documentos, endereços)
+        n_params = len(parameters) if isinstance(parameters, (list, tuple, dict)) else 0
+        sql = " ".join(statement.split())
+        logger.warning(
+            f"Query lenta ({duration_ms:.1f}ms) em {label}: {sql[:500]} "
+            f"[{n_params} parâmetro(s) omitidos]"
+        )
+    elif logger.isEnabledFor(logging.DEBUG):
+        query_type, table = _describe(statement)
+        log_database_query(query_type, table, duration_ms)
+
+
+def _on_query_error(exception_context) -> None:
+    # Query que falhou não passa pelo after_cursor_execute: descarta o início
+    # dela para a conexão (reaproveitada pelo pool) não parear tempos errados
+    conn = exception_context.connection
+    if conn is None:
+        return
+    starts = conn.info.get("query_start_time")
+    if starts:
+        starts.pop()
+
+
+def install_query_instrumentation(engine) -> None:
+    """Registra os hooks de medição no engine (idempotente)"""
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _on_query_error)
+
+
+# ═══════════════════════════════════════════════════════════
+# LEITURA DAS MÉTRICAS
+# ═══════════════════════════════════════════════════════════
+
+def get_query_metrics() -> List[dict]:
+    """Retorna os agregados por label, ordenados pelo tempo total (desc)"""
+    with _lock:
+        snapshot = [
+            (label, s.queries, s.total_ms, s.max_ms, s.slow, s.invocations, sorted(s.samples))
+            for label, s in _stats.items()
+            if s.queries
+        ]
+
+    result = []
+    for label, queries, total_ms, max_ms, slow, invocations, samples in snapshot:
+        result.append({
+            "label": label,
+            "queries": queries,
+            "invocations": invocations,
+            "queries_per_call": round(queries / invocations, 1) if invocations else None,
+            "total_ms": round(total_ms, 2),
+            "avg_ms": round(total_ms / queries, 2) if queries else 0.0,
+            "p50_ms": round(_percentile(samples, 50), 2),
+            "p95_ms": round(_percentile(samples, 95), 2),
+            "p99_ms": round(_percentile(samples, 99), 2),
+            "max_ms": round(max_ms, 2),
+            "slow": slow,
+        })
+    result.sort(key=lambda r: r["total_ms"], reverse=True)
+    return result
+
+
+def reset_query_metrics() -> None:
+    """Zera todos os agregados"""
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,33 @@
+"""
+Impressão digital (hash) de dados para cache
+
+Gera um SHA-256 estável de estruturas JSON-serializáveis (dicts, listas,
+números). Usado para saber se os KPIs que alimentam um prompt de IA mudaram:
+mesmo fingerprint → mesma entrada → o texto já gerado pode ser reaproveitado.
+"""
+
+import hashlib
+import json
+from typing import Any
+
+
+def _normalize(value: Any) -> Any:
+    """Arredonda floats para evitar diferenças de ponto flutuante no hash"""
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def fingerprint(data: Any) -> str:
+    """
+    Hash hexadecimal de `data` (chaves ordenadas, floats com 2 casas).
+
+    Exemplo:
+        fingerprint({"receita": 1200.0, "motoristas": [...]})  # 'a3f1...'
+    """
+    canonical = json.dumps(_normalize(data), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
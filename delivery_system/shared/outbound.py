@@ -0,0 +1,500 @@
+"""
+Fila de saída do Telegram (envios com limite de taxa, prioridade e retry)
+
+Os envios do bot eram awaits em série com `except: pass`: um 429 (flood
+control) no meio das fotos de um comprovante descartava o resto sem aviso.
+Todo envio "para fora" (canal do motorista, gerentes, jobs do scheduler,
+/enviarrota) passa pelo OutboundDispatcher:
+
+- Token bucket global (OUTBOUND_GLOBAL_RATE msg/s) e por chat: chat privado
+  ~1 msg/s, grupo/canal ~20 msg/min (limites documentados do Telegram)
+- Prioridade: HIGH (motorista esperando) > NORMAL (gerentes) > LOW (arquivo
+  no canal). Dentro de um chat a ordem de envio é sempre a ordem da fila
+- RetryAfter: o chat fica pausado pelo tempo pedido e a mensagem volta para
+  o início da fila do chat (não conta como falha)
+- Falha de conexão: nova tentativa com backoff exponencial (OUTBOUND_MAX_RETRIES)
+- TimedOut: falha na hora. O Telegram pode ter recebido a mensagem e repetir
+  duplicaria o envio; chamadas idempotentes (edições, exclusões) podem optar
+  por repetir com retry_timeouts=True
+- BadRequest/Forbidden: falha na hora (repetir não adianta); "message is not
+  modified" numa edição conta como enviado (a mensagem já está como pedido)
+- Edições (submit_edit/edit): uma edição ainda na fila para a mesma mensagem
+  é substituída pela nova (vale o texto mais recente; os dois Futures são o
+  mesmo). Streaming e barras de progresso não acumulam edições velhas
+- Até OUTBOUND_MAX_CONCURRENCY chats sendo atendidos ao mesmo tempo; um chat
+  esperando o próprio limite não segura um worker
+- Métricas por label: enviados, falhas, retries, flood waits, edições
+  juntadas e tempo na fila
+
+Exemplo:
+    from shared.outbound import outbound, HIGH, LOW
+
+    # Aguarda o envio (levanta a exceção se falhar de vez)
+    msg = await outbound.send(bot.send_message, chat_id=tid, text="...", priority=HIGH, label="rota")
+
+    # Só enfileira (o resultado fica no Future; falhas vão para o log e métricas)
+    outbound.submit(bot.send_photo, chat_id=canal, photo=file_id, priority=LOW, label="comprovante")
+
+    # Edição de uma mensagem já enviada (junta com a pendente da mesma mensagem)
+    outbound.submit_edit(msg, text="50%...", label="progresso")
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Union
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1.0"))
+OUTBOUND_GROUP_RATE_PER_MIN = float(os.getenv("OUTBOUND_GROUP_RATE_PER_MIN", "20"))
+# Mensagens que um chat pode receber de uma vez antes de o limite valer
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_CONCURRENCY = int(os.getenv("OUTBOUND_MAX_CONCURRENCY", "8"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "4"))
+OUTBOUND_BACKOFF_MAX_S = 30.0
+# Amostras de tempo na fila mantidas por label
+SAMPLE_SIZE = 200
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+ChatId = Union[int, str]
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _is_group(chat_id: ChatId) -> bool:
+    """Grupos e canais têm id negativo (canais: -100...)"""
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return str(chat_id).startswith("@")  # @canal_publico
+
+
+class TokenBucket:
+    """Balde de fichas: `rate` fichas/s, até `capacity` acumuladas"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: Optional[float] = None) -> float:
+        """Segundos até poder enviar (0 = pode agora)"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """Pausa o balde (RetryAfter) e zera as fichas acumuladas"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = now
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+@dataclass
+class _Job:
+    method: Callable[..., Awaitable[Any]]
+    chat_id: ChatId
+    kwargs: Dict[str, Any]
+    priority: int
+    label: str
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    retry_timeouts: bool = False
+    coalesce_key: Optional[Hashable] = None
+
+
+class _Stats:
+    __slots__ = ("sent", "failed", "retries", "flood_waits", "coalesced", "samples")
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.flood_waits = 0
+        self.coalesced = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+
+class OutboundDispatcher:
+    """Fila única de envios do bot, com uma fila (FIFO) por chat"""
+
+    def __init__(
+        self,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        group_rate_per_min: float = OUTBOUND_GROUP_RATE_PER_MIN,
+        chat_burst: int = OUTBOUND_CHAT_BURST,
+        max_concurrency: int = OUTBOUND_MAX_CONCURRENCY,
+        max_retries: int = OUTBOUND_MAX_RETRIES,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_min / 60.0
+        self.chat_burst = chat_burst
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._stats: Dict[str, _Stats] = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        self._global = TokenBucket(self.global_rate, max(1.0, self.global_rate))
+        self._buckets: Dict[ChatId, TokenBucket] = {}
+        self._lanes: Dict[ChatId, Deque[_Job]] = {}
+        # Chats prontos para um worker: (prioridade do 1º da fila, seq, chat)
+        self._ready: Optional[asyncio.PriorityQueue] = None
+        self._active: set = set()
+        self._scheduled: set = set()
+        self._workers: List[asyncio.Task] = []
+
+    # ─────────────────────────────────────────────────────────
+    # Enfileiramento
+    # ─────────────────────────────────────────────────────────
+
+    def _ensure_started(self) -> None:
+        """Workers nascem no event loop em uso (e renascem se o loop mudar)"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._reset_state()
+        if self._ready is None:
+            self._ready = asyncio.PriorityQueue()
+        if not self._workers:
+            self._workers = [
+                loop.create_task(self._worker(), name=f"outbound-{i}")
+                for i in range(self.max_concurrency)
+            ]
+
+    def submit(
+        self,
+        method: Callable[..., Awaitable[Any]],
+        *,
+        chat_id: ChatId,
+        priority: int = NORMAL,
+        label: str = "outbound",
+        retry_timeouts: bool = False,
+        coalesce_key: Optional[Hashable] = None,
+        **kwargs,
+    ) -> asyncio.Future:
+        """
+        Enfileira `method(chat_id=..., **kwargs)` e devolve o Future do resultado.
+        Falhas definitivas ficam no Future (e no log), nunca somem em silêncio.
+        retry_timeouts=True só para chamadas idempotentes (repetir não duplica).
+        coalesce_key: job ainda na fila do chat com a mesma chave recebe estes
+        kwargs no lugar dos dela (e o Future dela é devolvido)
+        """
+        self._ensure_started()
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = deque()
+        if coalesce_key is not None:
+            for queued in lane:
+                if queued.coalesce_key == coalesce_key and not queued.future.done():
+                    queued.method, queued.kwargs, queued.label = method, kwargs, label
+                    queued.retry_timeouts = retry_timeouts
+                    self._count(label, "coalesced")
+                    return queued.future
+        job = _Job(
+            method, chat_id, kwargs, priority, label, self._loop.create_future(),
+            retry_timeouts=retry_timeouts, coalesce_key=coalesce_key,
+        )
+        job.future.add_done_callback(lambda f, job=job: self._log_failure(job, f))
+        lane.append(job)
+        self._wake(chat_id)
+        return job.future
+
+    async def send(
+        self,
+        method: Callable[..., Awaitable[Any]],
+        *,
+        chat_id: ChatId,
+        priority: int = NORMAL,
+        label: str = "outbound",
+        retry_timeouts: bool = False,
+        coalesce_key: Optional[Hashable] = None,
+        **kwargs,
+    ) -> Any:
+        """Enfileira e aguarda o envio; levanta a exceção se falhar de vez"""
+        return await self.submit(
+            method, chat_id=chat_id, priority=priority, label=label,
+            retry_timeouts=retry_timeouts, coalesce_key=coalesce_key, **kwargs,
+        )
+
+    def submit_edit(self, message, *, priority: int = NORMAL, label: str = "edicao", **kwargs) -> asyncio.Future:
+        """
+        Edita o texto de `message` (kwargs de edit_message_text) pela fila.
+        Edição pendente da mesma mensagem é substituída; repetir após
+        timeout é seguro (o resultado é o mesmo).
+        """
+        return self.submit(
+            message.get_bot().edit_message_text, chat_id=message.chat_id, message_id=message.message_id,
+            priority=priority, label=label, retry_timeouts=True,
+            coalesce_key=("edit", message.message_id), **kwargs,
+        )
+
+    async def edit(self, message, *, priority: int = NORMAL, label: str = "edicao", **kwargs) -> Any:
+        """submit_edit e aguarda; levanta a exceção se falhar de vez"""
+        return await self.submit_edit(message, priority=priority, label=label, **kwargs)
+
+    def submit_delete(self, message, *, priority: int = NORMAL, label: str = "edicao") -> asyncio.Future:
+        """Apaga `message` pela fila (depois das edições já enfileiradas para ela)"""
+        return self.submit(
+            message.get_bot().delete_message, chat_id=message.chat_id, message_id=message.message_id,
+            priority=priority, label=label, retry_timeouts=True,
+        )
+
+    def _wake(self, chat_id: ChatId) -> None:
+        """Coloca o chat na fila de prontos (se não estiver sendo atendido/agendado)"""
+        lane = self._lanes.get(chat_id)
+        if not lane or chat_id in self._active or chat_id in self._scheduled:
+            return
+        self._scheduled.add(chat_id)
+        self._ready.put_nowait((lane[0].priority, next(self._seq), chat_id))
+
+    def _wake_later(self, chat_id: ChatId, delay: float) -> None:
+        self._scheduled.add(chat_id)
+
+        def wake():
+            self._scheduled.discard(chat_id)
+            self._wake(chat_id)
+
+        self._loop.call_later(delay, wake)
+
+    # ─────────────────────────────────────────────────────────
+    # Envio
+    # ─────────────────────────────────────────────────────────
+
+    def _bucket(self, chat_id: ChatId) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 1024:
+                now = time.monotonic()
+                for key in [k for k, b in self._buckets.items() if k not in self._lanes and b.idle(now)]:
+                    del self._buckets[key]
+            rate = self.group_rate if _is_group(chat_id) else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, chat_id = await self._ready.get()
+            self._scheduled.discard(chat_id)
+            lane = self._lanes.get(chat_id)
+            if not lane or chat_id in self._active:
+                continue
+
+            bucket = self._bucket(chat_id)
+            wait = bucket.delay()
+            if wait > 0:
+                # Chat no limite: volta para a fila quando liberar, sem segurar o worker
+                self._wake_later(chat_id, wait)
+                continue
+
+            self._active.add(chat_id)
+            job = lane.popleft()
+            try:
+                await self._send(job, bucket)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Fila de saída: erro inesperado no worker", exc_info=True)
+            finally:
+                self._active.discard(chat_id)
+                if lane:
+                    self._wake(chat_id)
+                elif self._lanes.get(chat_id) is lane:
+                    del self._lanes[chat_id]
+
+    async def _send(self, job: _Job, bucket: TokenBucket) -> None:
+        if job.future.done():  # cancelado por quem pediu
+            return
+        while True:
+            wait = self._global.delay()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._global.take()
+        bucket.take()
+
+        job.attempts += 1
+        try:
+            result = await job.method(chat_id=job.chat_id, **job.kwargs)
+        except RetryAfter as e:
+            retry_after = float(e.retry_after)
+            bucket.block(retry_after)
+            self._count(job.label, "flood_waits")
+            logger.warning(f"Fila de saída: flood control em {job.chat_id} ({job.label}), aguardando {retry_after:.0f}s")
+            self._requeue(job)
+            return
+        except (BadRequest, Forbidden) as e:
+            if isinstance(e, BadRequest) and "not modified" in str(e).lower():
+                result = None  # edição sem mudança: a mensagem já está como pedido
+            else:
+                self._fail(job, e)
+                return
+        except TimedOut as e:
+            # A requisição pode ter chegado ao Telegram: repetir duplicaria a mensagem
+            if not job.retry_timeouts:
+                self._fail(job, e)
+                return
+            self._retry(job, bucket, e)
+            return
+        except NetworkError as e:
+            # Falha de conexão: a requisição não foi entregue, pode repetir
+            self._retry(job, bucket, e)
+            return
+        except Exception as e:
+            self._fail(job, e)
+            return
+
+        with self._lock:
+            stats = self._get_stats(job.label)
+            stats.sent += 1
+            stats.samples.append((time.monotonic() - job.enqueued) * 1000)
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _requeue(self, job: _Job) -> None:
+        """Volta para o início da fila do chat (a ordem do chat é mantida)"""
+        lane = self._lanes.get(job.chat_id)
+        if lane is None:
+            lane = self._lanes[job.chat_id] = deque()
+        lane.appendleft(job)
+
+    def _retry(self, job: _Job, bucket: TokenBucket, exc: Exception) -> None:
+        """Nova tentativa com backoff exponencial (ou falha após OUTBOUND_MAX_RETRIES)"""
+        if job.attempts > self.max_retries:
+            self._fail(job, exc)
+            return
+        delay = random.uniform(0, min(OUTBOUND_BACKOFF_MAX_S, 2 ** job.attempts))
+        bucket.block(delay)
+        self._count(job.label, "retries")
+        self._requeue(job)
+
+    def _fail(self, job: _Job, exc: BaseException) -> None:
+        self._count(job.label, "failed")
+        if not job.future.done():
+            job.future.set_exception(exc)
+
+    def _log_failure(self, job: _Job, future: asyncio.Future) -> None:
+        # Marca a exceção como lida: quem usou submit() pode não aguardar
+        if future.cancelled() or future.exception() is None:
+            return
+        exc = future.exception()
+        logger.warning(
+            f"Fila de saída: envio para {job.chat_id} ({job.label}) falhou após "
+            f"{job.attempts} tentativa(s): {type(exc).__name__}: {exc}"
+        )
+
+    # ─────────────────────────────────────────────────────────
+    # Métricas
+    # ─────────────────────────────────────────────────────────
+
+    def _get_stats(self, label: str) -> _Stats:
+        stats = self._stats.get(label)
+        if stats is None:
+            stats = self._stats.setdefault(label, _Stats())
+        return stats
+
+    def _count(self, label: str, counter: str) -> None:
+        with self._lock:
+            stats = self._get_stats(label)
+            setattr(stats, counter, getattr(stats, counter) + 1)
+
+    def pending(self) -> int:
+        """Mensagens aguardando envio (todas as filas)"""
+        return sum(len(lane) for lane in list(self._lanes.values()))
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Espera as filas esvaziarem (ex.: antes de desligar). False se estourar o timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending() or self._active:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def metrics(self) -> dict:
+        """Fila atual e agregados por label (tempo na fila = enfileirado → enviado)"""
+        with self._lock:
+            snapshot = [
+                (label, s.sent, s.failed, s.retries, s.flood_waits, s.coalesced, sorted(s.samples))
+                for label, s in self._stats.items()
+            ]
+        labels = [
+            {
+                "label": label,
+                "sent": sent,
+                "failed": failed,
+                "retries": retries,
+                "flood_waits": flood_waits,
+                "coalesced": coalesced,
+                "queue_p50_ms": round(_percentile(samples, 50), 2),
+                "queue_p95_ms": round(_percentile(samples, 95), 2),
+            }
+            for label, sent, failed, retries, flood_waits, coalesced, samples in snapshot
+        ]
+        labels.sort(key=lambda r: r["sent"], reverse=True)
+        return {
+            "pending": self.pending(),
+            "chats_waiting": len(self._lanes),
+            "max_concurrency": self.max_concurrency,
+            "labels": labels,
+        }
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+# Instância única do processo (bot, scheduler e API)
+outbound = OutboundDispatcher()
@@ -0,0 +1,82 @@
+"""
+Períodos de datas para consultas (semana, mês, dia)
+
+Todo período é semiaberto: [start, end). Filtrar com
+`coluna >= start AND coluna < end` mantém a consulta sargável, ou seja, o
+banco consegue usar o índice da coluna. Já `func.date(coluna) == dia`
+obriga a aplicar a função em todas as linhas.
+"""
+
+from datetime import date, datetime, time, timedelta
+from typing import NamedTuple, Union
+
+from sqlalchemy import and_
+
+
+class Period(NamedTuple):
+    """Período semiaberto [start, end) em dias"""
+    start: date
+    end: date
+
+    @property
+    def last_day(self) -> date:
+        """Último dia incluído no período (para exibição)"""
+        return self.end - timedelta(days=1)
+
+    @property
+    def start_dt(self) -> datetime:
+        return datetime.combine(self.start, time.min)
+
+    @property
+    def end_dt(self) -> datetime:
+        return datetime.combine(self.end, time.min)
+
+
+def _as_date(ref: Union[date, datetime]) -> date:
+    return ref.date() if isinstance(ref, datetime) else ref
+
+
+def day_period(ref: Union[date, datetime]) -> Period:
+    """O dia de `ref`"""
+    day = _as_date(ref)
+    return Period(day, day + timedelta(days=1))
+
+
+def days_period(first_day: date, last_day: date) -> Period:
+    """De first_day até last_day (ambos inclusos)"""
+    return Period(first_day, last_day + timedelta(days=1))
+
+
+def week_period(ref: Union[date, datetime], offset_weeks: int = 0) -> Period:
+    """Semana de segunda a domingo que contém `ref` (deslocada em semanas)"""
+    day = _as_date(ref)
+    monday = day - timedelta(days=day.weekday()) + timedelta(weeks=offset_weeks)
+    return Period(monday, monday + timedelta(days=7))
+
+
+def month_period(ref: Union[date, datetime], offset_months: int = 0) -> Period:
+    """Mês que contém `ref` (deslocado em meses)"""
+    day = _as_date(ref)
+    index = day.year * 12 + (day.month - 1) + offset_months
+    start = date(index // 12, index % 12 + 1, 1)
+    index += 1
+    return Period(start, date(index // 12, index % 12 + 1, 1))
+
+
+def in_period(column, period: Period):
+    """
+    Predicado sargável para a coluna no período.
+
+    Colunas Date são comparadas com dias; colunas DateTime, com o início do dia.
+
+    Exemplo:
+        db.query(Route).filter(in_period(Route.created_at, day_period(datetime.now())))
+    """
+    python_type = None
+    try:
+        python_type = column.type.python_type
+    except (AttributeError, NotImplementedError):
+        pass
+    if python_type is datetime:
+        return and_(column >= period.start_dt, column < period.end_dt)
+    return and_(column >= period.start, column < period.end)
@@ -0,0 +1,179 @@
+"""
+Mensagem de progresso com edições limitadas (Telegram)
+
+Fluxos com várias etapas (/relatorio, importação, envio de rota) mostravam
+cada etapa com um edit_text, mesmo quando a etapa levava microssegundos: o
+tempo do comando era quase todo ida e volta à API do Telegram.
+
+ProgressReporter:
+- Guarda só o estado mais recente (etapas rápidas se juntam numa edição)
+- No máximo uma edição a cada PROGRESS_EDIT_INTERVAL_S segundos; o último
+  estado pendente é enviado quando o intervalo termina
+- Não edita se o texto não mudou
+- finish() sempre aplica o estado final (cancela o que estava pendente)
+- As edições passam pela fila de saída (shared/outbound.py): limite por chat,
+  RetryAfter e, se uma edição ainda estiver na fila, a nova a substitui.
+  Etapas intermediárias não esperam a edição; só finish() aguarda
+
+Exemplo:
+    progress = await ProgressReporter.start(update.message.reply_text, "📊 *Gerando Relatório*", 10, "Iniciando...")
+    await progress.update(40, "Calculando métricas...")
+    await progress.finish("✅ Pronto!")
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from shared.outbound import outbound, HIGH
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+
+PROGRESS_EDIT_INTERVAL_S = float(os.getenv("PROGRESS_EDIT_INTERVAL_S", "1.0"))
+
+
+def progress_bar(percent: int, width: int = 10) -> str:
+    """[▓▓▓░░░░░░░] para o percentual"""
+    filled = min(width, max(0, int(percent * width / 100 + 0.5)))
+    return "▓" * filled + "░" * (width - filled)
+
+
+class ProgressReporter:
+    """Mantém uma mensagem de progresso atualizada sem exceder o intervalo de edição"""
+
+    def __init__(
+        self,
+        message,
+        title: str = "",
+        parse_mode: Optional[str] = "Markdown",
+        interval_s: float = PROGRESS_EDIT_INTERVAL_S,
+    ):
+        self.message = message
+        self.title = title
+        self.parse_mode = parse_mode
+        self.interval_s = interval_s
+        self.edits = 0
+        self.skipped = 0
+        self._shown: Optional[str] = getattr(message, "text", None) if message is not None else None
+        self._pending: Optional[str] = None
+        # Mensagem existente (ex.: do callback): a primeira etapa aparece na hora
+        self._last_edit = 0.0
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._finished = False
+
+    @classmethod
+    async def start(
+        cls,
+        send: Callable[..., Awaitable],
+        title: str,
+        percent: Optional[int] = None,
+        status: str = "",
+        icon: str = "🔄",
+        **kwargs,
+    ) -> "ProgressReporter":
+        """Envia a mensagem inicial (ex.: update.message.reply_text) e devolve o reporter"""
+        reporter = cls(None, title, **kwargs)
+        text = reporter.render(percent, status, icon)
+        reporter.message = await send(text, parse_mode=reporter.parse_mode)
+        reporter._shown = text
+        reporter._last_edit = time.monotonic()
+        return reporter
+
+    def render(self, percent: Optional[int], status: str, icon: str = "🔄") -> str:
+        if percent is None:
+            line = f"{icon} {status}"
+        else:
+            line = f"{icon} [{progress_bar(percent)}] {percent}% - {status}"
+        return f"{self.title}\n\n{line}" if self.title else line
+
+    async def update(self, percent: Optional[int], status: str, icon: str = "🔄") -> None:
+        """Registra a etapa atual; edita agora ou quando o intervalo terminar"""
+        await self.set_text(self.render(percent, status, icon))
+
+    async def set_text(self, text: str) -> None:
+        if self._finished:
+            return
+        if text == (self._pending or self._shown):
+            self.skipped += 1
+            return
+        if self._pending is not None:
+            self.skipped += 1
+        self._pending = text
+        wait = self._wait_time()
+        if wait <= 0:
+            await self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later(wait))
+
+    def _wait_time(self) -> float:
+        return max(self._last_edit + self.interval_s - time.monotonic(), 0.0)
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.debug(f"Progresso: edição adiada falhou: {e}")
+
+    async def flush(self) -> None:
+        """Envia o estado pendente (se houver e for diferente do que está na tela)"""
+        async with self._lock:
+            text, self._pending = self._pending, None
+            if self._finished or text is None or text == self._shown:
+                return
+            # Não espera: falhas ficam no log da fila de saída
+            outbound.submit_edit(self.message, text=text, parse_mode=self.parse_mode, priority=HIGH, label="progresso")
+            self._shown = text
+            self._last_edit = time.monotonic()
+            self.edits += 1
+
+    async def finish(
+        self,
+        text: Optional[str] = None,
+        parse_mode: Optional[str] = "Markdown",
+        fallback_text: Optional[str] = None,
+        **kwargs,
+    ) -> None:
+        """
+        Encerra o progresso. Com `text`, aplica o estado final na mensagem
+        (sempre, sem limite de intervalo); sem `text`, só descarta o pendente
+        para que a mensagem possa ser editada/apagada por quem chamou.
+
+        Se a versão formatada for rejeitada, envia fallback_text (ou o texto
+        sem formatação).
+        """
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        async with self._lock:
+            self._finished = True
+            self._pending = None
+            if text is None or (text == self._shown and not kwargs):
+                return
+            # Substitui a edição intermediária que ainda estiver na fila
+            try:
+                await outbound.edit(self.message, text=text, parse_mode=parse_mode,
+                                    priority=HIGH, label="progresso", **kwargs)
+            except Exception as e:
+                if not parse_mode:
+                    raise
+                logger.warning(f"Progresso: formatação {parse_mode} rejeitada, enviando sem formatação: {e}")
+                text = fallback_text if fallback_text is not None else text
+                await outbound.edit(self.message, text=text, priority=HIGH, label="progresso", **kwargs)
+            self._shown = text
+            self.edits += 1
+
+    async def delete(self) -> None:
+        """Encerra e apaga a mensagem de progresso"""
+        await self.finish()
+        try:
+            await outbound.submit_delete(self.message, priority=HIGH, label="progresso")
+        except Exception:
+            pass
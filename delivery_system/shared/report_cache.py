@@ -0,0 +1,273 @@
+"""
+Cache de relatórios (bot e API)
+
+- LRU com limite de entradas (REPORT_CACHE_MAX_ENTRIES)
+- TTL por entrada (REPORT_CACHE_TTL_S)
+- Invalidação por tag: toda gravação que muda os números (importação,
+  finalização, entrega, exclusões, receitas/despesas/KM) passa por
+  daily_summary, que invalida as tags dos meses recalculados
+- Métricas de hit/miss/expirados/evictions/invalidações (contadas por processo)
+- Backend opcional em disco (REPORT_CACHE_DIR): arquivo SQLite compartilhado
+  entre processos (ex.: vários workers do uvicorn). Uma invalidação em um
+  processo vale para todos.
+
+Exemplo:
+    from shared.report_cache import report_cache, month_tag
+
+    data = report_cache.get("monthly_stats:2025-01")
+    if data is None:
+        data = calcular()
+        report_cache.set("monthly_stats:2025-01", data, tags=[month_tag(2025, 1)])
+"""
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+REPORT_CACHE_TTL_S = float(os.getenv("REPORT_CACHE_TTL_S", "300"))
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "256"))
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR") or None
+
+
+def month_tag(year: int, month: int) -> str:
+    """Tag das entradas que dependem dos números de um mês"""
+    return f"month:{year:04d}-{month:02d}"
+
+
+# ═══════════════════════════════════════════════════════════
+# BACKENDS
+# ═══════════════════════════════════════════════════════════
+
+class _MemoryBackend:
+    """Dicionário LRU do processo"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[Any, frozenset, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[0], entry[2]
+
+    def set(self, key: str, value: Any, tags: frozenset, created_at: float) -> int:
+        with self._lock:
+            self._data[key] = (value, tags, created_at)
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_tags(self, tags: Iterable[str]) -> int:
+        tags = set(tags)
+        with self._lock:
+            keys = [k for k, (_, entry_tags, _) in self._data.items() if entry_tags & tags]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self._data)
+            self._data.clear()
+            return count
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _SQLiteBackend:
+    """Arquivo SQLite compartilhado entre processos (LRU por último acesso)"""
+
+    def __init__(self, directory: str, name: str, max_entries: int):
+        self.max_entries = max_entries
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        self.path = path / f"{name}.sqlite"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, tags TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache (accessed_at)")
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return pickle.loads(row[0]), row[1]
+
+    def set(self, key: str, value: Any, tags: frozenset, created_at: float) -> int:
+        # Tags gravadas como "|a|b|" para o filtro LIKE '%|tag|%'
+        tags_text = "|" + "|".join(sorted(tags)) + "|"
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, tags, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, tags_text, created_at, time.time()),
+            )
+            cursor = self._conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                " SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            return max(cursor.rowcount, 0)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def delete_tags(self, tags: Iterable[str]) -> int:
+        deleted = 0
+        with self._lock:
+            for tag in set(tags):
+                cursor = self._conn.execute("DELETE FROM cache WHERE tags LIKE ?", (f"%|{tag}|%",))
+                deleted += max(cursor.rowcount, 0)
+        return deleted
+
+    def clear(self) -> int:
+        with self._lock:
+            return max(self._conn.execute("DELETE FROM cache").rowcount, 0)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+# ═══════════════════════════════════════════════════════════
+# CACHE
+# ═══════════════════════════════════════════════════════════
+
+class ReportCache:
+    """Cache com LRU, TTL, invalidação por tag e métricas"""
+
+    def __init__(
+        self,
+        name: str,
+        ttl_s: float = REPORT_CACHE_TTL_S,
+        max_entries: int = REPORT_CACHE_MAX_ENTRIES,
+        directory: Optional[str] = REPORT_CACHE_DIR,
+    ):
+        self.name = name
+        self.ttl_s = ttl_s
+        self._backend = _MemoryBackend(max_entries)
+        if directory:
+            try:
+                self._backend = _SQLiteBackend(directory, name, max_entries)
+            except Exception:
+                logger.error(f"Cache {name}: não consegui abrir {directory}, usando memória", exc_info=True)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "expired": 0, "sets": 0, "evictions": 0, "invalidated": 0}
+
+    @property
+    def backend(self) -> str:
+        return "sqlite" if isinstance(self._backend, _SQLiteBackend) else "memory"
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] += amount
+
+    def get(self, key: str) -> Optional[Any]:
+        """Valor guardado, ou None se ausente/expirado"""
+        try:
+            entry = self._backend.get(key)
+        except Exception:
+            logger.warning(f"Cache {self.name}: falha ao ler {key}", exc_info=True)
+            entry = None
+        if entry is None:
+            self._count("misses")
+            return None
+        value, created_at = entry
+        age = time.time() - created_at
+        if age >= self.ttl_s:
+            self._backend.delete(key)
+            self._count("expired")
+            self._count("misses")
+            logger.debug(f"Cache EXPIRED para {key} (idade: {age:.1f}s)")
+            return None
+        self._count("hits")
+        logger.debug(f"Cache HIT para {key} (idade: {age:.1f}s)")
+        return value
+
+    def set(self, key: str, value: Any, tags: Iterable[str] = ()) -> None:
+        try:
+            evicted = self._backend.set(key, value, frozenset(tags), time.time())
+        except Exception:
+            logger.warning(f"Cache {self.name}: falha ao gravar {key}", exc_info=True)
+            return
+        self._count("sets")
+        if evicted:
+            self._count("evictions", evicted)
+        logger.debug(f"Cache SET para {key}")
+
+    def invalidate(self, *tags: str) -> int:
+        """Remove as entradas com qualquer uma das tags. Retorna quantas saíram."""
+        if not tags:
+            return 0
+        try:
+            removed = self._backend.delete_tags(tags)
+        except Exception:
+            logger.warning(f"Cache {self.name}: falha ao invalidar {tags}", exc_info=True)
+            return 0
+        if removed:
+            self._count("invalidated", removed)
+            logger.debug(f"Cache {self.name}: {removed} entrada(s) invalidada(s) ({', '.join(tags)})")
+        return removed
+
+    def clear(self) -> int:
+        removed = self._backend.clear()
+        self._count("invalidated", removed)
+        return removed
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "name": self.name,
+            "backend": self.backend,
+            "entries": len(self._backend),
+            "ttl_s": self.ttl_s,
+            **counters,
+            "hit_rate": round(counters["hits"] / lookups * 100, 1) if lookups else None,
+        }
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            for counter in self._counters:
+                self._counters[counter] = 0
+
+
+# Instância única dos relatórios (/relatorio e afins)
+report_cache = ReportCache("reports")
@@ -0,0 +1,92 @@
+"""
+Single-flight: chamadas simultâneas iguais dividem uma única execução
+
+Dois gerentes (ou um gerente impaciente) pedindo o mesmo /relatorio ao mesmo
+tempo não calculam os mesmos totais nem pagam duas chamadas idênticas à IA:
+a primeira chamada executa, as outras com a mesma chave aguardam e recebem
+o mesmo resultado (ou a mesma exceção).
+
+- Chave: (comando, período, fingerprint) — ver flight_key()
+- A execução roda numa task própria: se quem começou desistir (timeout,
+  cancelamento), quem está aguardando continua recebendo o resultado
+- Nada fica guardado depois que termina (não é cache); chamadas que chegam
+  depois do fim executam de novo
+- Métricas por comando: execuções e chamadas que aproveitaram uma em andamento
+
+Exemplo:
+    key = flight_key("relatorio", period, kpi_fp)
+    text = await single_flight.do(key, lambda: gerar_relatorio())
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+
+T = TypeVar("T")
+
+
+def flight_key(command: str, period: Any = None, fingerprint: Optional[str] = None) -> Tuple:
+    """Chave padrão: (comando, período, fingerprint dos dados de entrada)"""
+    return (command, period, fingerprint)
+
+
+class SingleFlight:
+    """Agrupa chamadas assíncronas simultâneas com a mesma chave"""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, key: Hashable, counter: str) -> None:
+        label = str(key[0]) if isinstance(key, tuple) and key else str(key)
+        with self._lock:
+            stats = self._stats.setdefault(label, {"executions": 0, "shared": 0, "errors": 0})
+            stats[counter] += 1
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Executa fn() ou aguarda a execução em andamento com a mesma chave"""
+        task = self._inflight.get(key)
+        if task is not None and not task.done():
+            self._count(key, "shared")
+            logger.debug(f"Single-flight: aguardando execução em andamento de {key[0] if isinstance(key, tuple) else key}")
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(fn())
+        self._inflight[key] = task
+        self._count(key, "executions")
+        task.add_done_callback(lambda t, key=key: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled():
+            return
+        # Marca a exceção como lida mesmo que ninguém esteja mais aguardando
+        if task.exception() is not None:
+            self._count(key, "errors")
+
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        """Por comando: execuções, chamadas que aproveitaram outra e erros"""
+        with self._lock:
+            return [{"command": label, **stats} for label, stats in sorted(self._stats.items())]
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+# Instância única do bot (relatórios, KPIs e otimização de rotas)
+single_flight = SingleFlight()
@@ -0,0 +1,201 @@
+"""
+Streaming de texto em mensagens do Telegram
+
+Mostra a resposta da IA enquanto ela é gerada: a primeira mensagem sai com o
+primeiro pedaço (o usuário vê algo em ~1s em vez de esperar a resposta
+inteira) e depois é editada em intervalos controlados.
+
+- Edição a cada AI_STREAM_EDIT_INTERVAL_S segundos ou AI_STREAM_EDIT_CHARS
+  caracteres novos (o que vier primeiro), nunca mais de uma por MIN_EDIT_GAP_S
+- Envios e edições passam pela fila de saída (shared/outbound.py): limite
+  por chat e RetryAfter ficam com ela; um rascunho ainda na fila é
+  substituído pelo seguinte (o chat nunca recebe edições velhas em série)
+- Passou de 4000 caracteres: continua em uma nova mensagem (quebra em linha)
+- finish() aplica a versão formatada (Markdown/HTML), com fallback sem formatação
+
+Exemplo:
+    writer = TelegramStreamWriter(context.bot, chat_id, prefix="📊 Relatório\\n\\n")
+    text = await writer.consume(ai_gateway.stream(messages, label="relatorio"))
+    await writer.finish(f"📊 *Relatório*\\n\\n{text}", parse_mode="Markdown")
+"""
+
+import logging
+import os
+import time
+from typing import AsyncIterator, List, Optional
+
+from shared.outbound import outbound, HIGH
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+
+# ═══════════════════════════════════════════════════════════
+# CONFIGURAÇÃO
+# ═══════════════════════════════════════════════════════════
+AI_STREAM_EDIT_INTERVAL_S = float(os.getenv("AI_STREAM_EDIT_INTERVAL_S", "1.5"))
+AI_STREAM_EDIT_CHARS = int(os.getenv("AI_STREAM_EDIT_CHARS", "400"))
+# Telegram tolera ~1 edição/s por chat antes do flood control
+MIN_EDIT_GAP_S = 1.0
+# Limite do Telegram é 4096; margem para o cursor e formatação
+MAX_MESSAGE_LEN = 4000
+CURSOR = " ▌"
+INTERRUPTED_NOTE = "\n\n⚠️ Resposta interrompida."
+
+
+def split_message(text: str, max_len: int = MAX_MESSAGE_LEN) -> List[str]:
+    """Divide o texto em partes de até max_len, preferindo quebrar em linha"""
+    parts = []
+    while len(text) > max_len:
+        cut = text.rfind("\n", 0, max_len)
+        if cut < max_len // 2:
+            cut = max_len
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+class TelegramStreamWriter:
+    """Acumula pedaços de texto e mantém as mensagens do chat atualizadas"""
+
+    def __init__(
+        self,
+        bot,
+        chat_id: int,
+        prefix: str = "",
+        fallback_chat_id: Optional[int] = None,
+        min_interval_s: float = AI_STREAM_EDIT_INTERVAL_S,
+        min_chars: int = AI_STREAM_EDIT_CHARS,
+        max_len: int = MAX_MESSAGE_LEN,
+    ):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.prefix = prefix
+        self.fallback_chat_id = fallback_chat_id
+        self.min_interval_s = min_interval_s
+        self.min_chars = min_chars
+        self.max_len = max_len
+        self.text = ""
+        self.messages: list = []
+        self.edits = 0
+        self._shown: List[str] = []
+        self._flushed_len = 0
+        self._last_edit = 0.0
+
+    @property
+    def started(self) -> bool:
+        """True depois que a primeira mensagem foi enviada"""
+        return bool(self.messages)
+
+    async def append(self, piece: str) -> None:
+        """Adiciona um pedaço e atualiza o chat se já passou o intervalo"""
+        self.text += piece
+        now = time.monotonic()
+        if not self.started:
+            await self._render(self.prefix + self.text, cursor=True)
+            return
+        if now - self._last_edit < MIN_EDIT_GAP_S:
+            return
+        pending = len(self.text) - self._flushed_len
+        if pending >= self.min_chars or now - self._last_edit >= self.min_interval_s:
+            await self._render(self.prefix + self.text, cursor=True)
+
+    async def consume(self, pieces: AsyncIterator[str]) -> str:
+        """
+        Consome um stream de pedaços e devolve o texto completo.
+
+        Se o stream falhar depois de algo já estar no chat, marca a mensagem
+        como interrompida (sem cursor) e propaga o erro.
+        """
+        try:
+            async for piece in pieces:
+                await self.append(piece)
+        except Exception:
+            if self.started:
+                await self.finish(self.prefix + self.text + INTERRUPTED_NOTE)
+            raise
+        return self.text
+
+    async def finish(
+        self,
+        final_text: Optional[str] = None,
+        parse_mode: Optional[str] = None,
+        fallback_text: Optional[str] = None,
+    ) -> None:
+        """
+        Escreve a versão final (sem cursor) e remove mensagens que sobraram.
+
+        Se a versão formatada for rejeitada pelo Telegram, usa fallback_text
+        (ou o texto acumulado) sem parse_mode.
+        """
+        text = final_text if final_text is not None else self.prefix + self.text
+        if parse_mode:
+            try:
+                await self._render(text, parse_mode=parse_mode, final=True)
+                return
+            except Exception as e:
+                logger.warning(f"Formatação {parse_mode} rejeitada no stream, enviando sem formatação: {e}")
+                text = fallback_text if fallback_text is not None else self.prefix + self.text
+        await self._render(text, final=True)
+
+    async def _render(self, text: str, *, cursor: bool = False,
+                      parse_mode: Optional[str] = None, final: bool = False) -> None:
+        parts = split_message(text, self.max_len - len(CURSOR))
+        if cursor:
+            parts[-1] += CURSOR
+        for i, part in enumerate(parts):
+            if i < len(self.messages):
+                if self._shown[i] == part and not parse_mode:
+                    continue
+                await self._edit(i, part, parse_mode, final)
+            else:
+                await self._send(part, parse_mode)
+        if final:
+            # Versão final ficou com menos partes que o rascunho
+            for message in self.messages[len(parts):]:
+                try:
+                    await outbound.submit_delete(message, priority=HIGH, label="stream")
+                except Exception:
+                    pass
+            del self.messages[len(parts):]
+            del self._shown[len(parts):]
+        self._flushed_len = len(self.text)
+        self._last_edit = time.monotonic()
+
+    async def _send(self, part: str, parse_mode: Optional[str]) -> None:
+        while True:
+            try:
+                message = await outbound.send(
+                    self.bot.send_message, chat_id=self.chat_id, text=part, parse_mode=parse_mode,
+                    priority=HIGH, label="stream",
+                )
+                break
+            except Exception as e:
+                # Destino preferido inacessível (ex.: bot fora do canal): usa o chat de origem
+                if (self.started or parse_mode or not self.fallback_chat_id
+                        or self.fallback_chat_id == self.chat_id):
+                    raise
+                logger.warning(f"Stream: não consegui enviar para {self.chat_id} ({e}), usando {self.fallback_chat_id}")
+                self.chat_id = self.fallback_chat_id
+        self.messages.append(message)
+        self._shown.append(part)
+
+    async def _edit(self, index: int, part: str, parse_mode: Optional[str], final: bool) -> None:
+        message = self.messages[index]
+        if not final:
+            # Rascunho: não espera; o próximo substitui este se ainda estiver na fila
+            outbound.submit_edit(message, text=part, parse_mode=parse_mode, priority=HIGH, label="stream")
+        else:
+            try:
+                await outbound.edit(message, text=part, parse_mode=parse_mode, priority=HIGH, label="stream")
+            except Exception as e:
+                if parse_mode:
+                    raise
+                logger.warning(f"Stream: falha ao editar mensagem {index + 1}: {e}")
+                return
+        self.edits += 1
+        self._shown[index] = part
@@ -0,0 +1,191 @@
+"""
+Processamento simultâneo de updates com ordem garantida por chat
+
+A Application processava um update por vez: enquanto um gerente importava
+uma planilha ou gerava o /relatorio, nenhum motorista conseguia finalizar
+uma entrega. Com o PerChatUpdateProcessor:
+
+- Até BOT_MAX_CONCURRENT_UPDATES updates em andamento ao mesmo tempo
+- Updates do mesmo chat (ou do mesmo usuário, sem chat) rodam um de cada vez,
+  na ordem de chegada: as transições de estado dos ConversationHandlers
+  continuam iguais às do processamento sequencial
+- Um chat com vários updates na fila não ocupa mais de um worker; os demais
+  ficam esperando a vez do chat, não uma vaga
+- BOT_MAX_CONCURRENT_UPDATES=1 volta ao comportamento antigo (sequencial)
+
+Uso:
+    ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(PerChatUpdateProcessor.from_env())
+
+Teste de carga (simulado, sem Telegram): latência das entregas dos motoristas
+enquanto um gerente roda comandos pesados, sequencial x simultâneo:
+    python -m shared.update_processor
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+
+BOT_MAX_CONCURRENT_UPDATES = int(os.getenv("BOT_MAX_CONCURRENT_UPDATES", "16"))
+# Updates aceitos (rodando + aguardando a vez do chat) antes de segurar a leitura
+_PENDING_FACTOR = 8
+
+
+def update_chat_key(update: object) -> Optional[Hashable]:
+    """Chave de ordenação: chat do update, senão o usuário. None = sem ordem."""
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return ("chat", chat.id)
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return ("user", user.id)
+    return None
+
+
+class _ChatSlot:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Updates de chats diferentes em paralelo; do mesmo chat, em sequência"""
+
+    def __init__(self, max_concurrent_updates: int = BOT_MAX_CONCURRENT_UPDATES):
+        # O semáforo da classe base limita o que está aceito (rodando + na fila do chat);
+        # o limite de execução simultânea é o _workers, pego depois da vez do chat
+        super().__init__(max(1, max_concurrent_updates) * _PENDING_FACTOR)
+        self.max_workers = max(1, max_concurrent_updates)
+        self._workers: Optional[asyncio.Semaphore] = None
+        self._chats: Dict[Hashable, _ChatSlot] = {}
+        self.processed = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+
+    @classmethod
+    def from_env(cls) -> "PerChatUpdateProcessor":
+        return cls(BOT_MAX_CONCURRENT_UPDATES)
+
+    async def initialize(self) -> None:
+        self._workers = asyncio.Semaphore(self.max_workers)
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self._workers is None:
+            self._workers = asyncio.Semaphore(self.max_workers)
+        key = update_chat_key(update)
+        if key is None:
+            async with self._workers:
+                await self._run(coroutine)
+            return
+
+        slot = self._chats.get(key)
+        if slot is None:
+            slot = self._chats[key] = _ChatSlot()
+        slot.users += 1
+        try:
+            # A Application cria as tasks na ordem de chegada e o Lock é FIFO:
+            # a vez do chat segue a ordem dos updates
+            async with slot.lock:
+                async with self._workers:
+                    await self._run(coroutine)
+        finally:
+            slot.users -= 1
+            if slot.users == 0 and self._chats.get(key) is slot:
+                del self._chats[key]
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            await coroutine
+        finally:
+            self._in_flight -= 1
+            self.processed += 1
+
+    def metrics(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self._in_flight,
+            "max_in_flight": self.max_in_flight,
+            "chats_waiting": sum(1 for slot in self._chats.values() if slot.users > 1),
+            "processed": self.processed,
+        }
+
+
+# ═══════════════════════════════════════════════════════════
+# TESTE DE CARGA (python -m shared.update_processor)
+# ═══════════════════════════════════════════════════════════
+
+async def _load_test(max_workers: int, heavy_commands: int = 4, drivers: int = 20,
+                     deliveries: int = 5, heavy_s: float = 2.0, light_s: float = 0.05) -> dict:
+    """
+    Um gerente dispara `heavy_commands` comandos pesados (importação/relatório, heavy_s cada)
+    enquanto `drivers` motoristas finalizam `deliveries` entregas cada
+    (light_s cada, uma após a outra). Mede a latência de cada entrega
+    (chegada → fim) e confere se a ordem por chat foi mantida.
+    """
+    from types import SimpleNamespace
+
+    processor = PerChatUpdateProcessor(max_workers)
+    await processor.initialize()
+    latencies, order = [], {}
+
+    def update(chat_id: int):
+        return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+
+    async def handler(chat_id: int, seq: int, duration: float, arrived: float, record: bool):
+        # Parte síncrona (CPU/SQLite) + espera de I/O
+        time.sleep(min(duration, 0.002))
+        await asyncio.sleep(duration)
+        order.setdefault(chat_id, []).append(seq)
+        if record:
+            latencies.append(time.perf_counter() - arrived)
+
+    tasks = []
+    for seq in range(heavy_commands):
+        arrived = time.perf_counter()
+        tasks.append(asyncio.ensure_future(processor.process_update(
+            update(1), handler(1, seq, heavy_s, arrived, False)
+        )))
+    for seq in range(deliveries):
+        for driver in range(drivers):
+            chat_id = 1000 + driver
+            arrived = time.perf_counter()
+            tasks.append(asyncio.ensure_future(processor.process_update(
+                update(chat_id), handler(chat_id, seq, light_s, arrived, True)
+            )))
+        await asyncio.sleep(light_s)
+    await asyncio.gather(*tasks)
+    await processor.shutdown()
+
+    latencies.sort()
+    return {
+        "workers": max_workers,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000),
+        "max_ms": round(latencies[-1] * 1000),
+        "ordered": all(seqs == sorted(seqs) for seqs in order.values()),
+    }
+
+
+if __name__ == "__main__":
+    print("Latência das entregas dos motoristas (20 motoristas x 5 entregas):")
+    scenarios = [
+        ("sem gerente", BOT_MAX_CONCURRENT_UPDATES, 0),
+        ("gerente, sequencial", 1, 4),
+        (f"gerente, {BOT_MAX_CONCURRENT_UPDATES} workers", BOT_MAX_CONCURRENT_UPDATES, 4),
+    ]
+    for name, workers, heavy in scenarios:
+        result = asyncio.run(_load_test(workers, heavy))
+        print(
+            f"  {name:>22}: p50 {result['p50_ms']} ms | p95 {result['p95_ms']} ms | "
+            f"máx {result['max_ms']} ms | ordem por chat {'OK' if result['ordered'] else 'QUEBRADA'}"
+        )
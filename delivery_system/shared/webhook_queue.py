@@ -0,0 +1,221 @@
+"""
+Fila interna do webhook do Telegram (resposta imediata + deduplicação)
+
+O webhook aguardava o handler inteiro antes de responder 200. Um /relatorio
+ou uma importação demorada segurava a requisição, o Telegram estourava o
+timeout, reenviava o update e ele era processado duas vezes.
+
+Agora o endpoint só valida e enfileira:
+- offer(): guarda o update numa fila limitada (WEBHOOK_QUEUE_SIZE) e responde
+- update_id já visto (LRU de WEBHOOK_DEDUP_SIZE ids) → ignorado, responde 200
+- Fila cheia → 503: o Telegram reenvia depois (nada se perde, nada duplica,
+  porque o id só entra no LRU quando o update entra na fila)
+- Um despachante esvazia a fila criando uma task por update, em ordem de
+  chegada, até `max_in_flight` updates em andamento (o limite do processador
+  de updates do bot). A vez do chat é garantida pelo PerChatUpdateProcessor:
+  vários updates de um mesmo chat esperam a vez dele sem segurar os dos
+  outros chats (um worker aguardando o update inteiro seguraria)
+- Métricas: profundidade atual e máxima, recebidos, duplicados, recusados,
+  processados, erros e tempo na fila (p50/p95)
+
+Exemplo:
+    webhook_queue.start(process, max_in_flight=128)  # process(payload: dict) -> awaitable
+    status = webhook_queue.offer(payload) # "queued" | "duplicate" | "full"
+    await webhook_queue.stop(timeout=10)  # drena antes de desligar
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, List, Optional, Set
+
+# Import condicional para funcionar em testes standalone
+try:
+    from shared.logger import logger
+except ImportError:
+    logger = logging.getLogger(__name__)
+
+
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Updates em andamento ao mesmo tempo, se start() não receber o limite
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "128"))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "5000"))
+# Amostras de tempo na fila mantidas para p50/p95
+SAMPLE_SIZE = 500
+
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+FULL = "full"
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class WebhookQueue:
+    """Fila limitada de updates com despachante e LRU de update_id"""
+
+    def __init__(
+        self,
+        maxsize: int = WEBHOOK_QUEUE_SIZE,
+        max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT,
+        dedup_size: int = WEBHOOK_DEDUP_SIZE,
+    ):
+        self.maxsize = maxsize
+        self.max_in_flight = max(1, max_in_flight)
+        self.dedup_size = dedup_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        self._handler: Optional[Callable[[dict], Awaitable[Any]]] = None
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._reset_counters()
+
+    def _reset_counters(self) -> None:
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._samples = deque(maxlen=SAMPLE_SIZE)
+
+    @property
+    def running(self) -> bool:
+        return self._dispatcher is not None
+
+    def start(self, handler: Callable[[dict], Awaitable[Any]], max_in_flight: Optional[int] = None) -> None:
+        """
+        Cria a fila e o despachante no event loop em uso.
+        max_in_flight: updates em andamento ao mesmo tempo (use o limite do
+        processador de updates; acima dele as tasks só esperariam a vaga)
+        """
+        if self.running:
+            return
+        if max_in_flight is not None:
+            self.max_in_flight = max(1, max_in_flight)
+        self._handler = handler
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch(), name="webhook-dispatcher")
+        logger.info(
+            f"[WEBHOOK] Fila iniciada: até {self.max_in_flight} update(s) em andamento, "
+            f"até {self.maxsize} na fila"
+        )
+
+    def _seen_before(self, update_id: Optional[int]) -> bool:
+        if update_id is None:
+            return False
+        if update_id in self._seen:
+            self._seen.move_to_end(update_id)
+            return True
+        return False
+
+    def _remember(self, update_id: Optional[int]) -> None:
+        if update_id is None:
+            return
+        self._seen[update_id] = None
+        while len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+
+    def offer(self, payload: dict) -> str:
+        """Enfileira o update (JSON do Telegram) sem esperar o processamento"""
+        if self._queue is None:
+            raise RuntimeError("WebhookQueue não iniciada (chame start() no startup)")
+        update_id = payload.get("update_id")
+        with self._lock:
+            self.received += 1
+            if self._seen_before(update_id):
+                self.duplicates += 1
+                return DUPLICATE
+            try:
+                self._queue.put_nowait((time.monotonic(), payload))
+            except asyncio.QueueFull:
+                self.rejected += 1
+                return FULL
+            self._remember(update_id)
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        return QUEUED
+
+    async def _dispatch(self) -> None:
+        """Uma task por update, na ordem da fila; só espera por vaga, nunca pelo update"""
+        loop = asyncio.get_running_loop()
+        while True:
+            enqueued, payload = await self._queue.get()
+            await self._slots.acquire()
+            with self._lock:
+                self._samples.append((time.monotonic() - enqueued) * 1000)
+            task = loop.create_task(self._run(payload), name=f"webhook-{payload.get('update_id')}")
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, payload: dict) -> None:
+        self._busy += 1
+        try:
+            await self._handler(payload)
+            self.processed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.errors += 1
+            logger.error(f"[WEBHOOK] Erro ao processar update {payload.get('update_id')}", exc_info=True)
+        finally:
+            self._busy -= 1
+            self._slots.release()
+            self._queue.task_done()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Espera a fila e os updates em andamento (até `timeout` s) e encerra"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"[WEBHOOK] {self._queue.qsize() + len(self._running)} update(s) "
+                f"descartado(s) no desligamento"
+            )
+        tasks = [self._dispatcher, *self._running]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        self._running.clear()
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def metrics(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            return {
+                "depth": self.depth(),
+                "max_depth": self.max_depth,
+                "capacity": self.maxsize,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._busy,
+                "received": self.received,
+                "duplicates": self.duplicates,
+                "rejected_full": self.rejected,
+                "processed": self.processed,
+                "errors": self.errors,
+                "wait_p50_ms": round(_percentile(samples, 50), 2),
+                "wait_p95_ms": round(_percentile(samples, 95), 2),
+            }
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            self._reset_counters()
+
+
+# Instância única do processo (unified_app)
+webhook_queue = WebhookQueue()
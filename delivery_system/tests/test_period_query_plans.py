@@ -0,0 +1,95 @@
+"""
+Planos (EXPLAIN QUERY PLAN) das consultas por período do resumo diário
+
+Banco SQLite temporário criado por run_migrations(): confere que as consultas
+por período de daily_summary.py usam os índices de route.completed_at,
+route.finalized_at e delivery_proof.timestamp (migração 0003). Uma mudança
+no predicado (ex.: func.date(coluna) = dia) ou um índice removido vira
+varredura da tabela inteira e quebra o teste.
+
+    cd delivery_system && python -m pytest
+"""
+
+import os
+import tempfile
+from datetime import date, datetime
+
+import pytest
+
+_DB_DIR = tempfile.mkdtemp(prefix="plans_")
+_DB_URL = f"sqlite:///{os.path.join(_DB_DIR, 'plans.sqlite')}"
+# Antes de importar database: o engine é criado na importação
+os.environ["DATABASE_URL"] = _DB_URL
+
+from sqlalchemy import distinct, func, select  # noqa: E402
+
+import database  # noqa: E402
+from database import DeliveryProof, Package, Route, engine  # noqa: E402
+from migrate import run_migrations  # noqa: E402
+from shared.periods import days_period, in_period  # noqa: E402
+
+pytestmark = pytest.mark.skipif(
+    database.DATABASE_URL != _DB_URL,
+    reason="database já importado com outro DATABASE_URL",
+)
+
+PERIOD = days_period(date(2025, 1, 1), date(2025, 1, 31))
+
+
+@pytest.fixture(scope="module")
+def conn():
+    run_migrations()
+    with engine.connect() as connection:
+        yield connection
+
+
+def _plan(conn, stmt) -> str:
+    compiled = stmt.compile(dialect=engine.dialect, compile_kwargs={"render_postcompile": True})
+    params = tuple(
+        str(value) if isinstance(value, (date, datetime)) else value
+        for value in (compiled.params[name] for name in compiled.positiontup)
+    )
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).fetchall()
+    return " | ".join(str(row[-1]) for row in rows)
+
+
+@pytest.mark.parametrize("column, index", [
+    (Route.completed_at, "idx_route_completed_at"),
+    (Route.finalized_at, "idx_route_finalized_at"),
+])
+def test_route_event_queries_use_index(conn, column, index):
+    # Mesmo formato de daily_summary._compute (rotas concluídas/finalizadas no dia)
+    event_day = func.date(column)
+    stmt = (
+        select(event_day, Route.assigned_to_id, func.count(Route.id))
+        .where(in_period(column, PERIOD))
+        .group_by(event_day, Route.assigned_to_id)
+    )
+    plan = _plan(conn, stmt)
+    assert f"SEARCH route USING INDEX {index}" in plan, plan
+
+
+def test_delivery_proof_query_uses_timestamp_index(conn):
+    # Entregas do período (daily_summary._compute e exports.py)
+    proof_day = func.date(DeliveryProof.timestamp)
+    stmt = (
+        select(proof_day, Package.status, func.count(distinct(DeliveryProof.package_id)))
+        .join(Package, Package.id == DeliveryProof.package_id)
+        .where(
+            in_period(DeliveryProof.timestamp, PERIOD),
+            Package.status.in_(("delivered", "failed")),
+        )
+        .group_by(proof_day, Package.status)
+    )
+    plan = _plan(conn, stmt)
+    assert "SEARCH delivery_proof USING INDEX idx_deliveryproof_timestamp" in plan, plan
+
+
+def test_day_function_predicate_is_not_sargable(conn):
+    # Controle: com date(coluna) no predicado o índice só é percorrido inteiro (SCAN)
+    stmt = select(func.count(Route.id)).where(
+        func.date(Route.completed_at) >= PERIOD.start,
+        func.date(Route.completed_at) < PERIOD.end,
+    )
+    plan = _plan(conn, stmt)
+    assert "SEARCH" not in plan, plan
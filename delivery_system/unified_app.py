@@ -2,18 +2,27 @@
 Aplicação unificada: FastAPI (web) + Telegram Bot (webhook)
 Roda tudo em um único processo, usando plano FREE do Render
 """
+import hashlib
 import os
+import secrets
 from dotenv import load_dotenv
 
-from fastapi import Request
+from fastapi import Depends, HTTPException, Request
+from fastapi.responses import JSONResponse
 from telegram import Update
 from telegram.ext import Application
 
 # Importa a app FastAPI existente
-from app import create_app
+from app import create_app, require_api_token
 
 # Importa a configuração do bot
-from bot import setup_bot_handlers
+from bot import setup_bot_handlers, precompute_ai_report
+from daily_summary import ensure_backfilled, wait_pending_refreshes
+from migrate import run_migrations
+from scheduler import start_scheduler, stop_scheduler, scheduler_metrics
+from conversation_state import configure_builder, conversation_metrics
+from shared.update_processor import PerChatUpdateProcessor
+from shared.webhook_queue import webhook_queue, DUPLICATE, FULL
 
 load_dotenv()
 
@@ -21,6 +30,13 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 BASE_URL = os.getenv("BASE_URL", "")  # Ex: https://entrega-web.onrender.com
 WEBHOOK_PATH = f"/telegram-webhook/{BOT_TOKEN}"
 WEBHOOK_URL = f"{BASE_URL}{WEBHOOK_PATH}"
+# Conferido no header X-Telegram-Bot-Api-Secret-Token de cada update.
+# Sem SECRET_TOKEN, deriva do BOT_TOKEN: todas as réplicas/workers chegam ao
+# mesmo valor (um token aleatório por processo só valeria no último a subir).
+# Hex cabe no formato aceito pelo Telegram (A-Z, a-z, 0-9, _ e -).
+SECRET_TOKEN = os.getenv("SECRET_TOKEN") or hashlib.sha256(
+    f"webhook-secret:{BOT_TOKEN}".encode()
+).hexdigest()
 
 # Cria a aplicação FastAPI
 app = create_app()
@@ -30,11 +46,80 @@ bot_app: Application = None
 
 
 async def telegram_webhook(request: Request):
-    """Recebe updates do Telegram via webhook"""
-    json_data = await request.json()
-    update = Update.de_json(json_data, bot_app.bot)
-    await bot_app.process_update(update)
-    return {"ok": True}
+    """
+    Recebe updates do Telegram via webhook: valida, enfileira e responde na hora.
+    O processamento acontece nas tasks da webhook_queue.
+    """
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secrets.compare_digest(token.encode(), SECRET_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Token do webhook inválido")
+
+    status = webhook_queue.offer(await request.json())
+    if status == FULL:
+        # O Telegram reenvia o update mais tarde
+        return JSONResponse({"ok": False, "error": "queue full"}, status_code=503)
+    return {"ok": True, "duplicate": status == DUPLICATE}
+
+
+async def process_webhook_update(payload: dict):
+    """Task de um update da fila: passa pelo processador (limite de simultâneos e ordem por chat)"""
+    update = Update.de_json(payload, bot_app.bot)
+    await bot_app.update_processor.process_update(update, bot_app.process_update(update))
+
+
+# Métricas: protegidas por EXPORT_API_TOKEN; POST .../reset devolve e zera
+
+@app.get("/metrics/webhook", dependencies=[Depends(require_api_token)])
+def webhook_metrics():
+    """
+    Fila do webhook: profundidade atual/máxima, recebidos, duplicados
+    (update_id repetido), recusados por fila cheia, processados, erros e
+    tempo na fila (p50/p95).
+    """
+    return webhook_queue.metrics()
+
+
+@app.post("/metrics/webhook/reset", dependencies=[Depends(require_api_token)])
+def webhook_metrics_reset():
+    metrics = webhook_queue.metrics()
+    webhook_queue.reset_metrics()
+    return metrics
+
+
+@app.get("/metrics/scheduler", dependencies=[Depends(require_api_token)])
+def scheduler_job_metrics():
+    """
+    Scheduler deste processo: se é o líder (lease em scheduler_lease), quem
+    tem o lease e, por job, execuções, erros, horários ignorados por não ser
+    líder, recuperações após restart, duração (última, p50, p95) e próximo horário.
+    """
+    return scheduler_metrics()
+
+
+@app.post("/metrics/scheduler/reset", dependencies=[Depends(require_api_token)])
+def scheduler_job_metrics_reset():
+    return scheduler_metrics(reset=True)
+
+
+@app.get("/metrics/conversations", dependencies=[Depends(require_api_token)])
+async def conversation_state_metrics():
+    """
+    Estado de conversa (user_data) do bot: usuários, chaves, tamanho
+    serializado em bytes, chaves mais comuns e varreduras de itens vencidos.
+
+    async de propósito: roda no event loop, o mesmo que altera os dicts de
+    user_data (num `def` iria para o threadpool e leria durante as escritas).
+    """
+    if bot_app is None:
+        raise HTTPException(status_code=503, detail="Bot não iniciado")
+    return conversation_metrics(bot_app)
+
+
+@app.post("/metrics/conversations/reset", dependencies=[Depends(require_api_token)])
+async def conversation_state_metrics_reset():
+    if bot_app is None:
+        raise HTTPException(status_code=503, detail="Bot não iniciado")
+    return conversation_metrics(bot_app, reset=True)
 
 
 @app.on_event("startup")
@@ -42,6 +127,9 @@ async def on_startup():
     """Inicializa o bot com webhook quando a API inicia"""
     global bot_app
     
+    # Migrações versionadas + verificação de índices (uma vez por processo)
+    run_migrations()
+    
     if not BOT_TOKEN:
         print("⚠️ BOT_TOKEN não configurado, bot não será iniciado")
         return
@@ -50,25 +138,40 @@ async def on_startup():
         print("⚠️ BASE_URL não configurado, bot não será iniciado")
         return
     
+    # Popula o resumo diário dos relatórios na primeira execução
+    ensure_backfilled()
+    
     print(f"🤖 Iniciando bot com webhook...")
     print(f"📡 Webhook URL: {WEBHOOK_URL}")
     
     # Cria a aplicação do bot
-    bot_app = Application.builder().token(BOT_TOKEN).build()
+    bot_app = (
+        configure_builder(Application.builder())
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor.from_env())
+        .build()
+    )
     
     # Configura os handlers do bot (importa de bot.py)
     setup_bot_handlers(bot_app)
     
     # Inicializa o bot
     await bot_app.initialize()
+    await bot_app.start()
+    # Limite de tasks = semáforo do processador: a fila do webhook segura o excesso
+    webhook_queue.start(process_webhook_update, bot_app.update_processor.max_concurrent_updates)
     await bot_app.bot.delete_webhook(drop_pending_updates=True)
     await bot_app.bot.set_webhook(
         url=WEBHOOK_URL,
-        allowed_updates=Update.ALL_TYPES
+        allowed_updates=Update.ALL_TYPES,
+        secret_token=SECRET_TOKEN,
     )
     
     print(f"✅ Bot iniciado com webhook: {WEBHOOK_URL}")
     
+    # Jobs agendadas: todas as réplicas sobem o scheduler, só a líder executa
+    start_scheduler(ai_report_job=precompute_ai_report, bot=bot_app.bot)
+    
     # Registra a rota do webhook
     app.add_api_route(
         WEBHOOK_PATH,
@@ -83,7 +186,13 @@ async def on_shutdown():
     """Desliga o bot quando a API para"""
     global bot_app
     if bot_app:
+        # Antes do bot: nenhuma job nova usa o bot desligando; o lease fica livre
+        stop_scheduler()
         await bot_app.bot.delete_webhook()
+        # Termina o que já foi aceito antes de desligar
+        await webhook_queue.stop(timeout=10)
+        await wait_pending_refreshes()
+        await bot_app.stop()
         await bot_app.shutdown()
         print("✅ Bot desligado")
 
@@ -0,0 +1,168 @@
+"""
+Cache de usuários por telegram_user_id (papel, nome, canal e casa)
+
+Quase todo handler do bot abria uma sessão só para buscar o usuário e conferir
+se é gerente. Com o cache, a consulta acontece uma vez a cada USER_CACHE_TTL_S
+por usuário:
+
+- TTL por entrada (USER_CACHE_TTL_S) e limite de entradas (USER_CACHE_MAX_ENTRIES, LRU)
+- O valor é uma cópia (CachedUser), não a linha do ORM: pode ser usado depois
+  que a sessão fecha e nunca é gravado por engano
+- Invalidação automática: inserir, alterar ou remover um User (por qualquer
+  sessão deste processo) apaga a entrada no flush e de novo no commit, então
+  uma leitura concorrente entre os dois não deixa o valor antigo no cache
+- Outros processos (ex.: app.py) enxergam a mudança em até USER_CACHE_TTL_S
+- Usuário inexistente não fica em cache (o /start cadastra na hora)
+
+Exemplo:
+    from user_cache import cached_user
+
+    me = cached_user(update.effective_user.id)
+    if me and me.role == "manager":
+        ...
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+from sqlalchemy import event, inspect
+
+from database import SessionLocal, User
+
+
+USER_CACHE_TTL_S = float(os.getenv("USER_CACHE_TTL_S", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "1000"))
+
+# Chave em Session.info com os telegram_user_id alterados na transação
+_DIRTY_KEY = "user_cache_dirty"
+
+
+class CachedUser(NamedTuple):
+    """Cópia somente leitura das colunas de User"""
+    id: int
+    telegram_user_id: int
+    full_name: Optional[str]
+    role: str
+    channel_id: Optional[str]
+    home_latitude: Optional[float]
+    home_longitude: Optional[float]
+    home_address: Optional[str]
+
+    @classmethod
+    def from_row(cls, user: User) -> "CachedUser":
+        return cls(*(getattr(user, name) for name in cls._fields))
+
+
+class UserCache:
+    """LRU com TTL de CachedUser por telegram_user_id"""
+
+    def __init__(self, ttl_s: float = USER_CACHE_TTL_S, max_entries: int = USER_CACHE_MAX_ENTRIES):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Tuple[float, CachedUser]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._reset_counters()
+
+    def _reset_counters(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, telegram_user_id: int, db=None) -> Optional[CachedUser]:
+        """Usuário do cache; na falta, busca no banco (na sessão `db`, se informada)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(telegram_user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(telegram_user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        if db is not None:
+            row = db.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+            user = CachedUser.from_row(row) if row else None
+        else:
+            session = SessionLocal()
+            try:
+                row = session.query(User).filter(User.telegram_user_id == telegram_user_id).first()
+                user = CachedUser.from_row(row) if row else None
+            finally:
+                session.close()
+
+        if user is not None:
+            with self._lock:
+                self._entries[telegram_user_id] = (now + self.ttl_s, user)
+                self._entries.move_to_end(telegram_user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, telegram_user_id: int) -> None:
+        with self._lock:
+            if self._entries.pop(telegram_user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            self._reset_counters()
+
+
+# Instância única do processo
+user_cache = UserCache()
+
+
+def cached_user(telegram_user_id: int, db=None) -> Optional[CachedUser]:
+    return user_cache.get(telegram_user_id, db)
+
+
+# ═══════════════════════════════════════════════════════════
+# INVALIDAÇÃO (gravações em User)
+# ═══════════════════════════════════════════════════════════
+
+def _touched_ids(target: User) -> set:
+    """telegram_user_id atual e o anterior (se o próprio id foi alterado)"""
+    ids = {target.telegram_user_id}
+    history = inspect(target).attrs.telegram_user_id.history
+    ids.update(history.deleted or ())
+    ids.discard(None)
+    return ids
+
+
+def _on_user_write(_mapper, _connection, target: User) -> None:
+    ids = _touched_ids(target)
+    for tid in ids:
+        user_cache.invalidate(tid)
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault(_DIRTY_KEY, set()).update(ids)
+
+
+def _on_transaction_end(session) -> None:
+    for tid in session.info.pop(_DIRTY_KEY, ()):
+        user_cache.invalidate(tid)
+
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    event.listen(User, _event_name, _on_user_write)
+event.listen(SessionLocal, "after_commit", _on_transaction_end)
+event.listen(SessionLocal, "after_rollback", _on_transaction_end)
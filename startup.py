@@ -1,49 +1,36 @@
 #!/usr/bin/env python3
 """
 Script de startup que roda ANTES do bot iniciar.
-Aplica migrações automaticamente se necessário.
+Aplica as migrações pendentes (delivery_system/migrate.py) em todo boot;
+não é mais preciso ligar RUN_MIGRATION.
 """
 
-import os
 import sys
 from pathlib import Path
 
-# Adiciona o diretório raiz ao path
+# Adiciona o diretório raiz e o delivery_system ao path
+# (os módulos do bot importam `database`, `shared`, ... diretamente)
 sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parent / "delivery_system"))
 
 def run_migrations():
-    """Aplica migrações pendentes"""
+    """Aplica migrações pendentes (cadeia versionada do Alembic)"""
     print("=" * 60)
     print("🔍 Verificando migrações pendentes...")
     print("=" * 60)
     
-    # Verifica se deve rodar migração
-    run_migration = os.getenv("RUN_MIGRATION", "false").lower() == "true"
-    
-    if run_migration:
-        print("✅ RUN_MIGRATION=true detectado")
-        print("🔄 Aplicando migração CASCADE DELETE...")
-        
-        try:
-            from delivery_system.apply_cascade_migration import apply_migration
-            success = apply_migration()
-            
-            if success:
-                print("✅ Migração aplicada com sucesso!")
-                # Remove a flag para não rodar novamente
-                print("💡 Dica: Remova a variável RUN_MIGRATION do Railway")
-            else:
-                print("❌ Migração falhou!")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Erro ao aplicar migração: {e}")
-            import traceback
-            traceback.print_exc()
+    try:
+        from migrate import run_migrations as apply_pending
+        report = apply_pending()
+        print(f"✅ Banco na revisão {report['revision']}")
+        if report["missing"]:
+            print(f"⚠️ Índices faltando: {', '.join(report['missing'])}")
             return False
-    else:
-        print("ℹ️  Nenhuma migração pendente")
-        print("💡 Para forçar migração, adicione variável: RUN_MIGRATION=true")
+    except Exception as e:
+        print(f"❌ Erro ao aplicar migrações: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
     
     print("=" * 60)
     return True